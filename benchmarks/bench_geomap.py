@@ -0,0 +1,72 @@
+"""
+Benchmarks for `stsci.stimage.geomap`.
+"""
+
+from stsci import stimage
+
+from . import catalogs
+
+
+def _catalogs(n):
+    """
+    A rotated, scaled and shifted field with a small quadratic
+    distortion, noise and 2% outliers.
+    """
+    ref = catalogs.uniform(n, 4096.0)
+    input = catalogs.transform(ref, angle=0.5, scale=1.001,
+                               shift=(12.0, -7.0), noise=0.05,
+                               outliers=0.02)
+    input[:, 0] += 1e-6 * ref[:, 0] * ref[:, 1]
+    input[:, 1] += 2e-6 * ref[:, 0] ** 2
+    return input, ref
+
+
+class General:
+    """
+    The general fit across the surface function, the polynomial order,
+    the cross terms and the number of rejection iterations.
+    """
+    params = (['polynomial', 'legendre', 'chebyshev'],
+              [2, 3, 4, 6],
+              ['none', 'half', 'full'],
+              [0, 3])
+    param_names = ['function', 'order', 'xterms', 'maxiter']
+
+    def setup(self, function, order, xterms, maxiter):
+        self.input, self.ref = _catalogs(10000)
+
+    def _fit(self, function, order, xterms, maxiter):
+        stimage.geomap(self.input, self.ref, function=function,
+                       xxorder=order, xyorder=order,
+                       yxorder=order, yyorder=order,
+                       xxterms=xterms, yxterms=xterms,
+                       maxiter=maxiter, reject=3.0)
+
+    def time_geomap(self, function, order, xterms, maxiter):
+        self._fit(function, order, xterms, maxiter)
+
+    def peakmem_geomap(self, function, order, xterms, maxiter):
+        self._fit(function, order, xterms, maxiter)
+
+
+class Geometry:
+    """
+    The restricted fit geometries across the number of coordinates,
+    with and without the per-coordinate output.
+    """
+    params = (['shift', 'xyscale', 'rotate', 'rscale', 'rxyscale',
+               'general'],
+              [1000, 100000, 1000000],
+              ['full', 'none'])
+    param_names = ['fit_geometry', 'n', 'output']
+
+    def setup(self, fit_geometry, n, output):
+        self.input, self.ref = _catalogs(n)
+
+    def time_geomap(self, fit_geometry, n, output):
+        stimage.geomap(self.input, self.ref, fit_geometry=fit_geometry,
+                       output=output)
+
+    def peakmem_geomap(self, fit_geometry, n, output):
+        stimage.geomap(self.input, self.ref, fit_geometry=fit_geometry,
+                       output=output)
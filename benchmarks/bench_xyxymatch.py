@@ -0,0 +1,124 @@
+"""
+Benchmarks for `stsci.stimage.xyxymatch`.
+"""
+
+from stsci import stimage
+
+from . import catalogs
+
+
+class Tolerance:
+    """
+    The tolerance algorithm across the number of coordinates, their
+    density (coordinates per square pixel) and the spatial index.
+    """
+    params = ([1000, 10000, 100000, 1000000],
+              [1e-4, 1e-3, 1e-2],
+              ['sweep', 'grid'])
+    param_names = ['n', 'density', 'index']
+
+    def setup(self, n, density, index):
+        self.ref = catalogs.for_density(n, density)
+        self.input = catalogs.transform(self.ref, noise=0.1)
+
+    def time_xyxymatch(self, n, density, index):
+        stimage.xyxymatch(self.input, self.ref, index=index)
+
+    def peakmem_xyxymatch(self, n, density, index):
+        stimage.xyxymatch(self.input, self.ref, index=index)
+
+
+class Triangles:
+    """
+    The triangles algorithm across the number of coordinates, their
+    density and the way the triangles are formed.
+    """
+    params = ([100, 1000, 10000],
+              [1e-4, 1e-3, 1e-2],
+              ['all', 'knn'])
+    param_names = ['n', 'density', 'triangle_mode']
+
+    def setup(self, n, density, triangle_mode):
+        self.ref = catalogs.for_density(n, density)
+        self.input = catalogs.transform(
+            self.ref, angle=3.0, scale=1.01, shift=(5.0, -3.0), noise=0.05)
+
+    def time_xyxymatch(self, n, density, triangle_mode):
+        stimage.xyxymatch(self.input, self.ref, algorithm='triangles',
+                          triangle_mode=triangle_mode)
+
+    def peakmem_xyxymatch(self, n, density, triangle_mode):
+        stimage.xyxymatch(self.input, self.ref, algorithm='triangles',
+                          triangle_mode=triangle_mode)
+
+
+class Nmatch:
+    """
+    The triangles algorithm across *nmatch*, which bounds the number
+    of coordinates the triangles are formed from, so that the cost is
+    dominated by constructing and merging the triangles.
+    """
+    params = [10, 20, 30, 40, 50]
+    param_names = ['nmatch']
+
+    def setup(self, nmatch):
+        self.ref = catalogs.uniform(1000, 4096.0)
+        self.input = catalogs.transform(
+            self.ref, angle=3.0, scale=1.01, shift=(5.0, -3.0), noise=0.05)
+
+    def time_xyxymatch(self, nmatch):
+        stimage.xyxymatch(self.input, self.ref, algorithm='triangles',
+                          nmatch=nmatch)
+
+    def peakmem_xyxymatch(self, nmatch):
+        stimage.xyxymatch(self.input, self.ref, algorithm='triangles',
+                          nmatch=nmatch)
+
+
+class Clustered:
+    """
+    The tolerance algorithm on clustered fields, where sorting and
+    culling the coordinates closer than *separation* dominate.
+    """
+    params = ([10000, 100000],
+              [10, 100],
+              [0.0, 9.0])
+    param_names = ['n', 'nclusters', 'separation']
+
+    def setup(self, n, nclusters, separation):
+        self.ref = catalogs.clustered(n, 4096.0, nclusters, 20.0)
+        self.input = catalogs.transform(self.ref, noise=0.1)
+
+    def time_xyxymatch(self, n, nclusters, separation):
+        stimage.xyxymatch(self.input, self.ref, separation=separation)
+
+    def peakmem_xyxymatch(self, n, nclusters, separation):
+        stimage.xyxymatch(self.input, self.ref, separation=separation)
+
+
+class Prepared:
+    """
+    Matching many input lists against the same reference coordinates,
+    as an array, as a `~stsci.stimage.ReferenceCatalog`, and in
+    parallel.
+    """
+    params = [1000, 100000]
+    param_names = ['n']
+
+    def setup(self, n):
+        self.ref = catalogs.uniform(n, 4096.0)
+        self.catalog = stimage.ReferenceCatalog(self.ref)
+        self.inputs = [catalogs.transform(self.ref, noise=0.1, seed=i)
+                       for i in range(8)]
+
+    def time_xyxymatch(self, n):
+        for input in self.inputs:
+            stimage.xyxymatch(input, self.ref)
+
+    def time_xyxymatch_catalog(self, n):
+        for input in self.inputs:
+            stimage.xyxymatch(input, self.catalog)
+
+    def time_xyxymatch_many(self, n):
+        stimage.xyxymatch_many(
+            [(input, self.catalog) for input in self.inputs])
@@ -0,0 +1,59 @@
+"""
+Deterministic synthetic catalogs for the benchmarks.
+
+Every generator takes a *seed*, so a benchmark sees the same catalog
+on every run and every machine.
+"""
+
+import numpy as np
+
+
+def uniform(n, width, seed=0):
+    """
+    *n* coordinates uniformly distributed in a *width* x *width* field.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0.0, width, size=(n, 2))
+
+
+def for_density(n, density, seed=0):
+    """
+    *n* uniformly distributed coordinates with *density* coordinates
+    per square pixel.
+    """
+    return uniform(n, np.sqrt(n / density), seed=seed)
+
+
+def clustered(n, width, nclusters, sigma, seed=0):
+    """
+    *n* coordinates in *nclusters* gaussian clusters of standard
+    deviation *sigma*, with centers uniformly distributed in a *width*
+    x *width* field.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0.0, width, size=(nclusters, 2))
+    members = np.arange(n) * nclusters // n
+    return centers[members] + rng.normal(0.0, sigma, size=(n, 2))
+
+
+def transform(coords, angle=0.0, scale=1.0, shift=(0.0, 0.0), noise=0.0,
+              outliers=0.0, seed=1):
+    """
+    Rotate *coords* by *angle* degrees, scale and shift them, and add
+    gaussian *noise*.  A fraction *outliers* of the coordinates is
+    moved by a further 20 pixels rms.
+    """
+    rng = np.random.default_rng(seed)
+    theta = np.deg2rad(angle)
+    c = scale * np.cos(theta)
+    s = scale * np.sin(theta)
+    out = np.empty_like(coords)
+    out[:, 0] = c * coords[:, 0] - s * coords[:, 1] + shift[0]
+    out[:, 1] = s * coords[:, 0] + c * coords[:, 1] + shift[1]
+    if noise:
+        out += rng.normal(0.0, noise, size=out.shape)
+    if outliers:
+        nbad = int(len(out) * outliers)
+        bad = rng.choice(len(out), size=nbad, replace=False)
+        out[bad] += rng.normal(0.0, 20.0, size=(nbad, 2))
+    return out
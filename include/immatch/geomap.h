@@ -37,7 +37,9 @@ DAMAGE.
 #define _STIMAGE_GEOMAP_H_
 
 #include "lib/util.h"
+#include "lib/coord_view.h"
 #include "lib/xybbox.h"
+#include "lib/stats.h"
 #include "surface/surface.h"
 
 typedef enum {
@@ -90,6 +92,21 @@ typedef struct {
     coord_t residual;
 } geomap_output_t;
 
+/**
+The fitted transformation from reference to input coordinates.  The x
+and y surfaces sx1 and sy1 hold the linear part of the fit, and sx2
+and sy2 the distortion part, which is only present when has_sx2 and
+has_sy2 are non-zero.
+*/
+typedef struct {
+    surface_t sx1;
+    surface_t sy1;
+    surface_t sx2;
+    surface_t sy2;
+    int       has_sx2;
+    int       has_sy2;
+} geomap_transform_t;
+
 typedef struct {
     geomap_fit_e fit_geometry;
     surface_type_e function;
@@ -107,8 +124,57 @@ typedef struct {
     double* x2coeff;
     size_t ny2coeff;
     double* y2coeff;
+    geomap_transform_t transform;
 } geomap_result_t;
 
+/**
+ Simply mark a geomap_transform object as uninitialized.
+*/
+void
+geomap_transform_new(
+        geomap_transform_t* const t);
+
+/**
+Free the surfaces in a geomap_transform object.
+*/
+void
+geomap_transform_free(
+        geomap_transform_t* const t);
+
+/**
+Apply a fitted transformation to an array of reference coordinates.
+
+The coordinates are read and evaluated in blocks, so the scratch
+memory needed does not depend on the number of coordinates.  out may
+be the same memory as ref.  Each coordinate is transformed on its own,
+so the result does not depend on nthreads.
+
+@param t The transformation
+
+@param distortion When zero, only the linear part of the fit is
+       applied.
+
+@param ref The reference coordinates
+
+@param nthreads The number of threads the coordinates are split
+       between.  If 0, the number of processors is used.
+
+@param out Array of transformed coordinates [ref->n]
+
+@param error
+
+@return Non-zero on error
+*/
+int
+geomap_transform_apply(
+        const geomap_transform_t* const t,
+        const int distortion,
+        const coord_view_t* const ref,
+        const size_t nthreads,
+        /* Output */
+        coord_t* const out,
+        stimage_error_t* const error);
+
 /**
 Initialize the geomap_result object.
 */
@@ -123,6 +189,51 @@ void
 geomap_result_free(
         geomap_result_t* const r);
 
+/**
+Apply a fitted transformation to the grid of reference coordinates
+(x[i], y[j]), such as the pixels of an image.  The surfaces are
+evaluated with surface_grid, which costs much less per point than
+geomap_transform_apply.
+
+@param t The transformation
+
+@param distortion When zero, only the linear part of the fit is
+       applied.
+
+@param nx The number of columns
+
+@param x The x coordinates of the columns [nx]
+
+@param ny The number of rows
+
+@param y The y coordinates of the rows [ny]
+
+@param row_stride The distance between the rows of out, in coordinates
+
+@param nthreads The number of threads the rows are split between.  If
+       0, the number of processors is used.
+
+@param out The transformed coordinates.  The coordinate for (x[i],
+       y[j]) is stored in out[j * row_stride + i].
+
+@param error
+
+@return Non-zero on error
+*/
+int
+geomap_transform_grid(
+        const geomap_transform_t* const t,
+        const int distortion,
+        const size_t nx,
+        const double* const x,
+        const size_t ny,
+        const double* const y,
+        const size_t row_stride,
+        const size_t nthreads,
+        /* Output */
+        coord_t* const out,
+        stimage_error_t* const error);
+
 /**
 `geomap` computes the transformation required to map the reference
 coordinate system to the input coordinate system.
@@ -231,12 +342,17 @@ coordinate system to the input coordinate system.
 
 @param reject The rejection limit in units of sigma.
 
-@param noutput The number of output records returned
+@param noutput The number of output records returned.  This is the
+       number of coordinates that were fit, even when output is NULL.
 
 @param output An array of output records matching input and reference
-       coordinates with their fit and residual values.
+       coordinates with their fit and residual values.  May be NULL,
+       in which case only result is computed, and the fitted values
+       and residuals of each coordinate are not evaluated.
 
-@param result A structure defining the fit that was found.
+@param result A structure defining the fit that was found.  Its
+       transform member holds the fitted surfaces, which can be
+       applied to other coordinates with geomap_transform_apply.
 
 @param error
 
@@ -260,10 +376,209 @@ geomap(
         /* Input/output */
         size_t* const noutput,
         /* Output */
-        geomap_output_t* const output, /* [MAX(ninput, nref)] */
+        geomap_output_t* const output, /* [MAX(ninput, nref)] or NULL */
+        geomap_result_t* const result,
+        stimage_error_t* const error);
+
+/**
+Same as geomap, but reads the input and reference coordinates through
+views, so they need not be coord_t arrays.  They are copied once, and
+only when they are not coord_t arrays or have to be limited to bbox.
+
+@param nthreads The number of threads the surfaces are fit and
+       evaluated on.  If 0, the number of processors is used.  The
+       result does not depend on nthreads.
+
+@param stats If not NULL, the wall time and counters of each stage of
+       the fit are added to it: the points removed by bbox, the fit
+       and its number of points, and the rejection iterations and
+       rejected points.
+
+@return Non-zero on error
+ */
+int
+geomap_view(
+        const coord_view_t* const input,
+        const coord_view_t* const ref,
+        const bbox_t* const bbox,
+        const geomap_fit_e fit_geometry,
+        const surface_type_e function,
+        const size_t xxorder,
+        const size_t xyorder,
+        const size_t yxorder,
+        const size_t yyorder,
+        const xterms_e xxterms,
+        const xterms_e yxterms,
+        const size_t maxiter,
+        const double reject,
+        const size_t nthreads,
+        /* Input/output */
+        size_t* const noutput,
+        /* Output */
+        geomap_output_t* const output, /* [MAX(input->n, ref->n)] or NULL */
+        geomap_result_t* const result,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error);
+
+/**
+The weighted means and centered cross products of a set of reference
+and input coordinates, in the order (ref x, ref y, input x, input y).
+*/
+typedef struct {
+    double sw;
+    double mean[4];
+    double comoment[4][4];
+} geomap_moments_t;
+
+/**
+The normal equations accumulated for the x or y fit of a shift,
+xyscale or general fit.  sf1 holds those of the linear surface and
+sf2, if has_sf2, those of the distortion surface.  Since sf2 is fit to
+the residuals of sf1, which are only known once sf1 is solved, the
+inner products of the basis functions of sf2 with each of those of
+sf1 are kept in cross.
+*/
+typedef struct {
+    surface_t sf1;
+    surface_t sf2;
+    int       has_sf2;
+    double*   cross; /* [sf1.ncoeff * sf2.ncoeff] */
+    double    zz;    /* weighted sum of the squared ordinates */
+} geomap_xy_sums_t;
+
+/**
+The partial sums of a geomap fit, accumulated from chunks of
+coordinates so that the whole list never has to be in memory at once.
+The bounding box must be given up front, since the surfaces are
+normalized to it.
+*/
+typedef struct {
+    geomap_fit_e     fit_geometry;
+    surface_type_e   function;
+    bbox_t           bbox;
+    size_t           ncoord;
+    size_t           n_zero_weighted;
+    coord_t          sum_ref;
+    coord_t          sum_input;
+    /* rotate, rscale and rxyscale */
+    geomap_moments_t moments;
+    /* shift, xyscale and general */
+    geomap_xy_sums_t x;
+    geomap_xy_sums_t y;
+} geomap_accumulator_t;
+
+/**
+ Simply mark a geomap_accumulator object as uninitialized.
+*/
+void
+geomap_accumulator_new(
+        geomap_accumulator_t* const acc);
+
+/**
+Initialize an empty geomap accumulator.  The parameters are the same
+as those of geomap, except that bbox must be finite and have a
+non-zero width and height, and that there is no rejection.
+
+@return Non-zero on error
+*/
+int
+geomap_accumulator_init(
+        geomap_accumulator_t* const acc,
+        const bbox_t* const bbox,
+        const geomap_fit_e fit_geometry,
+        const surface_type_e function,
+        const size_t xxorder,
+        const size_t xyorder,
+        const size_t yxorder,
+        const size_t yyorder,
+        const xterms_e xxterms,
+        const xterms_e yxterms,
+        stimage_error_t* const error);
+
+/**
+Free the memory in a geomap accumulator.
+*/
+void
+geomap_accumulator_free(
+        geomap_accumulator_t* const acc);
+
+/**
+Add a chunk of matched coordinates to the fit.  Coordinates whose
+reference coordinate is outside of the bounding box are ignored.
+The memory used only depends on the size of the chunk.
+
+@param input, ref The input and reference coordinates, of the same
+       length
+
+@param weights The weight of each coordinate, or NULL for a weight of
+       1.0
+
+@return Non-zero on error
+*/
+int
+geomap_accumulator_add(
+        geomap_accumulator_t* const acc,
+        const coord_view_t* const input,
+        const coord_view_t* const ref,
+        const double* const weights, /* [input->n] or NULL */
+        stimage_error_t* const error);
+
+/**
+Add the partial sums of other, which must have been initialized with
+the same parameters, to acc.
+
+@return Non-zero on error
+*/
+int
+geomap_accumulator_merge(
+        geomap_accumulator_t* const acc,
+        const geomap_accumulator_t* const other,
+        stimage_error_t* const error);
+
+/**
+Solve for the fit of all of the coordinates added so far.  The result
+is the same, up to rounding, as a single call to geomap on all of the
+coordinates with the same bbox and no rejection, except that the rms
+is computed from the accumulated sums rather than from the residuals
+of each coordinate.  acc is not changed, so more coordinates may be
+added afterwards.
+
+@return Non-zero on error
+*/
+int
+geomap_accumulator_solve(
+        const geomap_accumulator_t* const acc,
+        /* Output */
         geomap_result_t* const result,
         stimage_error_t* const error);
 
+/**
+The number of doubles in the state of the accumulator, as written by
+geomap_accumulator_get_state.
+*/
+size_t
+geomap_accumulator_state_size(
+        const geomap_accumulator_t* const acc);
+
+/**
+Copy the partial sums of the accumulator to state, so that they can
+be sent to another process.
+*/
+void
+geomap_accumulator_get_state(
+        const geomap_accumulator_t* const acc,
+        /* Output */
+        double* const state); /* [geomap_accumulator_state_size(acc)] */
+
+/**
+Restore the partial sums of the accumulator, which must have been
+initialized with the same parameters, from state.
+*/
+void
+geomap_accumulator_set_state(
+        geomap_accumulator_t* const acc,
+        const double* const state); /* [geomap_accumulator_state_size(acc)] */
+
 void
 geomap_result_print(
         const geomap_result_t* const result);
@@ -0,0 +1,133 @@
+/*
+Copyright (C) 2008-2025 Association of Universities for Research in Astronomy (AURA)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above
+      copyright notice, this list of conditions and the following
+      disclaimer in the documentation and/or other materials provided
+      with the distribution.
+
+    3. The name of AURA and its representatives may not be used to
+      endorse or promote products derived from this software without
+      specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY AURA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL AURA BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+*/
+
+#ifndef _STIMAGE_OFFSETS_H_
+#define _STIMAGE_OFFSETS_H_
+
+#include "lib/lintransform.h"
+#include "lib/stats.h"
+#include "lib/util.h"
+
+/**
+Estimate the shift, and optionally the rotation and scale, between two
+lists of coordinates by voting on the offsets between every pair of
+coordinates drawn from the two lists.
+
+Up to nmatch coordinates are taken from each list, in the order they
+appear in ref and input, so that when the lists are sorted brightest
+first, the brightest coordinates are used.  For each trial rotation
+and scale, the input coordinates are rotated and scaled about the
+origin, and the offsets from them to each of the reference
+coordinates are binned in a histogram with cells of size tolerance.
+The coordinates the two lists have in common all give nearly the same
+offset, so the densest 3x3 block of cells gives the shift.  The shift
+is then refined to the mean of the offsets within tolerance of it,
+and those offsets are its votes.  The trial with the most votes wins.
+
+Most of the offsets are between coordinates that do not correspond,
+and by chance some shift gets a few votes from them.  min_votes is
+the number of votes a shift needs to stand out from them, given the
+number of offsets, the areas the two lists cover and the number of
+trials.  A shift with fewer votes should not be trusted.
+
+@param nref The number of reference coordinates (specifically, the
+length of ref_sorted, not ref)
+
+@param ref The raw array of reference coordinates, whose order is the
+order in which the coordinates are taken.
+
+@param ref_sorted An array of pointers to reference coordinates in
+ref, culled with xycoincide.
+
+@param ninput The number of input coordinates (specifically, the
+length of input_sorted, not input)
+
+@param input The raw array of input coordinates
+
+@param input_sorted An array of pointers to input coordinates in
+input, culled with xycoincide.
+
+@param nmatch The maximum number of coordinates taken from each list.
+The number of offsets binned is the product of the numbers taken.
+
+@param tolerance The matching tolerance in pixels, which is the size
+of the histogram cells.  Must be positive.
+
+@param max_rotation The rotations tried are those from -max_rotation
+to max_rotation degrees in steps of rotation_step.  If 0, only no
+rotation is tried.
+
+@param rotation_step The step between the trial rotations, in degrees
+
+@param max_scale The scales tried are those from 1 - max_scale to 1 +
+max_scale in steps of scale_step.  If 0, only a scale of 1 is tried.
+
+@param scale_step The step between the trial scales
+
+@param lintransform Output: the transformation from the input
+coordinates to the reference coordinates with the most votes.  It is
+left alone if nvotes is 0.
+
+@param nvotes Output: the number of offsets that voted for
+lintransform, an upper bound on the number of coordinates it matches.
+
+@param min_votes Output: the fewest votes a shift needs to stand out
+from the random offsets, at least 3
+
+@param stats If not NULL, the time spent, the number of trials, the
+number of offsets binned, the number of votes and min_votes are added
+to the "offsets" statistics.
+
+@param error
+
+@return Non-zero on error
+*/
+int
+match_offsets(
+        const size_t nref,
+        const coord_t* const ref,
+        const coord_t* const * const ref_sorted, /*[nref]*/
+        const size_t ninput,
+        const coord_t* const input,
+        const coord_t* const * const input_sorted, /*[ninput]*/
+        const size_t nmatch,
+        const double tolerance,
+        const double max_rotation,
+        const double rotation_step,
+        const double max_scale,
+        const double scale_step,
+        lintransform_t* const lintransform,
+        size_t* const nvotes,
+        size_t* const min_votes,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error);
+
+#endif /* _STIMAGE_OFFSETS_H_ */
@@ -38,6 +38,7 @@ DAMAGE.
 
 #include "lib/util.h"
 #include "immatch/lib/match_util.h"
+#include "lib/xygrid.h"
 
 /**
 Given two lists of coordinates, finds pairs that are within a certain
@@ -89,4 +90,57 @@ match_tolerance(
         void*                        callback_data,
         stimage_error_t* const       error);
 
+/**
+Same as match_tolerance, but finds the candidate matches for each
+reference coordinate through a uniform grid built over the input
+coordinates, rather than by sweeping through all of the input
+coordinates that lie within tolerance in y.  Only the grid cells
+neighbouring each reference coordinate are visited, so the cost does
+not degrade when many coordinates share the same range in y.
+
+The results are identical to those of match_tolerance.  The
+parameters are the same as for match_tolerance.
+*/
+int
+match_tolerance_grid(
+        const size_t                 nref,
+        const coord_t* const         ref,
+        const coord_t* const * const ref_sorted,
+        const size_t                 ninput,
+        const coord_t* const         input,
+        const coord_t* const * const input_sorted,
+        const double                 tolerance,
+        coord_match_callback_t*      callback,
+        void*                        callback_data,
+        stimage_error_t* const       error);
+
+/**
+Same as match_tolerance, but uses a grid that has already been built
+over the reference coordinates, and visits the input coordinates in
+turn.  This is useful when the same reference coordinates are matched
+against many lists of input coordinates.
+
+The results, including the order in which the callback is called, are
+identical to those of match_tolerance.
+
+@param ref_grid A grid built with xygrid_init over the first nref
+coordinates of ref_sorted.  Its requested cell size should be
+tolerance.
+
+The other parameters are the same as for match_tolerance.
+*/
+int
+match_tolerance_ref_grid(
+        const size_t                 nref,
+        const coord_t* const         ref,
+        const coord_t* const * const ref_sorted,
+        const xygrid_t* const        ref_grid,
+        const size_t                 ninput,
+        const coord_t* const         input,
+        const coord_t* const * const input_sorted,
+        const double                 tolerance,
+        coord_match_callback_t*      callback,
+        void*                        callback_data,
+        stimage_error_t* const       error);
+
 #endif /* _STIMAGE_XYINTERSECT_H_ */
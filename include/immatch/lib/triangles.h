@@ -36,9 +36,40 @@ DAMAGE.
 #ifndef _STIMAGE_TRIANGLES_H_
 #define _STIMAGE_TRIANGLES_H_
 
+#include "lib/stats.h"
 #include "lib/util.h"
 #include "immatch/lib/match_util.h"
 
+/**
+How the triangles to be matched are formed from each list of
+coordinates.
+*/
+typedef enum {
+    /** Every possible triangle */
+    triangle_mode_all,
+    /** Only triangles formed by a coordinate and two of its k nearest
+        neighbors */
+    triangle_mode_knn,
+    triangle_mode_LAST
+} triangle_mode_e;
+
+/**
+How the reference and input triangles are paired up.  Both find the
+same matches.
+*/
+typedef enum {
+    /** Sweep over the input triangles in order of ratio, testing every
+        input triangle within the largest ratio tolerance of each
+        reference triangle */
+    triangle_merge_sweep,
+    /** Look up the input triangles in a grid over (ratio, cosine),
+        testing only those in the cells the tolerances of each
+        reference triangle reach.  Faster when the triangles are many
+        or their ratio tolerances vary widely. */
+    triangle_merge_grid,
+    triangle_merge_LAST
+} triangle_merge_e;
+
 /**
 Compute the intersection of two lists using a pattern matching
 algorithm. This algorithm is based on one developed by Edward Groth
@@ -85,6 +116,15 @@ the triangles used for matching.
 
 @param nreject The maximum number of rejection iteration cycles.
 
+@param mode How the triangles are formed.  triangle_mode_all forms
+all C(n, 3) triangles from each list.  triangle_mode_knn only forms
+the triangles between each coordinate and pairs of its k nearest
+neighbors, which is O(n k^2), so that many more coordinates can be
+used.
+
+@param k The number of nearest neighbors used by triangle_mode_knn.
+Must be at least 2.
+
 @param callback A callback function that is called with each matching
 coordinate pair.  Its arguments are (data, ref_index, input_index,
 error).  data is always whatever callback_data is.  ref_index is the
@@ -111,6 +151,8 @@ match_triangles(
         const double tolerance,
         const double maxratio,
         const size_t nreject,
+        const triangle_mode_e mode,
+        const size_t k,
         coord_match_callback_t* callback,
         void* callback_data,
         stimage_error_t* const error);
@@ -120,38 +162,130 @@ BELOW IS THE SECONDARY API -- SUBJECT TO CHANGE
 ********************************************************************************/
 
 /**
-Stores information about a triangle
+The index of a coordinate or a triangle in a triangle table.  32 bits
+are enough, since the number of coordinates that triangles are formed
+from is limited by max_num_triangles.
+*/
+typedef unsigned int triangle_index_t;
+
+/**
+A table of triangles, stored by column, so that merge_triangles
+streams through the ratios alone and only reads the other columns of
+the candidates within the ratio tolerance.  Each triangle takes 36
+bytes.
+
+The log of the perimeter of a triangle and its sense (whether its
+vertices run clockwise) are only needed for the matched triangles, so
+they are not stored, but computed from the vertices by
+reject_triangles.
 */
 typedef struct {
-    /** The vertices of the triangle */
-    const coord_t* vertices[3];
+    /** The number of triangles */
+    size_t ntriangles;
+
+    /** The number of triangles the columns have room for */
+    size_t capacity;
 
-    /** The log of the perimeter of the triangle */
-    double log_perimeter;
+    /** The coordinates that the vertices index into.  This memory is
+        borrowed, and must outlive the table. */
+    const coord_t* const * coords;
 
-    /** The ratio of the longest to shortest side */
-    double ratio;
+    /** The ratio of the longest to shortest side, in increasing order
+        once the table is built.  The start of the single allocation
+        that holds all of the columns. */
+    double* ratio;
 
     /** Cosine of angle at vertex 1 */
-    double cosine_v1;
+    double* cosine_v1;
 
     /** Tolerance in the ratio */
-    double ratio_tolerance;
+    float* ratio_tolerance;
 
     /** Tolerance in the cosine */
-    double cosine_tolerance;
+    float* cosine_tolerance;
+
+    /** The indices in coords of the three vertices of each triangle
+        [3 * capacity] */
+    triangle_index_t* vertices;
+
+    /** Non-zero if the columns are in a buffer the table does not
+        own, set up by triangle_table_view, so they are not freed */
+    int borrowed;
+} triangle_table_t;
+
+/**
+Mark a triangle_table_t object as empty, so that it may be freed.
+*/
+void
+triangle_table_new(
+        triangle_table_t* const t);
+
+/**
+Allocate the columns of a triangle table for capacity triangles.  The
+table is initially empty.
+
+@param t The table
+
+@param capacity The number of triangles to allocate
+
+@param coords The coordinates that the vertices will index into
+
+@param error
+
+@return Non-zero on error
+*/
+int
+triangle_table_init(
+        triangle_table_t* const t,
+        const size_t capacity,
+        const coord_t* const * const coords,
+        stimage_error_t* const error);
+
+/**
+Return the size in bytes of the columns of a table with room for
+capacity triangles.  They are laid out one after another, in the
+order of the fields of triangle_table_t.
+*/
+size_t
+triangle_table_columns_size(
+        const size_t capacity);
 
-    /** Sense of the triangle (clockwise (non-zero) or anti-clockwise
-        (zero)) */
-    int sense;
-} triangle_t;
+/**
+Make a table of the ntriangles triangles in a buffer of columns laid
+out as described by triangle_table_columns_size, without copying
+them.  The columns are borrowed: the buffer must outlive the table,
+and triangle_table_free does not free it.
+
+@param t The table
+
+@param ntriangles The number of triangles in the buffer
+
+@param coords The coordinates that the vertices index into
+
+@param columns The buffer, aligned to 8 bytes.  The table only writes
+to it if the caller does.
+*/
+void
+triangle_table_view(
+        triangle_table_t* const t,
+        const size_t ntriangles,
+        const coord_t* const * const coords,
+        void* const columns);
 
 /**
-Pointers to a matching pair of triangles.
+Free the columns of a triangle table, unless they are borrowed.
+*/
+void
+triangle_table_free(
+        triangle_table_t* const t);
+
+/**
+Indices of a matching pair of triangles, in the left and right
+tables passed to merge_triangles.
 */
 typedef struct {
-    const triangle_t* l;
-    const triangle_t* r;
+    triangle_index_t l;
+    triangle_index_t r;
 } triangle_match_t;
 
 /**
@@ -178,12 +312,10 @@ between vertices 1 and 3.
 these coordinates have already been sorted with xysort and culled with
 xycoincide.
 
-@param ntriangles On input, the number of triangles allocated in the
-triangle list.  On output, the number of triangles found.  The number
-of triangles to allocate should be determined using max_num_triangles.
-
-@param triangles An array of triangle_t structs to store the
-triangles.
+@param triangles A table initialized with triangle_table_init on
+coords, to store the triangles in.  Its capacity should be determined
+using max_num_triangles.  On output, it holds the triangles found, in
+increasing order of ratio.
 
 @param maxnpoints The maximum number of points.
 
@@ -193,64 +325,159 @@ rejected.
 @param maxratio Triangles with a ratio of longest side to shortest
 side greater than maxratio are rejected.
 
+@param nthreads The number of threads the triangles are found and
+sorted on.  The triangles of each first vertex are found separately,
+and triangles of the same ratio are kept in the order they were
+found, so the result does not depend on nthreads.  If 0, the number
+of processors is used.
+
+@param stats If not NULL, the time spent and the number of triangles
+kept and rejected on maxratio are added to the "find_triangles"
+statistics.
+
 @param error Contains an error message if an error occurred.
  */
 int
 find_triangles(
         const size_t ncoords,
         const coord_t* const * const coords,
-        size_t* ntriangles,
-        triangle_t* triangles,
+        triangle_table_t* const triangles,
         const size_t maxnpoints,
         const double tolerance,
         const double maxratio,
+        const size_t nthreads,
+        stimage_stats_t* const stats,
         stimage_error_t* const error);
 
 /**
-Compute the intersection of the two sorted lists of triangles using
-the ratio tolerance parameter.
+Compute the number of triangles find_triangles_knn may find given the
+number of coordinates.
+*/
+int
+max_num_triangles_knn(
+        const size_t ncoords,
+        const size_t max_ncoords,
+        const size_t k,
+        size_t* num_triangles,
+        stimage_error_t* const error);
+
+/**
+Construct the triangles formed by each coordinate and each pair of its
+k nearest neighbors.  Triangles found from more than one of their
+vertices are only stored once.
+
+The parameters and the ordering of the vertices are the same as for
+find_triangles.  The number of triangles to allocate should be
+determined using max_num_triangles_knn.
+
+@param k The number of nearest neighbors of each coordinate.
 
-@param nr_triangles The number of reference triangles
+@param nthreads The number of threads the triangles are sorted on.
+
+@param stats The same as for find_triangles.
+ */
+int
+find_triangles_knn(
+        const size_t ncoords,
+        const coord_t* const * const coords,
+        triangle_table_t* const triangles,
+        const size_t maxnpoints,
+        const size_t k,
+        const double tolerance,
+        const double maxratio,
+        const size_t nthreads,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error);
 
-@param r_triangles An array of triangles
+/**
+Compute the intersection of the two sorted lists of triangles using
+the ratio tolerance parameter.
 
-@param nl_triangles The number of input triangles
+@param r_triangles The reference triangles
 
-@param l_triangles An array of triangles
+@param l_triangles The input triangles
 
 @param nmatches On input: The number of matches allocated.  On output:
 The number of matches found.
 
 @param matches An array to store the match pairs.
 
+@param nthreads The number of threads.  The reference triangles are
+split into ranges of ratio, and the search of each range starts from
+the first triangle in l_triangles within the tolerance of its first
+triangle, so the matches are the same as for a single sweep.  The
+ranges are only searched separately if nmatches is at least the
+number of reference triangles on input.  If 0, the number of
+processors is used.
+
+@param stats If not NULL, the time spent, the number of matches and
+the number of candidate pairs tested are added to the
+"merge_triangles" statistics.
+
 @param error
 */
 int
 merge_triangles(
-        const size_t nr_triangles,
-        const triangle_t* const r_triangles,
-        const size_t nl_triangles,
-        const triangle_t* const l_triangles,
+        const triangle_table_t* const r_triangles,
+        const triangle_table_t* const l_triangles,
         size_t* nmatches,
         triangle_match_t* const matches,
+        const size_t nthreads,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error);
+
+/**
+Same as merge_triangles, but looks up the candidate triangles in
+l_triangles in a grid over their ratios and cosines, rather than
+sweeping over every triangle within the largest ratio tolerance.  The
+grid has a level for each power-of-two cell size, and each triangle is
+stored in the level that suits its own tolerances, so the triangles
+with unusually large tolerances do not widen the search for the
+others.  The matches are the same as those of merge_triangles.
+
+@param stats If not NULL, the time spent, the number of matches, the
+number of candidate pairs tested and the number of grid levels are
+added to the "merge_triangles" statistics.
+
+The other parameters are the same as for merge_triangles.
+*/
+int
+merge_triangles_grid(
+        const triangle_table_t* const r_triangles,
+        const triangle_table_t* const l_triangles,
+        size_t* nmatches,
+        triangle_match_t* const matches,
+        const size_t nthreads,
+        stimage_stats_t* const stats,
         stimage_error_t* const error);
 
 /**
 Remove false matches from the list of matched triangles.
 
+@param r_triangles The table that the r index of each match refers to
+
+@param l_triangles The table that the l index of each match refers to
+
 @param nmatches The number of matches
 
 @param matches An array of triangle match pairs
 
 @param nreject The number of rejection iterations to perform
 
+@param stats If not NULL, the time spent, the number of iterations
+run and the number of matches kept are added to the
+"reject_triangles" statistics.
+
 @param error
 */
 int
 reject_triangles(
+        const triangle_table_t* const r_triangles,
+        const triangle_table_t* const l_triangles,
         size_t* nmatches,
         triangle_match_t* const matches,
         const size_t nreject,
+        stimage_stats_t* const stats,
         stimage_error_t* error);
 
 /**
@@ -259,6 +486,20 @@ in the set of matched triangles. If a particular pair of points occurs
 in many triangles it is much more likely to be a true match than if it
 occurs in very few.
 
+@param nleft The length of the left array
+
+@param left The array that the coordinates of all of the vertices of
+the left triangles point into
+
+@param l_triangles The table that the l index of each match refers to
+
+@param nright The length of the right array
+
+@param right The array that the coordinates of all of the vertices of
+the right triangles point into
+
+@param r_triangles The table that the r index of each match refers to
+
 @param ntriangle_matches The number of triangle match pairs
 
 @param triangle_matches An array of triangle match pairs
@@ -276,19 +517,142 @@ inputcoord_matches.
 reference set that correspond to the coordinates in
 inputcoord_matches.
 
+@param stats If not NULL, the time spent, the number of votes, the
+largest number of votes for a pair and the number of coordinate
+matches are added to the "vote" statistics.
+
 @param error
 */
 int
 vote_triangle_matches(
         const size_t nleft,
         const coord_t* const left,
+        const triangle_table_t* const l_triangles,
         const size_t nright,
         const coord_t* const right,
+        const triangle_table_t* const r_triangles,
         const size_t ntriangle_matches,
         const triangle_match_t* const triangle_matches,
         size_t* ncoord_matches,
         const coord_t** const refcoord_matches,
         const coord_t** const inputcoord_matches,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error);
+
+/**
+Build the triangles used for matching from a coordinate list, in the
+same way as match_triangles does.
+
+@param mode How the triangles are formed
+
+@param k The number of nearest neighbors used by triangle_mode_knn
+
+@param ncoords The number of coordinates in coords
+
+@param coords An array of pointers to coordinates, sorted with xysort
+and culled with xycoincide
+
+@param nmatch The maximum number of coordinates to use
+
+@param tolerance The matching tolerance in pixels
+
+@param maxratio The maximum ratio of the longest to shortest side of
+the triangles
+
+@param nthreads Passed to find_triangles or find_triangles_knn
+
+@param triangles Output: a newly allocated table of triangles, which
+must be freed by the caller with triangle_table_free.  The vertices
+index into coords.
+
+@param stats If not NULL, passed to find_triangles or
+find_triangles_knn.
+
+@param error
+
+@return Non-zero on error
+*/
+int
+build_triangles(
+        const triangle_mode_e mode,
+        const size_t k,
+        const size_t ncoords,
+        const coord_t* const * const coords,
+        const size_t nmatch,
+        const double tolerance,
+        const double maxratio,
+        const size_t nthreads,
+        triangle_table_t* const triangles,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error);
+
+/**
+Same as match_triangles, but the triangles from the reference
+coordinates may be provided, having been built in advance with
+build_triangles using the same ref_sorted, nref_unique, mode, k,
+nmatch, tolerance and maxratio.  This saves rebuilding them when the
+same reference coordinates are matched many times.
+
+@param ref_triangles The reference triangles, whose vertices index
+into ref_sorted.  If NULL, they are built from ref_sorted.  They are
+only used for the level of adaptive matching that uses nmatch
+coordinates.  The levels below it build the triangles of their own,
+fewer, reference coordinates, which costs little next to the level
+that uses nmatch.
+
+@param nmatch_start If not 0 and less than nmatch, the coordinates are
+matched adaptively.  Only the triangles from up to nmatch_start
+coordinates of each list are matched at first.  If fewer than 5 of
+them, or fewer than a fifth of those used, are matched, the number of
+coordinates is doubled, up to nmatch, and the triangles are matched
+again.  A level where none of the triangles of one of the lists pass
+maxratio also moves on to the next, but any other error is returned.
+Easy lists are then matched at the cheapest level, while lists with
+little in common still get the most coordinates.
+
+@param merge How the reference and input triangles are paired up.
+See triangle_merge_e.
+
+@param nthreads The number of threads the triangles are built and
+merged on.  The reference and input triangles are built at the same
+time, each on half of the threads.  The matches do not depend on
+nthreads.  If 0, the number of processors is used.
+
+@param nmatch_used Output: if not NULL, the number of coordinates of
+each list the returned matches were found with, which is nmatch
+unless matching adaptively.
+
+@param stats If not NULL, the statistics of each stage of the
+matching are added to it.  The number of levels tried and the number
+of coordinates of the last are added as "match_triangles.levels" and
+"match_triangles.nmatch".
+
+The other parameters are the same as for match_triangles.
+*/
+int
+match_triangles_prepared(
+        const size_t nref,
+        const size_t nref_unique,
+        const coord_t* const ref,
+        const coord_t* const * const ref_sorted, /*[nref]*/
+        const size_t ninput,
+        const size_t ninput_unique,
+        const coord_t* const input, /*[ninput]*/
+        const coord_t* const * const input_sorted,
+        const triangle_table_t* const ref_triangles,
+        const size_t nmatch_start,
+        const size_t nmatch,
+        const double tolerance,
+        const double maxratio,
+        const size_t nreject,
+        const triangle_mode_e mode,
+        const size_t k,
+        const triangle_merge_e merge,
+        const size_t nthreads,
+        size_t* const nmatch_used,
+        coord_match_callback_t* callback,
+        void* callback_data,
+        stimage_stats_t* const stats,
         stimage_error_t* const error);
 
 #endif /* _STIMAGE_TRIANGLES_H_ */
@@ -33,6 +33,10 @@ DAMAGE.
 #define _STIMAGE_XYXYMATCH_H_
 
 #include "lib/util.h"
+#include "lib/coord_view.h"
+#include "lib/stats.h"
+#include "immatch/lib/triangles.h"
+#include "lib/xygrid.h"
 
 typedef struct {
     coord_t coord;
@@ -41,12 +45,106 @@ typedef struct {
     size_t  ref_idx;
 } xyxymatch_output_t;
 
+/**
+A list of matches that holds only the indices of the matched input
+and reference coordinates.  It grows as matches are found, so it need
+not be allocated for the worst case in advance.
+*/
+typedef struct {
+    size_t  nmatches;
+    size_t  capacity;
+    size_t* coord_idx; /* [capacity] */
+    size_t* ref_idx;   /* [capacity] */
+} xyxymatch_indices_t;
+
 typedef enum {
     xyxymatch_algo_tolerance,
     xyxymatch_algo_triangles,
+    xyxymatch_algo_offsets,
     xyxymatch_algo_LAST
 } xyxymatch_algo_e;
 
+typedef enum {
+    xyxymatch_index_sweep,
+    xyxymatch_index_grid,
+    xyxymatch_index_LAST
+} xyxymatch_index_e;
+
+/**
+Additional options to xyxymatch that control how the matching is
+done, but not what is matched.
+*/
+typedef struct {
+    /** The spatial index used to find the candidate matches in the
+        tolerance algorithm:
+
+        - xyxymatch_index_sweep: Sweep through the input coordinates
+          sorted in y.
+
+        - xyxymatch_index_grid: Look up the input coordinates in a
+          uniform grid whose cells are the size of the tolerance. */
+    xyxymatch_index_e index;
+
+    /** How the triangles are formed in the triangles algorithm:
+
+        - triangle_mode_all: Every triangle that can be formed from up
+          to nmatch coordinates.
+
+        - triangle_mode_knn: Only the triangles formed by each
+          coordinate and two of its k nearest neighbors. */
+    triangle_mode_e triangle_mode;
+
+    /** The number of nearest neighbors used by triangle_mode_knn */
+    size_t k;
+
+    /** If not 0 and less than nmatch, the triangles algorithm first
+        matches only up to nmatch_start coordinates of each list, and
+        doubles the number, up to nmatch, until enough of them are
+        matched.  See match_triangles_prepared. */
+    size_t nmatch_start;
+
+    /** How the triangles algorithm pairs up the reference and input
+        triangles.  Both find the same matches:
+
+        - triangle_merge_sweep: Sweep through the input triangles
+          sorted by ratio.
+
+        - triangle_merge_grid: Look up the input triangles in a grid
+          over ratio and cosine. */
+    triangle_merge_e triangle_merge;
+
+    /** The trial rotations of the offsets algorithm are those from
+        -offsets_max_rotation to offsets_max_rotation degrees in steps
+        of offsets_rotation_step.  If offsets_max_rotation is 0, only
+        the initial transformation is tried. */
+    double offsets_max_rotation;
+    double offsets_rotation_step;
+
+    /** The trial scales of the offsets algorithm are those from
+        1 - offsets_max_scale to 1 + offsets_max_scale in steps of
+        offsets_scale_step, relative to the initial transformation. */
+    double offsets_max_scale;
+    double offsets_scale_step;
+
+    /** The number of threads the triangles algorithm builds and
+        merges its triangles on.  If 0, the number of processors is
+        used.  The matches do not depend on it. */
+    size_t nthreads;
+
+    /** If not NULL, the time spent in each stage of the matching and
+        the number of coordinates, triangles and matches each stage
+        produced are added to it.  The same object must not be shared
+        by calls running at the same time. */
+    stimage_stats_t* stats;
+} xyxymatch_options_t;
+
+/**
+Initialize an xyxymatch_options_t object with the default options.
+*/
+void
+xyxymatch_options_init(
+        xyxymatch_options_t* const options);
+
 /**
 xyxymatch
 
@@ -114,6 +212,23 @@ xyxymatch
       the x and y axes, and higher order distortion terms in the
       coordinate transformation.
 
+    - xyxymatch_algo_offsets: A linear transformation is applied to
+      the input coordinate list, and the offsets between up to nmatch
+      of the transformed input coordinates and up to nmatch of the
+      reference coordinates, taken in the order they are given, are
+      binned in a histogram with cells of size tolerance, optionally
+      after each of a set of trial rotations and scales (see
+      xyxymatch_options_t).  The densest block of cells gives the
+      shift between the lists, which is combined with the initial
+      transformation and used to match the whole lists with the
+      tolerance algorithm.  The matches are then used to fit a new
+      linear transformation, and the lists are matched again.  The
+      offsets algorithm needs no tie points and its cost grows only
+      as the square of nmatch, but it only finds rotations and
+      scales among those it tries.  If the lists are sorted
+      brightest first, the brightest coordinates are used.  If fewer
+      than 3 offsets agree, no matches are returned.
+
 @param tolerance The matching tolerance in pixels.
 
 @param separation The minimum separation for objects in the input and
@@ -124,9 +239,12 @@ to matching. (9.0)
 @param nmatch The maximum number of reference and input coordinates
 used by the xyxymatch_algo_triangles pattern matching algorithm.  If
 either list contains more coordinates than nmatch, the lists are
-subsampled.  nmatch should be kept small as the computation and memory
+subsampled, the matches in the subsample are used to fit a new linear
+transformation, and the whole lists are then matched using the
+xyxymatch_algo_tolerance algorithm.  nmatch should be kept small as the computation and memory
 requirements of the triangles algorithm depend on a high power of
-lengths of the respective lists.
+lengths of the respective lists.  It is also the number of coordinates
+taken from each list by the xyxymatch_algo_offsets algorithm.
 
 @param maxratio The maximum ratio of the longest to shortest side of the
 triangles generated by the triangles pattern matching algorithm.
@@ -137,6 +255,9 @@ set higher than 10.0 but may be set as low as 5.0.
 @param nreject The maximum number of rejection iterations for the
 triangles pattern matching algorithm.
 
+@param options Additional options.  If NULL, the defaults set by
+xyxymatch_options_init are used.
+
 @return Non-zero on error
  */
 int
@@ -154,6 +275,426 @@ xyxymatch(
     const size_t nmatch,
     const double maxratio,
     const size_t nreject,
+    const xyxymatch_options_t* const options,
+    stimage_error_t* const error);
+
+/**
+Same as xyxymatch, but reads the input and reference coordinates
+through views, so they need not be a coord_t array.  The input
+coordinates are read in place.  The reference coordinates are used in
+place when they are a coord_t array, and copied once otherwise.
+
+@return Non-zero on error
+ */
+int
+xyxymatch_view(
+    const coord_view_t* const input,
+    const coord_view_t* const ref,
+    size_t* noutput, xyxymatch_output_t* const output /*[noutput]*/,
+    const coord_t* const origin,
+    const coord_t* const mag,
+    const coord_t* const rotation,
+    const coord_t* const ref_origin,
+    const xyxymatch_algo_e algorithm,
+    const double tolerance,
+    const double separation,
+    const size_t nmatch,
+    const double maxratio,
+    const size_t nreject,
+    const xyxymatch_options_t* const options,
+    stimage_error_t* const error);
+
+/**
+A list of reference coordinates prepared for matching, so that the
+work that depends only on the reference coordinates is done once when
+the same list is matched against many lists of input coordinates.
+
+The reference coordinates are always sorted and culled.  A spatial
+grid for the tolerance algorithm and the reference triangles for the
+triangles algorithm may also be prepared; they are only used by
+xyxymatch_prepared when the parameters they were built with match the
+parameters of the call.
+*/
+typedef struct {
+    /** The reference coordinates.  This memory is borrowed, and must
+        outlive the object. */
+    size_t          nref;
+    const coord_t*  ref;
+
+    /** The sorted reference coordinates, with the first nref_unique
+        no closer together than separation */
+    const coord_t** ref_sorted;
+    size_t          nref_unique;
+    double          separation;
+
+    /** A grid over the unique reference coordinates, with cells the
+        size of tolerance */
+    int             has_grid;
+    double          tolerance;
+    xygrid_t        grid;
+
+    /** The triangles formed from the unique reference coordinates,
+        with vertices indexing into ref_sorted */
+    int              has_triangles;
+    size_t           nmatch;
+    double           triangle_tolerance;
+    double           maxratio;
+    triangle_mode_e  triangle_mode;
+    size_t           k;
+    triangle_table_t triangles;
+} xyxymatch_ref_t;
+
+/**
+Simply mark an xyxymatch_ref_t object as uninitialized.
+*/
+void
+xyxymatch_ref_new(
+        xyxymatch_ref_t* const r);
+
+/**
+Sort and cull a list of reference coordinates.
+
+@param r The object to initialize
+
+@param nref The number of reference coordinates
+
+@param ref Array of reference coordinates.  It is not copied, so it
+must outlive r.
+
+@param separation The minimum separation for objects in the reference
+coordinate list.  See xyxymatch.
+
+@param error
+
+@return Non-zero on error
+*/
+int
+xyxymatch_ref_init(
+        xyxymatch_ref_t* const r,
+        const size_t nref,
+        const coord_t* const ref /*[nref]*/,
+        const double separation,
+        stimage_error_t* const error);
+
+/**
+Build the grid used by the tolerance algorithm with the grid index.
+If tolerance is not positive, the tolerance is recorded but no grid is
+built.
+
+@param r An object initialized with xyxymatch_ref_init
+
+@param tolerance The matching tolerance in pixels
+
+@param error
+
+@return Non-zero on error
+*/
+int
+xyxymatch_ref_init_grid(
+        xyxymatch_ref_t* const r,
+        const double tolerance,
+        stimage_error_t* const error);
+
+/**
+Build the reference triangles used by the triangles algorithm.  The
+parameters have the same meaning as in xyxymatch.  If there are fewer
+than 3 unique reference coordinates, the parameters are recorded but
+no triangles are built.
+
+@param r An object initialized with xyxymatch_ref_init
+
+@param error
+
+@return Non-zero on error
+*/
+int
+xyxymatch_ref_init_triangles(
+        xyxymatch_ref_t* const r,
+        const size_t nmatch,
+        const double tolerance,
+        const double maxratio,
+        const triangle_mode_e triangle_mode,
+        const size_t k,
+        stimage_error_t* const error);
+
+/**
+Free the memory allocated in an xyxymatch_ref_t object.
+*/
+void
+xyxymatch_ref_free(
+        xyxymatch_ref_t* const r);
+
+/**
+The version of the format written by xyxymatch_ref_serialize.  It is
+increased whenever the layout changes, and buffers written with any
+other version are rejected by xyxymatch_ref_deserialize.
+*/
+#define XYXYMATCH_REF_FORMAT_VERSION 4
+
+/**
+Return the size in bytes of the buffer needed by
+xyxymatch_ref_serialize.
+*/
+size_t
+xyxymatch_ref_serialized_size(
+        const xyxymatch_ref_t* const r);
+
+/**
+Write a prepared list of reference coordinates to a flat buffer, so it
+can be saved to a file and shared between processes.
+
+The buffer contains a header, the reference coordinates, the sorted
+order of the reference coordinates and the reference triangles.  The
+sorted order is stored as 8-byte indices into the reference
+coordinates rather than as pointers, so the buffer may be loaded at
+any address.  The triangles are stored as the columns of their
+triangle_table_t, just as they are held in memory, with the vertices
+as 32-bit indices into the sorted order.  All values are stored in
+the native byte order.  The grid is not stored, since it is cheap to
+rebuild.
+
+@param r An object initialized with xyxymatch_ref_init
+
+@param size The size of buffer, which must be at least
+xyxymatch_ref_serialized_size(r)
+
+@param buffer The buffer to write to.  It must be aligned to 8 bytes.
+
+@param error
+
+@return Non-zero on error
+*/
+int
+xyxymatch_ref_serialize(
+        const xyxymatch_ref_t* const r,
+        const size_t size,
+        void* const buffer,
+        stimage_error_t* const error);
+
+/**
+Load a prepared list of reference coordinates from a buffer written by
+xyxymatch_ref_serialize.
+
+Neither the reference coordinates nor the triangles are copied:
+r->ref and the columns of r->triangles point into buffer, which must
+outlive r.  This allows buffer to be a read-only memory mapping of a
+file shared between processes.  Only the sorted order is converted
+back to pointers, taking 8 bytes per reference coordinate, and the
+grid, if there was one, is rebuilt.
+
+The buffer is checked for the format version, the byte order, a
+checksum and consistency, so a truncated or corrupt buffer results in
+an error.
+
+@param r An object initialized with xyxymatch_ref_new
+
+@param size The size of buffer
+
+@param buffer The buffer to read from.  It must be aligned to 8 bytes.
+
+@param error
+
+@return Non-zero on error
+*/
+int
+xyxymatch_ref_deserialize(
+        xyxymatch_ref_t* const r,
+        const size_t size,
+        const void* const buffer,
+        stimage_error_t* const error);
+
+/**
+Same as xyxymatch, but matches against a prepared list of reference
+coordinates.  The separation parameter only applies to the input
+coordinates: the reference coordinates were culled by
+xyxymatch_ref_init.
+
+xyxymatch(..., nref, ref, ..., separation, ...) is the same as
+calling xyxymatch_prepared with an object initialized by
+xyxymatch_ref_init(r, nref, ref, separation, error).
+
+@return Non-zero on error
+ */
+int
+xyxymatch_prepared(
+    const size_t ninput, const coord_t* const input /*[ninput]*/,
+    const xyxymatch_ref_t* const ref,
+    size_t* noutput, xyxymatch_output_t* const output /*[noutput]*/,
+    const coord_t* const origin,
+    const coord_t* const mag,
+    const coord_t* const rotation,
+    const coord_t* const ref_origin,
+    const xyxymatch_algo_e algorithm,
+    const double tolerance,
+    const double separation,
+    const size_t nmatch,
+    const double maxratio,
+    const size_t nreject,
+    const xyxymatch_options_t* const options,
+    stimage_error_t* const error);
+
+/**
+Same as xyxymatch_prepared, but reads the input coordinates in place
+through a view.
+
+@return Non-zero on error
+ */
+int
+xyxymatch_prepared_view(
+    const coord_view_t* const input,
+    const xyxymatch_ref_t* const ref,
+    size_t* noutput, xyxymatch_output_t* const output /*[noutput]*/,
+    const coord_t* const origin,
+    const coord_t* const mag,
+    const coord_t* const rotation,
+    const coord_t* const ref_origin,
+    const xyxymatch_algo_e algorithm,
+    const double tolerance,
+    const double separation,
+    const size_t nmatch,
+    const double maxratio,
+    const size_t nreject,
+    const xyxymatch_options_t* const options,
+    stimage_error_t* const error);
+
+void
+xyxymatch_indices_new(
+        xyxymatch_indices_t* const m);
+
+void
+xyxymatch_indices_free(
+        xyxymatch_indices_t* const m);
+
+/**
+Same as xyxymatch_view, but only stores the indices of the matches in
+matches, growing it as needed.  Any matches already in it are
+discarded, but its memory is reused.
+
+@return Non-zero on error
+ */
+int
+xyxymatch_indices(
+    const coord_view_t* const input,
+    const coord_view_t* const ref,
+    xyxymatch_indices_t* const matches,
+    const coord_t* const origin,
+    const coord_t* const mag,
+    const coord_t* const rotation,
+    const coord_t* const ref_origin,
+    const xyxymatch_algo_e algorithm,
+    const double tolerance,
+    const double separation,
+    const size_t nmatch,
+    const double maxratio,
+    const size_t nreject,
+    const xyxymatch_options_t* const options,
+    stimage_error_t* const error);
+
+/**
+Same as xyxymatch_prepared_view, but only stores the indices of the
+matches in matches, growing it as needed.
+
+@return Non-zero on error
+ */
+int
+xyxymatch_prepared_indices(
+    const coord_view_t* const input,
+    const xyxymatch_ref_t* const ref,
+    xyxymatch_indices_t* const matches,
+    const coord_t* const origin,
+    const coord_t* const mag,
+    const coord_t* const rotation,
+    const coord_t* const ref_origin,
+    const xyxymatch_algo_e algorithm,
+    const double tolerance,
+    const double separation,
+    const size_t nmatch,
+    const double maxratio,
+    const size_t nreject,
+    const xyxymatch_options_t* const options,
+    stimage_error_t* const error);
+
+/**
+Called by xyxymatch_tiled with the matches found in each tile.
+
+@param data Whatever sink_data was passed to xyxymatch_tiled
+
+@param nmatches The number of matches
+
+@param matches The matches.  This memory is reused for the next tile,
+       so it must be copied to be kept.
+
+@param error Set to a meaningful message if an error occurred.
+
+@return Non-zero on error, which stops xyxymatch_tiled
+*/
+typedef int (xyxymatch_sink_t)(
+        void* data,
+        size_t nmatches,
+        const xyxymatch_output_t* matches,
+        stimage_error_t* error);
+
+/**
+Match lists of coordinates too large to be matched at once, with the
+tolerance algorithm, in bounded memory.
+
+The bounding box of the reference coordinates is divided into square
+tiles of side tile_size.  Each tile collects the reference
+coordinates and the transformed input coordinates that lie within it
+or within a halo of tolerance + separation around it, and matches
+them as xyxymatch would.  Only the matches to reference coordinates
+inside the tile are kept, so each reference coordinate is matched by
+exactly one tile, and the halo lets it match (or be culled by) a
+coordinate across the edge.
+
+The input and reference coordinates are read through views, so they
+may be memory-mapped files: they are read once to count the
+coordinates each tile collects, and then once for each batch of
+consecutive tiles that together collect at most max_coords
+coordinates (or for each tile that collects more by itself).  Only
+one batch is held in memory at a time, and its tiles are matched in
+parallel.  The matches are passed to sink one tile at a time, in
+row-major order of the tiles, from the calling thread.
+
+The matches are the same as those of xyxymatch with the tolerance
+algorithm, except in their order, and except that culling by
+separation only looks as far as the halo: a chain of coordinates each
+within separation of the next that crosses from the halo into the
+tile may be culled differently.  With a separation of 0 the matches
+are always the same.  Coordinates that are not finite are ignored.
+
+@param tile_size The width and height of the tiles, in reference
+       pixels.  It should be much larger than tolerance + separation.
+
+@param max_coords The most coordinates to hold in memory at once
+
+@param nthreads The number of threads used to match the tiles of a
+       batch.  If 0, the number of processors is used.
+
+@param sink Called with the matches found in each tile
+
+@param sink_data Passed to sink
+
+The other parameters are the same as for xyxymatch.
+
+@return Non-zero on error
+*/
+int
+xyxymatch_tiled(
+    const coord_view_t* const input,
+    const coord_view_t* const ref,
+    const coord_t* const origin,
+    const coord_t* const mag,
+    const coord_t* const rotation,
+    const coord_t* const ref_origin,
+    const double tolerance,
+    const double separation,
+    const double tile_size,
+    const size_t max_coords,
+    const size_t nthreads,
+    const xyxymatch_options_t* const options,
+    xyxymatch_sink_t* sink,
+    void* sink_data,
     stimage_error_t* const error);
 
 #endif /* _STIMAGE_XYXYMATCH_H_ */
@@ -0,0 +1,128 @@
+/*
+Copyright (C) 2008-2025 Association of Universities for Research in Astronomy (AURA)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above
+      copyright notice, this list of conditions and the following
+      disclaimer in the documentation and/or other materials provided
+      with the distribution.
+
+    3. The name of AURA and its representatives may not be used to
+      endorse or promote products derived from this software without
+      specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY AURA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL AURA BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+*/
+
+#ifndef _STIMAGE_COORD_VIEW_H_
+#define _STIMAGE_COORD_VIEW_H_
+
+#include <stddef.h>
+
+#include "lib/util.h"
+
+typedef enum {
+    coord_view_float64,
+    coord_view_float32,
+    coord_view_LAST
+} coord_view_type_e;
+
+/*
+A read-only view of a list of coordinates stored in someone else's
+memory, such as two columns of a table.  The x and y values may be
+double or single precision, in either byte order, and each may have
+its own stride, so the coordinates can be read in place instead of
+being copied into a coord_t array first.
+*/
+typedef struct {
+    size_t            n;
+    const char*       x;       /* address of the first x value */
+    const char*       y;       /* address of the first y value */
+    ptrdiff_t         xstride; /* bytes between x values */
+    ptrdiff_t         ystride; /* bytes between y values */
+    coord_view_type_e type;
+    int               swap;    /* non-zero if not in native byte order */
+} coord_view_t;
+
+/**
+Initialize a view of a coord_t array.
+*/
+void
+coord_view_init(
+        coord_view_t* const v,
+        const size_t n,
+        const coord_t* const coords /* [n] */);
+
+/**
+Initialize a view of separate x and y columns.
+
+@param v The view
+
+@param n The number of coordinates
+
+@param type The type of both columns
+
+@param swap Non-zero if the values are not in native byte order
+
+@param x The first x value
+
+@param xstride The distance between x values, in bytes
+
+@param y The first y value
+
+@param ystride The distance between y values, in bytes
+*/
+void
+coord_view_init_columns(
+        coord_view_t* const v,
+        const size_t n,
+        const coord_view_type_e type,
+        const int swap,
+        const void* const x,
+        const ptrdiff_t xstride,
+        const void* const y,
+        const ptrdiff_t ystride);
+
+/**
+If the view is of a coord_t array, return the array, so it can be
+used without copying.  Otherwise return NULL.
+*/
+const coord_t*
+coord_view_packed(
+        const coord_view_t* const v);
+
+/**
+Return the ith coordinate.
+*/
+coord_t
+coord_view_get(
+        const coord_view_t* const v,
+        const size_t i);
+
+/**
+Copy the coordinates [start, start + n) into a coord_t array.
+*/
+void
+coord_view_gather(
+        const coord_view_t* const v,
+        const size_t start,
+        const size_t n,
+        /* Output */
+        coord_t* const coords /* [n] */);
+
+#endif /* _STIMAGE_COORD_VIEW_H_ */
@@ -86,4 +86,47 @@ apply_lintransform(
     const coord_t* const input, /* [ncoords] */
     coord_t* output);
 
+/**
+Combine two linear transformations into one.
+
+@param first The transformation applied first
+
+@param second The transformation applied to the result of first
+
+@param coeffs The output set of coefficients, which maps a coordinate
+as second would map its image through first.  May be equal to either
+input.
+*/
+void
+compose_lintransform(
+    const lintransform_t* const first,
+    const lintransform_t* const second,
+    lintransform_t* coeffs);
+
+/**
+Compute the linear transformation that best maps one list of
+coordinates onto another, in the least squares sense.  All six
+coefficients are fit, so the transformation may include shifts,
+scales, rotations and skew.
+
+@param ncoords The number of coordinate pairs.  Must be at least 3.
+
+@param input The coordinates to be transformed
+
+@param ref The coordinates they should be transformed onto
+
+@param coeffs The output set of coefficients
+
+@param error Set if the coordinates are too few or collinear
+
+@return Non-zero on error
+*/
+int
+fit_lintransform(
+    const size_t ncoords,
+    const coord_t* const input, /* [ncoords] */
+    const coord_t* const ref, /* [ncoords] */
+    lintransform_t* coeffs,
+    stimage_error_t* const error);
+
 #endif /* _STIMAGE_LINTRANSFORM_H_ */
@@ -0,0 +1,90 @@
+/*
+Copyright (C) 2008-2025 Association of Universities for Research in Astronomy (AURA)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above
+      copyright notice, this list of conditions and the following
+      disclaimer in the documentation and/or other materials provided
+      with the distribution.
+
+    3. The name of AURA and its representatives may not be used to
+      endorse or promote products derived from this software without
+      specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY AURA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL AURA BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+*/
+
+#ifndef _STIMAGE_PARALLEL_H_
+#define _STIMAGE_PARALLEL_H_
+
+#include "lib/util.h"
+
+/**
+A task run by parallel_for.
+
+@param data Whatever data was passed to parallel_for
+
+@param index The index of the task, in the range [0, ntasks)
+
+@param error Set to a meaningful message if an error occurred.  Each
+thread has its own error object.
+
+@return Non-zero on error
+*/
+typedef int (parallel_task_t)(void* data, size_t index, stimage_error_t* error);
+
+/**
+Return the number of processors available, or 1 if it can not be
+determined.
+*/
+size_t
+parallel_ncpus(void);
+
+/**
+Run ntasks tasks on a pool of native threads.  The tasks are handed
+out to the threads in increasing order of index, but may complete in
+any order, so each task should only write to its own part of data.
+The library functions called by the tasks are reentrant.
+
+If any task fails, no more tasks are started, the error message from
+the first failing task is copied to error and a non-zero value is
+returned.
+
+@param ntasks The number of tasks
+
+@param nthreads The number of threads.  If 0, the number of
+processors is used.  No more threads than tasks are started, and if
+only one thread would be used the tasks are run in the calling thread.
+
+@param task The function to run for each task
+
+@param data Passed to each task
+
+@param error
+
+@return Non-zero on error
+*/
+int
+parallel_for(
+        const size_t ntasks,
+        const size_t nthreads,
+        parallel_task_t* task,
+        void* data,
+        stimage_error_t* const error);
+
+#endif /* _STIMAGE_PARALLEL_H_ */
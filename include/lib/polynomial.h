@@ -33,6 +33,7 @@ DAMAGE.
 #define _STIMAGE_POLYNOMIAL_H_
 
 #include "lib/util.h"
+#include "lib/workspace.h"
 
 /* was tgs_1devpoly */
 
@@ -49,6 +50,8 @@ Evaluate a 1D polynomial
 
 @param ref The reference points (length ncoord)
 
+@param workspace Scratch memory, or NULL to allocate it
+
 @param zfit The fitted values (length ncoord)
 
 @param error
@@ -62,6 +65,7 @@ eval_1dpoly(
         const size_t ncoord,
         const size_t axis,
         const coord_t* const ref,
+        workspace_t* const workspace,
         /* Output */
         double* const zfit,
         stimage_error_t* const error);
@@ -86,6 +90,8 @@ have been calculated.
 
 @param k2 Normalizing constant
 
+@param workspace Scratch memory, or NULL to allocate it
+
 @param zfit The fitted values (length ncoord)
 
 @param error
@@ -101,6 +107,7 @@ eval_1dchebyshev(
         const coord_t* const ref,
         const double k1,
         const double k2,
+        workspace_t* const workspace,
         /* Output */
         double* const zfit,
         stimage_error_t* const error);
@@ -123,6 +130,8 @@ have been calculated.
 
 @param k2 Normalizing constant
 
+@param workspace Scratch memory, or NULL to allocate it
+
 @param zfit The fitted values (length ncoord)
 
 @param error
@@ -138,6 +147,7 @@ eval_1dlegendre(
         const coord_t* const ref,
         const double k1,
         const double k2,
+        workspace_t* const workspace,
         /* Output */
         double* const zfit,
         stimage_error_t* const error);
@@ -167,6 +177,8 @@ Evaluate a polynomial.
 
 @param k2y Normalizing constant
 
+@param workspace Scratch memory, or NULL to allocate it
+
 @param zfit The fitted points
 
 @param error
@@ -185,6 +197,7 @@ eval_poly(
         const double k2x,
         const double k1y,
         const double k2y,
+        workspace_t* const workspace,
         /* Output */
         double* const zfit,
         stimage_error_t* const error);
@@ -215,6 +228,8 @@ been calculated.
 
 @param k2y Normalizing constant
 
+@param workspace Scratch memory, or NULL to allocate it
+
 @param zfit The fitted points
 
 @param error
@@ -233,6 +248,7 @@ eval_chebyshev(
         const double k2x,
         const double k1y,
         const double k2y,
+        workspace_t* const workspace,
         /* Output */
         double* const zfit,
         stimage_error_t* const error);
@@ -261,6 +277,8 @@ been calculated.
 
 @param k2y Normalizing constant
 
+@param workspace Scratch memory, or NULL to allocate it
+
 @param zfit The fitted points
 
 @param error
@@ -279,10 +297,33 @@ eval_legendre(
         const double k2x,
         const double k1y,
         const double k2y,
+        workspace_t* const workspace,
         /* Output */
         double* const zfit,
         stimage_error_t* const error);
 
+/**
+Evaluate the basis functions of a polynomial.  k1 and k2 are ignored.
+
+@param ncoord Number of points to be evaluated
+
+@param axis The axis number to use (0 = x, 1 = y)
+
+@param ref The reference points (length ncoord)
+
+@param order Order of the polynomial, 1 = constant
+
+@param k1 Normalizing constant
+
+@param k2 Normalizing constant
+
+@param basis The basis functions (length order * ncoord).  The values
+of the kth basis function are in basis[k * ncoord ... (k + 1) * ncoord]
+
+@param error
+
+@return non-zero on failure
+ */
 int
 basis_poly(
         const size_t ncoord,
@@ -294,6 +335,10 @@ basis_poly(
         double* const basis,
         stimage_error_t* const error);
 
+/**
+Evaluate the basis functions of a Chebyshev polynomial, with the same
+arguments as basis_poly.
+ */
 int
 basis_chebyshev(
         const size_t ncoord,
@@ -305,6 +350,10 @@ basis_chebyshev(
         double* const basis,
         stimage_error_t* const error);
 
+/**
+Evaluate the basis functions of a Legendre polynomial, with the same
+arguments as basis_poly.
+ */
 int
 basis_legendre(
         const size_t ncoord,
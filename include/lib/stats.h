@@ -0,0 +1,164 @@
+/*
+Copyright (C) 2008-2025 Association of Universities for Research in Astronomy (AURA)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above
+      copyright notice, this list of conditions and the following
+      disclaimer in the documentation and/or other materials provided
+      with the distribution.
+
+    3. The name of AURA and its representatives may not be used to
+      endorse or promote products derived from this software without
+      specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY AURA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL AURA BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+*/
+
+#ifndef _STIMAGE_STATS_H_
+#define _STIMAGE_STATS_H_
+
+#include "lib/util.h"
+
+/**
+Opt-in timings and counters of the stages of xyxymatch and geomap.
+
+Each statistic is named "stage.counter", such as "find_triangles.kept",
+and the wall time spent in a stage is named "stage.time".  Recording
+a time or a count under the same name again adds to its value, so a
+stage that runs several times reports its total, while a maximum
+keeps the largest value recorded.
+
+Every function that records statistics takes a stimage_stats_t
+pointer, which may be NULL, in which case nothing is recorded and the
+clock is not read.
+*/
+
+typedef enum {
+    stimage_stat_time,
+    stimage_stat_count,
+    stimage_stat_max
+} stimage_stat_kind_e;
+
+typedef struct {
+    const char*         name;  /* A string literal, not copied */
+    stimage_stat_kind_e kind;
+    double              value; /* Seconds for stimage_stat_time */
+} stimage_stat_t;
+
+/* Statistics beyond this number are silently dropped */
+#define STIMAGE_STATS_MAX 64
+
+typedef struct {
+    size_t         nstats;
+    stimage_stat_t stats[STIMAGE_STATS_MAX];
+} stimage_stats_t;
+
+/**
+Initialize a stimage_stats_t object with no statistics.
+*/
+void
+stimage_stats_init(
+        stimage_stats_t* const s);
+
+/**
+Return the time in seconds from a monotonic clock.
+*/
+double
+stimage_stats_clock(void);
+
+/**
+Add value to the statistic called name, or for stimage_stat_max keep
+the larger of the two, creating it if it does not exist yet.
+*/
+void
+stimage_stats_add(
+        stimage_stats_t* const s,
+        const char* const name,
+        const stimage_stat_kind_e kind,
+        const double value);
+
+/**
+Return the value of the statistic called name, or 0 if it has not
+been recorded.
+*/
+double
+stimage_stats_get(
+        const stimage_stats_t* const s,
+        const char* const name);
+
+/**
+Add each statistic of src to dst, as stimage_stats_add would.  This
+gathers the statistics of stages that ran on separate threads, each
+with its own object.
+*/
+void
+stimage_stats_merge(
+        stimage_stats_t* const dst,
+        const stimage_stats_t* const src);
+
+/**
+Return the start time of a stage, to be passed to stimage_stats_stop,
+or 0 if s is NULL.
+*/
+static inline double
+stimage_stats_start(
+        const stimage_stats_t* const s) {
+    return (s != NULL) ? stimage_stats_clock() : 0.0;
+}
+
+/**
+Add the time since start to the statistic called name.
+*/
+static inline void
+stimage_stats_stop(
+        stimage_stats_t* const s,
+        const char* const name,
+        const double start) {
+    if (s != NULL) {
+        stimage_stats_add(
+                s, name, stimage_stat_time, stimage_stats_clock() - start);
+    }
+}
+
+/**
+Add n to the counter called name.
+*/
+static inline void
+stimage_stats_count(
+        stimage_stats_t* const s,
+        const char* const name,
+        const double n) {
+    if (s != NULL) {
+        stimage_stats_add(s, name, stimage_stat_count, n);
+    }
+}
+
+/**
+Record n in the maximum called name.
+*/
+static inline void
+stimage_stats_max(
+        stimage_stats_t* const s,
+        const char* const name,
+        const double n) {
+    if (s != NULL) {
+        stimage_stats_add(s, name, stimage_stat_max, n);
+    }
+}
+
+#endif /* _STIMAGE_STATS_H_ */
@@ -155,6 +155,16 @@ calloc_with_error(
         size_t size,
         stimage_error_t* error);
 
+/**
+Like realloc, but sets error on failure.  ptr is left alone when NULL
+is returned.
+*/
+void *
+realloc_with_error(
+        void* ptr,
+        size_t size,
+        stimage_error_t* error);
+
 /**
 Compute the factorial of n.
 
@@ -0,0 +1,93 @@
+/*
+Copyright (C) 2008-2025 Association of Universities for Research in Astronomy (AURA)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above
+      copyright notice, this list of conditions and the following
+      disclaimer in the documentation and/or other materials provided
+      with the distribution.
+
+    3. The name of AURA and its representatives may not be used to
+      endorse or promote products derived from this software without
+      specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY AURA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL AURA BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+*/
+
+#ifndef _STIMAGE_WORKSPACE_H_
+#define _STIMAGE_WORKSPACE_H_
+
+#include "lib/util.h"
+
+/**
+Scratch memory that can be kept between calls, so that repeated fits
+and evaluations do not allocate their temporary arrays every time.
+
+Memory is handed out from the front of the buffer by workspace_alloc.
+A function using a workspace records used on entry, reserves all the
+memory it needs with workspace_reserve before taking any of it, and
+sets used back to the recorded value when it is done.
+*/
+typedef struct {
+    size_t  size;   /* doubles allocated */
+    size_t  used;   /* doubles handed out */
+    double* buffer; /* [size] */
+} workspace_t;
+
+/**
+ Simply mark a workspace object as uninitialized.
+*/
+void
+workspace_new(
+        workspace_t* const w);
+
+/**
+Make sure that at least size more doubles can be handed out.  The
+buffer may be moved, so this must be called before any of the memory
+in use by the caller was handed out.
+
+@param w The workspace
+
+@param size The number of doubles
+
+@param error
+
+@return Non-zero on error
+*/
+int
+workspace_reserve(
+        workspace_t* const w,
+        const size_t size,
+        stimage_error_t* const error);
+
+/**
+Hand out size doubles of reserved memory.
+*/
+double*
+workspace_alloc(
+        workspace_t* const w,
+        const size_t size);
+
+/**
+Free the allocated memory in a workspace object.
+*/
+void
+workspace_free(
+        workspace_t* const w);
+
+#endif /* _STIMAGE_WORKSPACE_H_ */
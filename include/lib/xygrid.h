@@ -0,0 +1,118 @@
+/*
+Copyright (C) 2008-2025 Association of Universities for Research in Astronomy (AURA)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above
+      copyright notice, this list of conditions and the following
+      disclaimer in the documentation and/or other materials provided
+      with the distribution.
+
+    3. The name of AURA and its representatives may not be used to
+      endorse or promote products derived from this software without
+      specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY AURA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL AURA BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+*/
+
+#ifndef _STIMAGE_XYGRID_H_
+#define _STIMAGE_XYGRID_H_
+
+#include "lib/util.h"
+#include "lib/xybbox.h"
+
+/**
+A uniform grid over a list of coordinates, used as a spatial index.
+
+The coordinates are bucketed into square cells of size cell_size.
+The positions (in the coordinate list the grid was built from) of the
+coordinates in cell (ix, iy) are stored in
+
+    items[cell_start[iy * nx + ix] ... cell_start[iy * nx + ix + 1]]
+
+in increasing order.
+*/
+typedef struct {
+    bbox_t  bbox;
+    double  cell_size;
+    size_t  nx;
+    size_t  ny;
+    size_t* cell_start; /* [nx * ny + 1] */
+    size_t* items;      /* [ncoords] */
+    size_t  nitems;
+} xygrid_t;
+
+/**
+ Simply mark a grid object as uninitialized.
+*/
+void
+xygrid_new(
+        xygrid_t* const g);
+
+/**
+Build a grid over a list of coordinates.
+
+@param g The grid to initialize
+
+@param ncoords The number of coordinates
+
+@param coords A list of pointers to coordinates.  Non-finite
+coordinates are not added to the grid.
+
+@param cell_size The requested size of the cells.  The cells will be
+made larger if necessary to keep the number of cells proportional to
+the number of coordinates.
+
+@param error
+
+@return Non-zero on error
+*/
+int
+xygrid_init(
+        xygrid_t* const g,
+        const size_t ncoords,
+        const coord_t* const * const coords, /* [ncoords] */
+        const double cell_size,
+        stimage_error_t* const error);
+
+/**
+Free the allocated memory in a grid object.
+*/
+void
+xygrid_free(
+        xygrid_t* const g);
+
+/**
+Determine the range of cells that may contain coordinates within
+radius of center (in each axis).  The range is conservative: it
+allows for rounding in the computation of the cell indices.
+
+@return Zero if no cells are in range, in which case the output
+values are undefined.
+*/
+int
+xygrid_cell_range(
+        const xygrid_t* const g,
+        const coord_t* const center,
+        const double radius,
+        /* Output */
+        size_t* const x0,
+        size_t* const y0,
+        size_t* const x1,
+        size_t* const y1);
+
+#endif /* _STIMAGE_XYGRID_H_ */
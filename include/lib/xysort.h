@@ -39,7 +39,8 @@ DAMAGE.
 #include "lib/util.h"
 
 /*
-Sorts coordinates by (y, x).
+Sorts coordinates by (y, x).  Coordinates with equal x and y are kept
+in the order of their indices.
 
 Returns a list of sorted pointers to coordinates.
 
@@ -55,4 +56,28 @@ xysort(
     const coord_t* const coords, /* [ncoords] */
     const coord_t** const coord_ptr /* [ncoords] */);
 
+/*
+Sorts coordinates by (y, x), in the same order as xysort, but returns
+the sorted order as a permutation of indices into coords.
+
+Long lists are radix sorted on y, so the cost is linear in the number
+of coordinates, and only runs of equal y are sorted on x.
+
+@param ncoords The number of coordinates in the input array
+
+@param coords Input array
+
+@param perm Output array of indices into coords, in sorted order
+
+@param error
+
+@return Non-zero on error
+ */
+int
+xysort_permutation(
+    const size_t ncoords,
+    const coord_t* const coords, /* [ncoords] */
+    size_t* const perm, /* [ncoords] */
+    stimage_error_t* const error);
+
 #endif /* _STIMAGE_XYSORT_H_ */
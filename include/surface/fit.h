@@ -53,6 +53,19 @@ typedef enum {
     surface_fit_weight_LAST
 } surface_fit_weight_e;
 
+/**
+The basis functions of a surface evaluated at a set of points, kept
+so that the surface can be refit to the same points with different
+weights without evaluating them again.
+*/
+typedef struct {
+    size_t  ncoord;
+    size_t  xorder;
+    size_t  yorder;
+    double* xbasis; /* [xorder * ncoord] */
+    double* ybasis; /* [yorder * ncoord] */
+} surface_basis_t;
+
 /* was: dgsfit */
 
 /**
@@ -77,6 +90,8 @@ used to solve for the s->ncoeff-vector coeff.
 
 @param weight_type type of weights
 
+@param nthreads The number of threads, as for surface_fit_add_points
+
 @param error_type
 
 @param error
@@ -89,6 +104,181 @@ surface_fit(
         const double* const z,
         double* const w,
         const surface_fit_weight_e weight_type,
+        const size_t nthreads,
+        /* Output */
+        surface_fit_error_e* const error_type,
+        stimage_error_t* const error);
+
+/* was: dgsacpts */
+
+/**
+Accumulate a set of data points into the normal equations of a
+surface, in accumulate mode.  The surface must have been zeroed with
+surface_zero first.  May be called several times to fit more points
+than fit in memory at once, followed by surface_fit_solve.
+
+@param s Surface descriptor
+
+@param ncoord Number of data points
+
+@param coord Data points
+
+@param z data array
+
+@param w weights array.  Filled in unless weight_type is
+       surface_fit_weight_user.
+
+@param weight_type type of weights
+
+@param nthreads The number of threads the points are accumulated on.
+       If 0, the number of processors is used.  Many points are split
+       into chunks that only depend on ncoord, and the partial sums of
+       the chunks are added in order, so the result does not depend on
+       nthreads.
+
+@param error
+*/
+int
+surface_fit_add_points(
+        surface_t* const s,
+        const size_t ncoord,
+        const coord_t* const coord,
+        const double* const z,
+        double* const w,
+        const surface_fit_weight_e weight_type,
+        const size_t nthreads,
+        stimage_error_t* const error);
+
+/**
+Solve the normal equations accumulated by surface_fit_add_points for
+the coefficients of the surface.
+
+@param s Surface descriptor
+
+@param error_type
+
+@param error
+*/
+int
+surface_fit_solve(
+        surface_t* const s,
+        /* Output */
+        surface_fit_error_e* const error_type,
+        stimage_error_t* const error);
+
+/**
+Accumulate the inner products of the basis functions of a surface and
+a data array into vector, without touching the normal equations of
+the surface.  This is used to project one fit onto the basis of
+another.
+
+@param s Surface descriptor
+
+@param ncoord Number of data points
+
+@param coord Data points
+
+@param z data array
+
+@param w weights array
+
+@param vector The s->ncoeff vector to accumulate into
+
+@param error
+*/
+int
+surface_fit_add_vector(
+        const surface_t* const s,
+        const size_t ncoord,
+        const coord_t* const coord,
+        const double* const z,
+        const double* const w,
+        /* Input/Output */
+        double* const vector,
+        stimage_error_t* const error);
+
+/**
+Add the normal equations accumulated in other to those of s.  Both
+must be the same kind of surface on the same bounding box.
+
+@param s Surface descriptor
+
+@param other Surface descriptor holding the partial sums to add
+
+@param error
+*/
+int
+surface_fit_merge(
+        surface_t* const s,
+        const surface_t* const other,
+        stimage_error_t* const error);
+
+/**
+Simply mark a surface_basis_t object as uninitialized.
+*/
+void
+surface_basis_new(
+        surface_basis_t* const b);
+
+/**
+Evaluate the basis functions of a surface at a set of points.
+
+@param b The basis object to fill
+
+@param s Surface descriptor
+
+@param ncoord Number of data points
+
+@param coord Data points
+
+@param error
+*/
+int
+surface_basis_init(
+        surface_basis_t* const b,
+        const surface_t* const s,
+        const size_t ncoord,
+        const coord_t* const coord,
+        stimage_error_t* const error);
+
+/**
+Free the allocated memory in a surface_basis_t object.
+*/
+void
+surface_basis_free(
+        surface_basis_t* const b);
+
+/**
+Refit a surface to the same points with new weights.  s must hold the
+normal equations of a fit to the points in basis with weights w_old
+(by surface_fit or an earlier call to this function).  Only the
+contributions of the points whose weight changed are updated in the
+matrix, so rejecting a few points from a large fit costs little more
+than accumulating the vector.  If more than half of the total weight
+changed, the matrix is accumulated again instead, to avoid losing
+precision.
+
+@param s Surface descriptor
+
+@param basis The basis functions at the points of the fit
+
+@param z data array
+
+@param w_old weights of the previous fit
+
+@param w new weights array
+
+@param error_type
+
+@param error
+*/
+int
+surface_fit_reweight(
+        surface_t* const s,
+        const surface_basis_t* const basis,
+        const double* const z,
+        const double* const w_old,
+        const double* const w,
         /* Output */
         surface_fit_error_e* const error_type,
         stimage_error_t* const error);
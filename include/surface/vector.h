@@ -37,17 +37,58 @@ DAMAGE.
 #define _STIMAGE_SURFACE_VECTOR_H_
 
 #include "surface.h"
+#include "lib/workspace.h"
 
 /*
   was dgsvector
 
-Evaluate the fitted surface at an array of points.
+Evaluate the fitted surface at an array of points.  Many points are
+split into chunks that are evaluated on nthreads threads, or on every
+processor if nthreads is 0.
 */
 int
 surface_vector(
         const surface_t* const s,
         const size_t ncoord,
         const coord_t* const ref,
+        const size_t nthreads,
+        /* Output */
+        double* const zfit,
+        stimage_error_t* const error);
+
+/*
+Evaluate the fitted surface at an array of points, taking the scratch
+memory from workspace.
+*/
+int
+surface_vector_workspace(
+        const surface_t* const s,
+        const size_t ncoord,
+        const coord_t* const ref,
+        workspace_t* const workspace,
+        /* Output */
+        double* const zfit,
+        stimage_error_t* const error);
+
+/*
+Evaluate the fitted surface on the grid of points (x[i], y[j]).  The
+basis functions are separable, so they are evaluated once per column
+and once per row, and each row of the grid is a combination of the
+column basis functions.
+
+The value at (x[i], y[j]) is stored in zfit[j * row_stride + i *
+col_stride], or added to it when accumulate is non-zero.
+*/
+int
+surface_grid(
+        const surface_t* const s,
+        const size_t nx,
+        const double* const x,
+        const size_t ny,
+        const double* const y,
+        const int accumulate,
+        const size_t row_stride,
+        const size_t col_stride,
         /* Output */
         double* const zfit,
         stimage_error_t* const error);
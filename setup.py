@@ -44,6 +44,7 @@ if sys.platform == 'win32':
 else:
     cfg['define_macros'].append(('NDEBUG', None))
     cfg['libraries'].append('m')
+    cfg['libraries'].append('pthread')
     cfg['extra_compile_args'] += [
         '-Wall',
         '-Wextra',
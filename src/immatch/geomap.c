@@ -39,8 +39,10 @@ DAMAGE.
 #define _USE_MATH_DEFINES       /* needed for MS Windows to define M_PI */
 #include <math.h>
 #include <stdio.h>
+#include <string.h>
 
 #include "immatch/geomap.h"
+#include "lib/parallel.h"
 #include "lib/xybbox.h"
 #include "surface/fit.h"
 #include "surface/vector.h"
@@ -79,6 +81,12 @@ typedef struct {
     bbox_t  bbox;
     size_t  n_zero_weighted;
     size_t  ncoord;
+
+    /* The threads the surfaces are fit and evaluated on */
+    size_t nthreads;
+
+    /* Where the stages of the fit are recorded, or NULL */
+    stimage_stats_t* stats;
 } geomap_fit_t;
 
 /* was geo_minit */
@@ -119,6 +127,8 @@ geomap_fit_init(
     fit->reject  = reject;
     fit->nreject = 0;
     fit->rej     = NULL;
+    fit->nthreads = 1;
+    fit->stats   = NULL;
 
     fit->initialized = 1;
 }
@@ -142,40 +152,105 @@ geomap_fit_free(
 }
 #pragma GCC diagnostic pop
 
+/* Compute the weighted means and the centered cross products of the
+   reference and input coordinates */
 static void
-compute_sums(
+compute_moments(
         const size_t ncoord,
         const coord_t* const input,
         const coord_t* const ref,
         const double* const weights,
         /* Output */
-        double* const sw,
-        coord_t* const si,
-        coord_t* const sr) {
+        geomap_moments_t* const m) {
 
+    double v[4];
     size_t i = 0;
+    size_t k = 0;
+    size_t l = 0;
 
     assert(input);
     assert(ref);
     assert(weights);
-    assert(sw);
-    assert(si);
-    assert(sr);
-
-    *sw = 0.0;
-    si->x = 0.0;
-    si->y = 0.0;
-    sr->x = 0.0;
-    sr->y = 0.0;
+    assert(m);
+
+    memset(m, 0, sizeof(geomap_moments_t));
+
+    for (i = 0; i < ncoord; ++i) {
+        m->sw      += weights[i];
+        m->mean[0] += weights[i] * ref[i].x;
+        m->mean[1] += weights[i] * ref[i].y;
+        m->mean[2] += weights[i] * input[i].x;
+        m->mean[3] += weights[i] * input[i].y;
+    }
+
+    if (m->sw <= 0.0) {
+        memset(m->mean, 0, sizeof(m->mean));
+        return;
+    }
+
+    for (k = 0; k < 4; ++k) {
+        m->mean[k] /= m->sw;
+    }
+
     for (i = 0; i < ncoord; ++i) {
-        *sw   += weights[i];
-        si->x += weights[i] * input[i].x;
-        si->y += weights[i] * input[i].y;
-        sr->x += weights[i] * ref[i].x;
-        sr->y += weights[i] * ref[i].y;
+        v[0] = ref[i].x - m->mean[0];
+        v[1] = ref[i].y - m->mean[1];
+        v[2] = input[i].x - m->mean[2];
+        v[3] = input[i].y - m->mean[3];
+        for (k = 0; k < 4; ++k) {
+            for (l = k; l < 4; ++l) {
+                m->comoment[k][l] += weights[i] * v[k] * v[l];
+            }
+        }
+    }
+
+    for (k = 0; k < 4; ++k) {
+        for (l = 0; l < k; ++l) {
+            m->comoment[k][l] = m->comoment[l][k];
+        }
     }
 }
 
+/* Add the moments b of a set of points to the moments a of another */
+static void
+merge_moments(
+        geomap_moments_t* const a,
+        const geomap_moments_t* const b) {
+
+    double delta[4];
+    double sw = 0.0;
+    double f  = 0.0;
+    size_t k  = 0;
+    size_t l  = 0;
+
+    assert(a);
+    assert(b);
+
+    if (b->sw <= 0.0) {
+        return;
+    }
+
+    if (a->sw <= 0.0) {
+        *a = *b;
+        return;
+    }
+
+    sw = a->sw + b->sw;
+    f = a->sw * b->sw / sw;
+    for (k = 0; k < 4; ++k) {
+        delta[k] = b->mean[k] - a->mean[k];
+    }
+
+    for (k = 0; k < 4; ++k) {
+        for (l = 0; l < 4; ++l) {
+            a->comoment[k][l] += b->comoment[k][l] + f * delta[k] * delta[l];
+        }
+        a->mean[k] += delta[k] * b->sw / sw;
+    }
+
+    a->sw = sw;
+}
+
 static int
 compute_surface_coefficients(
         const surface_type_e function,
@@ -245,6 +320,7 @@ compute_residuals(
         const size_t ncoord,
         const coord_t* const input,
         const coord_t* const ref,
+        const size_t nthreads,
         /* Output */
         double* const residual_x,
         double* const residual_y,
@@ -260,9 +336,13 @@ compute_residuals(
     assert(residual_y);
     assert(error);
 
-    if (surface_vector(sx1, ncoord, ref, residual_x, error)) return 1;
+    if (surface_vector(sx1, ncoord, ref, nthreads, residual_x, error)) {
+        return 1;
+    }
 
-    if (surface_vector(sy1, ncoord, ref, residual_y, error)) return 1;
+    if (surface_vector(sy1, ncoord, ref, nthreads, residual_y, error)) {
+        return 1;
+    }
 
     for (i = 0; i < ncoord; ++i) {
         residual_x[i] = input[i].x - residual_x[i];
@@ -318,88 +398,80 @@ count_zero_weighted(
     return count;
 }
 
-/** DIFF: was geo_fthetad */
-
-/* Compute the shift and rotation angle required to match one set of
-   coordinates to another.  The result is stored in the fit
-   structure. */
-static int
-geo_fit_theta(
-        geomap_fit_t* const fit,
-        surface_t* const sx1,
-        surface_t* const sy1,
-        const size_t ncoord,
-        const coord_t* const input,
-        const coord_t* const ref,
-        const double* const weights,
+/* Compute the rotation and scale terms of a rotate, rscale or
+   rxyscale fit from the moments of the coordinates.  The x fit is
+   i0.x + cthetac.x * (xref - r0.x) + sthetac.x * (yref - r0.y), and
+   the y fit i0.y - sthetac.y * (xref - r0.x) + cthetac.y * (yref -
+   r0.y). */
+static void
+geo_rotation_coefficients(
+        const geomap_fit_e fit_geometry,
+        const geomap_moments_t* const m,
         /* Output */
-        double* const residual_x,
-        double* const residual_y,
-        stimage_error_t* error) {
-
-    bbox_t  bbox;
-    double  sw      = 0.0;
-    coord_t sr      = {0.0, 0.0};
-    coord_t si      = {0.0, 0.0};
-    coord_t r0      = {0.0, 0.0};
-    coord_t i0      = {0.0, 0.0};
-    double  syrxi   = 0.0;
-    double  sxryi   = 0.0;
-    double  sxrxi   = 0.0;
-    double  syryi   = 0.0;
-    double  num     = 0.0;
-    double  denom   = 0.0;
-    double  det     = 0.0;
-    double  theta   = 0.0;
-    double  ctheta  = 0.0;
-    double  stheta  = 0.0;
-    coord_t cthetac = {0.0, 0.0};
-    coord_t sthetac = {0.0, 0.0};
-    size_t  i       = 0;
-    int     status  = 1;
-
-    assert(fit);
-    assert(sx1);
-    assert(sy1);
-    assert(input);
-    assert(ref);
-    assert(weights);
-    assert(residual_x);
-    assert(residual_y);
-    assert(error);
+        coord_t* const cthetac,
+        coord_t* const sthetac) {
+
+    const double sxrxr = m->comoment[0][0];
+    const double syryr = m->comoment[1][1];
+    const double syrxi = m->comoment[1][2];
+    const double sxryi = m->comoment[0][3];
+    const double sxrxi = m->comoment[0][2];
+    const double syryi = m->comoment[1][3];
+    double       num   = 0.0;
+    double       denom = 0.0;
+    double       det   = 0.0;
+    double       theta = 0.0;
+    double       ctheta = 0.0;
+    double       stheta = 0.0;
+    double       mag   = 1.0;
+    double       xmag  = 0.0;
+    double       ymag  = 0.0;
+
+    assert(m);
+    assert(cthetac);
+    assert(sthetac);
 
-    surface_free(sx1);
-    surface_free(sy1);
+    if (fit_geometry == geomap_fit_rxyscale) {
+        /* Compute the rotation angle */
+        num = 2.0 * (sxrxr * syrxi * syryi - syryr * sxrxi * sxryi);
+        denom = syryr * (sxrxi - sxryi) * (sxrxi + sxryi) - \
+            sxrxr * (syrxi + syryi) * (syrxi - syryi);
+        if (double_approx_equal(num, 0.0) && double_approx_equal(denom, 0.0)) {
+            theta = 0.0;
+        } else {
+            theta = atan2(num, denom) / 2.0;
+            if (theta < 0.0) {
+                theta += M_PI * 2.0;
+            }
+        }
 
-    bbox_copy(&fit->bbox, &bbox);
-    bbox_make_nonsingular(&bbox);
+        ctheta = cos(theta);
+        stheta = sin(theta);
 
-    /* Compute the sums required to determine the offsets */
-    compute_sums(ncoord, input, ref, weights, &sw, &si, &sr);
+        /* Compute the X magnification factor */
+        num = sxrxi * ctheta - sxryi * stheta;
+        denom = sxrxr;
+        if (denom <= 0.0) {
+            xmag = 1.0;
+        } else {
+            xmag = num / denom;
+        }
 
-    /* Do the fit */
-    if (sw < 2.0) {
-        if (fit->projection == geomap_proj_none) {
-            stimage_error_set_message(
-                    error, "Too few data points for X and Y fits.");
-            goto exit;
+        /* Compute the Y magnification factor */
+        num = syrxi * stheta + syryi * ctheta;
+        denom = syryr;
+        if (denom <= 0.0) {
+            ymag = 1.0;
         } else {
-            stimage_error_set_message(
-                    error, "Too few data points for XI and ETA fits.");
-            goto exit;
+            ymag = num / denom;
         }
-    }
 
-    /* Compute the sums required to compute the rotation angle */
-    r0.x = sr.x / sw;
-    r0.y = sr.y / sw;
-    i0.x = si.x / sw;
-    i0.y = si.y / sw;
-    for (i = 0; i < ncoord; ++i) {
-        syrxi += weights[i] * (ref[i].y - r0.y) * (input[i].x - i0.x);
-        sxryi += weights[i] * (ref[i].x - r0.x) * (input[i].y - i0.y);
-        sxryi += weights[i] * (ref[i].x - r0.x) * (input[i].x - i0.x);
-        syryi += weights[i] * (ref[i].y - r0.y) * (input[i].y - i0.y);
+        /* Compute the polynomial coefficients */
+        cthetac->x = xmag * ctheta;
+        sthetac->x = ymag * stheta;
+        sthetac->y = xmag * stheta;
+        cthetac->y = ymag * ctheta;
+        return;
     }
 
     /* Compute the rotation angle */
@@ -428,204 +500,61 @@ geo_fit_theta(
         }
     }
 
-    /* Compute the polynomial coefficients */
     ctheta = cos(theta);
     stheta = sin(theta);
+
+    if (fit_geometry == geomap_fit_rscale) {
+        /* Compute the magnification factor */
+        num = denom * ctheta + num * stheta;
+        denom = sxrxr + syryr;
+        if (denom <= 0.0) {
+            mag = 1.0;
+        } else {
+            mag = num / denom;
+        }
+    }
+
+    /* Compute the polynomial coefficients */
     if (det < 0.0) {
-        cthetac.x = -ctheta;
-        sthetac.y = -stheta;
+        cthetac->x = -mag * ctheta;
+        sthetac->y = -mag * stheta;
     } else {
-        cthetac.x = ctheta;
-        sthetac.y = stheta;
+        cthetac->x = mag * ctheta;
+        sthetac->y = mag * stheta;
     }
-    sthetac.x = stheta;
-    cthetac.y = ctheta;
-
-    /* Compute the X and Y fit coefficients */
-    if (compute_surface_coefficients(
-                fit->function, &bbox, &i0, &r0, &cthetac, &sthetac, sx1, sy1,
-                error)) goto exit;
-
-    /* Compute the residuals */
-    if (compute_residuals(
-                sx1, sy1, ncoord, input, ref, residual_x, residual_y,
-                error)) goto exit;
-
-    /* Compute the number of zero-weighted points */
-    fit->n_zero_weighted = count_zero_weighted(ncoord, weights);
-
-    /* Compute the rms of the x and y fits */
-    compute_rms(
-            ncoord, weights, residual_x, residual_y, &fit->xrms, &fit->yrms);
-
-    fit->ncoord = ncoord;
-
-    status = 0;
-
- exit:
-
-    return status;
+    sthetac->x = mag * stheta;
+    cthetac->y = mag * ctheta;
 }
 
-/* DIFF: was geo_fmagnify */
+/* Check that there is enough weight in a rotate, rscale or rxyscale
+   fit */
 static int
-geo_fit_magnify(
-        geomap_fit_t* const fit,
-        surface_t* const sx1,
-        surface_t* const sy1,
-        const size_t ncoord,
-        const coord_t* const input,
-        const coord_t* const ref,
-        const double* const weights,
-        double* const residual_x,
-        double* const residual_y,
+geo_rotation_check_weight(
+        const geomap_fit_t* const fit,
+        const double sw,
         stimage_error_t* error) {
 
-    bbox_t  bbox;
-    double  sw      = 0.0;
-    coord_t sr      = {0.0, 0.0};
-    coord_t si      = {0.0, 0.0};
-    coord_t r0      = {0.0, 0.0};
-    coord_t i0      = {0.0, 0.0};
-    double  sxrxr   = 0.0;
-    double  syryr   = 0.0;
-    double  syrxi   = 0.0;
-    double  sxryi   = 0.0;
-    double  sxrxi   = 0.0;
-    double  syryi   = 0.0;
-    double  num     = 0.0;
-    double  denom   = 0.0;
-    double  det     = 0.0;
-    double  theta   = 0.0;
-    double  ctheta  = 0.0;
-    double  stheta  = 0.0;
-    double  mag     = 0.0;
-    coord_t cthetac = {0.0, 0.0};
-    coord_t sthetac = {0.0, 0.0};
-    size_t  i       = 0;
-    int     status  = 1;
-
-    assert(fit);
-    assert(sx1);
-    assert(sy1);
-    assert(input);
-    assert(ref);
-    assert(weights);
-    assert(residual_x);
-    assert(residual_y);
-
-    surface_free(sx1);
-    surface_free(sy1);
-
-    bbox_copy(&fit->bbox, &bbox);
-    bbox_make_nonsingular(&bbox);
-
-    /* Compute the sums required to determine the offsets */
-    compute_sums(ncoord, input, ref, weights, &sw, &si, &sr);
-
-    /* Do the fit */
-    if (sw < 2.0) {
+    if (sw < (fit->fit_geometry == geomap_fit_rxyscale ? 3.0 : 2.0)) {
         if (fit->projection == geomap_proj_none) {
             stimage_error_set_message(
-                    error, "Too few data points for X and Y fits");
+                    error, "Too few data points for X and Y fits.");
         } else {
             stimage_error_set_message(
-                    error, "Too few data points for XI and ETA fits");
-        }
-        goto exit;
-    }
-
-    /* Compute the sums */
-    r0.x = sr.x / sw;
-    r0.y = sr.y / sw;
-    i0.x = si.x / sw;
-    i0.y = si.y / sw;
-    for (i = 0; i < ncoord; ++i) {
-        sxrxr += weights[i] * (ref[i].x - r0.x) * (ref[i].x - r0.x);
-        syryr += weights[i] * (ref[i].y - r0.y) * (ref[i].y - r0.y);
-        syrxi += weights[i] * (ref[i].y - r0.y) * (input[i].x - i0.x);
-        sxryi += weights[i] * (ref[i].x - r0.x) * (input[i].y - i0.y);
-        sxrxi += weights[i] * (ref[i].x - r0.x) * (input[i].x - i0.x);
-        syryi += weights[i] * (ref[i].y - r0.y) * (input[i].y - i0.y);
-    }
-
-    /* Compute the rotation angle */
-    num = sxrxi * syryi;
-    denom = syrxi * sxryi;
-    if (double_approx_equal(num, denom)) {
-        det = 0.0;
-    } else {
-        det = num - denom;
-    }
-
-    if (det < 0.0) {
-        num = syrxi + sxryi;
-        denom = -sxrxi + syryi;
-    } else {
-        num = syrxi - sxryi;
-        denom = sxrxi + syryi;
-    }
-
-    if (double_approx_equal(num, 0.0) && double_approx_equal(denom, 0.0)) {
-        theta = 0.0;
-    } else {
-        theta = atan2(num, denom);
-        if (theta < 0.0) {
-            theta += 2.0 * M_PI;
+                    error, "Too few data points for XI and ETA fits.");
         }
+        return 1;
     }
 
-    /* Compute the magnification factor */
-    ctheta = cos(theta);
-    stheta = sin(theta);
-    num = denom * ctheta + num * stheta;
-    denom = sxrxr + syryr;
-    if (denom <= 0.0) {
-        mag = 1.0;
-    } else {
-        mag = num / denom;
-    }
-
-    /* Compute the polynomial coefficients */
-    if (det < 0.0) {
-        cthetac.x = -mag * ctheta;
-        sthetac.y = -mag * stheta;
-    } else {
-        cthetac.x = mag * ctheta;
-        sthetac.y = mag * stheta;
-    }
-    sthetac.x = mag * stheta;
-    cthetac.y = mag * ctheta;
-
-    /* Compute the X fit coefficients */
-    if (compute_surface_coefficients(
-                fit->function, &bbox, &i0, &r0, &cthetac, &sthetac, sx1, sy1,
-                error)) goto exit;
-
-    /* Compute the residuals */
-    if (compute_residuals(
-                sx1, sy1, ncoord, input, ref, residual_x, residual_y,
-                error)) goto exit;
-
-    /* Compute the number of zero-weighted points */
-    fit->n_zero_weighted = count_zero_weighted(ncoord, weights);
-
-    /* Compute the rms of the x and y fits */
-    compute_rms(
-            ncoord, weights, residual_x, residual_y, &fit->xrms, &fit->yrms);
-
-    fit->ncoord = ncoord;
-
-    status = 0;
-
- exit:
-
-    return status;
+    return 0;
 }
 
-/* DIFF: was gto_fit_rxyscale */
+/** DIFF: was geo_fthetad, geo_fmagnify and geo_flinear */
+
+/* Compute the shift, rotation angle and scale (depending on the fit
+   geometry) required to match one set of coordinates to another.
+   The result is stored in the fit structure. */
 static int
-geo_fit_linear(
+geo_fit_rotation(
         geomap_fit_t* const fit,
         surface_t* const sx1,
         surface_t* const sy1,
@@ -633,33 +562,18 @@ geo_fit_linear(
         const coord_t* const input,
         const coord_t* const ref,
         const double* const weights,
+        /* Output */
         double* const residual_x,
         double* const residual_y,
         stimage_error_t* error) {
 
-    bbox_t  bbox;
-    double  sw      = 0.0;
-    coord_t sr      = {0.0, 0.0};
-    coord_t si      = {0.0, 0.0};
-    coord_t r0      = {0.0, 0.0};
-    coord_t i0      = {0.0, 0.0};
-    double  sxrxr   = 0.0;
-    double  syryr   = 0.0;
-    double  syrxi   = 0.0;
-    double  sxryi   = 0.0;
-    double  sxrxi   = 0.0;
-    double  syryi   = 0.0;
-    double  num     = 0.0;
-    double  denom   = 0.0;
-    double  theta   = 0.0;
-    double  ctheta  = 0.0;
-    double  stheta  = 0.0;
-    coord_t cthetac = {0.0, 0.0};
-    coord_t sthetac = {0.0, 0.0};
-    double  xmag    = 0.0;
-    double  ymag    = 0.0;
-    size_t  i       = 0;
-    int     status  = 1;
+    bbox_t           bbox;
+    geomap_moments_t m;
+    coord_t          r0      = {0.0, 0.0};
+    coord_t          i0      = {0.0, 0.0};
+    coord_t          cthetac = {0.0, 0.0};
+    coord_t          sthetac = {0.0, 0.0};
+    int              status  = 1;
 
     assert(fit);
     assert(sx1);
@@ -669,6 +583,7 @@ geo_fit_linear(
     assert(weights);
     assert(residual_x);
     assert(residual_y);
+    assert(error);
 
     surface_free(sx1);
     surface_free(sy1);
@@ -676,72 +591,18 @@ geo_fit_linear(
     bbox_copy(&fit->bbox, &bbox);
     bbox_make_nonsingular(&bbox);
 
-    /* Compute the sums required to determine the offsets */
-    compute_sums(ncoord, input, ref, weights, &sw, &si, &sr);
-
-    if (sw < 3.0) {
-        if (fit->projection == geomap_proj_none) {
-            stimage_error_set_message(
-                    error, "Too few data points for X and Y fits.");
-        } else {
-            stimage_error_set_message(
-                    error, "Too few data points for XI and ETA fits.");
-        }
-        goto exit;
-    }
-
-    r0.x = sr.x / sw;
-    r0.y = sr.y / sw;
-    i0.x = si.x / sw;
-    i0.y = si.y / sw;
-    for (i = 0; i < ncoord; ++i) {
-        sxrxr += weights[i] * (ref[i].x - r0.x) * (ref[i].x - r0.x);
-        syryr += weights[i] * (ref[i].y - r0.y) * (ref[i].y - r0.y);
-        syrxi += weights[i] * (ref[i].y - r0.y) * (input[i].x - i0.x);
-        sxryi += weights[i] * (ref[i].x - r0.x) * (input[i].y - i0.y);
-        sxrxi += weights[i] * (ref[i].x - r0.x) * (input[i].x - i0.x);
-        syryi += weights[i] * (ref[i].y - r0.y) * (input[i].y - i0.y);
-    }
-
-    /* Compute the rotation angle */
-    num = 2.0 * (sxrxr * syrxi * syryi - syryr * sxrxi * sxryi);
-    denom = syryr * (sxrxi - sxryi) * (sxrxi + sxryi) - \
-        sxrxr * (syrxi + syryi) * (syrxi - syryi);
-    if (double_approx_equal(num, 0.0) && double_approx_equal(denom, 0.0)) {
-        theta = 0.0;
-    } else {
-        theta = atan2(num, denom) / 2.0;
-        if (theta < 0.0) {
-            theta += M_PI * 2.0;
-        }
-    }
-
-    ctheta = cos(theta);
-    stheta = sin(theta);
-
-    /* Compute the X magnification factor */
-    num = sxrxi * ctheta - sxryi * stheta;
-    denom = sxrxr;
-    if (denom <= 0.0) {
-        xmag = 1.0;
-    } else {
-        xmag = num / denom;
-    }
+    /* Compute the sums required to determine the offsets and the
+       rotation angle */
+    compute_moments(ncoord, input, ref, weights, &m);
 
-    /* Compute the Y magnification factor */
-    num = syrxi * stheta + syryi * ctheta;
-    denom = syryr;
-    if (denom <= 0.0) {
-        ymag = 1.0;
-    } else {
-        ymag = num / denom;
-    }
+    /* Do the fit */
+    if (geo_rotation_check_weight(fit, m.sw, error)) goto exit;
 
-    /* Compute the polynomial coefficients */
-    cthetac.x = xmag * ctheta;
-    sthetac.x = ymag * stheta;
-    sthetac.y = xmag * stheta;
-    cthetac.x = ymag * ctheta;
+    r0.x = m.mean[0];
+    r0.y = m.mean[1];
+    i0.x = m.mean[2];
+    i0.y = m.mean[3];
+    geo_rotation_coefficients(fit->fit_geometry, &m, &cthetac, &sthetac);
 
     /* Compute the X and Y fit coefficients */
     if (compute_surface_coefficients(
@@ -750,8 +611,8 @@ geo_fit_linear(
 
     /* Compute the residuals */
     if (compute_residuals(
-                sx1, sy1, ncoord, input, ref, residual_x, residual_y,
-                error)) goto exit;
+                sx1, sy1, ncoord, input, ref, fit->nthreads,
+                residual_x, residual_y, error)) goto exit;
 
     /* Compute the number of zero-weighted points */
     fit->n_zero_weighted = count_zero_weighted(ncoord, weights);
@@ -806,26 +667,137 @@ _geo_fit_xy_validate_fit_error(
     return 0;
 }
 
-/* was geo_fxyd */
+/* Set s to the surface of a shift fit along x (if xfit) or y, whose
+   constant term, as fit to the coordinate differences, is shift */
 static int
-geo_fit_xy(
-        geomap_fit_t* const fit,
-        surface_t* const sf1,
-        surface_t* const sf2,
-        const size_t ncoord,
+geo_shift_surface(
+        const surface_type_e function,
+        const bbox_t* const bbox,
         const int xfit,
-        const coord_t* const input,
-        const coord_t* const ref,
+        const double shift,
         /* Output */
-        int* has_secondary,
-        double* const weights,
-        double* const residual,
+        surface_t* const s,
         stimage_error_t* error) {
 
-    bbox_t              bbox;
+    assert(bbox);
+    assert(s);
+    assert(error);
+
+    if (surface_init(
+                s, function, 2, 2, xterms_none, bbox, error)) return 1;
+
+    if (function == surface_type_polynomial) {
+        s->coeff[0] = shift;
+        s->coeff[1] = xfit ? 1.0 : 0.0;
+        s->coeff[2] = xfit ? 0.0 : 1.0;
+    } else if (xfit) {
+        s->coeff[0] = shift + (bbox->max.x + bbox->min.x) / 2.0;
+        s->coeff[1] = (bbox->max.x - bbox->min.x) / 2.0;
+        s->coeff[2] = 0.0;
+    } else {
+        s->coeff[0] = shift + (bbox->min.y + bbox->max.y) / 2.0;
+        s->coeff[1] = 0.0;
+        s->coeff[2] = (bbox->max.y - bbox->min.y) / 2.0;
+    }
+
+    return 0;
+}
+
+/* Initialize the surfaces of a shift, xyscale or general fit along x
+   (if xfit) or y.  has_secondary is set if the fit has a distortion
+   surface sf2. */
+static int
+geo_init_xy_surfaces(
+        const geomap_fit_t* const fit,
+        const bbox_t* const bbox,
+        const int xfit,
+        /* Output */
+        surface_t* const sf1,
+        surface_t* const sf2,
+        int* const has_secondary,
+        stimage_error_t* error) {
+
+    const size_t   xorder = xfit ? fit->xxorder : fit->yxorder;
+    const size_t   yorder = xfit ? fit->xyorder : fit->yyorder;
+    const xterms_e xterms = xfit ? fit->xxterms : fit->yxterms;
+
+    *has_secondary = 0;
+
+    switch (fit->fit_geometry) {
+    case geomap_fit_shift:
+        return surface_init(sf1, fit->function, 1, 1, xterms_none, bbox, error);
+
+    case geomap_fit_xyscale:
+        return surface_init(
+                sf1, fit->function, xfit ? 2 : 1, xfit ? 1 : 2, xterms_none,
+                bbox, error);
+
+    default:
+        if (surface_init(
+                    sf1, fit->function, 2, 2, xterms_none, bbox, error)) {
+            return 1;
+        }
+
+        if (xorder > 2 || yorder > 2 || xterms == xterms_full) {
+            if (surface_init(
+                        sf2, fit->function, xorder, yorder, xterms, bbox,
+                        error)) {
+                surface_free(sf1);
+                return 1;
+            }
+            *has_secondary = 1;
+        }
+        break;
+    }
+
+    return 0;
+}
+
+/* Gather the x (if xfit) or y input coordinates to fit, or for a
+   shift fit their differences from the reference coordinates */
+static void
+geo_get_ordinate(
+        const geomap_fit_e fit_geometry,
+        const int xfit,
+        const size_t ncoord,
+        const coord_t* const input,
+        const coord_t* const ref,
+        /* Output */
+        double* const z) {
+
+    size_t i = 0;
+
+    for (i = 0; i < ncoord; ++i) {
+        z[i] = xfit ? input[i].x : input[i].y;
+    }
+
+    if (fit_geometry == geomap_fit_shift) {
+        for (i = 0; i < ncoord; ++i) {
+            z[i] -= xfit ? ref[i].x : ref[i].y;
+        }
+    }
+}
+
+/* was geo_fxyd */
+static int
+geo_fit_xy(
+        geomap_fit_t* const fit,
+        surface_t* const sf1,
+        surface_t* const sf2,
+        const size_t ncoord,
+        const int xfit,
+        const coord_t* const input,
+        const coord_t* const ref,
+        /* Output */
+        int* has_secondary,
+        double* const weights,
+        double* const residual,
+        stimage_error_t* error) {
+
+    bbox_t              bbox;
+    double*             z         = NULL;
     double*             zfit      = NULL;
-    const double* const z = (double*)input + (xfit ? 0 : 1);
-    surface_t           savefit;
+    double              shift     = 0.0;
     surface_fit_error_e fit_error = surface_fit_error_ok;
     size_t              i         = 0;
     int                 status    = 1;
@@ -833,18 +805,20 @@ geo_fit_xy(
     assert(fit);
     assert(sf1);
     assert(sf2);
+    assert(input);
     assert(ref);
     assert(weights);
     assert(residual);
     assert(has_secondary);
     assert(error);
 
-    surface_new(&savefit);
-
     surface_free(sf1);
     surface_free(sf2);
 
-    *has_secondary = 1;
+    *has_secondary = 0;
+
+    z = malloc_with_error(ncoord * sizeof(double), error);
+    if (z == NULL) goto exit;
 
     zfit = malloc_with_error(ncoord * sizeof(double), error);
     if (zfit == NULL) goto exit;
@@ -852,147 +826,46 @@ geo_fit_xy(
     bbox_copy(&fit->bbox, &bbox);
     bbox_make_nonsingular(&bbox);
 
-    if (xfit) {
-        switch(fit->fit_geometry) {
-        case geomap_fit_shift:
-            if (surface_init(
-                        &savefit, fit->function, 2, 2, xterms_none, &bbox,
-                        error)) goto exit;
-            surface_free(sf1);
-            if (surface_init(
-                        sf1, fit->function, 1, 1, xterms_none, &bbox,
-                        error)) goto exit;
-            for (i = 0; i < ncoord; ++i) {
-                zfit[i] = z[i<<1] - ref[i].x;
-            }
-
-            if (surface_fit(
-                        sf1, ncoord, ref, zfit, weights,
-                        surface_fit_weight_user, &fit_error, error)) goto exit;
-
-            if (fit->function == surface_type_polynomial) {
-                savefit.coeff[0] = sf1->coeff[0];
-                savefit.coeff[1] = 1.0;
-                savefit.coeff[2] = 0.0;
-            } else {
-                savefit.coeff[0] = sf1->coeff[0] + (bbox.max.x + bbox.min.x) / 2.0;
-                savefit.coeff[1] = (bbox.max.x - bbox.min.x) / 2.0;
-                savefit.coeff[2] = 0.0;
-            }
-            surface_free(sf1);
-            if (surface_copy(&savefit, sf1, error)) goto exit;
-            *has_secondary = 0;
-            break;
-
-        case geomap_fit_xyscale:
-            if (surface_init(
-                        sf1, fit->function, 2, 1, xterms_none, &bbox,
-                        error)) goto exit;
-            if (surface_fit(
-                        sf1, ncoord, ref, z, weights,
-                        surface_fit_weight_user, &fit_error, error)) goto exit;
-            *has_secondary = 0;
-            break;
-
-        default:
-            if (surface_init(
-                        sf1, fit->function, 2, 2, xterms_none, &bbox,
-                        error)) goto exit;
-            if (surface_fit(
-                        sf1, ncoord, ref, z, weights,
-                        surface_fit_weight_user, &fit_error, error)) goto exit;
-
-            if (fit->xxorder > 2 || fit->xyorder > 2 ||
-                fit->xxterms == xterms_full) {
-                if (surface_init(
-                            sf2, fit->function, fit->xxorder, fit->xyorder,
-                            fit->xxterms, &fit->bbox, error)) {
-                    surface_free(sf1);
-                    goto exit;
-                }
-            } else {
-                *has_secondary = 0;
-            }
-            break;
-        }
-    } else {
-        switch(fit->fit_geometry) {
-        case geomap_fit_shift:
-            if (surface_init(
-                        &savefit, fit->function, 2, 2, xterms_none, &bbox,
-                        error)) goto exit;
-            surface_free(sf1);
-            if (surface_init(
-                        sf1, fit->function, 1, 1, xterms_none, &bbox,
-                        error)) goto exit;
-            for (i = 0; i < ncoord; ++i) {
-                zfit[i] = z[i<<1] - ref[i].y;
-            }
-            if (surface_fit(
-                        sf1, ncoord, ref, zfit, weights,
-                        surface_fit_weight_user, &fit_error, error)) goto exit;
-            if (fit->function == surface_type_polynomial) {
-                savefit.coeff[0] = sf1->coeff[0];
-                savefit.coeff[1] = 0.0;
-                savefit.coeff[2] = 1.0;
-            } else {
-                savefit.coeff[0] = sf1->coeff[0] + (bbox.min.y + bbox.max.y) / 2.0;
-                savefit.coeff[1] = 0.0;
-                savefit.coeff[2] = (bbox.max.y - bbox.min.y) / 2.0;
-            }
-            surface_free(sf1);
-            if (surface_copy(&savefit, sf1, error)) goto exit;
-
-            *has_secondary = 0;
-            break;
-
-        case geomap_fit_xyscale:
-            if (surface_init(
-                        sf1, fit->function, 1, 2, xterms_none, &bbox,
-                        error)) goto exit;
-            if (surface_fit(
-                        sf1, ncoord, ref, z, weights,
-                        surface_fit_weight_user, &fit_error, error)) goto exit;
-            *has_secondary = 0;
-            break;
+    if (geo_init_xy_surfaces(
+                fit, &bbox, xfit, sf1, sf2, has_secondary, error)) goto exit;
 
-        default:
-            if (surface_init(
-                        sf1, fit->function, 2, 2, xterms_none, &bbox,
-                        error)) goto exit;
-            if (surface_fit(
-                        sf1, ncoord, ref, z, weights,
-                        surface_fit_weight_user, &fit_error, error)) goto exit;
-            if (fit->yxorder > 2 || fit->yyorder > 2 ||
-                fit->yxterms == xterms_full) {
-                if (surface_init(
-                            sf2, fit->function, fit->yxorder, fit->yyorder,
-                            fit->yxterms, &bbox, error)) goto exit;
-            } else {
-                *has_secondary = 0;
-            }
+    geo_get_ordinate(fit->fit_geometry, xfit, ncoord, input, ref, z);
 
-            break;
-        }
-    }
+    if (surface_fit(
+                sf1, ncoord, ref, z, weights,
+                surface_fit_weight_user, fit->nthreads, &fit_error,
+                error)) goto exit;
 
     if (_geo_fit_xy_validate_fit_error(
                 fit_error, xfit, fit->projection, error)) goto exit;
 
-    if (surface_vector(sf1, ncoord, ref, residual, error)) goto exit;
+    if (fit->fit_geometry == geomap_fit_shift) {
+        /* Turn the fitted shift into a linear surface of the
+           coordinates themselves */
+        shift = sf1->coeff[0];
+        surface_free(sf1);
+        if (geo_shift_surface(
+                    fit->function, &bbox, xfit, shift, sf1, error)) goto exit;
+        geo_get_ordinate(geomap_fit_general, xfit, ncoord, input, ref, z);
+    }
+
+    if (surface_vector(
+                sf1, ncoord, ref, fit->nthreads, residual, error)) goto exit;
     for (i = 0; i < ncoord; ++i) {
-        residual[i] = z[i<<1] - residual[i];
+        residual[i] = z[i] - residual[i];
     }
 
     /* Calculate the higher-order fit */
     if (*has_secondary) {
         if (surface_fit(
                     sf2, ncoord, ref, residual, weights,
-                    surface_fit_weight_user, &fit_error, error)) goto exit;
+                    surface_fit_weight_user, fit->nthreads, &fit_error,
+                    error)) goto exit;
         if (_geo_fit_xy_validate_fit_error(
                     fit_error, xfit, fit->projection, error)) goto exit;
 
-        if (surface_vector(sf2, ncoord, ref, zfit, error)) goto exit;
+        if (surface_vector(
+                    sf2, ncoord, ref, fit->nthreads, zfit, error)) goto exit;
         for (i = 0; i < ncoord; ++i) {
             residual[i] = zfit[i] - residual[i];
         }
@@ -1020,7 +893,108 @@ geo_fit_xy(
 
  exit:
 
-    surface_free(&savefit);
+    free(z);
+    free(zfit);
+
+    return status;
+}
+
+/* Refit the general fit done by geo_fit_xy (with the same xfit) after
+   the weights changed from w_old to weights.  The basis functions of
+   sf1 and sf2 at the reference coordinates are in basis1 and basis2,
+   so only the points whose weight changed are added to or removed
+   from the normal equations. */
+static int
+geo_fit_xy_reweight(
+        geomap_fit_t* const fit,
+        surface_t* const sf1,
+        surface_t* const sf2,
+        const surface_basis_t* const basis1,
+        const surface_basis_t* const basis2,
+        const size_t ncoord,
+        const int xfit,
+        const coord_t* const input,
+        const coord_t* const ref,
+        const int has_secondary,
+        const double* const w_old,
+        /* Output */
+        double* const weights,
+        double* const residual,
+        stimage_error_t* error) {
+
+    double*             z         = NULL;
+    double*             zfit      = NULL;
+    surface_fit_error_e fit_error = surface_fit_error_ok;
+    double              rms       = 0.0;
+    size_t              i         = 0;
+    int                 status    = 1;
+
+    assert(fit);
+    assert(fit->fit_geometry == geomap_fit_general);
+    assert(sf1);
+    assert(sf2);
+    assert(basis1);
+    assert(basis2);
+    assert(ref);
+    assert(w_old);
+    assert(weights);
+    assert(residual);
+    assert(error);
+
+    z = malloc_with_error(ncoord * sizeof(double), error);
+    if (z == NULL) goto exit;
+
+    zfit = malloc_with_error(ncoord * sizeof(double), error);
+    if (zfit == NULL) goto exit;
+
+    geo_get_ordinate(fit->fit_geometry, xfit, ncoord, input, ref, z);
+
+    if (surface_fit_reweight(
+                sf1, basis1, z, w_old, weights, &fit_error, error)) goto exit;
+    if (_geo_fit_xy_validate_fit_error(
+                fit_error, xfit, fit->projection, error)) goto exit;
+
+    if (surface_vector(
+                sf1, ncoord, ref, fit->nthreads, residual, error)) goto exit;
+    for (i = 0; i < ncoord; ++i) {
+        residual[i] = z[i] - residual[i];
+    }
+
+    /* Calculate the higher-order fit */
+    if (has_secondary) {
+        if (surface_fit_reweight(
+                    sf2, basis2, residual, w_old, weights, &fit_error,
+                    error)) goto exit;
+        if (_geo_fit_xy_validate_fit_error(
+                    fit_error, xfit, fit->projection, error)) goto exit;
+
+        if (surface_vector(
+                    sf2, ncoord, ref, fit->nthreads, zfit, error)) goto exit;
+        for (i = 0; i < ncoord; ++i) {
+            residual[i] = zfit[i] - residual[i];
+        }
+    }
+
+    /* Compute the number of zero weighted points */
+    fit->n_zero_weighted = count_zero_weighted(ncoord, weights);
+
+    /* Calculate the RMS of the fit */
+    for (i = 0; i < ncoord; ++i) {
+        rms += weights[i] * residual[i] * residual[i];
+    }
+    if (xfit) {
+        fit->xrms = rms;
+    } else {
+        fit->yrms = rms;
+    }
+
+    fit->ncoord = ncoord;
+
+    status = 0;
+
+ exit:
+
+    free(z);
     free(zfit);
 
     return status;
@@ -1044,13 +1018,16 @@ geo_fit_reject(
         double* const residual_y,
         stimage_error_t* error) {
 
-    double* tweights = NULL;
-    size_t  nreject  = 0;
-    size_t  niter    = 0;
-    double  cutx     = 0.0;
-    double  cuty     = 0.0;
-    size_t  i        = 0;
-    int     status   = 1;
+    double*         tweights = NULL;
+    double*         pweights = NULL;
+    surface_basis_t bx1, by1, bx2, by2;
+    int             reweight = 0;
+    size_t          nreject  = 0;
+    size_t          niter    = 0;
+    double          cutx     = 0.0;
+    double          cuty     = 0.0;
+    size_t          i        = 0;
+    int             status   = 1;
 
     assert(fit);
     assert(sx1);
@@ -1064,6 +1041,11 @@ geo_fit_reject(
     assert(residual_y);
     assert(error);
 
+    surface_basis_new(&bx1);
+    surface_basis_new(&by1);
+    surface_basis_new(&bx2);
+    surface_basis_new(&by2);
+
     tweights = malloc_with_error(ncoord * sizeof(double), error);
     if (tweights == NULL) goto exit;
 
@@ -1100,9 +1082,8 @@ geo_fit_reject(
                 ((fabs(residual_x[i]) > cutx) || fabs(residual_y[i]) > cuty)) {
                 //((abs(residual_x[i]) > cutx) || abs(residual_y[i]) > cuty)) {
                     tweights[i] = 0.0;
-                ++nreject;
                 assert(nreject < ncoord);
-                fit->rej[nreject] = i;
+                fit->rej[nreject++] = i;
             }
         }
 
@@ -1117,27 +1098,49 @@ geo_fit_reject(
         /* Recompute the X and Y fit */
         switch (fit->fit_geometry) {
         case geomap_fit_rotate:
-            if (geo_fit_theta(
-                        fit, sx1, sy1, ncoord, input, ref, tweights,
-                        residual_x, residual_y, error)) goto exit;
-            break;
         case geomap_fit_rscale:
-            if (geo_fit_magnify(
-                        fit, sx1, sy1, ncoord, input, ref, tweights,
-                        residual_x, residual_y, error)) goto exit;
-            break;
         case geomap_fit_rxyscale:
-            if (geo_fit_linear(
+            if (geo_fit_rotation(
                         fit, sx1, sy1, ncoord, input, ref, tweights,
                         residual_x, residual_y, error)) goto exit;
             break;
         default:
+            if (reweight) {
+                if (geo_fit_xy_reweight(
+                            fit, sx1, sx2, &bx1, &bx2, ncoord, 1, input, ref,
+                            *has_sx2, pweights, tweights, residual_x, error) ||
+                    geo_fit_xy_reweight(
+                            fit, sy1, sy2, &by1, &by2, ncoord, 0, input, ref,
+                            *has_sy2, pweights, tweights, residual_y,
+                            error)) goto exit;
+                memcpy(pweights, tweights, ncoord * sizeof(double));
+                break;
+            }
+
             if (geo_fit_xy(
                         fit, sx1, sx2, ncoord, 1, input, ref, has_sx2, tweights,
                         residual_x, error) ||
                 geo_fit_xy(
                         fit, sy1, sy2, ncoord, 0, input, ref, has_sy2, tweights,
                         residual_y, error)) goto exit;
+
+            /* The later iterations of a general fit only update the
+               normal equations for the newly rejected points, using
+               the basis functions kept from this one. */
+            if (fit->fit_geometry == geomap_fit_general &&
+                niter + 1 < fit->maxiter) {
+                pweights = malloc_with_error(ncoord * sizeof(double), error);
+                if (pweights == NULL) goto exit;
+                memcpy(pweights, tweights, ncoord * sizeof(double));
+
+                if (surface_basis_init(&bx1, sx1, ncoord, ref, error) ||
+                    surface_basis_init(&by1, sy1, ncoord, ref, error)) goto exit;
+                if (*has_sx2 &&
+                    surface_basis_init(&bx2, sx2, ncoord, ref, error)) goto exit;
+                if (*has_sy2 &&
+                    surface_basis_init(&by2, sy2, ncoord, ref, error)) goto exit;
+                reweight = 1;
+            }
             break;
         }
 
@@ -1149,11 +1152,19 @@ geo_fit_reject(
         ++niter;
     } while (niter < fit->maxiter);
 
+    stimage_stats_count(fit->stats, "reject.iterations", (double)niter);
+    stimage_stats_count(fit->stats, "reject.rejected", (double)fit->nreject);
+
     status = 0;
 
  exit:
 
     free(tweights);
+    free(pweights);
+    surface_basis_free(&bx1);
+    surface_basis_free(&by1);
+    surface_basis_free(&bx2);
+    surface_basis_free(&by2);
 
     return status;
 }
@@ -1176,6 +1187,7 @@ geofit(
 
     double* residual_x = NULL;
     double* residual_y = NULL;
+    double  start      = 0.0;
     int status = 1;
 
     assert(fit);
@@ -1199,39 +1211,36 @@ geofit(
     residual_y = malloc_with_error(ncoord * sizeof(double), error);
     if (residual_y == NULL) goto exit;
 
+    start = stimage_stats_start(fit->stats);
     switch(fit->fit_geometry) {
     case geomap_fit_rotate:
-        if (geo_fit_theta(
-                    fit, sx1, sy1, ncoord, input, ref, weights,
-                    residual_x, residual_y, error)) goto exit;
-        break;
     case geomap_fit_rscale:
-        if (geo_fit_magnify(
-                    fit, sx1, sy1, ncoord, input, ref, weights,
-                    residual_x, residual_y, error)) goto exit;
-        break;
     case geomap_fit_rxyscale:
-        if (geo_fit_linear(
+        if (geo_fit_rotation(
                     fit, sx1, sy1, ncoord, input, ref, weights,
                     residual_x, residual_y, error)) goto exit;
         break;
     default:
         if (geo_fit_xy(
-                    fit, sx1, sx2, ncoord, 0, input, ref, has_sx2, weights,
+                    fit, sx1, sx2, ncoord, 1, input, ref, has_sx2, weights,
                     residual_x, error)
             ||
             geo_fit_xy(
-                    fit, sy1, sy2, ncoord, 1, input, ref, has_sy2, weights,
+                    fit, sy1, sy2, ncoord, 0, input, ref, has_sy2, weights,
                     residual_y, error)) goto exit;
         break;
     }
+    stimage_stats_stop(fit->stats, "fit.time", start);
+    stimage_stats_count(fit->stats, "fit.points", (double)ncoord);
 
     if (fit->maxiter <= 0 || !isfinite(fit->reject)) {
         fit->nreject = 0;
     } else {
+        start = stimage_stats_start(fit->stats);
         if (geo_fit_reject(
                     fit, sx1, sy1, sx2, sy2, has_sx2, has_sy2, ncoord, input,
                     ref, weights, residual_x, residual_y, error)) goto exit;
+        stimage_stats_stop(fit->stats, "reject.time", start);
     }
 
     status = 0;
@@ -1242,62 +1251,39 @@ geofit(
     return status;
 }
 
-/* DIFF: was geo_evald */
+/* Evaluate the surface s, plus the surface s2 if has_s2, at ref.  tmp
+   holds ncoord doubles when has_s2. */
 static int
-geoeval(
-        const surface_t* const sx1,
-        const surface_t* const sy1,
-        const surface_t* const sx2,
-        const surface_t* const sy2,
-        const int has_sx2,
-        const int has_sy2,
+geo_eval_surface(
+        const surface_t* const s,
+        const surface_t* const s2,
+        const int has_s2,
         const size_t ncoord,
         const coord_t* const ref,
-        double* const xfit,
-        double* const yfit,
+        workspace_t* const workspace,
+        double* const tmp,
+        /* Output */
+        double* const zfit,
         stimage_error_t* const error) {
 
-    double* tmp    = NULL;
-    size_t  i      = 0;
-    int     status = 1;
-
-    assert(sx1);
-    assert(sy1);
-    assert(sx2);
-    assert(sy2);
-    assert(ref);
-    assert(xfit);
-    assert(yfit);
-    assert(error);
+    size_t i = 0;
 
-    if (has_sx2 || has_sy2) {
-        tmp = malloc_with_error(ncoord * sizeof(double), error);
-        if (tmp == NULL) goto exit;
+    if (surface_vector_workspace(s, ncoord, ref, workspace, zfit, error)) {
+        return 1;
     }
 
-    if (surface_vector(sx1, ncoord, ref, xfit, error)) goto exit;
-    if (has_sx2) {
-        if (surface_vector(sx2, ncoord, ref, tmp, error)) goto exit;
-        for (i = 0; i < ncoord; ++i) {
-            xfit[i] += tmp[i];
+    if (has_s2) {
+        assert(tmp);
+        if (surface_vector_workspace(
+                    s2, ncoord, ref, workspace, tmp, error)) {
+            return 1;
         }
-    }
-
-    if (surface_vector(sy1, ncoord, ref, yfit, error)) goto exit;
-    if (has_sy2) {
-        if (surface_vector(sy2, ncoord, ref, tmp, error)) goto exit;
         for (i = 0; i < ncoord; ++i) {
-            yfit[i] += tmp[i];
+            zfit[i] += tmp[i];
         }
     }
 
-    status = 0;
-
- exit:
-
-    free(tmp);
-
-    return status;
+    return 0;
 }
 
 static int
@@ -1313,12 +1299,12 @@ geo_get_coeff(
     size_t nxxcoeff, nxycoeff, nyxcoeff, nyycoeff;
     double xxrange  = 1.0;
     double xyrange  = 1.0;
-    double xxmaxmin = 1.0;
-    double xymaxmin = 1.0;
+    double xxmaxmin = 0.0;
+    double xymaxmin = 0.0;
     double yxrange  = 1.0;
     double yyrange  = 1.0;
-    double yxmaxmin = 1.0;
-    double yymaxmin = 1.0;
+    double yxmaxmin = 0.0;
+    double yymaxmin = 0.0;
     double a, b, c, d;
 
     assert(sx);
@@ -1328,35 +1314,26 @@ geo_get_coeff(
     assert(rot);
     assert(sx->coeff);
     assert(sy->coeff);
-    assert(sx->ncoeff >= 3);
-    assert(sy->ncoeff >= 3);
-
-    nxxcoeff = nyxcoeff = sx->nxcoeff;
-    nxycoeff = nyycoeff = sy->nycoeff;
+    nxxcoeff = sx->nxcoeff;
+    nxycoeff = sx->nycoeff;
+    nyxcoeff = sy->nxcoeff;
+    nyycoeff = sy->nycoeff;
 
     /* Get the data range */
     if (sx->type != surface_type_polynomial) {
         xxrange = (sx->bbox.max.x - sx->bbox.min.x) / 2.0;
-        xxmaxmin = -(sx->bbox.max.x - sx->bbox.min.x) / 2.0;
+        xxmaxmin = -(sx->bbox.max.x + sx->bbox.min.x) / 2.0;
         xyrange = (sx->bbox.max.y - sx->bbox.min.y) / 2.0;
-        xymaxmin = (sx->bbox.max.y - sx->bbox.min.y) / 2.0;
+        xymaxmin = -(sx->bbox.max.y + sx->bbox.min.y) / 2.0;
     }
 
     if (sy->type != surface_type_polynomial) {
         yxrange = (sy->bbox.max.x - sy->bbox.min.x) / 2.0;
-        yxmaxmin = (sy->bbox.max.x - sy->bbox.min.x) / 2.0;
+        yxmaxmin = -(sy->bbox.max.x + sy->bbox.min.x) / 2.0;
         yyrange = (sy->bbox.max.y - sy->bbox.min.y) / 2.0;
-        yymaxmin = (sy->bbox.max.y - sy->bbox.min.y) / 2.0;
+        yymaxmin = -(sy->bbox.max.y + sy->bbox.min.y) / 2.0;
     }
 
-    /* Get the shifts */
-    shift->x = sx->coeff[0] + \
-        sx->coeff[1] * xxmaxmin / xxrange + \
-        sx->coeff[2] * xymaxmin / xyrange;
-    shift->y = sy->coeff[0] + \
-        sy->coeff[1] * yxmaxmin / yxrange +
-        sx->coeff[2] * yymaxmin / yyrange;
-
     /* Get the rotation and scaling parameters */
     if (nxxcoeff > 1) {
         a = sx->coeff[1] / xxrange;
@@ -1371,7 +1348,7 @@ geo_get_coeff(
     }
 
     if (nyxcoeff > 1) {
-        c = sx->coeff[1] / yxrange;
+        c = sy->coeff[1] / yxrange;
     } else {
         c = 0.0;
     }
@@ -1382,6 +1359,10 @@ geo_get_coeff(
         d = 0.0;
     }
 
+    /* Get the shifts */
+    shift->x = sx->coeff[0] + a * xxmaxmin + b * xymaxmin;
+    shift->y = sy->coeff[0] + c * yxmaxmin + d * yymaxmin;
+
     scale->x = sqrt(a*a + c*c);
     scale->y = sqrt(b*b + d*d);
 
@@ -1506,6 +1487,31 @@ geo_get_results(
     return status;
 }
 
+/* Hand the fitted surfaces over to the result, leaving them
+   uninitialized */
+static void
+geo_give_transform(
+        surface_t* const sx1,
+        surface_t* const sy1,
+        surface_t* const sx2,
+        surface_t* const sy2,
+        const int has_sx2,
+        const int has_sy2,
+        /* Output */
+        geomap_result_t* const result) {
+
+    result->transform.sx1 = *sx1;
+    result->transform.sy1 = *sy1;
+    result->transform.sx2 = *sx2;
+    result->transform.sy2 = *sy2;
+    result->transform.has_sx2 = has_sx2;
+    result->transform.has_sy2 = has_sy2;
+    surface_new(sx1);
+    surface_new(sy1);
+    surface_new(sx2);
+    surface_new(sy2);
+}
+
 int
 geomap(
         const size_t ninput, const coord_t* const input,
@@ -1524,47 +1530,94 @@ geomap(
         /* Input/Output */
         size_t* const noutput,
         /* Output */
-        geomap_output_t* const output, /* [MAX(ninput, nref)] */
+        geomap_output_t* const output, /* [MAX(ninput, nref)] or NULL */
         geomap_result_t* const result,
         stimage_error_t* const error) {
 
-    geomap_fit_t     fit;
-    bbox_t           tbbox;
-    size_t           ninput_in_bbox = ninput;
-    size_t           nref_in_bbox   = nref;
-    coord_t*         input_in_bbox  = NULL;
-    coord_t*         ref_in_bbox    = NULL;
-    double*          xfit           = NULL;
-    double*          yfit           = NULL;
-    double*          weights        = NULL;
-    double*          tweights       = NULL;
-    geomap_output_t* outi           = NULL;
-    surface_t        sx1, sy1, sx2, sy2;
-    int              has_sx2        = 0;
+    coord_view_t input_view;
+    coord_view_t ref_view;
+
+    assert(input);
+    assert(ref);
+
+    coord_view_init(&input_view, ninput, input);
+    coord_view_init(&ref_view, nref, ref);
+
+    return geomap_view(
+            &input_view, &ref_view, bbox, fit_geometry, function,
+            xxorder, xyorder, yxorder, yyorder, xxterms, yxterms,
+            maxiter, reject, 1, noutput, output, result, NULL, error);
+}
+
+int
+geomap_view(
+        const coord_view_t* const input,
+        const coord_view_t* const ref,
+        const bbox_t* const bbox,
+        const geomap_fit_e fit_geometry,
+        const surface_type_e function,
+        const size_t xxorder,
+        const size_t xyorder,
+        const size_t yxorder,
+        const size_t yyorder,
+        const xterms_e xxterms,
+        const xterms_e yxterms,
+        const size_t maxiter,
+        const double reject,
+        const size_t nthreads,
+        /* Input/Output */
+        size_t* const noutput,
+        /* Output */
+        geomap_output_t* const output, /* [MAX(input->n, ref->n)] or NULL */
+        geomap_result_t* const result,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error) {
+
+    geomap_fit_t     fit;
+    bbox_t           tbbox;
+    const size_t     ninput         = input->n;
+    const size_t     nref           = ref->n;
+    size_t           ninput_in_bbox = ninput;
+    size_t           nref_in_bbox   = nref;
+    coord_t*         input_in_bbox  = NULL;
+    coord_t*         ref_in_bbox    = NULL;
+    int              use_bbox       = 0;
+    int              copied         = 0;
+    coord_view_t     fit_view;
+    coord_t*         fitted         = NULL;
+    double*          weights        = NULL;
+    double*          tweights       = NULL;
+    geomap_output_t* outi           = NULL;
+    surface_t        sx1, sy1, sx2, sy2;
+    int              has_sx2        = 0;
     int              has_sy2        = 0;
     size_t           i              = 0;
     double           my_nan         = fmod(1.0, 0.0);
+    double           start          = stimage_stats_start(stats);
+    double           stage_start    = 0.0;
     int              status         = 1;
 
     assert(input);
     assert(ref);
     assert(error);
 
+    surface_new(&sx1);
+    surface_new(&sy1);
+    surface_new(&sx2);
+    surface_new(&sy2);
+
     if (ninput != nref) {
         stimage_error_set_message(
             error, "Must have the same number of input and reference coordinates.");
         goto exit;
     }
 
-    surface_new(&sx1);
-    surface_new(&sy1);
-    surface_new(&sx2);
-    surface_new(&sy2);
-
     geomap_fit_init(
             &fit, geomap_proj_none, fit_geometry, function,
             xxorder, xyorder, xxterms, yxorder, yyorder, yxterms,
             maxiter, reject);
+    fit.nthreads = nthreads;
+    fit.stats = stats;
 
     /* If bbox is NULL, provide a dummy one full of NaNs */
     if (bbox == NULL) {
@@ -1573,29 +1626,42 @@ geomap(
         bbox_copy(bbox, &tbbox);
     }
 
-    /* If the bbox is all NaNs, we don't need to reduce the data, saving an
-       alloc and copy */
-    if (bbox == NULL ||
-        (!isfinite(tbbox.min.x) && !isfinite(tbbox.min.y) &&
-         !isfinite(tbbox.max.x) && !isfinite(tbbox.max.y))) {
-        /* If we have no bbox, we don't need to allocate and copy */
-        input_in_bbox = (coord_t*)input;
-        ref_in_bbox = (coord_t*)ref;
+    /* If the bbox is all NaNs, we don't need to reduce the data, and
+       coordinate arrays can be used without a copy */
+    use_bbox = (
+        bbox != NULL &&
+        (isfinite(tbbox.min.x) || isfinite(tbbox.min.y) ||
+         isfinite(tbbox.max.x) || isfinite(tbbox.max.y)));
+
+    if (!use_bbox &&
+        coord_view_packed(input) != NULL && coord_view_packed(ref) != NULL) {
+        input_in_bbox = (coord_t*)coord_view_packed(input);
+        ref_in_bbox = (coord_t*)coord_view_packed(ref);
         ninput_in_bbox = ninput;
         nref_in_bbox = nref;
     } else {
+        copied = 1;
+
         input_in_bbox = malloc_with_error(
-                ninput * sizeof(coord_t), error);
+                MAX(1, ninput) * sizeof(coord_t), error);
         if (input_in_bbox == NULL) goto exit;
 
         ref_in_bbox = malloc_with_error(
-                nref * sizeof(coord_t), error);
+                MAX(1, nref) * sizeof(coord_t), error);
         if (ref_in_bbox == NULL) goto exit;
 
-        /* Reduce data to only those in the bbox */
-        ninput_in_bbox = nref_in_bbox = limit_to_bbox(
-                ninput, input, ref, &tbbox, input_in_bbox, ref_in_bbox);
+        coord_view_gather(input, 0, ninput, input_in_bbox);
+        coord_view_gather(ref, 0, nref, ref_in_bbox);
+
+        /* Reduce data to only those in the bbox, in place */
+        if (use_bbox) {
+            ninput_in_bbox = nref_in_bbox = limit_to_bbox(
+                    ninput, input_in_bbox, ref_in_bbox, &tbbox,
+                    input_in_bbox, ref_in_bbox);
+        }
     }
+    stimage_stats_count(
+            stats, "bbox.removed", (double)(ninput - ninput_in_bbox));
 
     /* Compute the mean of the reference and input coordinates */
     compute_mean_coord(nref_in_bbox, ref_in_bbox, &fit.oref);
@@ -1605,13 +1671,6 @@ geomap(
     fit.refpt.x = my_nan;
     fit.refpt.y = my_nan;
 
-    /* Allocate some memory */
-    xfit = malloc_with_error(ninput_in_bbox * sizeof(double), error);
-    if (xfit == NULL) goto exit;
-
-    yfit = malloc_with_error(ninput_in_bbox * sizeof(double), error);
-    if (yfit == NULL) goto exit;
-
     /* Compute the weights */
     weights = malloc_with_error(ninput_in_bbox * sizeof(double), error);
     if (weights == NULL) goto exit;
@@ -1629,15 +1688,33 @@ geomap(
                 ninput_in_bbox, input_in_bbox, ref_in_bbox, weights,
                 error)) goto exit;
 
-    /* Compute the fitted x and y values */
-    if (geoeval(
-                &sx1, &sy1, &sx2, &sy2, has_sx2, has_sy2, ninput_in_bbox,
-                ref_in_bbox, xfit, yfit, error)) goto exit;
-
     if (geo_get_results(
                 &fit, &sx1, &sy1, &sx2, &sy2, has_sx2, has_sy2, result,
                 error)) goto exit;
 
+    /* Hand the fitted surfaces over to the result */
+    geo_give_transform(&sx1, &sy1, &sx2, &sy2, has_sx2, has_sy2, result);
+
+    *noutput = ninput_in_bbox;
+
+    /* The caller only wants the fit */
+    if (output == NULL) {
+        status = 0;
+        goto exit;
+    }
+
+    /* Compute the fitted x and y values */
+    fitted = malloc_with_error(
+            MAX(1, ninput_in_bbox) * sizeof(coord_t), error);
+    if (fitted == NULL) goto exit;
+
+    stage_start = stimage_stats_start(stats);
+    coord_view_init(&fit_view, ninput_in_bbox, ref_in_bbox);
+    if (geomap_transform_apply(
+                &result->transform, 1, &fit_view, nthreads, fitted,
+                error)) goto exit;
+    stimage_stats_stop(stats, "evaluate.time", stage_start);
+
     /* DIFF: This section is from geo_plistd */
 
     /* Copy the results to the output buffer */
@@ -1663,10 +1740,10 @@ geomap(
         outi->input.x = input_in_bbox[i].x;
         outi->input.y = input_in_bbox[i].y;
         if (tweights[i] > 0.0) {
-            outi->fit.x = xfit[i];
-            outi->fit.y = yfit[i];
-            outi->residual.x = input_in_bbox[i].x - xfit[i];
-            outi->residual.y = input_in_bbox[i].y - yfit[i];
+            outi->fit.x = fitted[i].x;
+            outi->fit.y = fitted[i].y;
+            outi->residual.x = input_in_bbox[i].x - fitted[i].x;
+            outi->residual.y = input_in_bbox[i].y - fitted[i].y;
         } else {
             outi->fit.x = my_nan;
             outi->fit.y = my_nan;
@@ -1674,30 +1751,748 @@ geomap(
             outi->residual.y = my_nan;
         }
     }
-    *noutput = ninput_in_bbox;
 
     status = 0;
 
  exit:
 
-    if (input_in_bbox != input) {
+    if (copied) {
         free(input_in_bbox);
-    }
-    if (ref_in_bbox != ref) {
         free(ref_in_bbox);
     }
     free(weights);
-    free(xfit);
-    free(yfit);
+    free(fitted);
     free(tweights);
     surface_free(&sx1);
     surface_free(&sy1);
     surface_free(&sx2);
     surface_free(&sy2);
 
+    if (status == 0) {
+        stimage_stats_stop(stats, "geomap.time", start);
+    }
+
+    return status;
+}
+
+static void
+geo_xy_sums_new(
+        geomap_xy_sums_t* const sums) {
+
+    surface_new(&sums->sf1);
+    surface_new(&sums->sf2);
+    sums->has_sf2 = 0;
+    sums->cross = NULL;
+    sums->zz = 0.0;
+}
+
+static void
+geo_xy_sums_free(
+        geomap_xy_sums_t* const sums) {
+
+    surface_free(&sums->sf1);
+    surface_free(&sums->sf2);
+    free(sums->cross);
+    geo_xy_sums_new(sums);
+}
+
+static int
+geo_xy_sums_init(
+        const geomap_fit_t* const fit,
+        const bbox_t* const bbox,
+        const int xfit,
+        geomap_xy_sums_t* const sums,
+        stimage_error_t* const error) {
+
+    if (geo_init_xy_surfaces(
+                fit, bbox, xfit, &sums->sf1, &sums->sf2, &sums->has_sf2,
+                error) ||
+        surface_zero(&sums->sf1, error)) {
+        return 1;
+    }
+
+    if (sums->has_sf2) {
+        if (surface_zero(&sums->sf2, error)) return 1;
+        sums->cross = calloc(
+                sums->sf1.ncoeff * sums->sf2.ncoeff, sizeof(double));
+        if (sums->cross == NULL) {
+            stimage_error_set_message(error, "Out of memory");
+            return 1;
+        }
+    }
+
+    return 0;
+}
+
+/* Accumulate the normal equations of the x (if xfit) or y fit of a
+   shift, xyscale or general fit.  z and tmp are scratch space for
+   ncoord values each. */
+static int
+geo_xy_sums_add(
+        const geomap_fit_e fit_geometry,
+        geomap_xy_sums_t* const sums,
+        const int xfit,
+        const size_t ncoord,
+        const coord_t* const input,
+        const coord_t* const ref,
+        double* const weights,
+        double* const z,
+        double* const tmp,
+        stimage_error_t* const error) {
+
+    surface_t    unit;
+    const size_t n2     = sums->sf2.ncoeff;
+    size_t       i      = 0;
+    size_t       j      = 0;
+    int          status = 1;
+
+    surface_new(&unit);
+
+    geo_get_ordinate(fit_geometry, xfit, ncoord, input, ref, z);
+    for (i = 0; i < ncoord; ++i) {
+        sums->zz += weights[i] * z[i] * z[i];
+    }
+
+    if (surface_fit_add_points(
+                &sums->sf1, ncoord, ref, z, weights, surface_fit_weight_user,
+                1, error)) goto exit;
+
+    if (sums->has_sf2) {
+        if (surface_fit_add_points(
+                    &sums->sf2, ncoord, ref, z, weights,
+                    surface_fit_weight_user, 1, error)) goto exit;
+
+        /* Project each basis function of sf1 onto the basis of sf2 */
+        if (surface_copy(&sums->sf1, &unit, error)) goto exit;
+        for (j = 0; j < unit.ncoeff; ++j) {
+            for (i = 0; i < unit.ncoeff; ++i) {
+                unit.coeff[i] = (i == j) ? 1.0 : 0.0;
+            }
+            if (surface_vector(&unit, ncoord, ref, 1, tmp, error) ||
+                surface_fit_add_vector(
+                        &sums->sf2, ncoord, ref, tmp, weights,
+                        sums->cross + j * n2, error)) goto exit;
+        }
+    }
+
+    status = 0;
+
+ exit:
+
+    surface_free(&unit);
+
+    return status;
+}
+
+/* Returns c^T M c, where M is the matrix of the normal equations of
+   s.  Row i of the matrix holds the elements of columns i and
+   above. */
+static double
+normal_quadratic(
+        const surface_t* const s,
+        const double* const c) {
+
+    const size_t n   = s->ncoeff;
+    double       sum = 0.0;
+    size_t       i   = 0;
+    size_t       j   = 0;
+
+    for (i = 0; i < n; ++i) {
+        sum += c[i] * c[i] * s->matrix[i * n];
+        for (j = i + 1; j < n; ++j) {
+            sum += 2.0 * c[i] * c[j] * s->matrix[i * n + j - i];
+        }
+    }
+
+    return sum;
+}
+
+static double
+dot_product(
+        const size_t n,
+        const double* const a,
+        const double* const b) {
+
+    double sum = 0.0;
+    size_t i   = 0;
+
+    for (i = 0; i < n; ++i) {
+        sum += a[i] * b[i];
+    }
+
+    return sum;
+}
+
+/* Solve the normal equations accumulated for the x (if xfit) or y fit
+   of a shift, xyscale or general fit.  The weighted sum of the
+   squared residuals is returned in rms. */
+static int
+geo_xy_sums_solve(
+        const geomap_fit_t* const fit,
+        const geomap_xy_sums_t* const sums,
+        const bbox_t* const bbox,
+        const int xfit,
+        /* Output */
+        surface_t* const sf1,
+        surface_t* const sf2,
+        int* const has_secondary,
+        double* const rms,
+        stimage_error_t* const error) {
+
+    surface_fit_error_e fit_error = surface_fit_error_ok;
+    double              sum       = 0.0;
+    double              shift     = 0.0;
+    size_t              i         = 0;
+    size_t              j         = 0;
+
+    *has_secondary = 0;
+
+    if (surface_copy(&sums->sf1, sf1, error) ||
+        surface_fit_solve(sf1, &fit_error, error) ||
+        _geo_fit_xy_validate_fit_error(
+                fit_error, xfit, fit->projection, error)) {
+        return 1;
+    }
+
+    sum = sums->zz - 2.0 * dot_product(sf1->ncoeff, sf1->coeff, sf1->vector) +
+        normal_quadratic(sf1, sf1->coeff);
+
+    if (sums->has_sf2) {
+        /* Fit sf2 to the residuals of sf1 */
+        if (surface_copy(&sums->sf2, sf2, error)) return 1;
+        for (j = 0; j < sf1->ncoeff; ++j) {
+            for (i = 0; i < sf2->ncoeff; ++i) {
+                sf2->vector[i] -= sums->cross[j * sf2->ncoeff + i] * sf1->coeff[j];
+            }
+        }
+
+        if (surface_fit_solve(sf2, &fit_error, error) ||
+            _geo_fit_xy_validate_fit_error(
+                    fit_error, xfit, fit->projection, error)) {
+            return 1;
+        }
+
+        sum += -2.0 * dot_product(sf2->ncoeff, sf2->coeff, sf2->vector) +
+            normal_quadratic(sf2, sf2->coeff);
+        *has_secondary = 1;
+    }
+
+    *rms = MAX(sum, 0.0);
+
+    if (fit->fit_geometry == geomap_fit_shift) {
+        shift = sf1->coeff[0];
+        surface_free(sf1);
+        if (geo_shift_surface(
+                    fit->function, bbox, xfit, shift, sf1, error)) return 1;
+    }
+
+    return 0;
+}
+
+/* Returns the weighted sum of the squared residuals of coordinate k
+   of the moments from the fit mean[k] + a * (xref - mean[0]) + b *
+   (yref - mean[1]) */
+static double
+moments_rms(
+        const geomap_moments_t* const m,
+        const size_t k,
+        const double a,
+        const double b) {
+
+    double sum = 0.0;
+
+    sum = m->comoment[k][k] -
+        2.0 * (a * m->comoment[0][k] + b * m->comoment[1][k]) +
+        a * a * m->comoment[0][0] +
+        2.0 * a * b * m->comoment[0][1] +
+        b * b * m->comoment[1][1];
+
+    return MAX(sum, 0.0);
+}
+
+void
+geomap_accumulator_new(
+        geomap_accumulator_t* const acc) {
+
+    assert(acc);
+
+    memset(acc, 0, sizeof(geomap_accumulator_t));
+    geo_xy_sums_new(&acc->x);
+    geo_xy_sums_new(&acc->y);
+}
+
+int
+geomap_accumulator_init(
+        geomap_accumulator_t* const acc,
+        const bbox_t* const bbox,
+        const geomap_fit_e fit_geometry,
+        const surface_type_e function,
+        const size_t xxorder,
+        const size_t xyorder,
+        const size_t yxorder,
+        const size_t yyorder,
+        const xterms_e xxterms,
+        const xterms_e yxterms,
+        stimage_error_t* const error) {
+
+    geomap_fit_t fit;
+    bbox_t       tbbox;
+
+    assert(acc);
+    assert(bbox);
+    assert(error);
+
+    geomap_accumulator_free(acc);
+
+    if (!isfinite(bbox->min.x) || !isfinite(bbox->min.y) ||
+        !isfinite(bbox->max.x) || !isfinite(bbox->max.y) ||
+        !(bbox->max.x > bbox->min.x) || !(bbox->max.y > bbox->min.y)) {
+        stimage_error_set_message(
+                error, "bbox must be finite, with a non-zero width and height");
+        return 1;
+    }
+
+    acc->fit_geometry = fit_geometry;
+    acc->function = function;
+    bbox_copy(bbox, &acc->bbox);
+
+    geomap_fit_init(
+            &fit, geomap_proj_none, fit_geometry, function,
+            xxorder, xyorder, xxterms, yxorder, yyorder, yxterms, 0, 0.0);
+    bbox_copy(bbox, &tbbox);
+    bbox_make_nonsingular(&tbbox);
+
+    switch (fit_geometry) {
+    case geomap_fit_rotate:
+    case geomap_fit_rscale:
+    case geomap_fit_rxyscale:
+        break;
+    default:
+        if (geo_xy_sums_init(&fit, &tbbox, 1, &acc->x, error) ||
+            geo_xy_sums_init(&fit, &tbbox, 0, &acc->y, error)) {
+            geomap_accumulator_free(acc);
+            return 1;
+        }
+        break;
+    }
+
+    return 0;
+}
+
+void
+geomap_accumulator_free(
+        geomap_accumulator_t* const acc) {
+
+    assert(acc);
+
+    geo_xy_sums_free(&acc->x);
+    geo_xy_sums_free(&acc->y);
+    geomap_accumulator_new(acc);
+}
+
+int
+geomap_accumulator_add(
+        geomap_accumulator_t* const acc,
+        const coord_view_t* const input,
+        const coord_view_t* const ref,
+        const double* const weights,
+        stimage_error_t* const error) {
+
+    const size_t     n       = input->n;
+    coord_t*         tinput  = NULL;
+    coord_t*         tref    = NULL;
+    double*          w       = NULL;
+    double*          z       = NULL;
+    double*          tmp     = NULL;
+    geomap_moments_t moments;
+    size_t           ncoord  = 0;
+    size_t           i       = 0;
+    int              status  = 1;
+
+    assert(acc);
+    assert(input);
+    assert(ref);
+    assert(error);
+
+    if (input->n != ref->n) {
+        stimage_error_set_message(
+            error, "Must have the same number of input and reference coordinates.");
+        goto exit;
+    }
+
+    if (n == 0) {
+        status = 0;
+        goto exit;
+    }
+
+    tinput = malloc_with_error(n * sizeof(coord_t), error);
+    if (tinput == NULL) goto exit;
+    tref = malloc_with_error(n * sizeof(coord_t), error);
+    if (tref == NULL) goto exit;
+    w = malloc_with_error(3 * n * sizeof(double), error);
+    if (w == NULL) goto exit;
+    z = w + n;
+    tmp = z + n;
+
+    coord_view_gather(input, 0, n, tinput);
+    coord_view_gather(ref, 0, n, tref);
+
+    /* Reduce the chunk to the coordinates in the bbox, in place */
+    for (i = 0; i < n; ++i) {
+        if (tref[i].x < acc->bbox.min.x || tref[i].x > acc->bbox.max.x ||
+            tref[i].y < acc->bbox.min.y || tref[i].y > acc->bbox.max.y) {
+            continue;
+        }
+        tinput[ncoord] = tinput[i];
+        tref[ncoord] = tref[i];
+        w[ncoord] = (weights == NULL) ? 1.0 : weights[i];
+        ++ncoord;
+    }
+
+    acc->ncoord += ncoord;
+    acc->n_zero_weighted += count_zero_weighted(ncoord, w);
+    for (i = 0; i < ncoord; ++i) {
+        acc->sum_ref.x += tref[i].x;
+        acc->sum_ref.y += tref[i].y;
+        acc->sum_input.x += tinput[i].x;
+        acc->sum_input.y += tinput[i].y;
+    }
+
+    if (ncoord == 0) {
+        status = 0;
+        goto exit;
+    }
+
+    switch (acc->fit_geometry) {
+    case geomap_fit_rotate:
+    case geomap_fit_rscale:
+    case geomap_fit_rxyscale:
+        compute_moments(ncoord, tinput, tref, w, &moments);
+        merge_moments(&acc->moments, &moments);
+        break;
+    default:
+        if (geo_xy_sums_add(
+                    acc->fit_geometry, &acc->x, 1, ncoord, tinput, tref, w,
+                    z, tmp, error) ||
+            geo_xy_sums_add(
+                    acc->fit_geometry, &acc->y, 0, ncoord, tinput, tref, w,
+                    z, tmp, error)) goto exit;
+        break;
+    }
+
+    status = 0;
+
+ exit:
+
+    free(tinput);
+    free(tref);
+    free(w);
+
+    return status;
+}
+
+static int
+geo_xy_sums_merge(
+        geomap_xy_sums_t* const sums,
+        const geomap_xy_sums_t* const other,
+        stimage_error_t* const error) {
+
+    size_t i = 0;
+
+    if (sums->sf1.coeff == NULL) {
+        return 0;
+    }
+
+    if (other->has_sf2 != sums->has_sf2 ||
+        surface_fit_merge(&sums->sf1, &other->sf1, error) ||
+        (sums->has_sf2 &&
+         surface_fit_merge(&sums->sf2, &other->sf2, error))) {
+        stimage_error_set_message(
+                error, "Can not merge geomap accumulators with different parameters");
+        return 1;
+    }
+
+    if (sums->has_sf2) {
+        for (i = 0; i < sums->sf1.ncoeff * sums->sf2.ncoeff; ++i) {
+            sums->cross[i] += other->cross[i];
+        }
+    }
+
+    sums->zz += other->zz;
+
+    return 0;
+}
+
+int
+geomap_accumulator_merge(
+        geomap_accumulator_t* const acc,
+        const geomap_accumulator_t* const other,
+        stimage_error_t* const error) {
+
+    assert(acc);
+    assert(other);
+    assert(error);
+
+    if (acc->fit_geometry != other->fit_geometry ||
+        acc->function != other->function ||
+        acc->bbox.min.x != other->bbox.min.x ||
+        acc->bbox.min.y != other->bbox.min.y ||
+        acc->bbox.max.x != other->bbox.max.x ||
+        acc->bbox.max.y != other->bbox.max.y ||
+        (acc->x.sf1.coeff == NULL) != (other->x.sf1.coeff == NULL)) {
+        stimage_error_set_message(
+                error, "Can not merge geomap accumulators with different parameters");
+        return 1;
+    }
+
+    if (geo_xy_sums_merge(&acc->x, &other->x, error) ||
+        geo_xy_sums_merge(&acc->y, &other->y, error)) {
+        return 1;
+    }
+
+    acc->ncoord += other->ncoord;
+    acc->n_zero_weighted += other->n_zero_weighted;
+    acc->sum_ref.x += other->sum_ref.x;
+    acc->sum_ref.y += other->sum_ref.y;
+    acc->sum_input.x += other->sum_input.x;
+    acc->sum_input.y += other->sum_input.y;
+    merge_moments(&acc->moments, &other->moments);
+
+    return 0;
+}
+
+int
+geomap_accumulator_solve(
+        const geomap_accumulator_t* const acc,
+        geomap_result_t* const result,
+        stimage_error_t* const error) {
+
+    geomap_fit_t fit;
+    bbox_t       bbox;
+    surface_t    sx1, sy1, sx2, sy2;
+    int          has_sx2 = 0;
+    int          has_sy2 = 0;
+    coord_t      r0      = {0.0, 0.0};
+    coord_t      i0      = {0.0, 0.0};
+    coord_t      cthetac = {0.0, 0.0};
+    coord_t      sthetac = {0.0, 0.0};
+    double       my_nan  = fmod(1.0, 0.0);
+    int          status  = 1;
+
+    assert(acc);
+    assert(result);
+    assert(error);
+
+    surface_new(&sx1);
+    surface_new(&sy1);
+    surface_new(&sx2);
+    surface_new(&sy2);
+
+    /* The orders and cross terms are already in the surfaces */
+    geomap_fit_init(
+            &fit, geomap_proj_none, acc->fit_geometry, acc->function,
+            2, 2, xterms_none, 2, 2, xterms_none, 0, 0.0);
+    bbox_copy(&acc->bbox, &fit.bbox);
+    bbox_copy(&acc->bbox, &bbox);
+    bbox_make_nonsingular(&bbox);
+
+    fit.oref.x = acc->sum_ref.x / (double)acc->ncoord;
+    fit.oref.y = acc->sum_ref.y / (double)acc->ncoord;
+    fit.oin.x = acc->sum_input.x / (double)acc->ncoord;
+    fit.oin.y = acc->sum_input.y / (double)acc->ncoord;
+    fit.refpt.x = my_nan;
+    fit.refpt.y = my_nan;
+    fit.ncoord = acc->ncoord;
+    fit.n_zero_weighted = acc->n_zero_weighted;
+
+    switch (acc->fit_geometry) {
+    case geomap_fit_rotate:
+    case geomap_fit_rscale:
+    case geomap_fit_rxyscale:
+        if (geo_rotation_check_weight(&fit, acc->moments.sw, error)) goto exit;
+
+        r0.x = acc->moments.mean[0];
+        r0.y = acc->moments.mean[1];
+        i0.x = acc->moments.mean[2];
+        i0.y = acc->moments.mean[3];
+        geo_rotation_coefficients(
+                acc->fit_geometry, &acc->moments, &cthetac, &sthetac);
+
+        if (compute_surface_coefficients(
+                    fit.function, &bbox, &i0, &r0, &cthetac, &sthetac,
+                    &sx1, &sy1, error)) goto exit;
+
+        fit.xrms = moments_rms(&acc->moments, 2, cthetac.x, sthetac.x);
+        fit.yrms = moments_rms(&acc->moments, 3, -sthetac.y, cthetac.y);
+        break;
+    default:
+        if (geo_xy_sums_solve(
+                    &fit, &acc->x, &bbox, 1, &sx1, &sx2, &has_sx2, &fit.xrms,
+                    error) ||
+            geo_xy_sums_solve(
+                    &fit, &acc->y, &bbox, 0, &sy1, &sy2, &has_sy2, &fit.yrms,
+                    error)) goto exit;
+        break;
+    }
+
+    if (geo_get_results(
+                &fit, &sx1, &sy1, &sx2, &sy2, has_sx2, has_sy2, result,
+                error)) goto exit;
+
+    geo_give_transform(&sx1, &sy1, &sx2, &sy2, has_sx2, has_sy2, result);
+
+    status = 0;
+
+ exit:
+
+    surface_free(&sx1);
+    surface_free(&sy1);
+    surface_free(&sx2);
+    surface_free(&sy2);
+
     return status;
 }
 
+/* Copies n doubles to (if get) or from state, and returns the
+   position after them */
+static double*
+geo_state_copy(
+        const int get,
+        double* const state,
+        double* const values,
+        const size_t n) {
+
+    if (get) {
+        memcpy(state, values, n * sizeof(double));
+    } else {
+        memcpy(values, state, n * sizeof(double));
+    }
+
+    return state + n;
+}
+
+static double*
+geo_xy_sums_state(
+        const int get,
+        double* state,
+        geomap_xy_sums_t* const sums) {
+
+    double npoints[2];
+
+    if (sums->sf1.coeff == NULL) {
+        return state;
+    }
+
+    npoints[0] = (double)sums->sf1.npoints;
+    npoints[1] = (double)sums->sf2.npoints;
+    state = geo_state_copy(get, state, npoints, 2);
+    sums->sf1.npoints = (size_t)npoints[0];
+    sums->sf2.npoints = (size_t)npoints[1];
+
+    state = geo_state_copy(get, state, &sums->zz, 1);
+    state = geo_state_copy(
+            get, state, sums->sf1.matrix, sums->sf1.ncoeff * sums->sf1.ncoeff);
+    state = geo_state_copy(get, state, sums->sf1.vector, sums->sf1.ncoeff);
+
+    if (sums->has_sf2) {
+        state = geo_state_copy(
+                get, state, sums->sf2.matrix,
+                sums->sf2.ncoeff * sums->sf2.ncoeff);
+        state = geo_state_copy(get, state, sums->sf2.vector, sums->sf2.ncoeff);
+        state = geo_state_copy(
+                get, state, sums->cross, sums->sf1.ncoeff * sums->sf2.ncoeff);
+    }
+
+    return state;
+}
+
+/* Copies the state of the accumulator to (if get) or from state, and
+   returns the number of doubles copied */
+static size_t
+geo_accumulator_state(
+        const int get,
+        double* state,
+        geomap_accumulator_t* const acc) {
+
+    double* const start = state;
+    double        counts[6];
+
+    counts[0] = (double)acc->ncoord;
+    counts[1] = (double)acc->n_zero_weighted;
+    counts[2] = acc->sum_ref.x;
+    counts[3] = acc->sum_ref.y;
+    counts[4] = acc->sum_input.x;
+    counts[5] = acc->sum_input.y;
+    state = geo_state_copy(get, state, counts, 6);
+    acc->ncoord = (size_t)counts[0];
+    acc->n_zero_weighted = (size_t)counts[1];
+    acc->sum_ref.x = counts[2];
+    acc->sum_ref.y = counts[3];
+    acc->sum_input.x = counts[4];
+    acc->sum_input.y = counts[5];
+
+    state = geo_state_copy(get, state, &acc->moments.sw, 1);
+    state = geo_state_copy(get, state, acc->moments.mean, 4);
+    state = geo_state_copy(get, state, &acc->moments.comoment[0][0], 16);
+
+    state = geo_xy_sums_state(get, state, &acc->x);
+    state = geo_xy_sums_state(get, state, &acc->y);
+
+    return (size_t)(state - start);
+}
+
+size_t
+geomap_accumulator_state_size(
+        const geomap_accumulator_t* const acc) {
+
+    const geomap_xy_sums_t* sums[2];
+    size_t                  size = 6 + 1 + 4 + 16;
+    size_t                  i    = 0;
+
+    assert(acc);
+
+    sums[0] = &acc->x;
+    sums[1] = &acc->y;
+    for (i = 0; i < 2; ++i) {
+        if (sums[i]->sf1.coeff == NULL) {
+            continue;
+        }
+        size += 3 + sums[i]->sf1.ncoeff * (sums[i]->sf1.ncoeff + 1);
+        if (sums[i]->has_sf2) {
+            size += sums[i]->sf2.ncoeff * (sums[i]->sf2.ncoeff + 1) +
+                sums[i]->sf1.ncoeff * sums[i]->sf2.ncoeff;
+        }
+    }
+
+    return size;
+}
+
+void
+geomap_accumulator_get_state(
+        const geomap_accumulator_t* const acc,
+        double* const state) {
+
+    geomap_accumulator_t copy;
+
+    assert(acc);
+    assert(state);
+
+    /* Only the pointers are shared, and they are only read */
+    copy = *acc;
+    geo_accumulator_state(1, state, &copy);
+}
+
+void
+geomap_accumulator_set_state(
+        geomap_accumulator_t* const acc,
+        const double* const state) {
+
+    assert(acc);
+    assert(state);
+
+    geo_accumulator_state(0, (double*)state, acc);
+}
+
 void
 geomap_result_init(
         geomap_result_t* const r) {
@@ -1706,6 +2501,7 @@ geomap_result_init(
     r->ycoeff = NULL;
     r->x2coeff = NULL;
     r->y2coeff = NULL;
+    geomap_transform_new(&r->transform);
 }
 
 void
@@ -1716,6 +2512,245 @@ geomap_result_free(
     free(r->ycoeff); r->ycoeff = NULL;
     free(r->x2coeff); r->x2coeff = NULL;
     free(r->y2coeff); r->y2coeff = NULL;
+    geomap_transform_free(&r->transform);
+}
+
+void
+geomap_transform_new(
+        geomap_transform_t* const t) {
+
+    assert(t);
+
+    surface_new(&t->sx1);
+    surface_new(&t->sy1);
+    surface_new(&t->sx2);
+    surface_new(&t->sy2);
+    t->has_sx2 = 0;
+    t->has_sy2 = 0;
+}
+
+void
+geomap_transform_free(
+        geomap_transform_t* const t) {
+
+    assert(t);
+
+    surface_free(&t->sx1);
+    surface_free(&t->sy1);
+    surface_free(&t->sx2);
+    surface_free(&t->sy2);
+    t->has_sx2 = 0;
+    t->has_sy2 = 0;
+}
+
+#define GEOMAP_TRANSFORM_BLOCK 4096
+
+/* The number of coordinates transformed by each task, and the number
+   of grid points that the rows handed to each task add up to */
+#define GEOMAP_TRANSFORM_CHUNK (16 * GEOMAP_TRANSFORM_BLOCK)
+
+typedef struct {
+    const geomap_transform_t* t;
+    int                       has_sx2;
+    int                       has_sy2;
+    const coord_view_t*       ref;
+    coord_t*                  out;
+} geo_apply_t;
+
+static int
+geo_apply_task(
+        void* data,
+        size_t index,
+        stimage_error_t* error) {
+
+    const geo_apply_t* const a = (geo_apply_t*)data;
+    const geomap_transform_t* const t = a->t;
+    const coord_view_t* const ref = a->ref;
+    const size_t   end     = MIN(ref->n, (index + 1) * GEOMAP_TRANSFORM_CHUNK);
+    workspace_t    workspace;
+    const coord_t* packed  = NULL;
+    const coord_t* block   = NULL;
+    double*        buffer  = NULL;
+    double*        xfit    = NULL;
+    double*        yfit    = NULL;
+    double*        tmp     = NULL;
+    coord_t*       coords  = NULL;
+    size_t         start   = 0;
+    size_t         nblock  = 0;
+    size_t         i       = 0;
+    int            status  = 1;
+
+    workspace_new(&workspace);
+
+    buffer = malloc_with_error(
+            3 * GEOMAP_TRANSFORM_BLOCK * sizeof(double), error);
+    if (buffer == NULL) goto exit;
+    xfit = buffer;
+    yfit = buffer + GEOMAP_TRANSFORM_BLOCK;
+    tmp = buffer + 2 * GEOMAP_TRANSFORM_BLOCK;
+
+    packed = coord_view_packed(ref);
+    if (packed == NULL) {
+        coords = malloc_with_error(
+                GEOMAP_TRANSFORM_BLOCK * sizeof(coord_t), error);
+        if (coords == NULL) goto exit;
+    }
+
+    /* The whole block is evaluated before any of it is written, so out
+       may alias ref */
+    for (start = index * GEOMAP_TRANSFORM_CHUNK; start < end;
+         start += GEOMAP_TRANSFORM_BLOCK) {
+        nblock = MIN(GEOMAP_TRANSFORM_BLOCK, end - start);
+
+        if (packed != NULL) {
+            block = packed + start;
+        } else {
+            coord_view_gather(ref, start, nblock, coords);
+            block = coords;
+        }
+
+        if (geo_eval_surface(
+                    &t->sx1, &t->sx2, a->has_sx2, nblock, block,
+                    &workspace, tmp, xfit, error)) goto exit;
+        if (geo_eval_surface(
+                    &t->sy1, &t->sy2, a->has_sy2, nblock, block,
+                    &workspace, tmp, yfit, error)) goto exit;
+
+        for (i = 0; i < nblock; ++i) {
+            a->out[start + i].x = xfit[i];
+            a->out[start + i].y = yfit[i];
+        }
+    }
+
+    status = 0;
+
+ exit:
+
+    free(buffer);
+    free(coords);
+    workspace_free(&workspace);
+
+    return status;
+}
+
+int
+geomap_transform_apply(
+        const geomap_transform_t* const t,
+        const int distortion,
+        const coord_view_t* const ref,
+        const size_t nthreads,
+        /* Output */
+        coord_t* const out,
+        stimage_error_t* const error) {
+
+    geo_apply_t apply;
+
+    assert(t);
+    assert(ref);
+    assert(out);
+    assert(error);
+
+    if (t->sx1.coeff == NULL || t->sy1.coeff == NULL) {
+        stimage_error_set_message(error, "Transform is not initialized");
+        return 1;
+    }
+
+    apply.t = t;
+    apply.has_sx2 = distortion && t->has_sx2;
+    apply.has_sy2 = distortion && t->has_sy2;
+    apply.ref = ref;
+    apply.out = out;
+
+    return parallel_for(
+            (ref->n + GEOMAP_TRANSFORM_CHUNK - 1) / GEOMAP_TRANSFORM_CHUNK,
+            nthreads, &geo_apply_task, &apply, error);
+}
+
+typedef struct {
+    const geomap_transform_t* t;
+    int                       distortion;
+    size_t                    nx;
+    const double*             x;
+    size_t                    ny;
+    const double*             y;
+    size_t                    row_stride;
+    size_t                    nrows;   /* rows per task */
+    coord_t*                  out;
+} geo_grid_t;
+
+static int
+geo_grid_task(
+        void* data,
+        size_t index,
+        stimage_error_t* error) {
+
+    const geo_grid_t* const g = (geo_grid_t*)data;
+    const geomap_transform_t* const t = g->t;
+    const size_t row = index * g->nrows;
+    const size_t ny = MIN(g->nrows, g->ny - row);
+    const double* const y = g->y + row;
+    double* const xout = (double*)(g->out + row * g->row_stride);
+    double* const yout = xout + 1;
+    const size_t nx = g->nx;
+    const double* const x = g->x;
+
+    return (
+        surface_grid(
+                &t->sx1, nx, x, ny, y, 0, 2 * g->row_stride, 2, xout,
+                error) ||
+        (g->distortion && t->has_sx2 &&
+         surface_grid(
+                 &t->sx2, nx, x, ny, y, 1, 2 * g->row_stride, 2, xout,
+                 error)) ||
+        surface_grid(
+                &t->sy1, nx, x, ny, y, 0, 2 * g->row_stride, 2, yout,
+                error) ||
+        (g->distortion && t->has_sy2 &&
+         surface_grid(
+                 &t->sy2, nx, x, ny, y, 1, 2 * g->row_stride, 2, yout,
+                 error)));
+}
+
+int
+geomap_transform_grid(
+        const geomap_transform_t* const t,
+        const int distortion,
+        const size_t nx,
+        const double* const x,
+        const size_t ny,
+        const double* const y,
+        const size_t row_stride,
+        const size_t nthreads,
+        /* Output */
+        coord_t* const out,
+        stimage_error_t* const error) {
+
+    geo_grid_t grid;
+
+    assert(t);
+    assert(x);
+    assert(y);
+    assert(out);
+    assert(error);
+
+    if (t->sx1.coeff == NULL || t->sy1.coeff == NULL) {
+        stimage_error_set_message(error, "Transform is not initialized");
+        return 1;
+    }
+
+    grid.t = t;
+    grid.distortion = distortion;
+    grid.nx = nx;
+    grid.x = x;
+    grid.ny = ny;
+    grid.y = y;
+    grid.row_stride = row_stride;
+    grid.nrows = MAX(1, GEOMAP_TRANSFORM_CHUNK / MAX(1, nx));
+    grid.out = out;
+
+    return parallel_for(
+            (ny + grid.nrows - 1) / grid.nrows, nthreads, &geo_grid_task,
+            &grid, error);
 }
 
 void
@@ -0,0 +1,586 @@
+/*
+Copyright (C) 2008-2025 Association of Universities for Research in Astronomy (AURA)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above
+      copyright notice, this list of conditions and the following
+      disclaimer in the documentation and/or other materials provided
+      with the distribution.
+
+    3. The name of AURA and its representatives may not be used to
+      endorse or promote products derived from this software without
+      specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY AURA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL AURA BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+*/
+
+#define _USE_MATH_DEFINES       /* needed for MS Windows to define M_PI */
+#include <assert.h>
+#include <math.h>
+#include <stdlib.h>
+
+#include "immatch/lib/offsets.h"
+
+/* Offsets further than this many cells from the origin cannot be
+   binned, and are ignored */
+#define OFFSETS_MAX_CELL 1e15
+
+/* The chance allowed that a shift from random offsets alone gets
+   enough votes to be trusted */
+#define OFFSETS_FALSE_ALARM 0.01
+
+/* However few offsets are expected by chance, a shift needs at least
+   this many votes */
+#define OFFSETS_MIN_VOTES 3
+
+typedef struct {
+    STIMAGE_Int64 ix;
+    STIMAGE_Int64 iy;
+    coord_t       offset;
+} offset_t;
+
+/* A run of offsets in the same histogram cell */
+typedef struct {
+    STIMAGE_Int64 ix;
+    STIMAGE_Int64 iy;
+    size_t        count;
+} offset_cell_t;
+
+static int
+offset_compare(
+        const void* a,
+        const void* b) {
+
+    const offset_t* const oa = (const offset_t*)a;
+    const offset_t* const ob = (const offset_t*)b;
+
+    if (oa->iy != ob->iy) {
+        return oa->iy < ob->iy ? -1 : 1;
+    }
+    if (oa->ix != ob->ix) {
+        return oa->ix < ob->ix ? -1 : 1;
+    }
+    return 0;
+}
+
+static int
+coord_ptr_compare(
+        const void* a,
+        const void* b) {
+
+    const coord_t* const pa = *(const coord_t* const *)a;
+    const coord_t* const pb = *(const coord_t* const *)b;
+
+    return (pa > pb) - (pa < pb);
+}
+
+static void
+coord_ptr_sift_down(
+        const coord_t** const heap,
+        const size_t n,
+        size_t i) {
+
+    const coord_t* tmp;
+    size_t         child;
+
+    for (;;) {
+        child = 2 * i + 1;
+        if (child >= n) {
+            break;
+        }
+        if (child + 1 < n && heap[child + 1] > heap[child]) {
+            ++child;
+        }
+        if (heap[i] >= heap[child]) {
+            break;
+        }
+        tmp = heap[i];
+        heap[i] = heap[child];
+        heap[child] = tmp;
+        i = child;
+    }
+}
+
+/* Take the first nmatch of the coordinates, in the order they appear
+   in their raw array.  The coordinates are kept in a max-heap of
+   their addresses, so that the last of those taken so far can be
+   replaced. */
+static size_t
+first_coords(
+        const size_t ncoords,
+        const coord_t* const * const sorted,
+        const size_t nmatch,
+        const coord_t** const first /*[MIN(ncoords, nmatch)]*/) {
+
+    const size_t n = MIN(ncoords, nmatch);
+    size_t       i;
+
+    if (n == 0) {
+        return 0;
+    }
+
+    for (i = 0; i < n; ++i) {
+        first[i] = sorted[i];
+    }
+    for (i = n / 2; i-- > 0; ) {
+        coord_ptr_sift_down(first, n, i);
+    }
+
+    for (i = n; i < ncoords; ++i) {
+        if (sorted[i] < first[0]) {
+            first[0] = sorted[i];
+            coord_ptr_sift_down(first, n, 0);
+        }
+    }
+
+    qsort((void*)first, n, sizeof(coord_t*), &coord_ptr_compare);
+
+    return n;
+}
+
+/* Whether cell (ax, ay) comes before cell (bx, by), in the order the
+   cells are sorted in */
+static inline int
+offset_cell_less(
+        const STIMAGE_Int64 ax,
+        const STIMAGE_Int64 ay,
+        const STIMAGE_Int64 bx,
+        const STIMAGE_Int64 by) {
+
+    return ay < by || (ay == by && ax < bx);
+}
+
+/**
+Bin the offsets from the transformed input coordinates to the
+reference coordinates, and find the shift with the most votes.
+*/
+static void
+vote_offsets(
+        const size_t nref,
+        const coord_t* const * const ref, /*[nref]*/
+        const size_t ninput,
+        const coord_t* const input, /*[ninput]*/
+        const double tolerance,
+        offset_t* const offsets, /*[nref * ninput]*/
+        offset_cell_t* const cells, /*[nref * ninput]*/
+        coord_t* const shift,
+        size_t* const nvotes) {
+
+    const double  tolerance2 = tolerance * tolerance;
+    size_t        noffsets   = 0;
+    size_t        ncells     = 0;
+    size_t        best       = 0;
+    size_t        best_score = 0;
+    size_t        row[3];
+    size_t        score, nblock, i, j;
+    STIMAGE_Int64 dy, iy;
+    coord_t       offset, sum, mean;
+    double        cx, cy;
+
+    *nvotes = 0;
+
+    for (i = 0; i < nref; ++i) {
+        for (j = 0; j < ninput; ++j) {
+            offset.x = ref[i]->x - input[j].x;
+            offset.y = ref[i]->y - input[j].y;
+            cx = floor(offset.x / tolerance);
+            cy = floor(offset.y / tolerance);
+            if (!(fabs(cx) < OFFSETS_MAX_CELL) ||
+                !(fabs(cy) < OFFSETS_MAX_CELL)) {
+                continue;
+            }
+            offsets[noffsets].ix = (STIMAGE_Int64)cx;
+            offsets[noffsets].iy = (STIMAGE_Int64)cy;
+            offsets[noffsets].offset = offset;
+            ++noffsets;
+        }
+    }
+
+    if (noffsets == 0) {
+        return;
+    }
+
+    /* Count the offsets in each cell */
+    qsort(offsets, noffsets, sizeof(offset_t), &offset_compare);
+
+    for (i = 0; i < noffsets; ++i) {
+        if (ncells == 0 ||
+            offsets[i].ix != cells[ncells - 1].ix ||
+            offsets[i].iy != cells[ncells - 1].iy) {
+            cells[ncells].ix = offsets[i].ix;
+            cells[ncells].iy = offsets[i].iy;
+            cells[ncells].count = 0;
+            ++ncells;
+        }
+        ++cells[ncells - 1].count;
+    }
+
+    /* Find the densest 3x3 block of cells.  The cells are sorted by
+       row, so the first cell of the block in each of the three rows
+       only moves forward from one cell to the next.  The first block
+       found wins a tie. */
+    for (dy = 0; dy < 3; ++dy) {
+        row[dy] = 0;
+    }
+    for (i = 0; i < ncells; ++i) {
+        score = 0;
+        for (dy = 0; dy < 3; ++dy) {
+            iy = cells[i].iy + dy - 1;
+            while (row[dy] < ncells &&
+                   offset_cell_less(
+                           cells[row[dy]].ix, cells[row[dy]].iy,
+                           cells[i].ix - 1, iy)) {
+                ++row[dy];
+            }
+            for (j = row[dy];
+                 j < ncells &&
+                     !offset_cell_less(
+                             cells[i].ix + 1, iy, cells[j].ix, cells[j].iy);
+                 ++j) {
+                score += cells[j].count;
+            }
+        }
+        if (score > best_score) {
+            best_score = score;
+            best = i;
+        }
+    }
+
+    /* The mean of the offsets in the block... */
+    sum.x = sum.y = 0.0;
+    nblock = 0;
+    for (i = 0; i < noffsets; ++i) {
+        if (offsets[i].ix >= cells[best].ix - 1 &&
+            offsets[i].ix <= cells[best].ix + 1 &&
+            offsets[i].iy >= cells[best].iy - 1 &&
+            offsets[i].iy <= cells[best].iy + 1) {
+            sum.x += offsets[i].offset.x;
+            sum.y += offsets[i].offset.y;
+            ++nblock;
+        }
+    }
+    mean.x = sum.x / (double)nblock;
+    mean.y = sum.y / (double)nblock;
+
+    /* ...refined to the mean of those within tolerance of it */
+    sum.x = sum.y = 0.0;
+    for (i = 0; i < noffsets; ++i) {
+        if (euclid_distance2(&offsets[i].offset, &mean) <= tolerance2) {
+            sum.x += offsets[i].offset.x;
+            sum.y += offsets[i].offset.y;
+            ++*nvotes;
+        }
+    }
+
+    if (*nvotes) {
+        shift->x = sum.x / (double)*nvotes;
+        shift->y = sum.y / (double)*nvotes;
+    }
+}
+
+/* The covariance of the coordinates, as (var x, var y, cov xy) */
+static void
+coords_covariance(
+        const size_t ncoords,
+        const coord_t* const * const coords, /*[ncoords]*/
+        double* const covariance /*[3]*/) {
+
+    coord_t mean = {0.0, 0.0};
+    double  dx, dy;
+    size_t  i;
+
+    covariance[0] = covariance[1] = covariance[2] = 0.0;
+    if (ncoords == 0) {
+        return;
+    }
+
+    for (i = 0; i < ncoords; ++i) {
+        mean.x += coords[i]->x;
+        mean.y += coords[i]->y;
+    }
+    mean.x /= (double)ncoords;
+    mean.y /= (double)ncoords;
+
+    for (i = 0; i < ncoords; ++i) {
+        dx = coords[i]->x - mean.x;
+        dy = coords[i]->y - mean.y;
+        covariance[0] += dx * dx;
+        covariance[1] += dy * dy;
+        covariance[2] += dx * dy;
+    }
+    for (i = 0; i < 3; ++i) {
+        covariance[i] /= (double)ncoords;
+    }
+}
+
+/* The area covered by coordinates with the given covariance, taking
+   them to be spread uniformly over a rectangle, which has an area of
+   12 sqrt(det(covariance)) whatever its orientation.  It is at least
+   min_area. */
+static double
+covariance_area(
+        const double* const covariance /*[3]*/,
+        const double min_area) {
+
+    const double det = covariance[0] * covariance[1] -
+        covariance[2] * covariance[2];
+
+    return MAX(12.0 * sqrt(MAX(det, 0.0)), min_area);
+}
+
+/* The fewest votes a shift needs to stand out from the offsets
+   between coordinates that do not correspond.  Those are spread over
+   offset space, and are densest where the two lists overlap most,
+   where a circle of radius tolerance expects
+
+       lambda = nref * ninput * pi tolerance^2 / max(area)
+
+   of them.  The number of votes in such a circle is Poisson, and
+   there are as many independent circles as fit in the area the
+   offsets cover in each trial.  The result is the smallest number of
+   votes that random offsets reach in any of them with a chance of
+   less than OFFSETS_FALSE_ALARM. */
+static size_t
+offsets_min_votes(
+        const size_t nref,
+        const coord_t* const * const ref, /*[nref]*/
+        const size_t ninput,
+        const coord_t* const * const input, /*[ninput]*/
+        const double tolerance,
+        const size_t ntrials) {
+
+    const double circle = M_PI * tolerance * tolerance;
+    double       ref_cov[3], input_cov[3], offset_cov[3];
+    double       lambda, ntests, tail;
+    size_t       v, i;
+
+    coords_covariance(nref, ref, ref_cov);
+    coords_covariance(ninput, input, input_cov);
+    for (i = 0; i < 3; ++i) {
+        offset_cov[i] = ref_cov[i] + input_cov[i];
+    }
+
+    lambda = (double)nref * (double)ninput * circle /
+        MAX(covariance_area(ref_cov, circle),
+            covariance_area(input_cov, circle));
+    ntests = (double)ntrials * covariance_area(offset_cov, circle) / circle;
+
+    if (!(lambda > 0.0)) {
+        return OFFSETS_MIN_VOTES;
+    }
+
+    /* Above the mean, the terms of the Poisson tail fall faster than
+       a geometric series with ratio lambda / (v + 1), which bounds
+       the tail from above */
+    v = MAX((size_t)floor(lambda) + 1, OFFSETS_MIN_VOTES);
+    for (;; ++v) {
+        tail = exp((double)v * log(lambda) - lambda -
+                   lgamma((double)v + 1.0)) /
+            (1.0 - lambda / ((double)v + 1.0));
+        if (!(ntests * tail >= OFFSETS_FALSE_ALARM)) {
+            break;
+        }
+    }
+
+    return v;
+}
+
+/* The trial value of index i of 2 * n + 1, in the order 0, +step,
+   -step, +2 step, -2 step, ..., so that the trials closest to center
+   come first and win ties */
+static double
+trial_value(
+        const double center,
+        const double step,
+        const size_t i) {
+
+    const double k = (double)((i + 1) / 2);
+
+    return (i % 2) ? center + k * step : center - k * step;
+}
+
+static int
+trial_count(
+        const char* const name,
+        const double max,
+        const double step,
+        size_t* const n,
+        stimage_error_t* const error) {
+
+    if (!(max >= 0.0) || !isfinite(max)) {
+        stimage_error_format_message(
+            error, "The maximum %s must be finite and non-negative", name);
+        return 1;
+    }
+
+    if (max == 0.0) {
+        *n = 0;
+        return 0;
+    }
+
+    if (!(step > 0.0) || !isfinite(step)) {
+        stimage_error_format_message(
+            error, "The %s step must be finite and positive", name);
+        return 1;
+    }
+
+    *n = (size_t)floor(max / step + 1e-9);
+
+    return 0;
+}
+
+int
+match_offsets(
+        const size_t nref,
+        const coord_t* const ref,
+        const coord_t* const * const ref_sorted, /*[nref]*/
+        const size_t ninput,
+        const coord_t* const input,
+        const coord_t* const * const input_sorted, /*[ninput]*/
+        const size_t nmatch,
+        const double tolerance,
+        const double max_rotation,
+        const double rotation_step,
+        const double max_scale,
+        const double scale_step,
+        lintransform_t* const lintransform,
+        size_t* const nvotes,
+        size_t* const min_votes,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error) {
+
+    const double    start       = stimage_stats_start(stats);
+    const coord_t** ref_first   = NULL;
+    const coord_t** input_first = NULL;
+    coord_t*        trial       = NULL;
+    offset_t*       offsets     = NULL;
+    offset_cell_t*  cells       = NULL;
+    size_t          nref_first, ninput_first, npairs;
+    size_t          nrotations  = 0;
+    size_t          nscales     = 0;
+    size_t          ir, is, i;
+    size_t          votes       = 0;
+    double          angle, scale, c, s;
+    coord_t         shift;
+    int             status      = 1;
+
+    assert(ref);
+    assert(ref_sorted);
+    assert(input);
+    assert(input_sorted);
+    assert(lintransform);
+    assert(nvotes);
+    assert(min_votes);
+    assert(error);
+
+    *nvotes = 0;
+    *min_votes = 0;
+
+    if (!(tolerance > 0.0) || !isfinite(tolerance)) {
+        stimage_error_set_message(
+            error,
+            "The offsets algorithm requires a finite, positive tolerance");
+        goto exit;
+    }
+
+    if (trial_count("rotation", max_rotation, rotation_step,
+                    &nrotations, error) ||
+        trial_count("scale", max_scale, scale_step, &nscales, error)) {
+        goto exit;
+    }
+
+    if (max_scale >= 1.0) {
+        stimage_error_set_message(
+            error,
+            "The maximum scale must be less than 1");
+        goto exit;
+    }
+
+    ref_first = malloc_with_error(
+            MAX(MIN(nref, nmatch), 1) * sizeof(coord_t*), error);
+    if (ref_first == NULL) goto exit;
+
+    input_first = malloc_with_error(
+            MAX(MIN(ninput, nmatch), 1) * sizeof(coord_t*), error);
+    if (input_first == NULL) goto exit;
+
+    nref_first = first_coords(nref, ref_sorted, nmatch, ref_first);
+    ninput_first = first_coords(ninput, input_sorted, nmatch, input_first);
+    npairs = MAX(nref_first * ninput_first, 1);
+    *min_votes = offsets_min_votes(
+            nref_first, ref_first, ninput_first, input_first, tolerance,
+            (2 * nrotations + 1) * (2 * nscales + 1));
+
+    trial = malloc_with_error(MAX(ninput_first, 1) * sizeof(coord_t), error);
+    if (trial == NULL) goto exit;
+
+    offsets = malloc_with_error(npairs * sizeof(offset_t), error);
+    if (offsets == NULL) goto exit;
+
+    cells = malloc_with_error(npairs * sizeof(offset_cell_t), error);
+    if (cells == NULL) goto exit;
+
+    for (ir = 0; ir < 2 * nrotations + 1; ++ir) {
+        angle = trial_value(0.0, rotation_step, ir);
+        for (is = 0; is < 2 * nscales + 1; ++is) {
+            scale = trial_value(1.0, scale_step, is);
+            c = scale * cos(DEGTORAD(angle));
+            s = scale * sin(DEGTORAD(angle));
+
+            for (i = 0; i < ninput_first; ++i) {
+                trial[i].x = c * input_first[i]->x - s * input_first[i]->y;
+                trial[i].y = s * input_first[i]->x + c * input_first[i]->y;
+            }
+
+            vote_offsets(
+                    nref_first, ref_first, ninput_first, trial, tolerance,
+                    offsets, cells, &shift, &votes);
+
+            if (votes > *nvotes) {
+                *nvotes = votes;
+                lintransform->a = c;
+                lintransform->b = -s;
+                lintransform->c = shift.x;
+                lintransform->d = s;
+                lintransform->e = c;
+                lintransform->f = shift.y;
+            }
+        }
+    }
+
+    stimage_stats_stop(stats, "offsets.time", start);
+    stimage_stats_count(
+            stats, "offsets.trials",
+            (double)((2 * nrotations + 1) * (2 * nscales + 1)));
+    stimage_stats_count(
+            stats, "offsets.pairs", (double)(nref_first * ninput_first));
+    stimage_stats_count(stats, "offsets.votes", (double)*nvotes);
+    stimage_stats_count(stats, "offsets.min_votes", (double)*min_votes);
+
+    status = 0;
+
+ exit:
+
+    free(ref_first);
+    free(input_first);
+    free(trial);
+    free(offsets);
+    free(cells);
+
+    return status;
+}
@@ -121,3 +121,216 @@ match_tolerance(
 
     return 0;
 }
+
+int
+match_tolerance_grid(
+        const size_t nref,
+        const coord_t* const ref,
+        const coord_t* const * const ref_sorted,
+        const size_t ninput,
+        const coord_t* const input,
+        const coord_t* const * const input_sorted,
+        const double tolerance,
+        coord_match_callback_t* callback,
+        void* callback_data,
+        stimage_error_t* const error) {
+
+    const double   tolerance2  = tolerance*tolerance;
+    xygrid_t       grid;
+    size_t         rp          = 0;
+    size_t         lp          = 0;
+    size_t         ix, iy, x0, y0, x1, y1;
+    size_t         k, cell;
+    size_t         input_index = 0;
+    size_t         ref_index   = 0;
+    double         dx, dy, rmax2, r2;
+    const coord_t* rcoord;
+    const coord_t* lcoord;
+    size_t         lmatch;
+    int            status      = 1;
+
+    assert(ref);
+    assert(ref_sorted);
+    assert(input);
+    assert(input_sorted);
+    assert(callback);
+    assert(error);
+
+    xygrid_new(&grid);
+
+    /* Nothing can fall within a non-positive tolerance */
+    if (!(tolerance > 0.0) || nref == 0 || ninput == 0) {
+        status = 0;
+        goto exit;
+    }
+
+    if (xygrid_init(&grid, ninput, input_sorted, tolerance, error)) goto exit;
+
+    for (rp = 0; rp < nref; ++rp) {
+        rcoord = ref_sorted[rp];
+
+        if (!xygrid_cell_range(
+                    &grid, rcoord, tolerance, &x0, &y0, &x1, &y1)) {
+            continue;
+        }
+
+        /* Find the closest match to the reference object.  The tests
+           are the same as those in match_tolerance, and ties are
+           broken in favor of the later input in sorted order, so the
+           results are identical. */
+        rmax2 = tolerance2;
+        lmatch = ninput;
+        for (iy = y0; iy <= y1; ++iy) {
+            for (ix = x0; ix <= x1; ++ix) {
+                cell = iy * grid.nx + ix;
+                for (k = grid.cell_start[cell];
+                     k < grid.cell_start[cell + 1];
+                     ++k) {
+                    lp = grid.items[k];
+                    lcoord = input_sorted[lp];
+                    dy = rcoord->y - lcoord->y;
+                    if (dy >= tolerance || dy < -tolerance) {
+                        continue;
+                    }
+                    dx = rcoord->x - lcoord->x;
+                    r2 = dx*dx + dy*dy;
+
+                    if (r2 < rmax2 ||
+                        (r2 == rmax2 && (lmatch == ninput || lp > lmatch))) {
+                        rmax2 = r2;
+                        lmatch = lp;
+                    }
+                }
+            }
+        }
+
+        /* A match was found, so write the results to the output array */
+        if (lmatch != ninput) {
+            ref_index = rcoord - ref;
+            input_index = input_sorted[lmatch] - input;
+
+            if (callback(callback_data, ref_index, input_index, error)) {
+                goto exit;
+            }
+        }
+    }
+
+    status = 0;
+
+ exit:
+
+    xygrid_free(&grid);
+
+    return status;
+}
+
+int
+match_tolerance_ref_grid(
+        const size_t nref,
+        const coord_t* const ref,
+        const coord_t* const * const ref_sorted,
+        const xygrid_t* const ref_grid,
+        const size_t ninput,
+        const coord_t* const input,
+        const coord_t* const * const input_sorted,
+        const double tolerance,
+        coord_match_callback_t* callback,
+        void* callback_data,
+        stimage_error_t* const error) {
+
+    const double   tolerance2  = tolerance*tolerance;
+    double*        rmax2       = NULL;
+    size_t*        lmatch      = NULL;
+    size_t         rp          = 0;
+    size_t         lp          = 0;
+    size_t         ix, iy, x0, y0, x1, y1;
+    size_t         k, cell;
+    size_t         input_index = 0;
+    size_t         ref_index   = 0;
+    double         dx, dy, r2;
+    const coord_t* rcoord;
+    const coord_t* lcoord;
+    int            status      = 1;
+
+    assert(ref);
+    assert(ref_sorted);
+    assert(ref_grid);
+    assert(input);
+    assert(input_sorted);
+    assert(callback);
+    assert(error);
+
+    /* Nothing can fall within a non-positive tolerance */
+    if (!(tolerance > 0.0) || nref == 0 || ninput == 0) {
+        status = 0;
+        goto exit;
+    }
+
+    rmax2 = malloc_with_error(nref * sizeof(double), error);
+    if (rmax2 == NULL) goto exit;
+
+    lmatch = malloc_with_error(nref * sizeof(size_t), error);
+    if (lmatch == NULL) goto exit;
+
+    for (rp = 0; rp < nref; ++rp) {
+        rmax2[rp] = tolerance2;
+        lmatch[rp] = ninput;
+    }
+
+    /* Keep the closest input coordinate to each reference coordinate.
+       The input coordinates are visited in sorted order, so taking
+       the later of equally close ones breaks ties the same way as
+       match_tolerance. */
+    for (lp = 0; lp < ninput; ++lp) {
+        lcoord = input_sorted[lp];
+
+        if (!xygrid_cell_range(
+                    ref_grid, lcoord, tolerance, &x0, &y0, &x1, &y1)) {
+            continue;
+        }
+
+        for (iy = y0; iy <= y1; ++iy) {
+            for (ix = x0; ix <= x1; ++ix) {
+                cell = iy * ref_grid->nx + ix;
+                for (k = ref_grid->cell_start[cell];
+                     k < ref_grid->cell_start[cell + 1];
+                     ++k) {
+                    rp = ref_grid->items[k];
+                    rcoord = ref_sorted[rp];
+                    dy = rcoord->y - lcoord->y;
+                    if (dy >= tolerance || dy < -tolerance) {
+                        continue;
+                    }
+                    dx = rcoord->x - lcoord->x;
+                    r2 = dx*dx + dy*dy;
+
+                    if (r2 <= rmax2[rp]) {
+                        rmax2[rp] = r2;
+                        lmatch[rp] = lp;
+                    }
+                }
+            }
+        }
+    }
+
+    /* Write the results in the order of the reference coordinates */
+    for (rp = 0; rp < nref; ++rp) {
+        if (lmatch[rp] != ninput) {
+            ref_index = ref_sorted[rp] - ref;
+            input_index = input_sorted[lmatch[rp]] - input;
+
+            if (callback(callback_data, ref_index, input_index, error)) {
+                goto exit;
+            }
+        }
+    }
+
+    status = 0;
+
+ exit:
+
+    free(rmax2);
+    free(lmatch);
+
+    return status;
+}
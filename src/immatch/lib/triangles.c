@@ -34,9 +34,141 @@ DAMAGE.
 */
 
 #include <assert.h>
+#include <float.h>
+#include <limits.h>
 #include <math.h>
+#include <string.h>
 
 #include "immatch/lib/triangles.h"
+#include "lib/parallel.h"
+
+void
+triangle_table_new(
+        triangle_table_t* const t) {
+
+    assert(t);
+
+    t->ntriangles = 0;
+    t->capacity = 0;
+    t->coords = NULL;
+    t->ratio = NULL;
+    t->cosine_v1 = NULL;
+    t->ratio_tolerance = NULL;
+    t->cosine_tolerance = NULL;
+    t->vertices = NULL;
+    t->borrowed = 0;
+}
+
+size_t
+triangle_table_columns_size(
+        const size_t capacity) {
+
+    return capacity * (2 * sizeof(double) + 2 * sizeof(float) +
+                       3 * sizeof(triangle_index_t));
+}
+
+/* Point the columns of a table with room for capacity triangles into
+   columns.  The 8-byte columns come first so that every column is
+   aligned. */
+static void
+triangle_table_set_columns(
+        triangle_table_t* const t,
+        const size_t capacity,
+        void* const columns) {
+
+    t->ratio = (double*)columns;
+    t->cosine_v1 = t->ratio + capacity;
+    t->ratio_tolerance = (float*)(t->cosine_v1 + capacity);
+    t->cosine_tolerance = t->ratio_tolerance + capacity;
+    t->vertices = (triangle_index_t*)(t->cosine_tolerance + capacity);
+}
+
+int
+triangle_table_init(
+        triangle_table_t* const t,
+        const size_t capacity,
+        const coord_t* const * const coords,
+        stimage_error_t* const error) {
+
+    const size_t n       = MAX(1, capacity);
+    void*        columns = NULL;
+
+    assert(t);
+    assert(error);
+
+    triangle_table_new(t);
+
+    if (capacity > UINT_MAX) {
+        stimage_error_set_message(
+            error,
+            "Too many triangles to index");
+        return 1;
+    }
+
+    /* All of the columns share one allocation */
+    columns = malloc_with_error(triangle_table_columns_size(n), error);
+    if (columns == NULL) return 1;
+
+    triangle_table_set_columns(t, n, columns);
+    t->capacity = capacity;
+    t->coords = coords;
+
+    return 0;
+}
+
+void
+triangle_table_view(
+        triangle_table_t* const t,
+        const size_t ntriangles,
+        const coord_t* const * const coords,
+        void* const columns) {
+
+    assert(t);
+    assert(columns || ntriangles == 0);
+
+    triangle_table_new(t);
+    triangle_table_set_columns(t, ntriangles, columns);
+    t->ntriangles = ntriangles;
+    t->capacity = ntriangles;
+    t->coords = coords;
+    t->borrowed = 1;
+}
+
+void
+triangle_table_free(
+        triangle_table_t* const t) {
+
+    if (t == NULL) {
+        return;
+    }
+
+    if (!t->borrowed) {
+        free(t->ratio);
+    }
+    triangle_table_new(t);
+}
+
+/* Move n triangles within a table from src to dst */
+static void
+triangle_table_move(
+        triangle_table_t* const t,
+        const size_t dst,
+        const size_t src,
+        const size_t n) {
+
+    if (dst == src || n == 0) {
+        return;
+    }
+
+    memmove(t->ratio + dst, t->ratio + src, n * sizeof(double));
+    memmove(t->cosine_v1 + dst, t->cosine_v1 + src, n * sizeof(double));
+    memmove(t->ratio_tolerance + dst, t->ratio_tolerance + src,
+            n * sizeof(float));
+    memmove(t->cosine_tolerance + dst, t->cosine_tolerance + src,
+            n * sizeof(float));
+    memmove(t->vertices + 3 * dst, t->vertices + 3 * src,
+            3 * n * sizeof(triangle_index_t));
+}
 
 int
 max_num_triangles(
@@ -65,49 +197,553 @@ sides_def [3][2] = {
     { 2, 0 }
 };
 
-/* Uses as a qsort functor */
+/* The ratios are sorted in place together with a permutation of the
+   triangle indices, on (ratio, index).  Triangles of the same ratio
+   are kept in the order they were found, so that no two triangles
+   compare equal and the order does not depend on the sorting
+   algorithm or the number of threads. */
+typedef struct {
+    double*           ratio;
+    triangle_index_t* perm;
+} triangle_sort_t;
+
+/* Ranges shorter than this are insertion sorted */
+#define TRIANGLE_SORT_INSERTION 16
+
+static inline int
+triangle_sort_less(
+        const triangle_sort_t* const s,
+        const size_t i,
+        const size_t j) {
+
+    return (s->ratio[i] < s->ratio[j] ||
+            (s->ratio[i] == s->ratio[j] && s->perm[i] < s->perm[j]));
+}
+
+static inline void
+triangle_sort_swap(
+        const triangle_sort_t* const s,
+        const size_t i,
+        const size_t j) {
+
+    const double           ratio = s->ratio[i];
+    const triangle_index_t perm  = s->perm[i];
+
+    s->ratio[i] = s->ratio[j];
+    s->perm[i] = s->perm[j];
+    s->ratio[j] = ratio;
+    s->perm[j] = perm;
+}
+
+/* Heapsort [lo, hi), for ranges quicksort has partitioned badly */
+static void
+triangle_sort_heap(
+        const triangle_sort_t* const s,
+        const size_t lo,
+        const size_t hi) {
+
+    const size_t n = hi - lo;
+    size_t       end, root, child, i;
+
+    for (i = n / 2; i-- > 0; ) {
+        for (root = i; (child = 2 * root + 1) < n; root = child) {
+            if (child + 1 < n &&
+                triangle_sort_less(s, lo + child, lo + child + 1)) {
+                ++child;
+            }
+            if (!triangle_sort_less(s, lo + root, lo + child)) {
+                break;
+            }
+            triangle_sort_swap(s, lo + root, lo + child);
+        }
+    }
+
+    for (end = n; end-- > 1; ) {
+        triangle_sort_swap(s, lo, lo + end);
+        for (root = 0; (child = 2 * root + 1) < end; root = child) {
+            if (child + 1 < end &&
+                triangle_sort_less(s, lo + child, lo + child + 1)) {
+                ++child;
+            }
+            if (!triangle_sort_less(s, lo + root, lo + child)) {
+                break;
+            }
+            triangle_sort_swap(s, lo + root, lo + child);
+        }
+    }
+}
+
+/* Partition [lo, hi) around the median of its first, middle and last
+   entries, and return the final position of the pivot.  Everything
+   before it is less, and everything after it greater. */
+static size_t
+triangle_sort_partition(
+        const triangle_sort_t* const s,
+        const size_t lo,
+        const size_t hi) {
+
+    const size_t mid = lo + (hi - lo) / 2;
+    size_t       i, j;
+
+    if (triangle_sort_less(s, mid, lo)) triangle_sort_swap(s, mid, lo);
+    if (triangle_sort_less(s, hi - 1, mid)) {
+        triangle_sort_swap(s, hi - 1, mid);
+        if (triangle_sort_less(s, mid, lo)) triangle_sort_swap(s, mid, lo);
+    }
+
+    /* Keep the pivot just before the last entry, which is already
+       known to be greater */
+    triangle_sort_swap(s, mid, hi - 2);
+    i = lo;
+    j = hi - 2;
+    for (;;) {
+        while (triangle_sort_less(s, ++i, hi - 2)) {}
+        while (triangle_sort_less(s, hi - 2, --j)) {}
+        if (i >= j) {
+            break;
+        }
+        triangle_sort_swap(s, i, j);
+    }
+    triangle_sort_swap(s, i, hi - 2);
+
+    return i;
+}
+
+/* Introsort [lo, hi): quicksort, falling back to heapsort if depth
+   partitions have not made the ranges short enough */
+static void
+triangle_sort_range(
+        const triangle_sort_t* const s,
+        size_t lo,
+        size_t hi,
+        size_t depth) {
+
+    size_t pivot, i, j;
+
+    while (hi - lo > TRIANGLE_SORT_INSERTION) {
+        if (depth-- == 0) {
+            triangle_sort_heap(s, lo, hi);
+            return;
+        }
+
+        pivot = triangle_sort_partition(s, lo, hi);
+
+        /* Recurse into the shorter side, so the stack stays shallow */
+        if (pivot - lo < hi - pivot) {
+            triangle_sort_range(s, lo, pivot, depth);
+            lo = pivot + 1;
+        } else {
+            triangle_sort_range(s, pivot + 1, hi, depth);
+            hi = pivot;
+        }
+    }
+
+    for (i = lo + 1; i < hi; ++i) {
+        for (j = i; j > lo && triangle_sort_less(s, j, j - 1); --j) {
+            triangle_sort_swap(s, j, j - 1);
+        }
+    }
+}
+
+/* The ranges that are left to be sorted on separate threads, once the
+   top levels of the quicksort have partitioned the table */
+typedef struct {
+    const triangle_sort_t* s;
+    size_t                 depth;
+    size_t*                bounds; /* [2 * nranges] */
+} triangle_sort_ranges_t;
+
 static int
-triangle_ratio_compare(
-        const void* ap,
-        const void* bp) {
+triangle_sort_task(
+        void* data,
+        size_t index,
+        stimage_error_t* error) {
 
-    const triangle_t* a = (const triangle_t*)ap;
-    const triangle_t* b = (const triangle_t*)bp;
+    const triangle_sort_ranges_t* const r = (triangle_sort_ranges_t*)data;
 
-    if (a->ratio < b->ratio) {
-        return -1;
-    } else if (a->ratio > b->ratio) {
-        return 1;
+    (void)error;
+
+    triangle_sort_range(
+            r->s, r->bounds[2 * index], r->bounds[2 * index + 1], r->depth);
+
+    return 0;
+}
+
+/* Sort the triangles of a table in increasing order of ratio.  Only
+   the ratios and a permutation are sorted, and then the other columns
+   are put in the sorted order in place, by following the cycles of
+   the permutation.  So the only extra memory is the 4 bytes per
+   triangle of the permutation. */
+static int
+sort_triangle_table(
+        triangle_table_t* const t,
+        const size_t nthreads,
+        stimage_error_t* const error) {
+
+    const size_t           n        = t->ntriangles;
+    const size_t           nworkers =
+        nthreads == 0 ? parallel_ncpus() : nthreads;
+    triangle_sort_t        s;
+    triangle_sort_ranges_t ranges;
+    size_t                 nranges  = 1;
+    size_t                 depth    = 0;
+    size_t                 longest  = 0;
+    size_t                 lo, hi, pivot;
+    double                 cosine_v1;
+    float                  ratio_tolerance;
+    float                  cosine_tolerance;
+    triangle_index_t       vertices[3];
+    size_t                 i, j, k, m;
+    int                    status   = 1;
+
+    ranges.bounds = NULL;
+
+    if (n < 2) {
+        return 0;
+    }
+
+    s.ratio = t->ratio;
+    s.perm = malloc_with_error(n * sizeof(triangle_index_t), error);
+    if (s.perm == NULL) goto exit;
+
+    for (i = 0; i < n; ++i) {
+        s.perm[i] = (triangle_index_t)i;
+    }
+
+    for (i = n; i > 0; i >>= 1) {
+        depth += 2;
+    }
+
+    if (nworkers > 1 && n > 4 * nworkers * TRIANGLE_SORT_INSERTION) {
+        /* Partition the longest range until there are a few ranges
+           per thread, and sort those in parallel.  The sort defines a
+           total order, so the result is the same. */
+        ranges.bounds = malloc_with_error(
+                2 * 4 * nworkers * sizeof(size_t), error);
+        if (ranges.bounds == NULL) goto exit;
+
+        ranges.bounds[0] = 0;
+        ranges.bounds[1] = n;
+        while (nranges < 4 * nworkers && depth > 0) {
+            longest = 0;
+            for (i = 1; i < nranges; ++i) {
+                if (ranges.bounds[2*i + 1] - ranges.bounds[2*i] >
+                    ranges.bounds[2*longest + 1] - ranges.bounds[2*longest]) {
+                    longest = i;
+                }
+            }
+
+            lo = ranges.bounds[2*longest];
+            hi = ranges.bounds[2*longest + 1];
+            if (hi - lo <= TRIANGLE_SORT_INSERTION) {
+                break;
+            }
+
+            pivot = triangle_sort_partition(&s, lo, hi);
+            ranges.bounds[2*longest + 1] = pivot;
+            ranges.bounds[2*nranges] = pivot + 1;
+            ranges.bounds[2*nranges + 1] = hi;
+            ++nranges;
+            --depth;
+        }
+
+        ranges.s = &s;
+        ranges.depth = depth;
+        if (parallel_for(
+                    nranges, nworkers, &triangle_sort_task, &ranges,
+                    error)) goto exit;
     } else {
+        triangle_sort_range(&s, 0, n, depth);
+    }
+
+    /* perm[i] is the index the i'th sorted triangle was found at, so
+       each cycle is rotated by moving every triangle along from where
+       perm says it comes from.  Once placed, perm[i] is set to i. */
+    for (i = 0; i < n; ++i) {
+        if (s.perm[i] == i) {
+            continue;
+        }
+
+        cosine_v1 = t->cosine_v1[i];
+        ratio_tolerance = t->ratio_tolerance[i];
+        cosine_tolerance = t->cosine_tolerance[i];
+        for (m = 0; m < 3; ++m) {
+            vertices[m] = t->vertices[3*i + m];
+        }
+
+        for (j = i; (k = s.perm[j]) != i; j = k) {
+            t->cosine_v1[j] = t->cosine_v1[k];
+            t->ratio_tolerance[j] = t->ratio_tolerance[k];
+            t->cosine_tolerance[j] = t->cosine_tolerance[k];
+            for (m = 0; m < 3; ++m) {
+                t->vertices[3*j + m] = t->vertices[3*k + m];
+            }
+            s.perm[j] = (triangle_index_t)j;
+        }
+
+        t->cosine_v1[j] = cosine_v1;
+        t->ratio_tolerance[j] = ratio_tolerance;
+        t->cosine_tolerance[j] = cosine_tolerance;
+        for (m = 0; m < 3; ++m) {
+            t->vertices[3*j + m] = vertices[m];
+        }
+        s.perm[j] = (triangle_index_t)j;
+    }
+
+    status = 0;
+
+ exit:
+
+    free(s.perm);
+    free(ranges.bounds);
+
+    return status;
+}
+
+/**
+Compute the differences in x and y, and the squared and plain lengths
+of the sides of the triangle with the given ordered vertices.
+*/
+static void
+triangle_sides(
+        const coord_t* const * const vertices,
+        double* const dx,
+        double* const dy,
+        double* const sides2,
+        double* const sides) {
+
+    size_t m;
+
+    for (m = 0; m < 3; ++m) {
+        dx[m] = vertices[sides_def[m][0]]->x -
+            vertices[sides_def[m][1]]->x;
+        dy[m] = vertices[sides_def[m][0]]->y -
+            vertices[sides_def[m][1]]->y;
+        sides2[m] = dx[m]*dx[m] + dy[m]*dy[m];
+        assert(sides2[m] >= 0.0);
+        sides[m] = sqrt(sides2[m]);
+    }
+}
+
+/**
+Compute the log of the perimeter of the triangle'th triangle in a
+table, and its sense (whether its vertices are arranged clockwise
+(non-zero) or anti-clockwise (zero)).
+*/
+static void
+triangle_shape(
+        const triangle_table_t* const t,
+        const size_t triangle,
+        double* const log_perimeter,
+        int* const sense) {
+
+    const coord_t* vertices[3];
+    double dx[3], dy[3], sides2[3], sides[3];
+    size_t m;
+
+    for (m = 0; m < 3; ++m) {
+        vertices[m] = t->coords[t->vertices[3*triangle + m]];
+    }
+
+    triangle_sides(vertices, dx, dy, sides2, sides);
+
+    *log_perimeter = log(sides[0] + sides[1] + sides[2]);
+    *sense = ((dx[1]*dy[0] - dy[1]*dx[0]) > 0.0);
+}
+
+/**
+Store the triangle with the vertices at indices a, b and c of the
+table's coordinates as its triangle'th triangle, given the squared
+lengths of its sides.  Returns 0 if the triangle is rejected because
+the ratio of its longest to shortest side is greater than maxratio.
+*/
+static int
+make_triangle(
+        const size_t a,
+        const size_t b,
+        const size_t c,
+        const double dist_ab,
+        const double dist_bc,
+        const double dist_ca,
+        const double tol2,
+        const double maxratio,
+        triangle_table_t* const t,
+        const size_t triangle) {
+
+    size_t m;
+    size_t v[3];
+    const coord_t* vertices[3];
+    double dx[3], dy[3], sides2[3], sides[3];
+    double cosc, cosc2, sinc2;
+    double ratio, loctol;
+
+    /* Order the vertices with the shortest side of the triangle
+       between vertices 1 and 2 and the intermediate side between
+       vertices 2 and 3.
+    */
+    if (dist_ab <= dist_bc) {
+        if (dist_ca <= dist_ab) {
+            v[0] = c;
+            v[1] = a;
+            v[2] = b;
+        } else if (dist_ca >= dist_bc) {
+            v[0] = a;
+            v[1] = b;
+            v[2] = c;
+        } else {
+            v[0] = b;
+            v[1] = a;
+            v[2] = c;
+        }
+    } else {
+        if (dist_ca <= dist_bc) {
+            v[0] = a;
+            v[1] = c;
+            v[2] = b;
+        } else if (dist_ca >= dist_ab) {
+            v[0] = c;
+            v[1] = b;
+            v[2] = a;
+        } else {
+            v[0] = b;
+            v[1] = c;
+            v[2] = a;
+        }
+    }
+
+    for (m = 0; m < 3; ++m) {
+        vertices[m] = t->coords[v[m]];
+    }
+
+    /* Compute the lengths of the sides */
+    triangle_sides(vertices, dx, dy, sides2, sides);
+
+    /* If the ratio of long to short is too high, reject
+       this triangle */
+    ratio = sides[2] / sides[1];
+    if (ratio > maxratio) {
         return 0;
     }
+
+    /* Compute the cos, cos ** 2 and sin ** 2 of the angle at
+       vertex 1. */
+    cosc = (dx[2]*dx[1] + dy[2]*dy[1]) / (sides[2]*sides[1]);
+    cosc2 = MAX(0.0, MIN(1.0, cosc*cosc));
+    sinc2 = MAX(0.0, MIN(1.0, 1.0 - cosc2));
+
+    /* Compute the tolerances.  They only bound the differences
+       between triangles, so single precision is plenty. */
+    loctol = (1.0/sides2[2] - cosc/(sides[2]*sides[1]) + 1.0/sides2[1]);
+    t->ratio_tolerance[triangle] = (float)(2.0*ratio*ratio*tol2*loctol);
+    t->cosine_tolerance[triangle] = (float)(
+        2.0*sinc2*tol2*loctol +
+        2.0*cosc2*tol2*tol2*loctol*loctol);
+
+    t->ratio[triangle] = ratio;
+    t->cosine_v1[triangle] = cosc;
+    for (m = 0; m < 3; ++m) {
+        t->vertices[3*triangle + m] = (triangle_index_t)v[m];
+    }
+
+    return 1;
+}
+
+typedef struct {
+    const coord_t* const * coords;
+    size_t                 nsample;
+    size_t                 npoints;   /* The number of sampled points */
+    double                 tol2;
+    double                 maxratio;
+    const size_t*          offset;    /* [npoints] */
+    size_t*                nkept;     /* [npoints] */
+    size_t*                nrejected; /* [npoints] */
+    triangle_table_t*      triangles;
+} find_triangles_t;
+
+/* Finds the triangles whose first vertex is the index'th sampled point,
+   and writes them from triangles[offset[index]] on */
+static int
+find_triangles_task(
+        void* data,
+        size_t index,
+        stimage_error_t* error) {
+
+    const find_triangles_t* const f = (find_triangles_t*)data;
+    const coord_t* const * const coords = f->coords;
+    const size_t nsample = f->nsample;
+    const size_t i = index;
+    const size_t offset = f->offset[index];
+    size_t j, k;
+    size_t ntri = 0;
+    size_t nrejected = 0;
+    double dist_ij, dist_jk, dist_ki;
+
+    (void)error;
+
+    #define SAMPLE(i) (coords[(i) * nsample])
+
+    for (j = i + 1; j < f->npoints - 1; ++j) {
+        dist_ij = euclid_distance2(SAMPLE(i), SAMPLE(j));
+        if (dist_ij <= f->tol2) {
+            continue;
+        }
+
+        for (k = j + 1; k < f->npoints; ++k) {
+            dist_jk = euclid_distance2(SAMPLE(j), SAMPLE(k));
+            if (dist_jk <= f->tol2) {
+                continue;
+            }
+
+            dist_ki = euclid_distance2(SAMPLE(k), SAMPLE(i));
+            if (dist_ki <= f->tol2) {
+                continue;
+            }
+
+            if (make_triangle(
+                    i * nsample, j * nsample, k * nsample,
+                    dist_ij, dist_jk, dist_ki,
+                    f->tol2, f->maxratio, f->triangles, offset + ntri)) {
+                ++ntri;
+            } else {
+                ++nrejected;
+            }
+        }
+    }
+
+    #undef SAMPLE
+
+    f->nkept[index] = ntri;
+    f->nrejected[index] = nrejected;
+
+    return 0;
 }
 
 int
 find_triangles(
         const size_t ncoords,
         const coord_t* const * const coords,
-        size_t* ntriangles,
-        triangle_t* triangles,
+        triangle_table_t* const triangles,
         const size_t maxnpoints,
         const double tolerance,
         const double maxratio,
+        const size_t nthreads,
+        stimage_stats_t* const stats,
         stimage_error_t* const error) {
 
-    const double tol2 = tolerance * tolerance;
-    const size_t nsample = MAX(1, ncoords / maxnpoints);
-    const size_t npoints = MIN(ncoords, nsample * maxnpoints);
-    triangle_t* tri = triangles;
-    size_t i, j, k, m;
-    size_t ntri = 0;
-    double dist_ij, dist_jk, dist_ki;
-    double dx[3], dy[3], sides2[3], sides[3];
-    double cosc, cosc2, sinc2;
-    double ratio, loctol;
+    const double     start     = stimage_stats_start(stats);
+    const size_t     nsample   = MAX(1, ncoords / maxnpoints);
+    const size_t     npoints   = MIN(ncoords, nsample * maxnpoints) / nsample;
+    find_triangles_t find;
+    size_t*          buffer    = NULL;
+    size_t*          offset    = NULL;
+    size_t           ntri      = 0;
+    size_t           nrejected = 0;
+    size_t           i;
+    int              status    = 1;
 
     assert(coords);
-    assert(ntriangles);
     assert(triangles);
+    assert(triangles->coords == coords);
     assert(error);
 
     if (maxratio > 10.0 || maxratio < 5.0) {
@@ -117,174 +753,721 @@ find_triangles(
         return 1;
     }
 
-    for (i = 0; i < npoints - (2 * nsample); i += nsample) {
-        for (j = i + nsample; j < npoints - nsample; j += nsample) {
-            dist_ij = euclid_distance2(coords[i], coords[j]);
-            if (dist_ij <= tol2) {
+    if (ncoords > UINT_MAX) {
+        stimage_error_set_message(
+            error,
+            "Too many coordinates to index");
+        return 1;
+    }
+
+    triangles->ntriangles = 0;
+
+    if (npoints < 3) {
+        return 0;
+    }
+
+    buffer = malloc_with_error(3 * npoints * sizeof(size_t), error);
+    if (buffer == NULL) goto exit;
+    offset = buffer;
+
+    /* The i'th sampled point is the first vertex of at most
+       C(npoints - 1 - i, 2) triangles, so the triangles of each point
+       can be found separately, each into its own part of the table,
+       and then packed together in the order a single loop over i, j
+       and k would have found them. */
+    for (i = 0; i < npoints - 2; ++i) {
+        offset[i] = ntri;
+        ntri += ((npoints - 1 - i) * (npoints - 2 - i)) / 2;
+    }
+
+    if (ntri > triangles->capacity) {
+        stimage_error_format_message(
+            error,
+            "Found more triangles than were allocated for (%lu)\n",
+            (unsigned long)triangles->capacity);
+        goto exit;
+    }
+
+    find.coords = coords;
+    find.nsample = nsample;
+    find.npoints = npoints;
+    find.tol2 = tolerance * tolerance;
+    find.maxratio = maxratio;
+    find.offset = offset;
+    find.nkept = buffer + npoints;
+    find.nrejected = buffer + 2 * npoints;
+    find.triangles = triangles;
+
+    if (parallel_for(
+                npoints - 2, nthreads, &find_triangles_task, &find,
+                error)) goto exit;
+
+    ntri = 0;
+    for (i = 0; i < npoints - 2; ++i) {
+        triangle_table_move(triangles, ntri, offset[i], find.nkept[i]);
+        ntri += find.nkept[i];
+        nrejected += find.nrejected[i];
+    }
+
+    triangles->ntriangles = ntri;
+
+    /* Sort the triangles in increasing order of ratio */
+    if (sort_triangle_table(triangles, nthreads, error)) goto exit;
+
+    stimage_stats_stop(stats, "find_triangles.time", start);
+    stimage_stats_count(stats, "find_triangles.kept", (double)ntri);
+    stimage_stats_count(
+            stats, "find_triangles.rejected_maxratio", (double)nrejected);
+
+    status = 0;
+
+ exit:
+
+    free(buffer);
+
+    return status;
+}
+
+int
+max_num_triangles_knn(
+        const size_t ncoords,
+        const size_t maxnpoints,
+        const size_t k,
+        size_t* num_triangles,
+        stimage_error_t* const error) {
+
+    const size_t n = MIN(ncoords, maxnpoints);
+    size_t nneighbors;
+
+    if (n == 0 || k < 2) {
+        stimage_error_set_message(
+            error,
+            "k must be at least 2 to form triangles from nearest neighbors");
+        return 1;
+    }
+
+    nneighbors = MIN(k, n - 1);
+    *num_triangles = n * ((nneighbors * (nneighbors - 1)) / 2);
+
+    return 0;
+}
+
+typedef struct {
+    size_t v[3];
+} triangle_vertices_t;
+
+/* Used as a qsort functor */
+static int
+triangle_vertices_compare(
+        const void* ap,
+        const void* bp) {
+
+    const triangle_vertices_t* a = (const triangle_vertices_t*)ap;
+    const triangle_vertices_t* b = (const triangle_vertices_t*)bp;
+    size_t i;
+
+    for (i = 0; i < 3; ++i) {
+        if (a->v[i] < b->v[i]) {
+            return -1;
+        } else if (a->v[i] > b->v[i]) {
+            return 1;
+        }
+    }
+
+    return 0;
+}
+
+static void
+sort_vertices(
+        triangle_vertices_t* const t) {
+
+    size_t tmp;
+
+    #define SWAP_IF_GREATER(i, j) \
+        if (t->v[i] > t->v[j]) { tmp = t->v[i]; t->v[i] = t->v[j]; t->v[j] = tmp; }
+
+    SWAP_IF_GREATER(0, 1);
+    SWAP_IF_GREATER(1, 2);
+    SWAP_IF_GREATER(0, 1);
+
+    #undef SWAP_IF_GREATER
+}
+
+int
+find_triangles_knn(
+        const size_t ncoords,
+        const coord_t* const * const coords,
+        triangle_table_t* const triangles,
+        const size_t maxnpoints,
+        const size_t k,
+        const double tolerance,
+        const double maxratio,
+        const size_t nthreads,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error) {
+
+    const double         start      = stimage_stats_start(stats);
+    const double         tol2       = tolerance * tolerance;
+    const size_t         nsample    = MAX(1, ncoords / maxnpoints);
+    const size_t         npoints    = MIN(ncoords, nsample * maxnpoints) / nsample;
+    size_t               nneighbors = 0;
+    size_t*              neighbors  = NULL;
+    double*              dists      = NULL;
+    triangle_vertices_t* tvs        = NULL;
+    size_t               ntvs       = 0;
+    size_t               ntri       = 0;
+    size_t               nrejected  = 0;
+    size_t               i, j, m, n, a, b;
+    double               dist, dist_ij, dist_jk, dist_ki;
+    int                  status     = 1;
+
+    assert(coords);
+    assert(triangles);
+    assert(triangles->coords == coords);
+    assert(error);
+
+    #define SAMPLE(i) (coords[(i) * nsample])
+
+    if (maxratio > 10.0 || maxratio < 5.0) {
+        stimage_error_format_message(
+            error,
+            "maxratio should be in the range 5.0 - 10.0 (%f)", maxratio);
+        goto exit;
+    }
+
+    if (ncoords > UINT_MAX) {
+        stimage_error_set_message(
+            error,
+            "Too many coordinates to index");
+        goto exit;
+    }
+
+    triangles->ntriangles = 0;
+
+    if (npoints < 3 || k < 2) {
+        status = 0;
+        goto exit;
+    }
+
+    nneighbors = MIN(k, npoints - 1);
+
+    neighbors = malloc_with_error(
+            npoints * nneighbors * sizeof(size_t), error);
+    if (neighbors == NULL) goto exit;
+
+    dists = malloc_with_error(nneighbors * sizeof(double), error);
+    if (dists == NULL) goto exit;
+
+    /* Find the nearest neighbors of each point by keeping an
+       insertion-sorted list of the closest points seen so far.
+       Points at equal distance are kept in increasing order of
+       index. */
+    for (i = 0; i < npoints; ++i) {
+        n = 0;
+        for (j = 0; j < npoints; ++j) {
+            if (j == i) {
                 continue;
             }
 
-            for (k = j + nsample; k < npoints; k += nsample) {
-                dist_jk = euclid_distance2(coords[j], coords[k]);
-                if (dist_jk <= tol2) {
-                    continue;
-                }
+            dist = euclid_distance2(SAMPLE(i), SAMPLE(j));
+            if (n == nneighbors && dist >= dists[n - 1]) {
+                continue;
+            }
 
-                dist_ki = euclid_distance2(coords[k], coords[i]);
-                if (dist_ki <= tol2) {
-                    continue;
-                }
+            if (n < nneighbors) {
+                ++n;
+            }
+            for (m = n - 1; m > 0 && dists[m - 1] > dist; --m) {
+                dists[m] = dists[m - 1];
+                neighbors[i * nneighbors + m] = neighbors[i * nneighbors + m - 1];
+            }
+            dists[m] = dist;
+            neighbors[i * nneighbors + m] = j;
+        }
+    }
 
-                #ifndef NDEBUG
-                    if (ntri >= *ntriangles) {
-                        stimage_error_format_message(
-                            error,
-                            "Found more triangles than were allocated for (%d)\n",
-                            *ntriangles);
-                        return 1;
-                    }
-                #endif /* NDEBUG */
-
-                tri = &triangles[ntri];
-                /* DIFF: The original stores the index of the
-                   triangle.  Do we need to do that? */
-
-                /* Order the vertices with the shortest side of the triangle
-                   between vertices 1 and 2 and the intermediate side between
-                   vertices 2 and 3.
-                */
-                if (dist_ij <= dist_jk) {
-                    if (dist_ki <= dist_ij) {
-                        tri->vertices[0] = coords[k];
-                        tri->vertices[1] = coords[i];
-                        tri->vertices[2] = coords[j];
-                    } else if (dist_ki >= dist_jk) {
-                        tri->vertices[0] = coords[i];
-                        tri->vertices[1] = coords[j];
-                        tri->vertices[2] = coords[k];
-                    } else {
-                        tri->vertices[0] = coords[j];
-                        tri->vertices[1] = coords[i];
-                        tri->vertices[2] = coords[k];
-                    }
-                } else {
-                    if (dist_ki <= dist_jk) {
-                        tri->vertices[0] = coords[i];
-                        tri->vertices[1] = coords[k];
-                        tri->vertices[2] = coords[j];
-                    } else if (dist_ki >= dist_ij) {
-                        tri->vertices[0] = coords[k];
-                        tri->vertices[1] = coords[j];
-                        tri->vertices[2] = coords[i];
-                    } else {
-                        tri->vertices[0] = coords[j];
-                        tri->vertices[1] = coords[k];
-                        tri->vertices[2] = coords[i];
-                    }
-                }
+    /* Form a triangle from each point and each pair of its
+       neighbors.  The same triangle can be found from more than one
+       of its vertices, so the vertices are sorted and duplicates
+       removed. */
+    tvs = malloc_with_error(
+            npoints * ((nneighbors * (nneighbors - 1)) / 2) *
+            sizeof(triangle_vertices_t), error);
+    if (tvs == NULL) goto exit;
+
+    for (i = 0; i < npoints; ++i) {
+        for (a = 0; a < nneighbors; ++a) {
+            for (b = a + 1; b < nneighbors; ++b) {
+                tvs[ntvs].v[0] = i;
+                tvs[ntvs].v[1] = neighbors[i * nneighbors + a];
+                tvs[ntvs].v[2] = neighbors[i * nneighbors + b];
+                sort_vertices(&tvs[ntvs]);
+                ++ntvs;
+            }
+        }
+    }
 
-                /* Compute the lengths of the sides */
-                for (m = 0; m < 3; ++m) {
-                    dx[m] = tri->vertices[sides_def[m][0]]->x -
-                        tri->vertices[sides_def[m][1]]->x;
-                    dy[m] = tri->vertices[sides_def[m][0]]->y -
-                        tri->vertices[sides_def[m][1]]->y;
-                    sides2[m] = dx[m]*dx[m] + dy[m]*dy[m];
-                    assert(sides2[m] >= 0.0);
-                    sides[m] = sqrt(sides2[m]);
-                }
+    qsort(tvs, ntvs, sizeof(triangle_vertices_t), &triangle_vertices_compare);
 
-                /* If the ratio of long to short is too high, reject
-                   this triangle */
-                ratio = sides[2] / sides[1];
-                if (ratio > maxratio) {
-                    continue;
-                }
+    for (m = 0; m < ntvs; ++m) {
+        if (m > 0 && triangle_vertices_compare(&tvs[m], &tvs[m - 1]) == 0) {
+            continue;
+        }
 
-                /* Compute the cos, cos ** 2 and sin ** 2 of the angle at
-                   vertex 1. */
-                cosc = (dx[2]*dx[1] + dy[2]*dy[1]) / (sides[2]*sides[1]);
-                cosc2 = MAX(0.0, MIN(1.0, cosc*cosc));
-                sinc2 = MAX(0.0, MIN(1.0, 1.0 - cosc2));
+        i = tvs[m].v[0];
+        j = tvs[m].v[1];
+        n = tvs[m].v[2];
 
-                /* Determine whether the triangles vertices are
-                   arranged clockwise or anti-clockwise */
-                tri->sense = ((dx[1]*dy[0] - dy[1]*dx[0]) > 0.0);
+        dist_ij = euclid_distance2(SAMPLE(i), SAMPLE(j));
+        if (dist_ij <= tol2) {
+            continue;
+        }
 
-                /* Compute the tolerances */
-                loctol = (1.0/sides2[2] - cosc/(sides[2]*sides[1]) + 1.0/sides2[1]);
-                tri->ratio_tolerance = 2.0*ratio*ratio*tol2*loctol;
-                tri->cosine_tolerance = \
-                    2.0*sinc2*tol2*loctol +
-                    2.0*cosc2*tol2*tol2*loctol*loctol;
+        dist_jk = euclid_distance2(SAMPLE(j), SAMPLE(n));
+        if (dist_jk <= tol2) {
+            continue;
+        }
 
-                /* Compute the perimeter */
-                tri->log_perimeter = log(sides[0] + sides[1] + sides[2]);
-                tri->ratio = ratio;
-                tri->cosine_v1 = cosc;
+        dist_ki = euclid_distance2(SAMPLE(n), SAMPLE(i));
+        if (dist_ki <= tol2) {
+            continue;
+        }
 
-                ++ntri;
+        #ifndef NDEBUG
+            if (ntri >= triangles->capacity) {
+                stimage_error_format_message(
+                    error,
+                    "Found more triangles than were allocated for (%lu)\n",
+                    (unsigned long)triangles->capacity);
+                goto exit;
             }
+        #endif /* NDEBUG */
+
+        if (make_triangle(
+                i * nsample, j * nsample, n * nsample,
+                dist_ij, dist_jk, dist_ki,
+                tol2, maxratio, triangles, ntri)) {
+            ++ntri;
+        } else {
+            ++nrejected;
         }
     }
 
-    *ntriangles = ntri;
+    #undef SAMPLE
+
+    triangles->ntriangles = ntri;
 
     /* Sort the triangles in increasing order of ratio */
-    qsort(triangles, ntri, sizeof(triangle_t), &triangle_ratio_compare);
+    if (sort_triangle_table(triangles, nthreads, error)) goto exit;
 
-    return 0;
+    stimage_stats_stop(stats, "find_triangles.time", start);
+    stimage_stats_count(stats, "find_triangles.kept", (double)ntri);
+    stimage_stats_count(
+            stats, "find_triangles.rejected_maxratio", (double)nrejected);
+
+    status = 0;
+
+ exit:
+
+    free(neighbors);
+    free(dists);
+    free(tvs);
+
+    return status;
 }
 
-int
-merge_triangles(
-        const size_t nr_triangles,
-        const triangle_t* const r_triangles,
-        const size_t nl_triangles,
-        const triangle_t* const l_triangles,
-        size_t* nmatches,
-        triangle_match_t* const matches,
+/* The number of triangles in R that each task of merge_triangles
+   finds the matches of */
+#define MERGE_TRIANGLES_CHUNK 4096
+
+/* The maximum number of levels of a triangle grid */
+#define TRIANGLE_GRID_MAX_LEVELS 64
+
+/* The maximum number of cells in the finest level of a triangle grid
+   per triangle */
+#define TRIANGLE_GRID_CELLS_PER_TRIANGLE 1
+
+/**
+A hierarchy of uniform grids over the (ratio, cosine_v1) plane of a
+triangle table, used by merge_triangles_grid.
+
+Each triangle is centered on its (ratio, cosine_v1) and extends by the
+square roots of its tolerances, its half-widths, in each direction.
+A triangle is stored in the finest level whose cells are at least as
+wide as its half-widths, in the cell that holds its center.  So a
+triangle that matches another triangle centered at c, with
+half-widths h, is in a cell of level k within h plus the cell widths
+of level k of c.  The cells of each level are twice as wide as those
+of the level below, and the coarsest level is a single cell that holds
+the triangles too wide for any of the others, including those with
+non-finite tolerances.
+
+The indices of the triangles in cell (ix, iy) of level k are stored in
+
+    items[cell_start[base[k] + iy * nx[k] + ix] ...
+          cell_start[base[k] + iy * nx[k] + ix + 1]]
+
+in increasing order.
+*/
+typedef struct {
+    size_t            nlevels;
+    double            ratio_min;
+    double            cosine_min;
+    double            ratio_width[TRIANGLE_GRID_MAX_LEVELS];
+    double            cosine_width[TRIANGLE_GRID_MAX_LEVELS];
+    size_t            nx[TRIANGLE_GRID_MAX_LEVELS];
+    size_t            ny[TRIANGLE_GRID_MAX_LEVELS];
+    size_t            base[TRIANGLE_GRID_MAX_LEVELS];
+    size_t            nitems[TRIANGLE_GRID_MAX_LEVELS];
+    triangle_index_t* cell_start; /* [total cells + 1] */
+    triangle_index_t* items;      /* [ntriangles] */
+} triangle_grid_t;
+
+static void
+triangle_grid_new(
+        triangle_grid_t* const g) {
+
+    memset(g, 0, sizeof(triangle_grid_t));
+}
+
+static void
+triangle_grid_free(
+        triangle_grid_t* const g) {
+
+    free(g->cell_start);
+    free(g->items);
+    triangle_grid_new(g);
+}
+
+static inline size_t
+triangle_grid_cell_index(
+        const double v,
+        const double min,
+        const double width,
+        const size_t n) {
+
+    double i = floor((v - min) / width);
+
+    if (!(i >= 0.0)) {
+        return 0;
+    } else if (i >= (double)n) {
+        return n - 1;
+    }
+    return (size_t)i;
+}
+
+/* The finest level whose cells are at least half_ratio and
+   half_cosine wide */
+static size_t
+triangle_grid_level(
+        const triangle_grid_t* const g,
+        const double half_ratio,
+        const double half_cosine) {
+
+    const size_t top = g->nlevels - 1;
+    size_t       level = 0;
+    int          e;
+
+    if (!(half_ratio <= MAX_DOUBLE) || !(half_cosine <= MAX_DOUBLE)) {
+        return top;
+    }
+
+    if (half_ratio > g->ratio_width[0]) {
+        frexp(half_ratio / g->ratio_width[0], &e);
+        level = MAX(level, (size_t)e);
+    }
+
+    if (half_cosine > g->cosine_width[0]) {
+        frexp(half_cosine / g->cosine_width[0], &e);
+        level = MAX(level, (size_t)e);
+    }
+
+    return MIN(level, top);
+}
+
+/* The global index of the cell of level that holds triangle i */
+static size_t
+triangle_grid_cell(
+        const triangle_grid_t* const g,
+        const triangle_table_t* const t,
+        const size_t level,
+        const size_t i) {
+
+    const size_t ix = triangle_grid_cell_index(
+            t->ratio[i], g->ratio_min, g->ratio_width[level], g->nx[level]);
+    const size_t iy = triangle_grid_cell_index(
+            t->cosine_v1[i], g->cosine_min, g->cosine_width[level],
+            g->ny[level]);
+
+    return g->base[level] + iy * g->nx[level] + ix;
+}
+
+/* The median of the binary exponents of n positive values, or 0 if
+   there are none */
+static int
+median_exponent(
+        const size_t n,
+        const float* const values,
+        size_t* const counts /* [2 * (FLT_MAX_EXP - FLT_MIN_EXP + 32)] */) {
+
+    const int offset = -(FLT_MIN_EXP - FLT_MANT_DIG - 2);
+    const int nbins  = 2 * (FLT_MAX_EXP - FLT_MIN_EXP + 32);
+    size_t    npositive = 0;
+    size_t    seen = 0;
+    size_t    i;
+    int       e;
+
+    memset(counts, 0, nbins * sizeof(size_t));
+
+    /* The half-width is the square root of the tolerance, so its
+       exponent is half of the tolerance's, rounded up */
+    for (i = 0; i < n; ++i) {
+        if (values[i] > 0.0f && values[i] <= FLT_MAX) {
+            frexp(sqrt((double)values[i]), &e);
+            ++counts[e + offset];
+            ++npositive;
+        }
+    }
+
+    if (npositive == 0) {
+        return 0;
+    }
+
+    for (e = 0; e < nbins; ++e) {
+        seen += counts[e];
+        if (2 * seen >= npositive) {
+            break;
+        }
+    }
+
+    return e - offset;
+}
+
+/**
+Build a triangle grid over a table, whose finest cells are as wide as
+the median half-widths of its triangles.
+*/
+static int
+triangle_grid_init(
+        triangle_grid_t* const g,
+        const triangle_table_t* const t,
         stimage_error_t* const error) {
 
-    size_t i;
-    size_t match_iter = 0;
-    double rmaxtol, lmaxtol, maxtol;
-    size_t blp = 0, rp = 0, lp = 0;
-    double dratio, dratio2, dcosine, dcosine2, dtratio, dtcosine;
-    const triangle_t* max_tri = NULL;
-    const triangle_t* l_tri = NULL;
-    const triangle_t* r_tri = NULL;
-    double max_dratio2, max_dcosine2;
+    const size_t n         = t->ntriangles;
+    const double max_cells =
+        (double)(TRIANGLE_GRID_CELLS_PER_TRIANGLE * n + 16);
+    double       ratio_max = 0.0;
+    double       cosine_max = 0.0;
+    double       range_r, range_c, nx, ny;
+    size_t*      counts    = NULL;
+    size_t       ncells    = 0;
+    size_t       cell, level, i;
+    int          er, ec;
+    int          status    = 1;
+
+    triangle_grid_new(g);
+
+    counts = malloc_with_error(
+            2 * (FLT_MAX_EXP - FLT_MIN_EXP + 32) * sizeof(size_t), error);
+    if (counts == NULL) goto exit;
+
+    er = median_exponent(n, t->ratio_tolerance, counts);
+    ec = median_exponent(n, t->cosine_tolerance, counts);
+
+    free(counts);
+    counts = NULL;
+
+    /* The extent of the centers */
+    g->ratio_min = ratio_max = t->ratio[0];
+    g->cosine_min = cosine_max = t->cosine_v1[0];
+    for (i = 1; i < n; ++i) {
+        g->ratio_min = MIN(g->ratio_min, t->ratio[i]);
+        ratio_max = MAX(ratio_max, t->ratio[i]);
+        g->cosine_min = MIN(g->cosine_min, t->cosine_v1[i]);
+        cosine_max = MAX(cosine_max, t->cosine_v1[i]);
+    }
+    range_r = ratio_max - g->ratio_min;
+    range_c = cosine_max - g->cosine_min;
 
-    assert(nr_triangles);
-    assert(r_triangles);
-    assert(nl_triangles);
-    assert(l_triangles);
-    assert(matches);
-    assert(error);
+    if (!isfinite(range_r) || !isfinite(range_c)) {
+        stimage_error_set_message(
+            error,
+            "Triangle ratios and cosines must be finite");
+        goto exit;
+    }
+
+    /* Coarsen the finest level, one dimension at a time, if it would
+       have too many cells */
+    for (;;) {
+        nx = floor(range_r / ldexp(1.0, er)) + 1.0;
+        ny = floor(range_c / ldexp(1.0, ec)) + 1.0;
+        if (nx * ny <= max_cells) {
+            break;
+        }
+        if (nx >= ny) {
+            ++er;
+        } else {
+            ++ec;
+        }
+    }
+
+    /* Each level doubles the cell widths, until a single cell covers
+       the whole extent.  That single cell is the top level. */
+    for (level = 0; level < TRIANGLE_GRID_MAX_LEVELS; ++level) {
+        g->ratio_width[level] = ldexp(1.0, er + (int)level);
+        g->cosine_width[level] = ldexp(1.0, ec + (int)level);
+        g->nx[level] = (size_t)(
+                floor(range_r / g->ratio_width[level]) + 1.0);
+        g->ny[level] = (size_t)(
+                floor(range_c / g->cosine_width[level]) + 1.0);
+        if (level == TRIANGLE_GRID_MAX_LEVELS - 1 ||
+            (g->nx[level] == 1 && g->ny[level] == 1)) {
+            g->nx[level] = g->ny[level] = 1;
+            break;
+        }
+    }
+    g->nlevels = level + 1;
+
+    for (level = 0; level < g->nlevels; ++level) {
+        g->base[level] = ncells;
+        ncells += g->nx[level] * g->ny[level];
+    }
+
+    g->cell_start = calloc_with_error(
+            ncells + 1, sizeof(triangle_index_t), error);
+    if (g->cell_start == NULL) goto exit;
+
+    counts = calloc_with_error(ncells, sizeof(size_t), error);
+    if (counts == NULL) goto exit;
+
+    g->items = malloc_with_error(
+            MAX(n, 1) * sizeof(triangle_index_t), error);
+    if (g->items == NULL) goto exit;
+
+    /* Counting sort of the triangles into the cells of their levels */
+    for (i = 0; i < n; ++i) {
+        level = triangle_grid_level(
+                g, sqrt((double)t->ratio_tolerance[i]),
+                sqrt((double)t->cosine_tolerance[i]));
+        ++counts[triangle_grid_cell(g, t, level, i)];
+        ++g->nitems[level];
+    }
+
+    for (cell = 0; cell < ncells; ++cell) {
+        g->cell_start[cell + 1] =
+            g->cell_start[cell] + (triangle_index_t)counts[cell];
+        counts[cell] = g->cell_start[cell];
+    }
+
+    for (i = 0; i < n; ++i) {
+        level = triangle_grid_level(
+                g, sqrt((double)t->ratio_tolerance[i]),
+                sqrt((double)t->cosine_tolerance[i]));
+        g->items[counts[triangle_grid_cell(g, t, level, i)]++] =
+            (triangle_index_t)i;
+    }
+
+    status = 0;
+
+ exit:
 
-    /* Find the maximum tolerance for each list */
-    rmaxtol = r_triangles[0].ratio_tolerance;
-    for (i = 1; i < nr_triangles; ++i) {
-        rmaxtol = MAX(rmaxtol, r_triangles[i].ratio_tolerance);
+    free(counts);
+    if (status) {
+        triangle_grid_free(g);
     }
 
-    lmaxtol = l_triangles[0].ratio_tolerance;
-    for (i = 1; i < nl_triangles; ++i) {
-        lmaxtol = MAX(lmaxtol, l_triangles[i].ratio_tolerance);
+    return status;
+}
+
+/* Determine the range of cells in one dimension of a level that may
+   hold centers within radius of center.  The range is conservative:
+   it allows for rounding in the computation of the cell indices.
+   Returns zero if no cells are in range. */
+static int
+triangle_grid_cell_range(
+        const double center,
+        const double radius,
+        const double min,
+        const double width,
+        const size_t n,
+        size_t* const i0,
+        size_t* const i1) {
+
+    const double pad =
+        radius * 1e-9 + (fabs(center) + fabs(min)) * 16.0 * EPS_DOUBLE;
+    const double lo = floor((center - radius - pad - min) / width);
+    const double hi = floor((center + radius + pad - min) / width);
+
+    if (!(hi >= 0.0) || !(lo < (double)n)) {
+        return 0;
     }
+    *i0 = lo < 0.0 ? 0 : (size_t)lo;
+    *i1 = hi >= (double)n ? n - 1 : (size_t)hi;
+
+    return 1;
+}
+
+typedef struct {
+    const triangle_table_t* r_triangles;
+    const triangle_table_t* l_triangles;
+    const triangle_grid_t*  grid; /* NULL for the sweep */
+    double                  maxtol;
+    size_t                  chunk;
+    size_t                  capacity;
+    triangle_match_t*       matches;
+    size_t*                 nfound;      /* [ntasks] */
+    size_t*                 ncandidates; /* [ntasks] */
+} merge_triangles_t;
+
+/* Finds the matches of the chunk of triangles in R starting at
+   index * chunk, and writes them from matches[index * chunk] on.  Each
+   triangle in R has at most one match, so the chunks do not overlap. */
+static int
+merge_triangles_task(
+        void* data,
+        size_t index,
+        stimage_error_t* error) {
+
+    const merge_triangles_t* const m = (merge_triangles_t*)data;
+    const triangle_table_t* const r = m->r_triangles;
+    const triangle_table_t* const l = m->l_triangles;
+    const size_t nl_triangles = l->ntriangles;
+    const double* const l_ratio = l->ratio;
+    const double maxtol = m->maxtol;
+    const size_t first = index * m->chunk;
+    const size_t last = MIN(r->ntriangles, first + m->chunk);
+    size_t match_iter = first;
+    size_t ncandidates = 0;
+    size_t blp = 0, rp = 0, lp = 0, hi = 0, mid = 0;
+    size_t max_lp = 0;
+    int found = 0;
+    double dratio, dratio2, dcosine, dcosine2, dtratio, dtcosine;
+    double r_ratio, r_cosine, r_ratio_tolerance, r_cosine_tolerance;
+    double max_dratio2, max_dcosine2;
 
-    maxtol = sqrt(rmaxtol + lmaxtol);
+    /* The first triangle in L that satisfies the ratio tolerance
+       requirement for the first triangle of the chunk.  The ratios of
+       both lists increase, so this is where a single sweep over all
+       of R would have got to. */
+    r_ratio = r->ratio[first];
+    hi = nl_triangles;
+    while (blp < hi) {
+        mid = blp + (hi - blp) / 2;
+        if (r_ratio - l_ratio[mid] <= maxtol) {
+            hi = mid;
+        } else {
+            blp = mid + 1;
+        }
+    }
 
-    /* Loop over all the triangles in R */
-    for (rp = 0; rp < nr_triangles; ++rp) {
-        r_tri = r_triangles + rp;
+    /* Loop over the triangles of the chunk in R */
+    for (rp = first; rp < last; ++rp) {
+        r_ratio = r->ratio[rp];
 
         /* Move to the first triangle in L that satisfies the ratio
            tolerance requirement */
         for ( ; blp < nl_triangles; ++blp) {
-            l_tri = l_triangles + blp;
-            dratio = r_tri->ratio - l_tri->ratio;
+            dratio = r_ratio - l_ratio[blp];
             if (dratio <= maxtol) {
                 break;
             }
@@ -304,58 +1487,327 @@ merge_triangles(
 
         /* Search through the appropriate range of triangles for the
            closest fit. */
+        r_cosine = r->cosine_v1[rp];
+        r_ratio_tolerance = r->ratio_tolerance[rp];
+        r_cosine_tolerance = r->cosine_tolerance[rp];
 
         /* Initialize the tolerances */
-        max_tri = NULL;
+        found = 0;
         max_dratio2 = 0.5 * MAX_DOUBLE;
         max_dcosine2 = 0.5 * MAX_DOUBLE;
 
         for (lp = blp; lp < nl_triangles; ++lp) {
-            l_tri = l_triangles + lp;
-
             /* Quit the loop if the next triangle is out of match range. */
-            dratio = r_tri->ratio - l_tri->ratio;
+            dratio = r_ratio - l_ratio[lp];
             if (dratio < -maxtol) {
                 break;
             }
+            ++ncandidates;
 
             /* Compute the tolerances for the two triangles */
             dratio2 = dratio*dratio;
-            dcosine = r_tri->cosine_v1 - l_tri->cosine_v1;
+            dcosine = r_cosine - l->cosine_v1[lp];
             dcosine2 = dcosine*dcosine;
-            dtratio = r_tri->ratio_tolerance + l_tri->ratio_tolerance;
-            dtcosine = r_tri->cosine_tolerance + l_tri->cosine_tolerance;
+            dtratio = r_ratio_tolerance + l->ratio_tolerance[lp];
+            dtcosine = r_cosine_tolerance + l->cosine_tolerance[lp];
 
             /* Find the best of all possible matches */
             if (dratio2 <= dtratio && dcosine2 <= dtcosine &&
                 (dratio2 + dcosine2) < (max_dratio2 + max_dcosine2)) {
-                max_tri = l_tri;
+                found = 1;
+                max_lp = lp;
                 max_dratio2 = dratio2;
                 max_dcosine2 = dcosine2;
             }
         }
 
-        if (max_tri != NULL) {
-            #ifndef NDEBUG
-                if (match_iter >= *nmatches) {
-                    stimage_error_set_message(
-                        error,
-                        "Found more triangle matches than were allocated for");
-                    return 1;
+        if (found) {
+            if (match_iter >= m->capacity) {
+                stimage_error_set_message(
+                    error,
+                    "Found more triangle matches than were allocated for");
+                return 1;
+            }
+
+            m->matches[match_iter].l = (triangle_index_t)max_lp;
+            m->matches[match_iter].r = (triangle_index_t)rp;
+            ++match_iter;
+        }
+    }
+
+    m->nfound[index] = match_iter - first;
+    m->ncandidates[index] = ncandidates;
+
+    return 0;
+}
+
+/* The same as merge_triangles_task, but looks up the candidates in L
+   in the grid, only in the cells that the tolerances of each pair
+   allow.  The sweep picks the first of the equally close matches in
+   L, so ties are broken on the index in L. */
+static int
+merge_triangles_grid_task(
+        void* data,
+        size_t index,
+        stimage_error_t* error) {
+
+    const merge_triangles_t* const m = (merge_triangles_t*)data;
+    const triangle_table_t* const r = m->r_triangles;
+    const triangle_table_t* const l = m->l_triangles;
+    const triangle_grid_t* const g = m->grid;
+    const double maxtol = m->maxtol;
+    const size_t first = index * m->chunk;
+    const size_t last = MIN(r->ntriangles, first + m->chunk);
+    size_t match_iter = first;
+    size_t ncandidates = 0;
+    size_t rp, lp, level, iy, x0, x1, y0, y1, item, end, row;
+    size_t max_lp = 0;
+    int found = 0;
+    double dratio, dratio2, dcosine, dcosine2, dtratio, dtcosine, dist2;
+    double r_ratio, r_cosine, r_ratio_tolerance, r_cosine_tolerance;
+    double r_half_ratio, r_half_cosine;
+    double max_dist2;
+
+    for (rp = first; rp < last; ++rp) {
+        r_ratio = r->ratio[rp];
+        r_cosine = r->cosine_v1[rp];
+        r_ratio_tolerance = r->ratio_tolerance[rp];
+        r_cosine_tolerance = r->cosine_tolerance[rp];
+        r_half_ratio = sqrt(r_ratio_tolerance);
+        r_half_cosine = sqrt(r_cosine_tolerance);
+
+        found = 0;
+        max_dist2 = MAX_DOUBLE;
+
+        for (level = 0; level < g->nlevels; ++level) {
+            if (g->nitems[level] == 0) {
+                continue;
+            }
+
+            /* The top level is a single cell, which also holds the
+               triangles wider than its cells */
+            if (level == g->nlevels - 1) {
+                x0 = x1 = y0 = y1 = 0;
+            } else if (
+                !triangle_grid_cell_range(
+                    r_ratio,
+                    MIN(maxtol, r_half_ratio + g->ratio_width[level]),
+                    g->ratio_min, g->ratio_width[level], g->nx[level],
+                    &x0, &x1) ||
+                !triangle_grid_cell_range(
+                    r_cosine, r_half_cosine + g->cosine_width[level],
+                    g->cosine_min, g->cosine_width[level], g->ny[level],
+                    &y0, &y1)) {
+                continue;
+            }
+
+            for (iy = y0; iy <= y1; ++iy) {
+                row = g->base[level] + iy * g->nx[level];
+                item = g->cell_start[row + x0];
+                end = g->cell_start[row + x1 + 1];
+                for ( ; item < end; ++item) {
+                    lp = g->items[item];
+                    ++ncandidates;
+
+                    /* The same tests as the sweep, including its
+                       window in ratio */
+                    dratio = r_ratio - l->ratio[lp];
+                    if (dratio > maxtol || dratio < -maxtol) {
+                        continue;
+                    }
+
+                    dratio2 = dratio*dratio;
+                    dcosine = r_cosine - l->cosine_v1[lp];
+                    dcosine2 = dcosine*dcosine;
+                    dtratio = r_ratio_tolerance + l->ratio_tolerance[lp];
+                    dtcosine = r_cosine_tolerance + l->cosine_tolerance[lp];
+                    dist2 = dratio2 + dcosine2;
+
+                    if (dratio2 <= dtratio && dcosine2 <= dtcosine &&
+                        (dist2 < max_dist2 ||
+                         (dist2 == max_dist2 && found && lp < max_lp))) {
+                        found = 1;
+                        max_lp = lp;
+                        max_dist2 = dist2;
+                    }
                 }
-            #endif /* NDEBUG */
+            }
+        }
 
-            matches[match_iter].l = max_tri;
-            matches[match_iter].r = r_tri;
+        if (found) {
+            if (match_iter >= m->capacity) {
+                stimage_error_set_message(
+                    error,
+                    "Found more triangle matches than were allocated for");
+                return 1;
+            }
+
+            m->matches[match_iter].l = (triangle_index_t)max_lp;
+            m->matches[match_iter].r = (triangle_index_t)rp;
             ++match_iter;
         }
     }
 
+    m->nfound[index] = match_iter - first;
+    m->ncandidates[index] = ncandidates;
+
+    return 0;
+}
+
+static int
+_merge_triangles(
+        const triangle_table_t* const r_triangles,
+        const triangle_table_t* const l_triangles,
+        const triangle_grid_t* const grid,
+        size_t* nmatches,
+        triangle_match_t* const matches,
+        const size_t nthreads,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error) {
+
+    merge_triangles_t merge;
+    size_t            nr_triangles;
+    size_t            nl_triangles;
+    size_t            ntasks      = 0;
+    size_t            match_iter  = 0;
+    size_t            ncandidates = 0;
+    size_t            i;
+    double            rmaxtol, lmaxtol;
+    int               status      = 1;
+
+    nr_triangles = r_triangles->ntriangles;
+    nl_triangles = l_triangles->ntriangles;
+    merge.nfound = NULL;
+
+    /* Find the maximum tolerance for each list */
+    rmaxtol = r_triangles->ratio_tolerance[0];
+    for (i = 1; i < nr_triangles; ++i) {
+        rmaxtol = MAX(rmaxtol, r_triangles->ratio_tolerance[i]);
+    }
+
+    lmaxtol = l_triangles->ratio_tolerance[0];
+    for (i = 1; i < nl_triangles; ++i) {
+        lmaxtol = MAX(lmaxtol, l_triangles->ratio_tolerance[i]);
+    }
+
+    merge.r_triangles = r_triangles;
+    merge.l_triangles = l_triangles;
+    merge.grid = grid;
+    merge.maxtol = sqrt(rmaxtol + lmaxtol);
+    merge.capacity = *nmatches;
+    merge.matches = matches;
+
+    /* R is split into chunks only if there is room for a match of
+       every triangle in it.  Otherwise the matches are found in a
+       single pass, and only need as much room as there are matches. */
+    merge.chunk = (*nmatches >= nr_triangles) ?
+        MERGE_TRIANGLES_CHUNK : nr_triangles;
+    ntasks = (nr_triangles + merge.chunk - 1) / merge.chunk;
+
+    merge.nfound = malloc_with_error(2 * ntasks * sizeof(size_t), error);
+    if (merge.nfound == NULL) goto exit;
+    merge.ncandidates = merge.nfound + ntasks;
+
+    if (parallel_for(
+                ntasks, nthreads,
+                grid ? &merge_triangles_grid_task : &merge_triangles_task,
+                &merge, error)) goto exit;
+
+    /* Pack the matches of each chunk together */
+    for (i = 0; i < ntasks; ++i) {
+        if (i * merge.chunk != match_iter) {
+            memmove(matches + match_iter, matches + i * merge.chunk,
+                    merge.nfound[i] * sizeof(triangle_match_t));
+        }
+        match_iter += merge.nfound[i];
+        ncandidates += merge.ncandidates[i];
+    }
+
     *nmatches = match_iter;
 
+    stimage_stats_count(stats, "merge_triangles.matches", (double)match_iter);
+    stimage_stats_count(
+            stats, "merge_triangles.candidates", (double)ncandidates);
+
+    status = 0;
+
+ exit:
+
+    free(merge.nfound);
+
+    return status;
+}
+
+int
+merge_triangles(
+        const triangle_table_t* const r_triangles,
+        const triangle_table_t* const l_triangles,
+        size_t* nmatches,
+        triangle_match_t* const matches,
+        const size_t nthreads,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error) {
+
+    const double start = stimage_stats_start(stats);
+
+    assert(r_triangles);
+    assert(r_triangles->ntriangles);
+    assert(l_triangles);
+    assert(l_triangles->ntriangles);
+    assert(nmatches);
+    assert(matches);
+    assert(error);
+
+    if (_merge_triangles(
+                r_triangles, l_triangles, NULL, nmatches, matches,
+                nthreads, stats, error)) return 1;
+
+    stimage_stats_stop(stats, "merge_triangles.time", start);
+
     return 0;
 }
 
+int
+merge_triangles_grid(
+        const triangle_table_t* const r_triangles,
+        const triangle_table_t* const l_triangles,
+        size_t* nmatches,
+        triangle_match_t* const matches,
+        const size_t nthreads,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error) {
+
+    const double    start  = stimage_stats_start(stats);
+    triangle_grid_t grid;
+    int             status = 1;
+
+    assert(r_triangles);
+    assert(r_triangles->ntriangles);
+    assert(l_triangles);
+    assert(l_triangles->ntriangles);
+    assert(nmatches);
+    assert(matches);
+    assert(error);
+
+    if (triangle_grid_init(&grid, l_triangles, error)) return 1;
+
+    if (_merge_triangles(
+                r_triangles, l_triangles, &grid, nmatches, matches,
+                nthreads, stats, error)) goto exit;
+
+    stimage_stats_stop(stats, "merge_triangles.time", start);
+    stimage_stats_count(
+            stats, "merge_triangles.grid_levels", (double)grid.nlevels);
+
+    status = 0;
+
+ exit:
+
+    triangle_grid_free(&grid);
+
+    return status;
+}
+
 static int
 reject_triangles_compute_sigma_mode_factor(
         const size_t nmatches,
@@ -405,11 +1857,15 @@ reject_triangles_compute_sigma_mode_factor(
 
 int
 reject_triangles(
+        const triangle_table_t* const r_triangles,
+        const triangle_table_t* const l_triangles,
         size_t* nmatches,
         triangle_match_t* const matches,
         const size_t nreject,
+        stimage_stats_t* const stats,
         stimage_error_t* error) {
 
+    const double      start        = stimage_stats_start(stats);
     size_t            i            = 0;
     double            sum          = 0.0;
     double            sumsq        = 0.0;
@@ -426,30 +1882,46 @@ reject_triangles(
     size_t            ncount       = 0;
     size_t            ncurrmatches = *nmatches;
     size_t            niter        = 0;
-    const triangle_t* r_tri        = NULL;
-    const triangle_t* l_tri        = NULL;
+    size_t            niterations  = 0;
+    double            r_log_perimeter, l_log_perimeter;
+    int               r_sense, l_sense;
+    double*           diffs        = NULL;
     double*           diffp        = NULL;
+    unsigned char*    same_sense   = NULL;
     int               status       = 1;
 
+    assert(r_triangles);
+    assert(l_triangles);
     assert(nmatches);
     assert(matches);
     assert(error);
 
-    diffp = malloc_with_error(ncurrmatches * sizeof(double), error);
-    if (diffp == NULL) goto exit;
+    /* diffs and same_sense stay in step with matches, while diffp is
+       sorted to find the mode */
+    diffs = malloc_with_error(
+            MAX(1, ncurrmatches) * (2 * sizeof(double) + 1), error);
+    if (diffs == NULL) goto exit;
+    diffp = diffs + MAX(1, ncurrmatches);
+    same_sense = (unsigned char*)(diffp + MAX(1, ncurrmatches));
 
     /* Accumulate the number of same-sense and number of
        opposite-sense matches as well as the log perimeter
-       statistics. */
+       statistics.  The log perimeter and the sense are not stored in
+       the triangle tables, so they are computed here for the matched
+       triangles only. */
     for (i = 0; i < ncurrmatches; ++i) {
-        r_tri = matches[i].r;
-        l_tri = matches[i].l;
+        triangle_shape(
+                r_triangles, matches[i].r, &r_log_perimeter, &r_sense);
+        triangle_shape(
+                l_triangles, matches[i].l, &l_log_perimeter, &l_sense);
 
-        diff = r_tri->log_perimeter - l_tri->log_perimeter;
+        diff = r_log_perimeter - l_log_perimeter;
+        diffs[i] = diff;
         diffp[i] = diff;
+        same_sense[i] = (r_sense == l_sense);
         sum += diff;
         sumsq += diff*diff;
-        if (r_tri->sense == l_tri->sense) {
+        if (same_sense[i]) {
             ++nplus;
         }
     }
@@ -465,18 +1937,17 @@ reject_triangles(
 
     /* Begin the rejection loop */
     for (niter = 0; niter < nreject; ++niter) {
+        ++niterations;
         ncount = 0;
         locut = mode - factor * sigma;
         hicut = mode + factor * sigma;
 
         for (i = 0; i < ncurrmatches; ++i) {
-            r_tri = matches[i].r;
-            l_tri = matches[i].l;
-            diff = r_tri->log_perimeter - l_tri->log_perimeter;
+            diff = diffs[i];
             if (diff < locut || diff > hicut) {
                 sum -= diff;
                 sumsq -= diff*diff;
-                if (r_tri->sense == l_tri->sense) {
+                if (same_sense[i]) {
                     --nplus;
                 } else {
                     --nminus;
@@ -492,9 +1963,10 @@ reject_triangles(
                         goto exit;
                     }
                 #endif
+                diffs[ncount] = diff;
                 diffp[ncount] = diff;
-                matches[ncount].r = r_tri;
-                matches[ncount].l = l_tri;
+                same_sense[ncount] = same_sense[i];
+                matches[ncount] = matches[i];
                 ++ncount;
             }
         }
@@ -523,11 +1995,8 @@ reject_triangles(
         if (nplus > nminus) {
             ncount = 0;
             for (i = 0; i < ncurrmatches; ++i) {
-                r_tri = matches[i].r;
-                l_tri = matches[i].l;
-                if (r_tri->sense == l_tri->sense) {
-                    matches[ncount].r = r_tri;
-                    matches[ncount].l = l_tri;
+                if (same_sense[i]) {
+                    matches[ncount] = matches[i];
                     ++ncount;
                 }
             }
@@ -535,11 +2004,8 @@ reject_triangles(
         } else {
             ncount = 0;
             for (i = 0; i < ncurrmatches; ++i) {
-                r_tri = matches[i].r;
-                l_tri = matches[i].l;
-                if (r_tri->sense != l_tri->sense) {
-                    matches[ncount].r = r_tri;
-                    matches[ncount].l = l_tri;
+                if (!same_sense[i]) {
+                    matches[ncount] = matches[i];
                     ++ncount;
                 }
             }
@@ -553,19 +2019,152 @@ reject_triangles(
 
  exit:
 
-    free(diffp);
+    if (status == 0) {
+        stimage_stats_stop(stats, "reject_triangles.time", start);
+        stimage_stats_count(
+                stats, "reject_triangles.iterations", (double)niterations);
+        stimage_stats_count(stats, "reject_triangles.kept", (double)*nmatches);
+    }
+
+    free(diffs);
 
     return status;
 }
 
+int
+build_triangles(
+        const triangle_mode_e mode,
+        const size_t k,
+        const size_t ncoords,
+        const coord_t* const * const coords,
+        const size_t nmatch,
+        const double tolerance,
+        const double maxratio,
+        const size_t nthreads,
+        triangle_table_t* const triangles,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error) {
+
+    size_t ntriangles = 0;
+
+    triangle_table_new(triangles);
+
+    if (mode == triangle_mode_knn) {
+        if (max_num_triangles_knn(
+                ncoords, nmatch, k, &ntriangles, error)) return 1;
+    } else {
+        if (max_num_triangles(ncoords, nmatch, &ntriangles, error)) return 1;
+    }
+
+    if (triangle_table_init(triangles, ntriangles, coords, error)) return 1;
+
+    if (mode == triangle_mode_knn) {
+        return find_triangles_knn(
+                ncoords, coords, triangles, nmatch, k,
+                tolerance, maxratio, nthreads, stats, error);
+    }
+
+    return find_triangles(
+            ncoords, coords, triangles, nmatch,
+            tolerance, maxratio, nthreads, stats, error);
+}
+
+typedef struct {
+    triangle_mode_e        mode;
+    size_t                 k;
+    size_t                 nmatch;
+    double                 tolerance;
+    double                 maxratio;
+    size_t                 nthreads;
+    size_t                 ncoords[2];
+    const coord_t* const * coords[2];
+    triangle_table_t       triangles[2];
+    stimage_stats_t*       stats[2];
+} build_triangles_pair_t;
+
+static int
+build_triangles_pair_task(
+        void* data,
+        size_t index,
+        stimage_error_t* error) {
+
+    build_triangles_pair_t* const b = (build_triangles_pair_t*)data;
+
+    return build_triangles(
+            b->mode, b->k, b->ncoords[index], b->coords[index],
+            b->nmatch, b->tolerance, b->maxratio, b->nthreads,
+            &b->triangles[index], b->stats[index], error);
+}
+
+/* Builds the triangles of two coordinate lists at the same time, each
+   on half of the threads */
+static int
+build_triangles_pair(
+        build_triangles_pair_t* const b,
+        const size_t nthreads,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error) {
+
+    const size_t    nworkers = nthreads == 0 ? parallel_ncpus() : nthreads;
+    stimage_stats_t pair_stats[2];
+    size_t          i;
+
+    b->nthreads = MAX(1, nworkers / 2);
+    triangle_table_new(&b->triangles[0]);
+    triangle_table_new(&b->triangles[1]);
+    b->stats[0] = b->stats[1] = stats;
+
+    /* Each list records its statistics separately while they run at
+       the same time */
+    if (nworkers > 1 && stats != NULL) {
+        for (i = 0; i < 2; ++i) {
+            stimage_stats_init(&pair_stats[i]);
+            b->stats[i] = &pair_stats[i];
+        }
+    }
+
+    if (parallel_for(
+                2, nworkers, &build_triangles_pair_task, b, error)) {
+        return 1;
+    }
+
+    if (b->stats[0] != stats) {
+        stimage_stats_merge(stats, &pair_stats[0]);
+        stimage_stats_merge(stats, &pair_stats[1]);
+    }
+
+    return 0;
+}
+
+/* Having no valid triangles in one of the lists is an error, unless
+   empty_ok is set, when it just means there are no matches */
+static int
+_match_no_triangles(
+        const int empty_ok,
+        const char* const message,
+        size_t* ncoord_matches,
+        stimage_error_t* const error) {
+
+    if (empty_ok) {
+        *ncoord_matches = 0;
+        return 0;
+    }
+
+    stimage_error_set_message(error, message);
+    return 1;
+}
+
 static int
 _match_triangles(
+        const size_t nref_all,
         const size_t nref,
-        const coord_t* const ref,
+        const coord_t* const ref, /*[nref_all]*/
         const coord_t* const * const ref_sorted, /*[nref]*/
+        const size_t ninput_all,
         const size_t ninput,
-        const coord_t* const input, /*[ninput]*/
-        const coord_t* const * const input_sorted,
+        const coord_t* const input, /*[ninput_all]*/
+        const coord_t* const * const input_sorted, /*[ninput]*/
+        const triangle_table_t* const ref_prepared,
         size_t* ncoord_matches,
         const coord_t** refcoord_matches_,
         const coord_t** inputcoord_matches_,
@@ -573,23 +2172,31 @@ _match_triangles(
         const double tolerance,
         const double maxratio,
         const size_t nreject,
+        const triangle_mode_e mode,
+        const size_t k,
+        const triangle_merge_e merge,
+        const size_t nthreads,
+        const int empty_ok,
         size_t* nkeep,
         size_t* nmerge,
+        stimage_stats_t* const stats,
         stimage_error_t* const error) {
 
-    const coord_t**   refcoord_matches   = NULL;
-    const coord_t**   inputcoord_matches = NULL;
-    size_t            nleft              = 0;
-    const coord_t*    left               = NULL;
-    size_t            nright             = 0;
-    const coord_t*    right              = NULL;
-    size_t            nref_triangles     = 0;
-    triangle_t*       ref_triangles      = NULL;
-    size_t            ninput_triangles   = 0;
-    triangle_t*       input_triangles    = NULL;
-    size_t            ntriangle_matches  = 0;
-    triangle_match_t* triangle_matches   = NULL;
-    int               status             = 1;
+    build_triangles_pair_t  build;
+    const coord_t**         refcoord_matches   = NULL;
+    const coord_t**         inputcoord_matches = NULL;
+    size_t                  nleft              = 0;
+    const coord_t*          left               = NULL;
+    const triangle_table_t* l_triangles        = NULL;
+    size_t                  nright             = 0;
+    const coord_t*          right              = NULL;
+    const triangle_table_t* r_triangles        = NULL;
+    const triangle_table_t* ref_triangles      = NULL;
+    triangle_table_t        ref_triangles_own;
+    triangle_table_t        input_triangles;
+    size_t                  ntriangle_matches  = 0;
+    triangle_match_t*       triangle_matches   = NULL;
+    int                     status             = 1;
 
     assert(ref);
     assert(ref_sorted);
@@ -602,6 +2209,12 @@ _match_triangles(
     assert(nmerge);
     assert(error);
 
+    *nkeep = 0;
+    *nmerge = 0;
+
+    triangle_table_new(&ref_triangles_own);
+    triangle_table_new(&input_triangles);
+
     if (nref < 3) {
         stimage_error_set_message(
             error,
@@ -616,84 +2229,102 @@ _match_triangles(
         goto exit;
     }
 
-    /* Find all the reference triangles */
-    if (max_num_triangles(nref, nmatch, &nref_triangles, error)) goto exit;
-
-    ref_triangles = malloc_with_error(
-            nref_triangles * sizeof(triangle_t), error);
-    if (ref_triangles == NULL) goto exit;
+    /* Find all the input triangles, and the reference triangles
+       unless they were already built by the caller */
+    if (ref_prepared != NULL) {
+        ref_triangles = ref_prepared;
 
-    if (find_triangles(nref, ref_sorted, &nref_triangles, ref_triangles,
-                       nmatch, tolerance, maxratio, error)) goto exit;
+        if (ref_triangles->ntriangles == 0) {
+            status = _match_no_triangles(
+                    empty_ok, "No valid reference triangles found.",
+                    ncoord_matches, error);
+            goto exit;
+        }
 
-    if (nref_triangles == 0) {
-        stimage_error_set_message(
-            error,
-            "No valid reference triangles found.");
-        goto exit;
+        if (build_triangles(
+                    mode, k, ninput, input_sorted, nmatch, tolerance,
+                    maxratio, nthreads, &input_triangles,
+                    stats, error)) goto exit;
+    } else {
+        build.mode = mode;
+        build.k = k;
+        build.nmatch = nmatch;
+        build.tolerance = tolerance;
+        build.maxratio = maxratio;
+        build.ncoords[0] = nref;
+        build.coords[0] = ref_sorted;
+        build.ncoords[1] = ninput;
+        build.coords[1] = input_sorted;
+
+        status = build_triangles_pair(&build, nthreads, stats, error);
+        ref_triangles_own = build.triangles[0];
+        input_triangles = build.triangles[1];
+        if (status) goto exit;
+        status = 1;
+
+        ref_triangles = &ref_triangles_own;
+
+        if (ref_triangles->ntriangles == 0) {
+            status = _match_no_triangles(
+                    empty_ok, "No valid reference triangles found.",
+                    ncoord_matches, error);
+            goto exit;
+        }
     }
 
-    /* Find all the input triangles */
-    if (max_num_triangles(ninput, nmatch, &ninput_triangles, error)) goto exit;
-
-    input_triangles = malloc_with_error(
-            ninput_triangles * sizeof(triangle_t), error);
-    if (input_triangles == NULL) goto exit;
-
-    if (find_triangles(ninput, input_sorted, &ninput_triangles,
-                       input_triangles, nmatch, tolerance, maxratio,
-                       error)) goto exit;
-
-    if (ninput_triangles == 0) {
-        stimage_error_set_message(
-            error,
-            "No valid input triangles found.");
+    if (input_triangles.ntriangles == 0) {
+        status = _match_no_triangles(
+                empty_ok, "No valid input triangles found.",
+                ncoord_matches, error);
         goto exit;
     }
 
-    ntriangle_matches = MAX(nref_triangles, ninput_triangles);
+    ntriangle_matches = MAX(
+            ref_triangles->ntriangles, input_triangles.ntriangles);
     triangle_matches = malloc_with_error(
         ntriangle_matches * sizeof(triangle_match_t), error);
     if (triangle_matches == NULL) goto exit;
 
     /* Match the triangles in the input list to those in the reference
        list */
-    if (nref_triangles <= ninput_triangles) {
+    if (ref_triangles->ntriangles <= input_triangles.ntriangles) {
         refcoord_matches = inputcoord_matches_;
         inputcoord_matches = refcoord_matches_;
-        nleft = ninput;
+        nleft = ninput_all;
         left = input;
-        nright = nref;
+        l_triangles = &input_triangles;
+        nright = nref_all;
         right = ref;
-        if (merge_triangles(
-                nref_triangles, ref_triangles,
-                ninput_triangles, input_triangles,
-                &ntriangle_matches, triangle_matches,
-                error)) goto exit;
+        r_triangles = ref_triangles;
     } else {
         refcoord_matches = refcoord_matches_;
         inputcoord_matches = inputcoord_matches_;
-        nleft = nref;
+        nleft = nref_all;
         left = ref;
-        nright = ninput;
+        l_triangles = ref_triangles;
+        nright = ninput_all;
         right = input;
-        if (merge_triangles(
-                ninput_triangles, input_triangles,
-                nref_triangles, ref_triangles,
-                &ntriangle_matches, triangle_matches,
-                error)) goto exit;
+        r_triangles = &input_triangles;
     }
 
+    if ((merge == triangle_merge_grid ?
+         merge_triangles_grid : merge_triangles)(
+            r_triangles, l_triangles,
+            &ntriangle_matches, triangle_matches,
+            nthreads, stats, error)) goto exit;
+
     *nmerge = ntriangle_matches;
 
     if (ntriangle_matches == 0) {
+        *ncoord_matches = 0;
         status = 0;
         goto exit;
     }
 
     /* Reject triangles */
-    if (reject_triangles(&ntriangle_matches, triangle_matches,
-                         nreject,
+    if (reject_triangles(r_triangles, l_triangles,
+                         &ntriangle_matches, triangle_matches,
+                         nreject, stats,
                          error)) {
         goto exit;
     }
@@ -708,10 +2339,10 @@ _match_triangles(
 
     /* Match the coordinates */
     if (vote_triangle_matches(
-                nleft, left, nright, right,
+                nleft, left, l_triangles, nright, right, r_triangles,
                 ntriangle_matches, triangle_matches,
                 ncoord_matches, refcoord_matches, inputcoord_matches,
-                error)) {
+                stats, error)) {
         goto exit;
     }
 
@@ -719,8 +2350,8 @@ _match_triangles(
 
  exit:
 
-    free(ref_triangles);
-    free(input_triangles);
+    triangle_table_free(&ref_triangles_own);
+    triangle_table_free(&input_triangles);
     free(triangle_matches);
     return status;
 }
@@ -739,65 +2370,193 @@ match_triangles(
         const double tolerance,
         const double maxratio,
         const size_t nreject,
+        const triangle_mode_e mode,
+        const size_t k,
+        coord_match_callback_t* callback,
+        void* callback_data,
+        stimage_error_t* const error) {
+
+    return match_triangles_prepared(
+            nref, nref_unique, ref, ref_sorted,
+            ninput, ninput_unique, input, input_sorted,
+            NULL, 0,
+            nmatch, tolerance, maxratio, nreject, mode, k,
+            triangle_merge_sweep, 1, NULL, callback, callback_data,
+            NULL, error);
+}
+
+/* A level of adaptive matching is convincing if at least this many
+   coordinates, and this fraction of those used, are matched */
+#define MATCH_TRIANGLES_MIN_CONFIDENT 5
+#define MATCH_TRIANGLES_CONFIDENT_FRACTION 0.2
+
+/* Match the triangles formed by up to nmatch coordinates of each list,
+   and check the matches with a second pass.  If empty_ok is set,
+   finding no valid triangles gives no matches rather than an
+   error. */
+static int
+_match_triangles_passes(
+        const size_t nref,
+        const size_t nref_unique,
+        const coord_t* const ref,
+        const coord_t* const * const ref_sorted, /*[nref]*/
+        const size_t ninput,
+        const size_t ninput_unique,
+        const coord_t* const input, /*[ninput]*/
+        const coord_t* const * const input_sorted,
+        const triangle_table_t* const ref_triangles,
+        size_t* ncoord_matches,
+        const coord_t** refcoord_matches, /*[nmatch]*/
+        const coord_t** inputcoord_matches, /*[nmatch]*/
+        const size_t nmatch,
+        const double tolerance,
+        const double maxratio,
+        const size_t nreject,
+        const triangle_mode_e mode,
+        const size_t k,
+        const triangle_merge_e merge,
+        const size_t nthreads,
+        const int empty_ok,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error) {
+
+    size_t nkeep  = 0;
+    size_t nmerge = 0;
+    size_t ncheck = 0;
+
+    *ncoord_matches = nmatch;
+
+    if (_match_triangles(
+        nref, nref_unique, ref, ref_sorted,
+        ninput, ninput_unique, input, input_sorted,
+        ref_triangles,
+        ncoord_matches, refcoord_matches, inputcoord_matches,
+        nmatch, tolerance, maxratio, nreject, mode, k, merge, nthreads,
+        empty_ok, &nkeep, &nmerge,
+        stats, error)) return 1;
+    stimage_stats_count(stats, "match_triangles.passes", 1.0);
+
+    if (*ncoord_matches == 0 || (*ncoord_matches <= 3 && nkeep < nmerge)) {
+        return 0;
+    }
+
+    /* If all the coordinates were not matched then make another pass
+       through the triangles matching algorithm. If the number of
+       matches decreases as a result of this then all the matches were
+       not true matches and declare the list unmatched.  This check
+       does not apply to triangle_mode_knn, since the nearest neighbors
+       within the matched coordinates are not the same as within the
+       whole lists. */
+    if (mode == triangle_mode_all &&
+        *ncoord_matches < nmatch && *ncoord_matches > 2) {
+        ncheck = *ncoord_matches;
+        if (_match_triangles(
+                nref, *ncoord_matches, ref, refcoord_matches,
+                ninput, *ncoord_matches, input, inputcoord_matches,
+                NULL,
+                ncoord_matches, refcoord_matches, inputcoord_matches,
+                nmatch, tolerance, maxratio, nreject, mode, k, merge, nthreads,
+                empty_ok, &nkeep, &nmerge, stats, error)) return 1;
+        stimage_stats_count(stats, "match_triangles.passes", 1.0);
+
+        if (*ncoord_matches < ncheck) {
+            *ncoord_matches = 0;
+        }
+    }
+
+    return 0;
+}
+
+int
+match_triangles_prepared(
+        const size_t nref,
+        const size_t nref_unique,
+        const coord_t* const ref,
+        const coord_t* const * const ref_sorted, /*[nref]*/
+        const size_t ninput,
+        const size_t ninput_unique,
+        const coord_t* const input, /*[ninput]*/
+        const coord_t* const * const input_sorted,
+        const triangle_table_t* const ref_triangles,
+        const size_t nmatch_start,
+        const size_t nmatch,
+        const double tolerance,
+        const double maxratio,
+        const size_t nreject,
+        const triangle_mode_e mode,
+        const size_t k,
+        const triangle_merge_e merge,
+        const size_t nthreads,
+        size_t* const nmatch_used,
         coord_match_callback_t* callback,
         void* callback_data,
+        stimage_stats_t* const stats,
         stimage_error_t* const error) {
 
-    size_t          ncoord_matches     = nmatch;
+    size_t          ncoord_matches     = 0;
     const coord_t** refcoord_matches   = NULL;
     const coord_t** inputcoord_matches = NULL;
-    size_t          nkeep              = 0;
-    size_t          nmerge             = 0;
-    size_t          ncheck             = 0;
+    size_t          level              = nmatch;
+    size_t          nused              = 0;
     size_t          ref_idx            = 0;
     size_t          input_idx          = 0;
     size_t          i                  = 0;
     int             status             = 1;
 
     refcoord_matches = malloc_with_error(
-            ncoord_matches * sizeof(coord_t*), error);
+            nmatch * sizeof(coord_t*), error);
     if (refcoord_matches == NULL) goto exit;
 
     inputcoord_matches = malloc_with_error(
-            ncoord_matches * sizeof(coord_t*), error);
+            nmatch * sizeof(coord_t*), error);
     if (inputcoord_matches == NULL) goto exit;
 
-    if (_match_triangles(
-        nref_unique, ref, ref_sorted,
-        ninput_unique, input, input_sorted,
-        &ncoord_matches, refcoord_matches, inputcoord_matches,
-        nmatch, tolerance, maxratio, nreject,
-        &nkeep, &nmerge,
-        error)) goto exit;
-
-    if (ncoord_matches == 0 || (ncoord_matches <= 3 && nkeep < nmerge)) {
-        status = 0;
-        goto exit;
+    if (nmatch_start > 0 && nmatch_start < nmatch) {
+        level = MAX(nmatch_start, 3);
     }
 
-    /* If all the coordinates were not matched then make another pass
-       through the triangles matching algorithm. If the number of
-       matches decreases as a result of this then all the matches were
-       not true matches and declare the list unmatched. */
-    if (ncoord_matches < nmatch && ncoord_matches > 2) {
-        ncheck = ncoord_matches;
-        if (_match_triangles(
-                ncoord_matches, ref, refcoord_matches,
-                ncoord_matches, input, inputcoord_matches,
-                &ncoord_matches, refcoord_matches, inputcoord_matches,
-                nmatch, tolerance, maxratio, nreject,
-                &nkeep, &nmerge, error)) goto exit;
-
-        if (ncoord_matches < ncheck) {
-            ncoord_matches = 0;
+    /* Start with the first level, and double it until the matches are
+       convincing, the level covers both lists or it reaches nmatch */
+    for (;;) {
+        nused = MIN(level, MIN(nref_unique, ninput_unique));
+
+        /* The prepared reference triangles are those of nmatch
+           coordinates, so a level below that builds its own.  It may
+           find no triangles that pass maxratio, which is not an
+           error: it just moves on to the next level. */
+        if (_match_triangles_passes(
+                    nref, nref_unique, ref, ref_sorted,
+                    ninput, ninput_unique, input, input_sorted,
+                    level == nmatch ? ref_triangles : NULL,
+                    &ncoord_matches, refcoord_matches, inputcoord_matches,
+                    level, tolerance, maxratio, nreject, mode, k, merge,
+                    nthreads, level < nmatch, stats, error)) goto exit;
+        stimage_stats_count(stats, "match_triangles.levels", 1.0);
+
+        if (level >= nmatch ||
+            (level >= nref_unique && level >= ninput_unique) ||
+            (ncoord_matches >= MATCH_TRIANGLES_MIN_CONFIDENT &&
+             (double)ncoord_matches >=
+                 MATCH_TRIANGLES_CONFIDENT_FRACTION * (double)nused)) {
+            break;
         }
+
+        level = MIN(2 * level, nmatch);
+    }
+
+    if (nmatch_used) {
+        *nmatch_used = level;
     }
+    stimage_stats_count(stats, "match_triangles.nmatch", (double)level);
 
     status = 0;
 
  exit:
 
     if (status == 0) {
+        stimage_stats_count(
+                stats, "match_triangles.matches", (double)ncoord_matches);
+
         /* Call the callback with all of the matches */
         for (i = 0; i < ncoord_matches; ++i) {
             ref_idx = refcoord_matches[i] - ref;
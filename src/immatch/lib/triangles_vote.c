@@ -34,103 +34,177 @@ DAMAGE.
 */
 
 #include <assert.h>
+#include <limits.h>
 #include <stdio.h>
 
 #include "immatch/lib/triangles.h"
 
+/* Used as a qsort functor */
+static int
+vote_index_compare(
+        const void* ap,
+        const void* bp) {
+
+    const triangle_index_t a = *(const triangle_index_t*)ap;
+    const triangle_index_t b = *(const triangle_index_t*)bp;
+
+    if (a < b) {
+        return -1;
+    } else if (a > b) {
+        return 1;
+    } else {
+        return 0;
+    }
+}
+
 int
 vote_triangle_matches(
         const size_t nleft,
         const coord_t* const left,
+        const triangle_table_t* const l_triangles,
         const size_t nright,
         const coord_t* const right,
+        const triangle_table_t* const r_triangles,
         const size_t ntriangle_matches,
         const triangle_match_t* const triangle_matches,
         size_t* ncoord_matches,
         const coord_t** const refcoord_matches,
         const coord_t** const inputcoord_matches,
+        stimage_stats_t* const stats,
         stimage_error_t* const error) {
 
     typedef size_t vote_t;
 
-    vote_t*           votes        = NULL;
+    const double      start        = stimage_stats_start(stats);
+    size_t*           row_start    = NULL;
+    triangle_index_t* votes        = NULL;
+    size_t            npairs       = 0;
     vote_t            maxvote      = 0;
     vote_t            half_maxvote = 0;
     vote_t            row_maxvote  = 0;
     vote_t            row_2maxvote = 0;
     vote_t            vote         = 0;
-    const triangle_t* r_tri        = NULL;
-    const triangle_t* l_tri        = NULL;
     const coord_t*    r_coord      = NULL;
     const coord_t*    l_coord      = NULL;
-    size_t            li           = 0;
     size_t            ri           = 0;
-    size_t            ri2          = 0;
+    size_t            end          = 0;
+    size_t            r_idx        = 0;
+    size_t            l_idx        = 0;
     size_t            ncount       = 0;
     size_t            i            = 0;
     size_t            j            = 0;
     int               status       = 1;
 
+    assert(l_triangles);
+    assert(r_triangles);
     assert(triangle_matches);
     assert(ncoord_matches);
     assert(refcoord_matches);
     assert(inputcoord_matches);
     assert(error);
 
-    /* Since the vote tallies are rather sparse, this uses a nested
-       map from reference coordinates to a map from input coordinates
-       to vote counts. */
+    /* The vote tallies are very sparse: at most 3 *
+       ntriangle_matches of the nleft * nright possible pairs get a
+       vote.  So the votes are bucketed by right coordinate, each as
+       the 32-bit index of the left coordinate it is for, and each
+       bucket is sorted so that the votes for each pair are adjacent
+       and in increasing order of the left index. */
+
+    npairs = 3 * ntriangle_matches;
+    if (npairs == 0) {
+        *ncoord_matches = 0;
+        status = 0;
+        goto exit;
+    }
 
-    #define VOTE(li, ri) votes[(ri) * nleft + (li)]
+    if (nleft > UINT_MAX) {
+        stimage_error_set_message(error, "Too many coordinates to index");
+        goto exit;
+    }
 
-    votes = (vote_t *) malloc(nleft * nright * sizeof(vote_t));
+    row_start = calloc_with_error(nright + 1, sizeof(size_t), error);
+    if (row_start == NULL) {
+        goto exit;
+    }
+
+    votes = malloc_with_error(npairs * sizeof(triangle_index_t), error);
     if (votes == NULL) {
         goto exit;
     }
 
-    for (i = 0; i < nleft * nright; ++i) {
-        votes[i] = 0;
+    /* Count the votes for each right coordinate, and then place them.
+       The coordinates the tables index into may be the output arrays,
+       so they are all converted to indices into left and right before
+       anything is written. */
+    for (i = 0; i < ntriangle_matches; ++i) {
+        r_idx = 3 * (size_t)triangle_matches[i].r;
+        for (j = 0; j < 3; ++j) {
+            r_coord = r_triangles->coords[r_triangles->vertices[r_idx + j]];
+            assert((size_t)(r_coord - right) < nright);
+            ++row_start[r_coord - right + 1];
+        }
+    }
+
+    for (ri = 0; ri < nright; ++ri) {
+        row_start[ri + 1] += row_start[ri];
     }
 
-    /* Accumulate the votes */
+    /* Each row_start[ri] is used as the position of the next vote of
+       ri, which leaves it at the start of the next row */
     for (i = 0; i < ntriangle_matches; ++i) {
-        r_tri = triangle_matches[i].r;
-        l_tri = triangle_matches[i].l;
+        r_idx = 3 * (size_t)triangle_matches[i].r;
+        l_idx = 3 * (size_t)triangle_matches[i].l;
 
         for (j = 0; j < 3; ++j) {
-            l_coord = l_tri->vertices[j];
-            r_coord = r_tri->vertices[j];
-            li = l_coord - left;
-            assert(li >= 0 && li < nleft);
-            ri = r_coord - right;
-            assert(ri >= 0 && ri < nright);
-            vote = ++VOTE(li, ri);
+            l_coord = l_triangles->coords[l_triangles->vertices[l_idx + j]];
+            assert((size_t)(l_coord - left) < nleft);
+            r_coord = r_triangles->coords[r_triangles->vertices[r_idx + j]];
+            votes[row_start[r_coord - right]++] =
+                (triangle_index_t)(l_coord - left);
+        }
+    }
+
+    for (ri = nright; ri > 0; --ri) {
+        row_start[ri] = row_start[ri - 1];
+    }
+    row_start[0] = 0;
+
+    for (ri = 0; ri < nright; ++ri) {
+        end = row_start[ri + 1];
+        qsort(votes + row_start[ri], end - row_start[ri],
+              sizeof(triangle_index_t), &vote_index_compare);
+
+        for (i = row_start[ri]; i < end; i = j) {
+            for (j = i + 1; j < end && votes[j] == votes[i]; ++j)
+                ;
+            vote = j - i;
             if (maxvote < vote) {
                 maxvote = vote;
             }
         }
     }
 
-    if (maxvote == 0) {
-        *ncoord_matches = 0;
-        status = 0;
-        goto exit;
-    }
-
     half_maxvote = maxvote >> 1;
     ncount = 0;
     for (ri = 0; ri < nright; ++ri) {
+        end = row_start[ri + 1];
+        if (row_start[ri] == end) {
+            continue;
+        }
+
         r_coord = right + ri;
 
         row_maxvote = 0;
         row_2maxvote = 0;
         l_coord = NULL;
-        for (li = 0; li < nleft; ++li) {
-            vote = VOTE(li, ri);
+        for (i = row_start[ri]; i < end; i = j) {
+            for (j = i + 1; j < end && votes[j] == votes[i]; ++j)
+                ;
+            vote = j - i;
             if (vote > row_maxvote) {
                 row_2maxvote = row_maxvote;
                 row_maxvote = vote;
-                l_coord = left + li;
+                l_coord = left + votes[i];
             }
         }
 
@@ -150,13 +224,6 @@ vote_triangle_matches(
             continue;
         }
 
-        /* Remove all future matches involving the input coord, so it
-           won't be matched twice. */
-        for (ri2 = ri; ri2 < nright; ++ri2) {
-            li = l_coord - left;
-            VOTE(li, ri) = 0;
-        }
-
         #ifndef NDEBUG
             if (ncount >= *ncoord_matches) {
                 stimage_error_format_message(
@@ -177,6 +244,14 @@ vote_triangle_matches(
 
  exit:
 
+    if (status == 0) {
+        stimage_stats_stop(stats, "vote.time", start);
+        stimage_stats_count(stats, "vote.votes", (double)npairs);
+        stimage_stats_max(stats, "vote.max_votes", (double)maxvote);
+        stimage_stats_count(stats, "vote.matches", (double)*ncoord_matches);
+    }
+
+    free(row_start);
     free(votes);
 
     return status;
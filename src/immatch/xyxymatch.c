@@ -34,22 +34,67 @@ DAMAGE.
 */
 
 #include <assert.h>
+#include <math.h>
+#include <stddef.h>
+#include <string.h>
 
 #include "immatch/xyxymatch.h"
+#include "lib/coord_view.h"
 #include "lib/lintransform.h"
 #include "lib/xycoincide.h"
 #include "lib/xysort.h"
+#include "immatch/lib/offsets.h"
 #include "immatch/lib/triangles.h"
 #include "immatch/lib/tolerance.h"
 
+/* When a linear transform is refit to the matches, pairs further than
+   this many times the rms residual of the fit are rejected, for at
+   most this many iterations */
+#define REFINE_REJECT 3.0
+#define REFINE_MAXITER 20
+
+/* The matches are written either to an array of xyxymatch_output_t
+   records, or only as indices to a growable xyxymatch_indices_t */
 typedef struct {
-    const coord_t*      ref;
-    const coord_t*      input;
-    size_t              noutput;
-    size_t              outputp;
-    xyxymatch_output_t* output;
+    const coord_t*       ref;
+    const coord_view_t*  input;
+    size_t               noutput;
+    size_t               outputp;
+    xyxymatch_output_t*  output;
+    xyxymatch_indices_t* indices;
 } xyxymatch_callback_data_t;
 
+static int
+xyxymatch_indices_reserve(
+        xyxymatch_indices_t* const m,
+        const size_t n,
+        stimage_error_t* const error) {
+
+    size_t  capacity = 0;
+    size_t* idx      = NULL;
+
+    if (n <= m->capacity) {
+        return 0;
+    }
+
+    capacity = MAX(64, m->capacity);
+    while (capacity < n) {
+        capacity *= 2;
+    }
+
+    idx = realloc_with_error(m->coord_idx, capacity * sizeof(size_t), error);
+    if (idx == NULL) return 1;
+    m->coord_idx = idx;
+
+    idx = realloc_with_error(m->ref_idx, capacity * sizeof(size_t), error);
+    if (idx == NULL) return 1;
+    m->ref_idx = idx;
+
+    m->capacity = capacity;
+
+    return 0;
+}
+
 static int
 xyxymatch_callback(
         void* data,
@@ -60,6 +105,19 @@ xyxymatch_callback(
     xyxymatch_callback_data_t* state = (xyxymatch_callback_data_t*)data;
     xyxymatch_output_t* entry;
 
+    if (state->indices != NULL) {
+        if (xyxymatch_indices_reserve(
+                    state->indices, state->outputp + 1, error)) {
+            return 1;
+        }
+
+        state->indices->coord_idx[state->outputp] = input_index;
+        state->indices->ref_idx[state->outputp] = ref_index;
+        state->indices->nmatches = ++(state->outputp);
+
+        return 0;
+    }
+
     if (state->outputp >= state->noutput) {
         stimage_error_format_message(
             error,
@@ -70,7 +128,7 @@ xyxymatch_callback(
 
     entry = &(state->output[state->outputp]);
 
-    entry->coord     = state->input[input_index];
+    entry->coord     = coord_view_get(state->input, input_index);
     entry->ref       = state->ref[ref_index];
     entry->coord_idx = input_index;
     entry->ref_idx   = ref_index;
@@ -80,50 +138,807 @@ xyxymatch_callback(
     return 0;
 }
 
-/** DIFF
+static int
+xyxymatch_tolerance(
+        const xyxymatch_options_t* const options,
+        const xyxymatch_ref_t* const ref,
+        const size_t ninput_unique,
+        const coord_t* const input_trans,
+        const coord_t* const * const input_trans_sorted,
+        const double tolerance,
+        xyxymatch_callback_data_t* state,
+        stimage_error_t* const error) {
 
-The original takes lists of input, reference and output files.  This
-(for now, until its determined insufficient) only takes a single array
-of coordinates for each.  It seems that the original never really took
-a list of reference files anyway.
+    const double start    = stimage_stats_start(options->stats);
+    const size_t noutput0 = state->outputp;
+    int          status;
 
-This takes arrays of coordinates, rather than 2-dimensional arrays of
-doubles.
+    if (options->index == xyxymatch_index_grid) {
+        /* Use the prepared reference grid if it has the right cell
+           size */
+        if (ref->has_grid && ref->tolerance == tolerance) {
+            status = match_tolerance_ref_grid(
+                    ref->nref_unique, ref->ref, ref->ref_sorted, &ref->grid,
+                    ninput_unique, input_trans, input_trans_sorted,
+                    tolerance,
+                    xyxymatch_callback, state,
+                    error);
+        } else {
+            status = match_tolerance_grid(
+                    ref->nref_unique, ref->ref, ref->ref_sorted,
+                    ninput_unique, input_trans, input_trans_sorted,
+                    tolerance,
+                    xyxymatch_callback, state,
+                    error);
+        }
+    } else {
+        status = match_tolerance(
+                ref->nref_unique, ref->ref, ref->ref_sorted,
+                ninput_unique, input_trans, input_trans_sorted,
+                tolerance,
+                xyxymatch_callback, state,
+                error);
+    }
 
-    Because of this, there is no flexibility about where the columns
-    lie (xcolumn, ycolumn, xrcolumn, yrcolumn parameters).  I am
-    assuming that this sort of cleanup can be done more easily with
-    Numpy slicing on the Python side.
- */
+    if (status == 0) {
+        stimage_stats_stop(options->stats, "tolerance.time", start);
+        stimage_stats_count(
+                options->stats, "tolerance.matches",
+                (double)(state->outputp - noutput0));
+    }
+
+    return status;
+}
+
+/**
+Fit a new linear transform from the original input coordinates to the
+reference coordinates of a set of matches.  Until every pair is within
+tolerance of its reference, the pairs further than REFINE_REJECT times
+the rms residual, or else the worst pair, are rejected and the fit
+repeated, so a few wrong matches do not spoil it.  refined is set to
+zero, and the transform is left alone, if fewer than three pairs
+remain or they are degenerate.
+*/
+static int
+xyxymatch_refine_lintransform(
+        const xyxymatch_callback_data_t* const matches,
+        const double tolerance,
+        lintransform_t* const lintransform,
+        int* const refined,
+        stimage_stats_t* const stats,
+        stimage_error_t* const error) {
+
+    const size_t   nmatches = matches->outputp;
+    coord_t*       input    = NULL;
+    coord_t*       ref      = NULL;
+    coord_t*       trans    = NULL;
+    double*        residual = NULL;
+    lintransform_t fit;
+    size_t         nfit     = nmatches;
+    size_t         nkeep    = 0;
+    size_t         worst    = 0;
+    size_t         niter    = 0;
+    double         dx       = 0.0;
+    double         dy       = 0.0;
+    double         sum2     = 0.0;
+    double         cut      = 0.0;
+    size_t         i        = 0;
+    int            status   = 1;
+
+    *refined = 0;
+
+    input = malloc_with_error(nmatches * sizeof(coord_t), error);
+    if (input == NULL) goto exit;
+
+    ref = malloc_with_error(nmatches * sizeof(coord_t), error);
+    if (ref == NULL) goto exit;
+
+    trans = malloc_with_error(nmatches * sizeof(coord_t), error);
+    if (trans == NULL) goto exit;
+
+    residual = malloc_with_error(nmatches * sizeof(double), error);
+    if (residual == NULL) goto exit;
+
+    if (matches->indices != NULL) {
+        for (i = 0; i < nmatches; ++i) {
+            input[i] = coord_view_get(
+                    matches->input, matches->indices->coord_idx[i]);
+            ref[i] = matches->ref[matches->indices->ref_idx[i]];
+        }
+    } else {
+        for (i = 0; i < nmatches; ++i) {
+            input[i] = matches->output[i].coord;
+            ref[i] = matches->output[i].ref;
+        }
+    }
+
+    for (; nfit >= 3 && niter < REFINE_MAXITER; ++niter) {
+        if (fit_lintransform(nfit, input, ref, &fit, error)) {
+            /* Keep the matches we have */
+            stimage_error_unset(error);
+            break;
+        }
+
+        apply_lintransform(&fit, nfit, input, trans);
+        sum2 = 0.0;
+        worst = 0;
+        for (i = 0; i < nfit; ++i) {
+            dx = trans[i].x - ref[i].x;
+            dy = trans[i].y - ref[i].y;
+            residual[i] = sqrt(dx*dx + dy*dy);
+            sum2 += residual[i] * residual[i];
+            if (residual[i] > residual[worst]) {
+                worst = i;
+            }
+        }
+
+        if (residual[worst] <= tolerance || niter + 1 == REFINE_MAXITER) {
+            *lintransform = fit;
+            *refined = 1;
+            break;
+        }
+
+        cut = MAX(REFINE_REJECT * sqrt(sum2 / (double)nfit), tolerance);
+        if (residual[worst] > cut) {
+            /* Compact the pairs within the cut to the front */
+            nkeep = 0;
+            for (i = 0; i < nfit; ++i) {
+                if (residual[i] <= cut) {
+                    input[nkeep] = input[i];
+                    ref[nkeep] = ref[i];
+                    ++nkeep;
+                }
+            }
+        } else {
+            /* The wrong pairs have pulled the fit too close for the
+               cut to separate them, so only drop the worst */
+            nkeep = nfit - 1;
+            input[worst] = input[nkeep];
+            ref[worst] = ref[nkeep];
+        }
+        nfit = nkeep;
+    }
+
+    stimage_stats_count(
+            stats, "refine.rejected", (double)(nmatches - nfit));
+
+    status = 0;
+
+ exit:
+
+    free(input);
+    free(ref);
+    free(trans);
+    free(residual);
+
+    return status;
+}
+
+/**
+Transform the input coordinates with a new linear transform, and match
+the whole lists again with the tolerance algorithm.
+*/
+static int
+xyxymatch_rematch(
+        const coord_view_t* const input,
+        const xyxymatch_ref_t* const ref,
+        const lintransform_t* const lintransform,
+        const double tolerance,
+        const double separation,
+        const xyxymatch_options_t* const options,
+        coord_t* const input_trans, /*[input->n]*/
+        const coord_t** const input_trans_sorted, /*[input->n]*/
+        size_t* const ninput_unique,
+        xyxymatch_callback_data_t* const state,
+        stimage_error_t* const error) {
+
+    const size_t     ninput      = input->n;
+    stimage_stats_t* stats       = options->stats;
+    double           stage_start = 0.0;
+
+    stage_start = stimage_stats_start(stats);
+    coord_view_gather(input, 0, ninput, input_trans);
+    apply_lintransform(lintransform, ninput, input_trans, input_trans);
+    stimage_stats_stop(stats, "transform.time", stage_start);
+
+    stage_start = stimage_stats_start(stats);
+    xysort(ninput, input_trans, input_trans_sorted);
+    stimage_stats_stop(stats, "xysort.time", stage_start);
+
+    stage_start = stimage_stats_start(stats);
+    *ninput_unique = xycoincide(
+            ninput, input_trans_sorted, input_trans_sorted, separation);
+    stimage_stats_stop(stats, "xycoincide.time", stage_start);
+
+    state->outputp = 0;
+    if (state->indices != NULL) {
+        state->indices->nmatches = 0;
+    }
+
+    return xyxymatch_tolerance(
+            options, ref,
+            *ninput_unique, input_trans, input_trans_sorted,
+            tolerance, state,
+            error);
+}
+
+/**
+Refit the linear transform to the matches found so far, and match the
+whole lists again with it.  If that finds fewer matches than there
+were before, the earlier matches are kept instead.
+*/
+static int
+xyxymatch_refine(
+        const coord_view_t* const input,
+        const xyxymatch_ref_t* const ref,
+        lintransform_t* const lintransform,
+        const double tolerance,
+        const double separation,
+        const xyxymatch_options_t* const options,
+        coord_t* const input_trans, /*[input->n]*/
+        const coord_t** const input_trans_sorted, /*[input->n]*/
+        size_t* const ninput_unique,
+        xyxymatch_callback_data_t* const state,
+        stimage_error_t* const error) {
+
+    const size_t        nprevious   = state->outputp;
+    stimage_stats_t*    stats       = options->stats;
+    xyxymatch_indices_t previous;
+    double              stage_start = 0.0;
+    int                 refined     = 0;
+    size_t              i           = 0;
+    int                 status      = 1;
+
+    xyxymatch_indices_new(&previous);
+
+    stage_start = stimage_stats_start(stats);
+    if (xyxymatch_refine_lintransform(
+                state, tolerance, lintransform, &refined, stats,
+                error)) goto exit;
+    stimage_stats_stop(stats, "refine.time", stage_start);
+    stimage_stats_count(stats, "refine.refined", (double)refined);
+
+    if (!refined) {
+        status = 0;
+        goto exit;
+    }
+
+    if (xyxymatch_indices_reserve(&previous, nprevious, error)) goto exit;
+    for (i = 0; i < nprevious; ++i) {
+        if (state->indices != NULL) {
+            previous.coord_idx[i] = state->indices->coord_idx[i];
+            previous.ref_idx[i] = state->indices->ref_idx[i];
+        } else {
+            previous.coord_idx[i] = state->output[i].coord_idx;
+            previous.ref_idx[i] = state->output[i].ref_idx;
+        }
+    }
+
+    if (xyxymatch_rematch(
+                input, ref, lintransform, tolerance, separation,
+                options, input_trans, input_trans_sorted,
+                ninput_unique, state, error)) goto exit;
+
+    /* The refit transform was wrong, so keep the earlier matches */
+    if (state->outputp < nprevious) {
+        stimage_stats_count(stats, "refine.kept", (double)nprevious);
+
+        state->outputp = 0;
+        if (state->indices != NULL) {
+            state->indices->nmatches = 0;
+        }
+        for (i = 0; i < nprevious; ++i) {
+            if (xyxymatch_callback(
+                        state, previous.ref_idx[i], previous.coord_idx[i],
+                        error)) goto exit;
+        }
+    }
+
+    status = 0;
+
+ exit:
+
+    xyxymatch_indices_free(&previous);
+
+    return status;
+}
+
+void
+xyxymatch_options_init(
+        xyxymatch_options_t* const options) {
+
+    assert(options);
+
+    options->index = xyxymatch_index_grid;
+    options->triangle_mode = triangle_mode_all;
+    options->k = 8;
+    options->triangle_merge = triangle_merge_sweep;
+    options->nmatch_start = 0;
+    options->offsets_max_rotation = 0.0;
+    options->offsets_rotation_step = 1.0;
+    options->offsets_max_scale = 0.0;
+    options->offsets_scale_step = 0.01;
+    options->nthreads = 1;
+    options->stats = NULL;
+}
+
+void
+xyxymatch_ref_new(
+        xyxymatch_ref_t* const r) {
+
+    assert(r);
+
+    r->nref = 0;
+    r->ref = NULL;
+    r->ref_sorted = NULL;
+    r->nref_unique = 0;
+    r->separation = 0.0;
+    r->has_grid = 0;
+    r->tolerance = 0.0;
+    xygrid_new(&r->grid);
+    r->has_triangles = 0;
+    r->nmatch = 0;
+    r->triangle_tolerance = 0.0;
+    r->maxratio = 0.0;
+    r->triangle_mode = triangle_mode_all;
+    r->k = 0;
+    triangle_table_new(&r->triangles);
+}
 
 int
-xyxymatch(
-        const size_t ninput, const coord_t* const input /*[ninput]*/,
-        const size_t nref, const coord_t* const ref /*[nref]*/,
-        size_t* noutput, xyxymatch_output_t* const output /*[noutput]*/,
-        const coord_t* origin, /* good default: 0.0, 0.0 */
-        const coord_t* mag, /* good default: 1.0, 1.0 */
-        const coord_t* rotation, /* good default: 0.0, 0.0 */
-        const coord_t* ref_origin, /* good default: 0.0, 0.0 */
+xyxymatch_ref_init(
+        xyxymatch_ref_t* const r,
+        const size_t nref,
+        const coord_t* const ref /*[nref]*/,
+        const double separation,
+        stimage_error_t* const error) {
+
+    assert(r);
+    assert(ref);
+    assert(error);
+
+    xyxymatch_ref_free(r);
+
+    if (nref == 0) {
+        stimage_error_set_message(error, "The reference coordinate list is empty");
+        return 1;
+    }
+
+    r->ref_sorted = malloc_with_error(nref * sizeof(coord_t*), error);
+    if (r->ref_sorted == NULL) return 1;
+
+    r->nref = nref;
+    r->ref = ref;
+    r->separation = separation;
+
+    xysort(nref, ref, r->ref_sorted);
+    r->nref_unique = xycoincide(nref, r->ref_sorted, r->ref_sorted, separation);
+
+    return 0;
+}
+
+int
+xyxymatch_ref_init_grid(
+        xyxymatch_ref_t* const r,
+        const double tolerance,
+        stimage_error_t* const error) {
+
+    assert(r);
+    assert(r->ref_sorted);
+    assert(error);
+
+    xygrid_free(&r->grid);
+    r->has_grid = 0;
+    r->tolerance = tolerance;
+
+    /* Nothing can be matched with a non-positive tolerance, so there
+       is nothing to prepare */
+    if (!(tolerance > 0.0)) {
+        return 0;
+    }
+
+    if (xygrid_init(
+                &r->grid, r->nref_unique, r->ref_sorted, tolerance,
+                error)) return 1;
+
+    r->has_grid = 1;
+
+    return 0;
+}
+
+int
+xyxymatch_ref_init_triangles(
+        xyxymatch_ref_t* const r,
+        const size_t nmatch,
+        const double tolerance,
+        const double maxratio,
+        const triangle_mode_e triangle_mode,
+        const size_t k,
+        stimage_error_t* const error) {
+
+    assert(r);
+    assert(r->ref_sorted);
+    assert(error);
+
+    triangle_table_free(&r->triangles);
+    r->has_triangles = 0;
+
+    if (triangle_mode >= triangle_mode_LAST || triangle_mode < 0) {
+        stimage_error_set_message(error, "Invalid triangle mode specified");
+        return 1;
+    }
+
+    if (triangle_mode == triangle_mode_knn && k < 2) {
+        stimage_error_set_message(
+                error,
+                "k must be at least 2 to form triangles from nearest neighbors");
+        return 1;
+    }
+
+    r->nmatch = nmatch;
+    r->triangle_tolerance = tolerance;
+    r->maxratio = maxratio;
+    r->triangle_mode = triangle_mode;
+    r->k = k;
+
+    /* Triangle matching will fail on too few coordinates anyway, so
+       there is nothing to prepare */
+    if (r->nref_unique < 3) {
+        return 0;
+    }
+
+    if (build_triangles(
+                triangle_mode, k, r->nref_unique, r->ref_sorted,
+                nmatch, tolerance, maxratio, 1,
+                &r->triangles, NULL, error)) return 1;
+
+    r->has_triangles = 1;
+
+    return 0;
+}
+
+void
+xyxymatch_ref_free(
+        xyxymatch_ref_t* const r) {
+
+    if (r == NULL) {
+        return;
+    }
+
+    free(r->ref_sorted);
+    xygrid_free(&r->grid);
+    triangle_table_free(&r->triangles);
+    xyxymatch_ref_new(r);
+}
+
+/* The layout of the buffers written by xyxymatch_ref_serialize.  Every
+   field of the header is 8 bytes wide, so there is no padding.  It is
+   followed by the coordinates, the sorted order as 8-byte indices and
+   the columns of the triangle table, padded to a multiple of 8
+   bytes. */
+static const char XYXYMATCH_REF_MAGIC[8] = "STIMREF";
+static const STIMAGE_Int64 XYXYMATCH_REF_BYTEORDER = 0x0102030405060708LL;
+
+typedef struct {
+    char          magic[8];
+    STIMAGE_Int64 version;
+    STIMAGE_Int64 byteorder;
+    STIMAGE_Int64 nref;
+    STIMAGE_Int64 nref_unique;
+    double        separation;
+    STIMAGE_Int64 has_grid;
+    double        tolerance;
+    STIMAGE_Int64 has_triangles;
+    STIMAGE_Int64 nmatch;
+    double        triangle_tolerance;
+    double        maxratio;
+    STIMAGE_Int64 triangle_mode;
+    STIMAGE_Int64 k;
+    STIMAGE_Int64 ntriangles;
+    STIMAGE_Int64 checksum;
+} xyxymatch_ref_header_t;
+
+/* The size of the triangle table columns, padded to 8 bytes */
+static size_t
+xyxymatch_ref_triangles_size(
+        const size_t ntriangles) {
+
+    const size_t size = triangle_table_columns_size(ntriangles);
+
+    return (size + sizeof(STIMAGE_Int64) - 1) /
+        sizeof(STIMAGE_Int64) * sizeof(STIMAGE_Int64);
+}
+
+/* A 64-bit FNV-1a hash of a serialized buffer of nwords words, taken
+   a word at a time, so that corrupt floating-point values (which would
+   send the matching astray rather than fail) are detected on loading.
+   It covers the whole header but the checksum itself, so that the
+   parameters the triangles were built with are checked too. */
+static STIMAGE_Int64
+xyxymatch_ref_checksum(
+        const size_t nwords,
+        const STIMAGE_Int64* const words) {
+
+    const size_t checksum_word =
+        offsetof(xyxymatch_ref_header_t, checksum) / sizeof(STIMAGE_Int64);
+    unsigned long long hash = 14695981039346656037ULL;
+    size_t             i    = 0;
+
+    for (i = 0; i < nwords; ++i) {
+        if (i == checksum_word) {
+            continue;
+        }
+        hash ^= (unsigned long long)words[i];
+        hash *= 1099511628211ULL;
+    }
+
+    return (STIMAGE_Int64)hash;
+}
+
+size_t
+xyxymatch_ref_serialized_size(
+        const xyxymatch_ref_t* const r) {
+
+    assert(r);
+
+    return (sizeof(xyxymatch_ref_header_t) +
+            r->nref * (sizeof(coord_t) + sizeof(STIMAGE_Int64)) +
+            xyxymatch_ref_triangles_size(r->triangles.ntriangles));
+}
+
+int
+xyxymatch_ref_serialize(
+        const xyxymatch_ref_t* const r,
+        const size_t size,
+        void* const buffer,
+        stimage_error_t* const error) {
+
+    xyxymatch_ref_header_t* header    = (xyxymatch_ref_header_t*)buffer;
+    coord_t*                coords    = NULL;
+    STIMAGE_Int64*          sorted    = NULL;
+    char*                   columns   = NULL;
+    const triangle_table_t* t         = &r->triangles;
+    triangle_table_t        triangles;
+    size_t                  n         = t->ntriangles;
+    size_t                  i         = 0;
+
+    assert(r);
+    assert(buffer);
+    assert(error);
+
+    if (r->ref_sorted == NULL) {
+        stimage_error_set_message(
+                error, "The reference coordinates have not been prepared");
+        return 1;
+    }
+
+    if (size < xyxymatch_ref_serialized_size(r)) {
+        stimage_error_set_message(error, "Buffer is too small");
+        return 1;
+    }
+
+    if ((size_t)buffer % sizeof(STIMAGE_Int64) != 0) {
+        stimage_error_set_message(error, "Buffer is not aligned");
+        return 1;
+    }
+
+    coords = (coord_t*)(header + 1);
+    sorted = (STIMAGE_Int64*)(coords + r->nref);
+    columns = (char*)(sorted + r->nref);
+
+    memset(header, 0, sizeof(xyxymatch_ref_header_t));
+    memcpy(header->magic, XYXYMATCH_REF_MAGIC, sizeof(header->magic));
+    header->version = XYXYMATCH_REF_FORMAT_VERSION;
+    header->byteorder = XYXYMATCH_REF_BYTEORDER;
+    header->nref = (STIMAGE_Int64)r->nref;
+    header->nref_unique = (STIMAGE_Int64)r->nref_unique;
+    header->separation = r->separation;
+    header->has_grid = r->has_grid;
+    header->tolerance = r->tolerance;
+    header->has_triangles = r->has_triangles;
+    header->nmatch = (STIMAGE_Int64)r->nmatch;
+    header->triangle_tolerance = r->triangle_tolerance;
+    header->maxratio = r->maxratio;
+    header->triangle_mode = r->triangle_mode;
+    header->k = (STIMAGE_Int64)r->k;
+    header->ntriangles = (STIMAGE_Int64)t->ntriangles;
+
+    memcpy(coords, r->ref, r->nref * sizeof(coord_t));
+
+    for (i = 0; i < r->nref; ++i) {
+        sorted[i] = (STIMAGE_Int64)(r->ref_sorted[i] - r->ref);
+    }
+
+    /* The table may have room for more triangles than it holds, so
+       its columns are copied one at a time into a table that is just
+       big enough, which is how they are used when loaded */
+    memset(columns, 0, xyxymatch_ref_triangles_size(n));
+    triangle_table_view(&triangles, n, NULL, columns);
+    memcpy(triangles.ratio, t->ratio, n * sizeof(double));
+    memcpy(triangles.cosine_v1, t->cosine_v1, n * sizeof(double));
+    memcpy(triangles.ratio_tolerance, t->ratio_tolerance, n * sizeof(float));
+    memcpy(triangles.cosine_tolerance, t->cosine_tolerance,
+           n * sizeof(float));
+    memcpy(triangles.vertices, t->vertices,
+           3 * n * sizeof(triangle_index_t));
+
+    header->checksum = xyxymatch_ref_checksum(
+            xyxymatch_ref_serialized_size(r) / sizeof(STIMAGE_Int64),
+            (const STIMAGE_Int64*)buffer);
+
+    return 0;
+}
+
+int
+xyxymatch_ref_deserialize(
+        xyxymatch_ref_t* const r,
+        const size_t size,
+        const void* const buffer,
+        stimage_error_t* const error) {
+
+    const xyxymatch_ref_header_t* header     = (const xyxymatch_ref_header_t*)buffer;
+    const coord_t*                coords     = NULL;
+    const STIMAGE_Int64*          sorted     = NULL;
+    const char*                   columns    = NULL;
+    triangle_table_t*             t          = &r->triangles;
+    size_t                        nref       = 0;
+    size_t                        ntriangles = 0;
+    size_t                        remaining  = 0;
+    size_t                        i          = 0;
+
+    assert(r);
+    assert(buffer);
+    assert(error);
+
+    xyxymatch_ref_free(r);
+
+    if ((size_t)buffer % sizeof(STIMAGE_Int64) != 0) {
+        stimage_error_set_message(error, "Buffer is not aligned");
+        goto fail;
+    }
+
+    if (size < sizeof(xyxymatch_ref_header_t) ||
+        memcmp(header->magic, XYXYMATCH_REF_MAGIC, sizeof(header->magic))) {
+        stimage_error_set_message(
+                error, "Not a prepared reference coordinate file");
+        goto fail;
+    }
+
+    if (header->byteorder != XYXYMATCH_REF_BYTEORDER) {
+        stimage_error_set_message(
+                error,
+                "Prepared reference coordinates were written with a "
+                "different byte order");
+        goto fail;
+    }
+
+    if (header->version != XYXYMATCH_REF_FORMAT_VERSION) {
+        stimage_error_format_message(
+                error,
+                "Unsupported prepared reference coordinate format version %d "
+                "(expected %d)",
+                (int)header->version, XYXYMATCH_REF_FORMAT_VERSION);
+        goto fail;
+    }
+
+    /* Check the sizes before computing anything from them, so a
+       corrupt header can not cause an overflow */
+    remaining = size - sizeof(xyxymatch_ref_header_t);
+    if (header->nref <= 0 ||
+        header->nref_unique < 0 ||
+        header->nref_unique > header->nref ||
+        header->ntriangles < 0 ||
+        (size_t)header->nref >
+            remaining / (sizeof(coord_t) + sizeof(STIMAGE_Int64))) {
+        goto corrupt;
+    }
+    nref = (size_t)header->nref;
+    remaining -= nref * (sizeof(coord_t) + sizeof(STIMAGE_Int64));
+    if ((size_t)header->ntriangles > remaining ||
+        xyxymatch_ref_triangles_size((size_t)header->ntriangles) !=
+            remaining) {
+        goto corrupt;
+    }
+    ntriangles = (size_t)header->ntriangles;
+
+    if (xyxymatch_ref_checksum(
+                size / sizeof(STIMAGE_Int64),
+                (const STIMAGE_Int64*)buffer) != header->checksum) {
+        goto corrupt;
+    }
+
+    if (header->triangle_mode < 0 ||
+        header->triangle_mode >= triangle_mode_LAST ||
+        header->nmatch < 0 ||
+        header->k < 0 ||
+        (ntriangles > 0 && !header->has_triangles)) {
+        goto corrupt;
+    }
+
+    coords = (const coord_t*)(header + 1);
+    sorted = (const STIMAGE_Int64*)(coords + nref);
+    columns = (const char*)(sorted + nref);
+
+    /* The sorted order is stored as indices, and has to be turned
+       back into pointers */
+    r->ref_sorted = malloc_with_error(nref * sizeof(coord_t*), error);
+    if (r->ref_sorted == NULL) goto fail;
+
+    for (i = 0; i < nref; ++i) {
+        if (sorted[i] < 0 || sorted[i] >= header->nref) goto corrupt;
+        r->ref_sorted[i] = coords + sorted[i];
+    }
+
+    /* The triangles are used in place.  Matching only reads them, so
+       the buffer may be read-only. */
+    triangle_table_view(t, ntriangles, r->ref_sorted, (void*)columns);
+    for (i = 0; i < 3 * ntriangles; ++i) {
+        if (t->vertices[i] >= (size_t)header->nref_unique) goto corrupt;
+    }
+
+    r->nref = nref;
+    r->ref = coords;
+    r->nref_unique = (size_t)header->nref_unique;
+    r->separation = header->separation;
+    r->has_triangles = header->has_triangles != 0;
+    r->nmatch = (size_t)header->nmatch;
+    r->triangle_tolerance = header->triangle_tolerance;
+    r->maxratio = header->maxratio;
+    r->triangle_mode = (triangle_mode_e)header->triangle_mode;
+    r->k = (size_t)header->k;
+
+    r->tolerance = header->tolerance;
+    if (header->has_grid) {
+        if (xyxymatch_ref_init_grid(r, header->tolerance, error)) goto fail;
+    }
+
+    return 0;
+
+ corrupt:
+    stimage_error_set_message(
+            error, "Prepared reference coordinates are corrupt");
+
+ fail:
+    xyxymatch_ref_free(r);
+    return 1;
+}
+
+static int
+xyxymatch_run_prepared(
+        const coord_view_t* const input,
+        const xyxymatch_ref_t* const ref,
+        xyxymatch_callback_data_t* const state,
+        const coord_t* origin,
+        const coord_t* mag,
+        const coord_t* rotation,
+        const coord_t* ref_origin,
         const xyxymatch_algo_e algorithm,
         const double tolerance,
-        const double separation, /* good default: 9.0 */
+        const double separation,
         const size_t nmatch,
         const double maxratio,
         const size_t nreject,
+        const xyxymatch_options_t* options,
         stimage_error_t* const error) {
 
     static const coord_t      DEFAULT_ORIGIN     = {0.0, 0.0};
     static const coord_t      DEFAULT_MAG        = {1.0, 1.0};
     static const coord_t      DEFAULT_ROTATION   = {0.0, 0.0};
     static const coord_t      DEFAULT_REF_ORIGIN = {0.0, 0.0};
+    const size_t              ninput             = input->n;
     coord_t*                  input_trans        = NULL;
     const coord_t**           input_trans_sorted = NULL;
     size_t                    ninput_unique      = ninput;
-    const coord_t**           ref_sorted         = NULL;
-    size_t                    nref_unique        = nref;
+    const triangle_table_t*   ref_triangles      = NULL;
     lintransform_t            lintransform;
-    xyxymatch_callback_data_t state;
+    lintransform_t            offsets;
+    size_t                    nvotes             = 0;
+    size_t                    min_votes          = 0;
+    size_t                    nmatch_used        = nmatch;
+    xyxymatch_options_t       default_options;
+    stimage_stats_t*          stats              = NULL;
+    double                    start              = 0.0;
+    double                    stage_start        = 0.0;
     int                       status             = 1;
 
     /****************************************
@@ -131,16 +946,15 @@ xyxymatch(
     */
     assert(input);
     assert(ref);
-    assert(output);
+    assert(state);
     assert(error);
-    assert(*noutput > 0);
 
     if (ninput == 0) {
         stimage_error_set_message(error, "The input coordinate list is empty");
         goto exit;
     }
 
-    if (nref == 0) {
+    if (ref->nref == 0 || ref->ref_sorted == NULL) {
         stimage_error_set_message(error, "The reference coordinate list is empty");
         goto exit;
     }
@@ -166,14 +980,37 @@ xyxymatch(
         ref_origin = &DEFAULT_REF_ORIGIN;
     }
 
-    /****************************************
-     PREPARE REFERENCE COORDINATES
-    */
-    ref_sorted = malloc_with_error(nref * sizeof(coord_t*), error);
-    if (ref_sorted == NULL) goto exit;
+    if (options == NULL) {
+        xyxymatch_options_init(&default_options);
+        options = &default_options;
+    }
+
+    stats = options->stats;
+    start = stimage_stats_start(stats);
 
-    xysort(nref, ref, ref_sorted);
-    nref_unique = xycoincide(nref, ref_sorted, ref_sorted, separation);
+    if (options->index >= xyxymatch_index_LAST || options->index < 0) {
+        stimage_error_set_message(error, "Invalid spatial index specified");
+        goto exit;
+    }
+
+    if (options->triangle_mode >= triangle_mode_LAST ||
+        options->triangle_mode < 0) {
+        stimage_error_set_message(error, "Invalid triangle mode specified");
+        goto exit;
+    }
+
+    if (options->triangle_merge >= triangle_merge_LAST ||
+        options->triangle_merge < 0) {
+        stimage_error_set_message(error, "Invalid triangle merge specified");
+        goto exit;
+    }
+
+    if (options->triangle_mode == triangle_mode_knn && options->k < 2) {
+        stimage_error_set_message(
+                error,
+                "k must be at least 2 to form triangles from nearest neighbors");
+        goto exit;
+    }
 
     /****************************************
      DETERMINE INITIAL TRANSFORM
@@ -189,37 +1026,105 @@ xyxymatch(
     input_trans_sorted = malloc_with_error(ninput * sizeof(coord_t*), error);
     if (input_trans_sorted == NULL) goto exit;
 
-    apply_lintransform(&lintransform, ninput, input, input_trans);
+    stage_start = stimage_stats_start(stats);
+    coord_view_gather(input, 0, ninput, input_trans);
+    apply_lintransform(&lintransform, ninput, input_trans, input_trans);
+    stimage_stats_stop(stats, "transform.time", stage_start);
+
+    stage_start = stimage_stats_start(stats);
     xysort(ninput, input_trans, input_trans_sorted);
+    stimage_stats_stop(stats, "xysort.time", stage_start);
+
+    stage_start = stimage_stats_start(stats);
     ninput_unique = xycoincide(ninput, input_trans_sorted, input_trans_sorted, separation);
+    stimage_stats_stop(stats, "xycoincide.time", stage_start);
 
     /****************************************
      RUN THE DESIRED ALGORITHM
     */
-    state.ref = ref;
-    state.input = input;
-    state.noutput = *noutput;
-    state.outputp = 0;
-    state.output = output;
+    state->ref = ref->ref;
+    state->input = input;
+    state->outputp = 0;
+    if (state->indices != NULL) {
+        state->indices->nmatches = 0;
+    }
 
     switch (algorithm) {
     case xyxymatch_algo_tolerance:
-        if (match_tolerance(
-                nref_unique, ref, ref_sorted,
+        if (xyxymatch_tolerance(
+                options, ref,
                 ninput_unique, input_trans, input_trans_sorted,
-                tolerance,
-                xyxymatch_callback, &state,
+                tolerance, state,
                 error)) goto exit;
-        *noutput = state.outputp;
         break;
     case xyxymatch_algo_triangles:
-        if (match_triangles(
-                nref, nref_unique, ref, ref_sorted,
+        /* Use the prepared reference triangles if they were built the
+           same way these would be */
+        if (ref->has_triangles &&
+            ref->nmatch == nmatch &&
+            ref->triangle_tolerance == tolerance &&
+            ref->maxratio == maxratio &&
+            ref->triangle_mode == options->triangle_mode &&
+            (options->triangle_mode != triangle_mode_knn ||
+             ref->k == options->k)) {
+            ref_triangles = &ref->triangles;
+            stimage_stats_count(
+                    stats, "find_triangles.reused",
+                    (double)ref_triangles->ntriangles);
+        }
+
+        if (match_triangles_prepared(
+                ref->nref, ref->nref_unique, ref->ref, ref->ref_sorted,
                 ninput, ninput_unique, input_trans, input_trans_sorted,
+                ref_triangles, options->nmatch_start,
                 nmatch, tolerance, maxratio, nreject,
-                &xyxymatch_callback, &state,
-                error)) goto exit;
-        *noutput = state.outputp;
+                options->triangle_mode, options->k,
+                options->triangle_merge, options->nthreads,
+                &nmatch_used, &xyxymatch_callback, state,
+                stats, error)) goto exit;
+
+        /* If either list was subsampled, or only nearest-neighbor
+           triangles were used, the triangle matches may only cover
+           some of the coordinates.  Use them to compute a better
+           linear transform, and match the whole lists with the
+           tolerance algorithm. */
+        if ((ref->nref_unique > nmatch_used ||
+             ninput_unique > nmatch_used ||
+             options->triangle_mode == triangle_mode_knn) &&
+            state->outputp >= 3 &&
+            xyxymatch_refine(
+                    input, ref, &lintransform, tolerance, separation,
+                    options, input_trans, input_trans_sorted,
+                    &ninput_unique, state, error)) goto exit;
+        break;
+    case xyxymatch_algo_offsets:
+        if (match_offsets(
+                ref->nref_unique, ref->ref, ref->ref_sorted,
+                ninput_unique, input_trans, input_trans_sorted,
+                nmatch, tolerance,
+                options->offsets_max_rotation, options->offsets_rotation_step,
+                options->offsets_max_scale, options->offsets_scale_step,
+                &offsets, &nvotes, &min_votes, stats, error)) goto exit;
+
+        /* Too few offsets agree for the shift to stand out from those
+           between coordinates that do not correspond */
+        if (nvotes < min_votes) {
+            break;
+        }
+
+        compose_lintransform(&lintransform, &offsets, &lintransform);
+        if (xyxymatch_rematch(
+                input, ref, &lintransform, tolerance, separation,
+                options, input_trans, input_trans_sorted,
+                &ninput_unique, state, error)) goto exit;
+
+        /* The trial rotations and scales are coarse, so fit a better
+           linear transform to the matches and match again */
+        if (state->outputp >= 3 &&
+            xyxymatch_refine(
+                    input, ref, &lintransform, tolerance, separation,
+                    options, input_trans, input_trans_sorted,
+                    &ninput_unique, state, error)) goto exit;
         break;
     case xyxymatch_algo_LAST:
     default:
@@ -227,15 +1132,336 @@ xyxymatch(
         goto exit;
     }
 
+    stimage_stats_count(
+            stats, "xycoincide.input_removed", (double)(ninput - ninput_unique));
+    stimage_stats_count(
+            stats, "xycoincide.ref_removed",
+            (double)(ref->nref - ref->nref_unique));
+    stimage_stats_stop(stats, "xyxymatch.time", start);
+    stimage_stats_count(stats, "xyxymatch.matches", (double)state->outputp);
+
     status = 0;
 
 exit:
 
-    free(ref_sorted);
     free(input_trans_sorted);
     free(input_trans);
     return status;
 }
 
+static int
+xyxymatch_run(
+        const coord_view_t* const input,
+        const coord_view_t* const ref,
+        xyxymatch_callback_data_t* const state,
+        const coord_t* origin,
+        const coord_t* mag,
+        const coord_t* rotation,
+        const coord_t* ref_origin,
+        const xyxymatch_algo_e algorithm,
+        const double tolerance,
+        const double separation,
+        const size_t nmatch,
+        const double maxratio,
+        const size_t nreject,
+        const xyxymatch_options_t* options,
+        stimage_error_t* const error) {
+
+    xyxymatch_ref_t  prepared;
+    const coord_t*   ref_coords = NULL;
+    coord_t*         ref_copy   = NULL;
+    stimage_stats_t* stats      = (options != NULL) ? options->stats : NULL;
+    double           start      = 0.0;
+    int              status     = 1;
+
+    assert(input);
+    assert(ref);
+    assert(error);
+
+    xyxymatch_ref_new(&prepared);
+
+    if (input->n == 0) {
+        stimage_error_set_message(error, "The input coordinate list is empty");
+        goto exit;
+    }
+
+    /****************************************
+     PREPARE REFERENCE COORDINATES
+    */
+    /* The prepared reference coordinates are sorted by pointer, so
+       they must be a coord_t array */
+    ref_coords = coord_view_packed(ref);
+    if (ref_coords == NULL) {
+        ref_copy = malloc_with_error(MAX(1, ref->n) * sizeof(coord_t), error);
+        if (ref_copy == NULL) goto exit;
+        coord_view_gather(ref, 0, ref->n, ref_copy);
+        ref_coords = ref_copy;
+    }
+
+    start = stimage_stats_start(stats);
+    if (xyxymatch_ref_init(
+                &prepared, ref->n, ref_coords, separation, error)) goto exit;
+    stimage_stats_stop(stats, "prepare_ref.time", start);
+
+    if (xyxymatch_run_prepared(
+                input, &prepared, state,
+                origin, mag, rotation, ref_origin,
+                algorithm, tolerance, separation, nmatch, maxratio, nreject,
+                options, error)) goto exit;
+
+    status = 0;
+
+exit:
+
+    xyxymatch_ref_free(&prepared);
+    free(ref_copy);
+    return status;
+}
+
+/** DIFF
+
+The original takes lists of input, reference and output files.  This
+(for now, until its determined insufficient) only takes a single array
+of coordinates for each.  It seems that the original never really took
+a list of reference files anyway.
+
+This takes arrays of coordinates, rather than 2-dimensional arrays of
+doubles.
+
+    Because of this, there is no flexibility about where the columns
+    lie (xcolumn, ycolumn, xrcolumn, yrcolumn parameters).  I am
+    assuming that this sort of cleanup can be done more easily with
+    Numpy slicing on the Python side.
+ */
+
+int
+xyxymatch(
+        const size_t ninput, const coord_t* const input /*[ninput]*/,
+        const size_t nref, const coord_t* const ref /*[nref]*/,
+        size_t* noutput, xyxymatch_output_t* const output /*[noutput]*/,
+        const coord_t* origin, /* good default: 0.0, 0.0 */
+        const coord_t* mag, /* good default: 1.0, 1.0 */
+        const coord_t* rotation, /* good default: 0.0, 0.0 */
+        const coord_t* ref_origin, /* good default: 0.0, 0.0 */
+        const xyxymatch_algo_e algorithm,
+        const double tolerance,
+        const double separation, /* good default: 9.0 */
+        const size_t nmatch,
+        const double maxratio,
+        const size_t nreject,
+        const xyxymatch_options_t* options,
+        stimage_error_t* const error) {
+
+    coord_view_t input_view;
+    coord_view_t ref_view;
+
+    assert(input);
+    assert(ref);
+
+    coord_view_init(&input_view, ninput, input);
+    coord_view_init(&ref_view, nref, ref);
+
+    return xyxymatch_view(
+            &input_view, &ref_view, noutput, output,
+            origin, mag, rotation, ref_origin,
+            algorithm, tolerance, separation, nmatch, maxratio, nreject,
+            options, error);
+}
+
+int
+xyxymatch_prepared(
+        const size_t ninput, const coord_t* const input /*[ninput]*/,
+        const xyxymatch_ref_t* const ref,
+        size_t* noutput, xyxymatch_output_t* const output /*[noutput]*/,
+        const coord_t* origin,
+        const coord_t* mag,
+        const coord_t* rotation,
+        const coord_t* ref_origin,
+        const xyxymatch_algo_e algorithm,
+        const double tolerance,
+        const double separation,
+        const size_t nmatch,
+        const double maxratio,
+        const size_t nreject,
+        const xyxymatch_options_t* options,
+        stimage_error_t* const error) {
+
+    coord_view_t input_view;
+
+    assert(input);
+
+    coord_view_init(&input_view, ninput, input);
+
+    return xyxymatch_prepared_view(
+            &input_view, ref, noutput, output,
+            origin, mag, rotation, ref_origin,
+            algorithm, tolerance, separation, nmatch, maxratio, nreject,
+            options, error);
+}
+
+int
+xyxymatch_view(
+        const coord_view_t* const input,
+        const coord_view_t* const ref,
+        size_t* noutput, xyxymatch_output_t* const output /*[noutput]*/,
+        const coord_t* origin,
+        const coord_t* mag,
+        const coord_t* rotation,
+        const coord_t* ref_origin,
+        const xyxymatch_algo_e algorithm,
+        const double tolerance,
+        const double separation,
+        const size_t nmatch,
+        const double maxratio,
+        const size_t nreject,
+        const xyxymatch_options_t* options,
+        stimage_error_t* const error) {
+
+    xyxymatch_callback_data_t state;
+
+    assert(output);
+    assert(*noutput > 0);
+
+    state.noutput = *noutput;
+    state.output = output;
+    state.indices = NULL;
+
+    if (xyxymatch_run(
+                input, ref, &state,
+                origin, mag, rotation, ref_origin,
+                algorithm, tolerance, separation, nmatch, maxratio, nreject,
+                options, error)) {
+        return 1;
+    }
+
+    *noutput = state.outputp;
+    return 0;
+}
+
+int
+xyxymatch_prepared_view(
+        const coord_view_t* const input,
+        const xyxymatch_ref_t* const ref,
+        size_t* noutput, xyxymatch_output_t* const output /*[noutput]*/,
+        const coord_t* origin,
+        const coord_t* mag,
+        const coord_t* rotation,
+        const coord_t* ref_origin,
+        const xyxymatch_algo_e algorithm,
+        const double tolerance,
+        const double separation,
+        const size_t nmatch,
+        const double maxratio,
+        const size_t nreject,
+        const xyxymatch_options_t* options,
+        stimage_error_t* const error) {
+
+    xyxymatch_callback_data_t state;
+
+    assert(output);
+    assert(*noutput > 0);
+
+    state.noutput = *noutput;
+    state.output = output;
+    state.indices = NULL;
+
+    if (xyxymatch_run_prepared(
+                input, ref, &state,
+                origin, mag, rotation, ref_origin,
+                algorithm, tolerance, separation, nmatch, maxratio, nreject,
+                options, error)) {
+        return 1;
+    }
+
+    *noutput = state.outputp;
+    return 0;
+}
+
+void
+xyxymatch_indices_new(
+        xyxymatch_indices_t* const m) {
+
+    assert(m);
+
+    m->nmatches = 0;
+    m->capacity = 0;
+    m->coord_idx = NULL;
+    m->ref_idx = NULL;
+}
+
+void
+xyxymatch_indices_free(
+        xyxymatch_indices_t* const m) {
 
+    assert(m);
 
+    free(m->coord_idx);
+    free(m->ref_idx);
+    xyxymatch_indices_new(m);
+}
+
+int
+xyxymatch_indices(
+        const coord_view_t* const input,
+        const coord_view_t* const ref,
+        xyxymatch_indices_t* const matches,
+        const coord_t* origin,
+        const coord_t* mag,
+        const coord_t* rotation,
+        const coord_t* ref_origin,
+        const xyxymatch_algo_e algorithm,
+        const double tolerance,
+        const double separation,
+        const size_t nmatch,
+        const double maxratio,
+        const size_t nreject,
+        const xyxymatch_options_t* options,
+        stimage_error_t* const error) {
+
+    xyxymatch_callback_data_t state;
+
+    assert(matches);
+
+    state.noutput = 0;
+    state.output = NULL;
+    state.indices = matches;
+
+    return xyxymatch_run(
+            input, ref, &state,
+            origin, mag, rotation, ref_origin,
+            algorithm, tolerance, separation, nmatch, maxratio, nreject,
+            options, error);
+}
+
+int
+xyxymatch_prepared_indices(
+        const coord_view_t* const input,
+        const xyxymatch_ref_t* const ref,
+        xyxymatch_indices_t* const matches,
+        const coord_t* origin,
+        const coord_t* mag,
+        const coord_t* rotation,
+        const coord_t* ref_origin,
+        const xyxymatch_algo_e algorithm,
+        const double tolerance,
+        const double separation,
+        const size_t nmatch,
+        const double maxratio,
+        const size_t nreject,
+        const xyxymatch_options_t* options,
+        stimage_error_t* const error) {
+
+    xyxymatch_callback_data_t state;
+
+    assert(matches);
+
+    state.noutput = 0;
+    state.output = NULL;
+    state.indices = matches;
+
+    return xyxymatch_run_prepared(
+            input, ref, &state,
+            origin, mag, rotation, ref_origin,
+            algorithm, tolerance, separation, nmatch, maxratio, nreject,
+            options, error);
+}
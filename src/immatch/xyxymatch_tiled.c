@@ -0,0 +1,566 @@
+/*
+Copyright (C) 2008-2025 Association of Universities for Research in Astronomy (AURA)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above
+      copyright notice, this list of conditions and the following
+      disclaimer in the documentation and/or other materials provided
+      with the distribution.
+
+    3. The name of AURA and its representatives may not be used to
+      endorse or promote products derived from this software without
+      specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY AURA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL AURA BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+*/
+
+/*
+ Author: Michael Droettboom
+*/
+
+#include <assert.h>
+#include <math.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "immatch/xyxymatch.h"
+#include "lib/coord_view.h"
+#include "lib/lintransform.h"
+#include "lib/parallel.h"
+
+/* The number of coordinates read and transformed at a time while
+   scanning the lists */
+#define XYXYMATCH_TILED_CHUNK 1024
+
+/* The most tiles the reference bounding box may be divided into */
+#define XYXYMATCH_TILED_MAX_TILES (1 << 24)
+
+typedef struct {
+    coord_t min;  /* the corner of the first tile */
+    double  size; /* the width and height of each tile */
+    double  halo; /* how far past its edges a tile collects coordinates */
+    size_t  nx;
+    size_t  ny;
+} tiling_t;
+
+/* The coordinates collected for a run of consecutive tiles */
+typedef struct {
+    const tiling_t*            tiling;
+    size_t                     tile0;
+    size_t                     ntiles;
+    size_t*                    input_start; /* [ntiles + 1] */
+    size_t*                    ref_start;   /* [ntiles + 1] */
+    size_t*                    input_fill;  /* [ntiles] */
+    size_t*                    ref_fill;    /* [ntiles] */
+    coord_t*                   input;       /* [input_start[ntiles]] */
+    size_t*                    input_idx;   /* [input_start[ntiles]] */
+    coord_t*                   ref;         /* [ref_start[ntiles]] */
+    size_t*                    ref_idx;     /* [ref_start[ntiles]] */
+    xyxymatch_indices_t*       matches;     /* [ntiles] */
+
+    /* The matching parameters */
+    const coord_t*             origin;
+    const coord_t*             mag;
+    const coord_t*             rotation;
+    const coord_t*             ref_origin;
+    double                     tolerance;
+    double                     separation;
+    const xyxymatch_options_t* options;
+} tiled_batch_t;
+
+static size_t
+tiling_axis(
+        const double offset,
+        const size_t n,
+        const double size) {
+
+    const double i = floor(offset / size);
+
+    if (i < 0.0) {
+        return 0;
+    } else if (i >= (double)n) {
+        return n - 1;
+    }
+    return (size_t)i;
+}
+
+/* The tile whose interior contains c */
+static size_t
+tiling_core(
+        const tiling_t* const t,
+        const coord_t* const c) {
+
+    return (tiling_axis(c->y - t->min.y, t->ny, t->size) * t->nx +
+            tiling_axis(c->x - t->min.x, t->nx, t->size));
+}
+
+/* The range of tiles [x0, x1] x [y0, y1] that collect c, including
+   their halos.  Returns zero if no tile does. */
+static int
+tiling_range(
+        const tiling_t* const t,
+        const coord_t* const c,
+        size_t* const x0,
+        size_t* const x1,
+        size_t* const y0,
+        size_t* const y1) {
+
+    const double xlo = floor((c->x - t->min.x - t->halo) / t->size);
+    const double xhi = floor((c->x - t->min.x + t->halo) / t->size);
+    const double ylo = floor((c->y - t->min.y - t->halo) / t->size);
+    const double yhi = floor((c->y - t->min.y + t->halo) / t->size);
+
+    if (!coord_is_finite(c) ||
+        xhi < 0.0 || xlo >= (double)t->nx ||
+        yhi < 0.0 || ylo >= (double)t->ny) {
+        return 0;
+    }
+
+    *x0 = xlo < 0.0 ? 0 : (size_t)xlo;
+    *x1 = xhi >= (double)t->nx ? t->nx - 1 : (size_t)xhi;
+    *y0 = ylo < 0.0 ? 0 : (size_t)ylo;
+    *y1 = yhi >= (double)t->ny ? t->ny - 1 : (size_t)yhi;
+
+    return 1;
+}
+
+/* Scan a list of coordinates, transformed by lintransform if it is
+   not NULL.  Each coordinate is counted in count[tile - tile0] for
+   every tile in [tile0, tile0 + ntiles) that collects it, or, if
+   coords is not NULL, stored with its index at coords[start[tile -
+   tile0] + fill[tile - tile0]++]. */
+static void
+tiled_scan(
+        const coord_view_t* const view,
+        const lintransform_t* const lintransform,
+        const tiling_t* const t,
+        const size_t tile0,
+        const size_t ntiles,
+        size_t* const count, /* [ntiles] */
+        const size_t* const start, /* [ntiles] */
+        coord_t* const coords,
+        size_t* const idx) {
+
+    coord_t orig[XYXYMATCH_TILED_CHUNK];
+    coord_t trans[XYXYMATCH_TILED_CHUNK];
+    size_t  offset, n, i, x, y, x0, x1, y0, y1, tile, k;
+
+    for (offset = 0; offset < view->n; offset += n) {
+        n = MIN(XYXYMATCH_TILED_CHUNK, view->n - offset);
+        coord_view_gather(view, offset, n, orig);
+        if (lintransform != NULL) {
+            apply_lintransform(lintransform, n, orig, trans);
+        } else {
+            memcpy(trans, orig, n * sizeof(coord_t));
+        }
+
+        for (i = 0; i < n; ++i) {
+            if (!tiling_range(t, &trans[i], &x0, &x1, &y0, &y1)) {
+                continue;
+            }
+
+            for (y = y0; y <= y1; ++y) {
+                for (x = x0; x <= x1; ++x) {
+                    tile = y * t->nx + x;
+                    if (tile < tile0 || tile >= tile0 + ntiles) {
+                        continue;
+                    }
+                    tile -= tile0;
+                    if (coords == NULL) {
+                        ++count[tile];
+                    } else {
+                        k = start[tile] + count[tile]++;
+                        coords[k] = orig[i];
+                        idx[k] = offset + i;
+                    }
+                }
+            }
+        }
+    }
+}
+
+/* Match the coordinates collected by one tile, and keep only the
+   matches to reference coordinates in its interior, converted to
+   indices into the whole lists */
+static int
+tiled_task(
+        void* data,
+        size_t index,
+        stimage_error_t* error) {
+
+    tiled_batch_t* const       batch   = (tiled_batch_t*)data;
+    xyxymatch_indices_t* const matches = &batch->matches[index];
+    const size_t               tile    = batch->tile0 + index;
+    const size_t               i0      = batch->input_start[index];
+    const size_t               ninput  = batch->input_start[index + 1] - i0;
+    const size_t               r0      = batch->ref_start[index];
+    const size_t               nref    = batch->ref_start[index + 1] - r0;
+    const coord_t* const       ref     = batch->ref + r0;
+    coord_view_t               input;
+    xyxymatch_ref_t            prepared;
+    size_t                     i, n;
+    int                        status  = 1;
+
+    matches->nmatches = 0;
+    if (ninput == 0 || nref == 0) {
+        return 0;
+    }
+
+    xyxymatch_ref_new(&prepared);
+    coord_view_init(&input, ninput, batch->input + i0);
+
+    if (xyxymatch_ref_init(
+                &prepared, nref, ref, batch->separation, error) ||
+        xyxymatch_prepared_indices(
+                &input, &prepared, matches,
+                batch->origin, batch->mag, batch->rotation, batch->ref_origin,
+                xyxymatch_algo_tolerance, batch->tolerance, batch->separation,
+                0, 0.0, 0, batch->options, error)) {
+        goto exit;
+    }
+
+    for (i = n = 0; i < matches->nmatches; ++i) {
+        if (tiling_core(batch->tiling, &ref[matches->ref_idx[i]]) != tile) {
+            continue;
+        }
+        matches->coord_idx[n] = matches->coord_idx[i];
+        matches->ref_idx[n] = matches->ref_idx[i];
+        ++n;
+    }
+    matches->nmatches = n;
+
+    status = 0;
+
+ exit:
+    xyxymatch_ref_free(&prepared);
+
+    return status;
+}
+
+/* Free the matches of the last batch, of which there are *n */
+static void
+tiled_free_matches(
+        tiled_batch_t* const batch,
+        size_t* const n) {
+
+    size_t i;
+
+    if (batch->matches != NULL) {
+        for (i = 0; i < *n; ++i) {
+            xyxymatch_indices_free(&batch->matches[i]);
+        }
+        free(batch->matches);
+        batch->matches = NULL;
+    }
+    *n = 0;
+}
+
+/* Find the bounding box of the finite reference coordinates, and
+   divide it into tiles */
+static int
+tiling_init(
+        const coord_view_t* const ref,
+        const double tile_size,
+        const double halo,
+        tiling_t* const t,
+        stimage_error_t* const error) {
+
+    coord_t chunk[XYXYMATCH_TILED_CHUNK];
+    coord_t max;
+    size_t  offset, n, i;
+    int     found = 0;
+    double  nx, ny;
+
+    t->min.x = t->min.y = 0.0;
+    max.x = max.y = 0.0;
+
+    for (offset = 0; offset < ref->n; offset += n) {
+        n = MIN(XYXYMATCH_TILED_CHUNK, ref->n - offset);
+        coord_view_gather(ref, offset, n, chunk);
+        for (i = 0; i < n; ++i) {
+            if (!coord_is_finite(&chunk[i])) {
+                continue;
+            }
+            if (!found) {
+                t->min = max = chunk[i];
+                found = 1;
+            }
+            t->min.x = MIN(t->min.x, chunk[i].x);
+            t->min.y = MIN(t->min.y, chunk[i].y);
+            max.x = MAX(max.x, chunk[i].x);
+            max.y = MAX(max.y, chunk[i].y);
+        }
+    }
+
+    if (!found) {
+        stimage_error_set_message(
+                error, "The reference coordinate list has no finite coordinates");
+        return 1;
+    }
+
+    nx = MAX(1.0, ceil((max.x - t->min.x) / tile_size));
+    ny = MAX(1.0, ceil((max.y - t->min.y) / tile_size));
+    if (nx * ny > (double)XYXYMATCH_TILED_MAX_TILES) {
+        stimage_error_set_message(
+                error,
+                "tile_size is too small for the extent of the reference "
+                "coordinates");
+        return 1;
+    }
+
+    t->size = tile_size;
+    t->halo = halo;
+    t->nx = (size_t)nx;
+    t->ny = (size_t)ny;
+
+    return 0;
+}
+
+int
+xyxymatch_tiled(
+        const coord_view_t* const input,
+        const coord_view_t* const ref,
+        const coord_t* origin,
+        const coord_t* mag,
+        const coord_t* rotation,
+        const coord_t* ref_origin,
+        const double tolerance,
+        const double separation,
+        const double tile_size,
+        const size_t max_coords,
+        const size_t nthreads,
+        const xyxymatch_options_t* options,
+        xyxymatch_sink_t* sink,
+        void* sink_data,
+        stimage_error_t* const error) {
+
+    static const coord_t DEFAULT_ORIGIN     = {0.0, 0.0};
+    static const coord_t DEFAULT_MAG        = {1.0, 1.0};
+    static const coord_t DEFAULT_ROTATION   = {0.0, 0.0};
+    static const coord_t DEFAULT_REF_ORIGIN = {0.0, 0.0};
+    tiling_t             tiling;
+    lintransform_t       lintransform;
+    tiled_batch_t        batch;
+    xyxymatch_options_t  default_options;
+    xyxymatch_options_t  tile_options;
+    size_t               ntiles       = 0;
+    size_t*              input_count  = NULL;
+    size_t*              ref_count    = NULL;
+    xyxymatch_output_t*  output       = NULL;
+    size_t               noutput      = 0;
+    size_t               nlists       = 0;
+    size_t               tile0, tile1, ncoords, i, j, k;
+    int                  status       = 1;
+
+    assert(input);
+    assert(ref);
+    assert(sink);
+    assert(error);
+
+    memset(&batch, 0, sizeof(tiled_batch_t));
+
+    if (input->n == 0) {
+        stimage_error_set_message(error, "The input coordinate list is empty");
+        goto exit;
+    }
+
+    if (ref->n == 0) {
+        stimage_error_set_message(error, "The reference coordinate list is empty");
+        goto exit;
+    }
+
+    if (!(tile_size > 0.0) || !isfinite(tile_size)) {
+        stimage_error_set_message(error, "tile_size must be positive");
+        goto exit;
+    }
+
+    if (origin == NULL) origin = &DEFAULT_ORIGIN;
+    if (mag == NULL) mag = &DEFAULT_MAG;
+    if (rotation == NULL) rotation = &DEFAULT_ROTATION;
+    if (ref_origin == NULL) ref_origin = &DEFAULT_REF_ORIGIN;
+    if (options == NULL) {
+        xyxymatch_options_init(&default_options);
+        options = &default_options;
+    }
+
+    /* The tiles are matched concurrently, each on a single thread, and
+       a stats record may not be shared between threads */
+    tile_options = *options;
+    tile_options.stats = NULL;
+    tile_options.nthreads = 1;
+
+    /* A coordinate near the edge of a tile may be matched to, or
+       culled by, one just across it */
+    if (tiling_init(
+                ref, tile_size, MAX(0.0, tolerance) + MAX(0.0, separation),
+                &tiling, error)) goto exit;
+    ntiles = tiling.nx * tiling.ny;
+
+    compute_lintransform(*origin, *mag, *rotation, *ref_origin, &lintransform);
+
+    /****************************************
+     COUNT THE COORDINATES COLLECTED BY EACH TILE
+    */
+    input_count = calloc_with_error(ntiles, sizeof(size_t), error);
+    if (input_count == NULL) goto exit;
+    ref_count = calloc_with_error(ntiles, sizeof(size_t), error);
+    if (ref_count == NULL) goto exit;
+
+    tiled_scan(input, &lintransform, &tiling, 0, ntiles, input_count,
+               NULL, NULL, NULL);
+    tiled_scan(ref, NULL, &tiling, 0, ntiles, ref_count, NULL, NULL, NULL);
+
+    batch.tiling = &tiling;
+    batch.origin = origin;
+    batch.mag = mag;
+    batch.rotation = rotation;
+    batch.ref_origin = ref_origin;
+    batch.tolerance = tolerance;
+    batch.separation = separation;
+    batch.options = &tile_options;
+
+    /****************************************
+     MATCH THE TILES IN BATCHES OF AT MOST max_coords COORDINATES
+    */
+    for (tile0 = 0; tile0 < ntiles; tile0 = tile1) {
+        ncoords = input_count[tile0] + ref_count[tile0];
+        for (tile1 = tile0 + 1; tile1 < ntiles; ++tile1) {
+            if (ncoords + input_count[tile1] + ref_count[tile1] > max_coords) {
+                break;
+            }
+            ncoords += input_count[tile1] + ref_count[tile1];
+        }
+
+        batch.tile0 = tile0;
+        batch.ntiles = tile1 - tile0;
+
+        free(batch.input_start);
+        batch.input_start = malloc_with_error(
+                (batch.ntiles + 1) * sizeof(size_t), error);
+        if (batch.input_start == NULL) goto exit;
+        free(batch.ref_start);
+        batch.ref_start = malloc_with_error(
+                (batch.ntiles + 1) * sizeof(size_t), error);
+        if (batch.ref_start == NULL) goto exit;
+
+        batch.input_start[0] = batch.ref_start[0] = 0;
+        for (i = 0; i < batch.ntiles; ++i) {
+            batch.input_start[i + 1] =
+                batch.input_start[i] + input_count[tile0 + i];
+            batch.ref_start[i + 1] =
+                batch.ref_start[i] + ref_count[tile0 + i];
+        }
+
+        free(batch.input_fill);
+        batch.input_fill = calloc_with_error(
+                batch.ntiles, sizeof(size_t), error);
+        if (batch.input_fill == NULL) goto exit;
+        free(batch.ref_fill);
+        batch.ref_fill = calloc_with_error(
+                batch.ntiles, sizeof(size_t), error);
+        if (batch.ref_fill == NULL) goto exit;
+
+        free(batch.input);
+        free(batch.input_idx);
+        free(batch.ref);
+        free(batch.ref_idx);
+        batch.input = batch.ref = NULL;
+        batch.input_idx = batch.ref_idx = NULL;
+        batch.input = malloc_with_error(
+                MAX(1, batch.input_start[batch.ntiles]) * sizeof(coord_t),
+                error);
+        if (batch.input == NULL) goto exit;
+        batch.input_idx = malloc_with_error(
+                MAX(1, batch.input_start[batch.ntiles]) * sizeof(size_t),
+                error);
+        if (batch.input_idx == NULL) goto exit;
+        batch.ref = malloc_with_error(
+                MAX(1, batch.ref_start[batch.ntiles]) * sizeof(coord_t),
+                error);
+        if (batch.ref == NULL) goto exit;
+        batch.ref_idx = malloc_with_error(
+                MAX(1, batch.ref_start[batch.ntiles]) * sizeof(size_t),
+                error);
+        if (batch.ref_idx == NULL) goto exit;
+
+        tiled_scan(input, &lintransform, &tiling, tile0, batch.ntiles,
+                   batch.input_fill, batch.input_start,
+                   batch.input, batch.input_idx);
+        tiled_scan(ref, NULL, &tiling, tile0, batch.ntiles,
+                   batch.ref_fill, batch.ref_start,
+                   batch.ref, batch.ref_idx);
+
+        tiled_free_matches(&batch, &nlists);
+        batch.matches = malloc_with_error(
+                batch.ntiles * sizeof(xyxymatch_indices_t), error);
+        if (batch.matches == NULL) goto exit;
+        for (nlists = 0; nlists < batch.ntiles; ++nlists) {
+            xyxymatch_indices_new(&batch.matches[nlists]);
+        }
+
+        if (parallel_for(
+                    batch.ntiles, nthreads, tiled_task, &batch,
+                    error)) goto exit;
+
+        /* Hand the matches of each tile to the sink, in order */
+        for (i = 0; i < batch.ntiles; ++i) {
+            const xyxymatch_indices_t* const m = &batch.matches[i];
+
+            if (m->nmatches == 0) {
+                continue;
+            }
+
+            if (m->nmatches > noutput) {
+                free(output);
+                noutput = m->nmatches;
+                output = malloc_with_error(
+                        noutput * sizeof(xyxymatch_output_t), error);
+                if (output == NULL) goto exit;
+            }
+
+            for (j = 0; j < m->nmatches; ++j) {
+                k = batch.input_start[i] + m->coord_idx[j];
+                output[j].coord = batch.input[k];
+                output[j].coord_idx = batch.input_idx[k];
+                k = batch.ref_start[i] + m->ref_idx[j];
+                output[j].ref = batch.ref[k];
+                output[j].ref_idx = batch.ref_idx[k];
+            }
+
+            if (sink(sink_data, m->nmatches, output, error)) goto exit;
+        }
+    }
+
+    status = 0;
+
+ exit:
+    free(input_count);
+    free(ref_count);
+    free(output);
+    free(batch.input_start);
+    free(batch.ref_start);
+    free(batch.input_fill);
+    free(batch.ref_fill);
+    free(batch.input);
+    free(batch.input_idx);
+    free(batch.ref);
+    free(batch.ref_idx);
+    tiled_free_matches(&batch, &nlists);
+
+    return status;
+}
@@ -0,0 +1,189 @@
+/*
+Copyright (C) 2008-2025 Association of Universities for Research in Astronomy (AURA)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above
+      copyright notice, this list of conditions and the following
+      disclaimer in the documentation and/or other materials provided
+      with the distribution.
+
+    3. The name of AURA and its representatives may not be used to
+      endorse or promote products derived from this software without
+      specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY AURA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL AURA BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+*/
+
+#include <assert.h>
+#include <string.h>
+
+#include "lib/coord_view.h"
+
+void
+coord_view_init(
+        coord_view_t* const v,
+        const size_t n,
+        const coord_t* const coords /* [n] */) {
+
+    coord_view_init_columns(
+            v, n, coord_view_float64, 0,
+            &coords->x, sizeof(coord_t), &coords->y, sizeof(coord_t));
+}
+
+void
+coord_view_init_columns(
+        coord_view_t* const v,
+        const size_t n,
+        const coord_view_type_e type,
+        const int swap,
+        const void* const x,
+        const ptrdiff_t xstride,
+        const void* const y,
+        const ptrdiff_t ystride) {
+
+    assert(v);
+    assert(type >= 0 && type < coord_view_LAST);
+
+    v->n = n;
+    v->x = (const char*)x;
+    v->y = (const char*)y;
+    v->xstride = xstride;
+    v->ystride = ystride;
+    v->type = type;
+    v->swap = swap;
+}
+
+const coord_t*
+coord_view_packed(
+        const coord_view_t* const v) {
+
+    assert(v);
+
+    if (v->type == coord_view_float64 && !v->swap &&
+        v->y == v->x + sizeof(double) &&
+        (v->n <= 1 ||
+         (v->xstride == (ptrdiff_t)sizeof(coord_t) &&
+          v->ystride == (ptrdiff_t)sizeof(coord_t))) &&
+        ((size_t)v->x % sizeof(double)) == 0) {
+        return (const coord_t*)v->x;
+    }
+
+    return NULL;
+}
+
+/* The values are copied byte by byte, so that unaligned and byte
+   swapped columns can be read safely */
+static double
+coord_view_read(
+        const coord_view_t* const v,
+        const char* const p) {
+
+    unsigned char b[sizeof(double)];
+    double        d;
+    float         f;
+    size_t        size = (v->type == coord_view_float64) ?
+        sizeof(double) : sizeof(float);
+    size_t        i;
+
+    if (v->swap) {
+        for (i = 0; i < size; ++i) {
+            b[i] = (unsigned char)p[size - 1 - i];
+        }
+    } else {
+        memcpy(b, p, size);
+    }
+
+    if (v->type == coord_view_float64) {
+        memcpy(&d, b, sizeof(double));
+        return d;
+    }
+
+    memcpy(&f, b, sizeof(float));
+    return (double)f;
+}
+
+coord_t
+coord_view_get(
+        const coord_view_t* const v,
+        const size_t i) {
+
+    coord_t c;
+
+    assert(v);
+    assert(i < v->n);
+
+    c.x = coord_view_read(v, v->x + (ptrdiff_t)i * v->xstride);
+    c.y = coord_view_read(v, v->y + (ptrdiff_t)i * v->ystride);
+
+    return c;
+}
+
+void
+coord_view_gather(
+        const coord_view_t* const v,
+        const size_t start,
+        const size_t n,
+        /* Output */
+        coord_t* const coords /* [n] */) {
+
+    const coord_t* packed = coord_view_packed(v);
+    const char*    xp     = NULL;
+    const char*    yp     = NULL;
+    size_t         i      = 0;
+
+    assert(v);
+    assert(start + n <= v->n);
+    assert(n == 0 || coords);
+
+    if (packed != NULL) {
+        if (packed + start != coords) {
+            memmove(coords, packed + start, n * sizeof(coord_t));
+        }
+        return;
+    }
+
+    xp = v->x + (ptrdiff_t)start * v->xstride;
+    yp = v->y + (ptrdiff_t)start * v->ystride;
+
+    /* Native columns are read directly; everything else goes through
+       coord_view_read */
+    if (!v->swap && v->type == coord_view_float64 &&
+        ((size_t)xp % sizeof(double)) == 0 &&
+        ((size_t)yp % sizeof(double)) == 0 &&
+        (v->xstride % (ptrdiff_t)sizeof(double)) == 0 &&
+        (v->ystride % (ptrdiff_t)sizeof(double)) == 0) {
+        for (i = 0; i < n; ++i) {
+            coords[i].x = *(const double*)(xp + (ptrdiff_t)i * v->xstride);
+            coords[i].y = *(const double*)(yp + (ptrdiff_t)i * v->ystride);
+        }
+    } else if (!v->swap && v->type == coord_view_float32 &&
+               ((size_t)xp % sizeof(float)) == 0 &&
+               ((size_t)yp % sizeof(float)) == 0 &&
+               (v->xstride % (ptrdiff_t)sizeof(float)) == 0 &&
+               (v->ystride % (ptrdiff_t)sizeof(float)) == 0) {
+        for (i = 0; i < n; ++i) {
+            coords[i].x = *(const float*)(xp + (ptrdiff_t)i * v->xstride);
+            coords[i].y = *(const float*)(yp + (ptrdiff_t)i * v->ystride);
+        }
+    } else {
+        for (i = 0; i < n; ++i) {
+            coords[i].x = coord_view_read(v, xp + (ptrdiff_t)i * v->xstride);
+            coords[i].y = coord_view_read(v, yp + (ptrdiff_t)i * v->ystride);
+        }
+    }
+}
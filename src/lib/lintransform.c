@@ -91,3 +91,104 @@ apply_lintransform(
         output[i].y = coeffs->d * x + coeffs->e * y + coeffs->f;
     }
 }
+
+void
+compose_lintransform(
+    const lintransform_t* const first,
+    const lintransform_t* const second,
+    lintransform_t* coeffs) {
+
+    lintransform_t result;
+
+    assert(first);
+    assert(second);
+    assert(coeffs);
+
+    result.a = second->a * first->a + second->b * first->d;
+    result.b = second->a * first->b + second->b * first->e;
+    result.c = second->a * first->c + second->b * first->f + second->c;
+    result.d = second->d * first->a + second->e * first->d;
+    result.e = second->d * first->b + second->e * first->e;
+    result.f = second->d * first->c + second->e * first->f + second->f;
+
+    *coeffs = result;
+}
+
+int
+fit_lintransform(
+    const size_t ncoords,
+    const coord_t* const input, /* [ncoords] */
+    const coord_t* const ref, /* [ncoords] */
+    lintransform_t* coeffs,
+    stimage_error_t* const error) {
+
+    coord_t mean_input = {0.0, 0.0};
+    coord_t mean_ref   = {0.0, 0.0};
+    double  sxx        = 0.0;
+    double  sxy        = 0.0;
+    double  syy        = 0.0;
+    double  sxu        = 0.0;
+    double  syu        = 0.0;
+    double  sxv        = 0.0;
+    double  syv        = 0.0;
+    double  dx, dy, du, dv, det;
+    size_t  i;
+
+    assert(input);
+    assert(ref);
+    assert(coeffs);
+    assert(error);
+
+    if (ncoords < 3) {
+        stimage_error_set_message(
+                error,
+                "At least 3 coordinates are required to fit a linear transform");
+        return 1;
+    }
+
+    for (i = 0; i < ncoords; ++i) {
+        mean_input.x += input[i].x;
+        mean_input.y += input[i].y;
+        mean_ref.x += ref[i].x;
+        mean_ref.y += ref[i].y;
+    }
+    mean_input.x /= (double)ncoords;
+    mean_input.y /= (double)ncoords;
+    mean_ref.x /= (double)ncoords;
+    mean_ref.y /= (double)ncoords;
+
+    /* Accumulate the normal equations about the means, which keeps
+       them well conditioned for coordinates far from the origin */
+    for (i = 0; i < ncoords; ++i) {
+        dx = input[i].x - mean_input.x;
+        dy = input[i].y - mean_input.y;
+        du = ref[i].x - mean_ref.x;
+        dv = ref[i].y - mean_ref.y;
+
+        sxx += dx * dx;
+        sxy += dx * dy;
+        syy += dy * dy;
+        sxu += dx * du;
+        syu += dy * du;
+        sxv += dx * dv;
+        syv += dy * dv;
+    }
+
+    det = sxx * syy - sxy * sxy;
+    if (!(det > EPS_DOUBLE * sxx * syy) || !isfinite(det)) {
+        stimage_error_set_message(
+                error,
+                "Can not fit a linear transform to collinear coordinates");
+        return 1;
+    }
+
+    coeffs->a = (syy * sxu - sxy * syu) / det;
+    coeffs->b = (sxx * syu - sxy * sxu) / det;
+    coeffs->c = mean_ref.x - coeffs->a * mean_input.x - coeffs->b * mean_input.y;
+
+    coeffs->d = (syy * sxv - sxy * syv) / det;
+    coeffs->e = (sxx * syv - sxy * sxv) / det;
+    coeffs->f = mean_ref.y - coeffs->d * mean_input.x - coeffs->e * mean_input.y;
+
+    return 0;
+}
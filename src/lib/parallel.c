@@ -0,0 +1,219 @@
+/*
+Copyright (C) 2008-2025 Association of Universities for Research in Astronomy (AURA)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above
+      copyright notice, this list of conditions and the following
+      disclaimer in the documentation and/or other materials provided
+      with the distribution.
+
+    3. The name of AURA and its representatives may not be used to
+      endorse or promote products derived from this software without
+      specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY AURA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL AURA BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+*/
+
+#include <assert.h>
+#include <string.h>
+
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <pthread.h>
+#include <unistd.h>
+#endif
+
+#include "lib/parallel.h"
+
+#ifdef _WIN32
+typedef HANDLE           parallel_thread_t;
+typedef CRITICAL_SECTION parallel_mutex_t;
+#define parallel_mutex_init(m)    InitializeCriticalSection(m)
+#define parallel_mutex_destroy(m) DeleteCriticalSection(m)
+#define parallel_mutex_lock(m)    EnterCriticalSection(m)
+#define parallel_mutex_unlock(m)  LeaveCriticalSection(m)
+#else
+typedef pthread_t        parallel_thread_t;
+typedef pthread_mutex_t  parallel_mutex_t;
+#define parallel_mutex_init(m)    pthread_mutex_init((m), NULL)
+#define parallel_mutex_destroy(m) pthread_mutex_destroy(m)
+#define parallel_mutex_lock(m)    pthread_mutex_lock(m)
+#define parallel_mutex_unlock(m)  pthread_mutex_unlock(m)
+#endif
+
+typedef struct {
+    size_t           ntasks;
+    size_t           next;
+    int              failed;
+    parallel_task_t* task;
+    void*            data;
+    parallel_mutex_t mutex;
+    stimage_error_t  error;
+} parallel_state_t;
+
+size_t
+parallel_ncpus(void) {
+
+#ifdef _WIN32
+    SYSTEM_INFO info;
+
+    GetSystemInfo(&info);
+    return MAX(1, (size_t)info.dwNumberOfProcessors);
+#else
+    long n = sysconf(_SC_NPROCESSORS_ONLN);
+
+    return n < 1 ? 1 : (size_t)n;
+#endif
+}
+
+static void
+parallel_worker(
+        parallel_state_t* const state) {
+
+    stimage_error_t error;
+    size_t          index;
+
+    stimage_error_init(&error);
+
+    for (;;) {
+        parallel_mutex_lock(&state->mutex);
+        if (state->failed || state->next >= state->ntasks) {
+            parallel_mutex_unlock(&state->mutex);
+            break;
+        }
+        index = state->next++;
+        parallel_mutex_unlock(&state->mutex);
+
+        if (state->task(state->data, index, &error)) {
+            parallel_mutex_lock(&state->mutex);
+            if (!state->failed) {
+                state->failed = 1;
+                memcpy(&state->error, &error, sizeof(stimage_error_t));
+            }
+            parallel_mutex_unlock(&state->mutex);
+            break;
+        }
+    }
+}
+
+#ifdef _WIN32
+static DWORD WINAPI
+parallel_thread_main(
+        LPVOID arg) {
+
+    parallel_worker((parallel_state_t*)arg);
+    return 0;
+}
+#else
+static void*
+parallel_thread_main(
+        void* arg) {
+
+    parallel_worker((parallel_state_t*)arg);
+    return NULL;
+}
+#endif
+
+int
+parallel_for(
+        const size_t ntasks,
+        const size_t nthreads,
+        parallel_task_t* task,
+        void* data,
+        stimage_error_t* const error) {
+
+    parallel_state_t   state;
+    parallel_thread_t* threads  = NULL;
+    size_t             nworkers = 0;
+    size_t             nstarted = 0;
+    size_t             i        = 0;
+    int                status   = 1;
+
+    assert(task);
+    assert(error);
+
+    if (ntasks == 0) {
+        return 0;
+    }
+
+    nworkers = nthreads == 0 ? parallel_ncpus() : nthreads;
+    nworkers = MIN(nworkers, ntasks);
+
+    if (nworkers <= 1) {
+        for (i = 0; i < ntasks; ++i) {
+            if (task(data, i, error)) {
+                return 1;
+            }
+        }
+        return 0;
+    }
+
+    state.ntasks = ntasks;
+    state.next = 0;
+    state.failed = 0;
+    state.task = task;
+    state.data = data;
+    stimage_error_init(&state.error);
+    parallel_mutex_init(&state.mutex);
+
+    threads = malloc_with_error(nworkers * sizeof(parallel_thread_t), error);
+    if (threads == NULL) goto exit;
+
+    /* The calling thread does its share of the work, so only start
+       nworkers - 1 new threads */
+    for (nstarted = 0; nstarted < nworkers - 1; ++nstarted) {
+#ifdef _WIN32
+        threads[nstarted] = CreateThread(
+                NULL, 0, parallel_thread_main, &state, 0, NULL);
+        if (threads[nstarted] == NULL) {
+            break;
+        }
+#else
+        if (pthread_create(
+                    &threads[nstarted], NULL, parallel_thread_main, &state)) {
+            break;
+        }
+#endif
+    }
+
+    parallel_worker(&state);
+
+    for (i = 0; i < nstarted; ++i) {
+#ifdef _WIN32
+        WaitForSingleObject(threads[i], INFINITE);
+        CloseHandle(threads[i]);
+#else
+        pthread_join(threads[i], NULL);
+#endif
+    }
+
+    if (state.failed) {
+        memcpy(error, &state.error, sizeof(stimage_error_t));
+        goto exit;
+    }
+
+    status = 0;
+
+ exit:
+
+    parallel_mutex_destroy(&state.mutex);
+    free(threads);
+
+    return status;
+}
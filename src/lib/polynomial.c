@@ -34,6 +34,10 @@ DAMAGE.
 
 #include "lib/polynomial.h"
 
+/* The points are processed in blocks of this many, so that each
+   coordinate is read once and the scratch arrays stay in cache */
+#define POLYNOMIAL_BLOCK 256
+
 typedef int (*basis_function_t)(
         const size_t,
         const size_t,
@@ -44,6 +48,24 @@ typedef int (*basis_function_t)(
         double* const,
         stimage_error_t* const);
 
+/* Reserve size doubles in workspace, or in local if workspace is
+   NULL, and return the workspace that was used */
+static workspace_t*
+reserve_workspace(
+        workspace_t* const workspace,
+        workspace_t* const local,
+        const size_t size,
+        stimage_error_t* const error) {
+
+    workspace_t* w = (workspace == NULL) ? local : workspace;
+
+    if (workspace_reserve(w, size, error)) {
+        return NULL;
+    }
+
+    return w;
+}
+
 int
 eval_1dpoly(
         const int order,
@@ -51,12 +73,20 @@ eval_1dpoly(
         const size_t ncoord,
         const size_t axis,
         const coord_t* const ref,
+        workspace_t* const workspace,
         double* const zfit,
         stimage_error_t* const error) {
 
     size_t        i      = 0;
+    size_t        start  = 0;
+    size_t        nblock = 0;
     int           j      = 0;
     const double* x      = (double *)ref + axis;
+    double*       z      = NULL;
+    workspace_t   local;
+    workspace_t*  w      = NULL;
+    size_t        mark   = 0;
+    double*       xp     = NULL;
     double*       tmp    = NULL;
     int           status = 1;
 
@@ -65,6 +95,8 @@ eval_1dpoly(
     assert(zfit);
     assert(error);
 
+    workspace_new(&local);
+
     for (i = 0; i < ncoord; ++i) {
         zfit[i] = coeff[0];
     }
@@ -81,25 +113,34 @@ eval_1dpoly(
         return 0;
     }
 
-    tmp = malloc_with_error(ncoord * sizeof(double), error);
-    if (tmp == NULL) goto exit;
+    w = reserve_workspace(workspace, &local, 2 * POLYNOMIAL_BLOCK, error);
+    if (w == NULL) goto exit;
+    mark = w->used;
+    xp = workspace_alloc(w, POLYNOMIAL_BLOCK);
+    tmp = workspace_alloc(w, POLYNOMIAL_BLOCK);
 
-    for (i = 0; i < ncoord; ++i) {
-        tmp[i] = x[i<<1];
-    }
+    for (start = 0; start < ncoord; start += POLYNOMIAL_BLOCK) {
+        nblock = MIN(POLYNOMIAL_BLOCK, ncoord - start);
+        z = zfit + start;
 
-    for (j = 2; j < order; ++j) {
-        for (i = 0; i < ncoord; ++i) {
-            tmp[i] *= x[i<<1];
-            zfit[i] += tmp[i] * coeff[j];
+        for (i = 0; i < nblock; ++i) {
+            xp[i] = tmp[i] = x[(start+i)<<1];
+        }
+
+        for (j = 2; j < order; ++j) {
+            for (i = 0; i < nblock; ++i) {
+                tmp[i] *= xp[i];
+                z[i] += tmp[i] * coeff[j];
+            }
         }
     }
 
+    w->used = mark;
     status = 0;
 
  exit:
 
-    free(tmp);
+    workspace_free(&local);
 
     return status;
 }
@@ -113,14 +154,21 @@ eval_1dchebyshev(
         const coord_t* const ref,
         const double k1,
         const double k2,
+        workspace_t* const workspace,
         double* const zfit,
         stimage_error_t* const error) {
 
     size_t        i      = 0;
+    size_t        start  = 0;
+    size_t        nblock = 0;
     int           j      = 0;
     const double* x      = (double *)ref + axis;
+    double*       z      = NULL;
     double        c1     = 0.0;
     double        c2     = 0.0;
+    workspace_t   local;
+    workspace_t*  w      = NULL;
+    size_t        mark   = 0;
     double*       sx     = NULL;
     double*       pn     = NULL;
     double*       pnm1   = NULL;
@@ -132,6 +180,8 @@ eval_1dchebyshev(
     assert(zfit);
     assert(error);
 
+    workspace_new(&local);
+
     for (i = 0; i < ncoord; ++i) {
         zfit[i] = coeff[0];
     }
@@ -150,50 +200,49 @@ eval_1dchebyshev(
         return 0;
     }
 
-    sx = malloc_with_error(ncoord * sizeof(double), error);
-    if (sx == NULL) goto exit;
-
-    pn = malloc_with_error(ncoord * sizeof(double), error);
-    if (pn == NULL) goto exit;
-
-    pnm1 = malloc_with_error(ncoord * sizeof(double), error);
-    if (pnm1 == NULL) goto exit;
-
-    pnm2 = malloc_with_error(ncoord * sizeof(double), error);
-    if (pnm2 == NULL) goto exit;
-
-    for (i = 0; i < ncoord; ++i) {
-        pnm2[i] = 1.0;
-        pnm1[i] = sx[i] = (x[i<<1] + k1) * k2;
-        sx[i] *= 2;
-    }
-
-    for (j = 2; j < order; ++j) {
-        for (i = 0; i < ncoord; ++i) {
-            pn[i] = (sx[i] * pnm1[i]) - pnm2[i];
+    w = reserve_workspace(workspace, &local, 4 * POLYNOMIAL_BLOCK, error);
+    if (w == NULL) goto exit;
+    mark = w->used;
+    sx = workspace_alloc(w, POLYNOMIAL_BLOCK);
+    pn = workspace_alloc(w, POLYNOMIAL_BLOCK);
+    pnm1 = workspace_alloc(w, POLYNOMIAL_BLOCK);
+    pnm2 = workspace_alloc(w, POLYNOMIAL_BLOCK);
+
+    for (start = 0; start < ncoord; start += POLYNOMIAL_BLOCK) {
+        nblock = MIN(POLYNOMIAL_BLOCK, ncoord - start);
+        z = zfit + start;
+
+        for (i = 0; i < nblock; ++i) {
+            pnm2[i] = 1.0;
+            pnm1[i] = sx[i] = (x[(start+i)<<1] + k1) * k2;
+            sx[i] *= 2;
         }
 
-        if (j < order - 1) {
-            for (i = 0; i < ncoord; ++i) {
-                pnm2[i] = pnm1[i];
-                pnm1[i] = pn[i];
+        for (j = 2; j < order; ++j) {
+            for (i = 0; i < nblock; ++i) {
+                pn[i] = (sx[i] * pnm1[i]) - pnm2[i];
             }
-        }
 
-        for (i = 0; i < ncoord; ++i) {
-            pn[i] *= coeff[j];
-            zfit[i] += pn[i];
+            if (j < order - 1) {
+                for (i = 0; i < nblock; ++i) {
+                    pnm2[i] = pnm1[i];
+                    pnm1[i] = pn[i];
+                }
+            }
+
+            for (i = 0; i < nblock; ++i) {
+                pn[i] *= coeff[j];
+                z[i] += pn[i];
+            }
         }
     }
 
+    w->used = mark;
     status = 0;
 
  exit:
 
-    free(sx);
-    free(pn);
-    free(pnm1);
-    free(pnm2);
+    workspace_free(&local);
 
     return status;
 }
@@ -207,15 +256,22 @@ eval_1dlegendre(
         const coord_t* const ref,
         const double k1,
         const double k2,
+        workspace_t* const workspace,
         double* const zfit,
         stimage_error_t* const error) {
 
     size_t        i      = 0;
+    size_t        start  = 0;
+    size_t        nblock = 0;
     int           j      = 0;
     const double* x      = (double *)ref + axis;
+    double*       z      = NULL;
     double        ri     = 0.0;
     double        ri1    = 0.0;
     double        ri2    = 0.0;
+    workspace_t   local;
+    workspace_t*  w      = NULL;
+    size_t        mark   = 0;
     double*       sx     = NULL;
     double*       pn     = NULL;
     double*       pnm1   = NULL;
@@ -227,6 +283,8 @@ eval_1dlegendre(
     assert(zfit);
     assert(error);
 
+    workspace_new(&local);
+
     for (i = 0; i < ncoord; ++i) {
         zfit[i] = coeff[0];
     }
@@ -245,58 +303,61 @@ eval_1dlegendre(
         return 0;
     }
 
-    sx = malloc_with_error(ncoord * sizeof(double), error);
-    if (sx == NULL) goto exit;
-
-    pn = malloc_with_error(ncoord * sizeof(double), error);
-    if (pn == NULL) goto exit;
-
-    pnm1 = malloc_with_error(ncoord * sizeof(double), error);
-    if (pnm1 == NULL) goto exit;
-
-    pnm2 = malloc_with_error(ncoord * sizeof(double), error);
-    if (pnm2 == NULL) goto exit;
-
-    for (i = 0; i < ncoord; ++i) {
-        pnm2[i] = 1.0;
-        pnm1[i] = sx[i] = (x[i<<1] + k1) * k2;
-    }
+    w = reserve_workspace(workspace, &local, 4 * POLYNOMIAL_BLOCK, error);
+    if (w == NULL) goto exit;
+    mark = w->used;
+    sx = workspace_alloc(w, POLYNOMIAL_BLOCK);
+    pn = workspace_alloc(w, POLYNOMIAL_BLOCK);
+    pnm1 = workspace_alloc(w, POLYNOMIAL_BLOCK);
+    pnm2 = workspace_alloc(w, POLYNOMIAL_BLOCK);
+
+    for (start = 0; start < ncoord; start += POLYNOMIAL_BLOCK) {
+        nblock = MIN(POLYNOMIAL_BLOCK, ncoord - start);
+        z = zfit + start;
+
+        for (i = 0; i < nblock; ++i) {
+            pnm2[i] = 1.0;
+            pnm1[i] = sx[i] = (x[(start+i)<<1] + k1) * k2;
+        }
 
-    for (j = 2; j < order; ++j) {
-        ri = (double)j + 1.0;
-        ri1 = (2.0 * ri - 3.0) / (ri - 1.0);
-        ri2 = -(ri - 2.0) / (ri - 1.0);
+        for (j = 2; j < order; ++j) {
+            ri = (double)j + 1.0;
+            ri1 = (2.0 * ri - 3.0) / (ri - 1.0);
+            ri2 = -(ri - 2.0) / (ri - 1.0);
 
-        for (i = 0; i < ncoord; ++i) {
-            pn[i] = sx[i] * pnm1[i];
-            pn[i] = pn[i] * ri1 + pnm2[i] * ri2;
-        }
+            for (i = 0; i < nblock; ++i) {
+                pn[i] = sx[i] * pnm1[i];
+                pn[i] = pn[i] * ri1 + pnm2[i] * ri2;
+            }
 
-        if (j < order - 1) {
-            for (i = 0; i < ncoord; ++i) {
-                pnm2[i] = pnm1[i];
-                pnm1[i] = pn[i];
+            if (j < order - 1) {
+                for (i = 0; i < nblock; ++i) {
+                    pnm2[i] = pnm1[i];
+                    pnm1[i] = pn[i];
+                }
             }
-        }
 
-        for (i = 0; i < ncoord; ++i) {
-            pn[i] *= coeff[j];
-            zfit[i] += pn[i];
+            for (i = 0; i < nblock; ++i) {
+                pn[i] *= coeff[j];
+                z[i] += pn[i];
+            }
         }
     }
 
+    w->used = mark;
     status = 0;
 
  exit:
 
-    free(sx);
-    free(pn);
-    free(pnm1);
-    free(pnm2);
+    workspace_free(&local);
 
     return status;
 }
 
+/* The basis functions are computed a block of points at a time, so
+   that the coordinates are read once, and the previous terms of the
+   recurrences are still in cache. */
+
 int
 basis_poly(
         const size_t ncoord,
@@ -308,35 +369,38 @@ basis_poly(
         double* const basis,
         stimage_error_t* const error) {
 
-    size_t              i  = 0;
-    int                 k  = 0;
-    const double* const x  = (double*)ref + axis;
-    double*             bp = basis;
+    size_t              i     = 0;
+    size_t              start = 0;
+    size_t              end   = 0;
+    int                 k     = 0;
+    const double* const x     = (double*)ref + axis;
+    double*             bp    = basis;
 
     assert(ref);
     assert(basis);
     assert(error);
 
-    for (k = 0; k < order; ++k) {
-        assert((bp - basis) >= 0);
+    for (start = 0; start < ncoord; start += POLYNOMIAL_BLOCK) {
+        end = MIN(start + POLYNOMIAL_BLOCK, ncoord);
+        bp = basis;
 
-        if (k == 0) {
-            for (i = 0; i < ncoord; ++i) {
-                bp[i] = 1.0;
-            }
-        } else if (k == 1) {
-            for (i = 0; i < ncoord; ++i) {
-                bp[i] = x[i<<1];
-            }
-        } else {
-            for (i = 0; i < ncoord; ++i) {
-                assert(((bp - basis) + i - ncoord) > 0);
-                assert(((bp - basis) + i - ncoord) < ncoord * order);
-                bp[i] = x[i<<1] * bp[i - ncoord];
+        for (k = 0; k < order; ++k) {
+            if (k == 0) {
+                for (i = start; i < end; ++i) {
+                    bp[i] = 1.0;
+                }
+            } else if (k == 1) {
+                for (i = start; i < end; ++i) {
+                    bp[i] = x[i<<1];
+                }
+            } else {
+                for (i = start; i < end; ++i) {
+                    bp[i] = basis[ncoord+i] * bp[i-ncoord];
+                }
             }
-        }
 
-        bp += ncoord;
+            bp += ncoord;
+        }
     }
 
     return 0;
@@ -353,37 +417,39 @@ basis_chebyshev(
         double* const basis,
         stimage_error_t* const error) {
 
-    size_t              i  = 0;
-    int                 k  = 0;
-    const double* const x  = (double*)ref + axis;
-    double*             bp = basis;
+    size_t              i     = 0;
+    size_t              start = 0;
+    size_t              end   = 0;
+    int                 k     = 0;
+    const double* const x     = (double*)ref + axis;
+    double*             bp    = basis;
 
     assert(ref);
     assert(basis);
     assert(error);
 
-    for (k = 0; k < order; ++k) {
-        if (k == 0) {
-            for (i = 0; i < ncoord; ++i) {
-                bp[i] = 1.0;
-            }
-        } else if (k == 1) {
-            for (i = 0; i < ncoord; ++i) {
-                bp[i] = (x[i<<1] + k1) * k2;
-            }
-        } else {
-            for (i = 0; i < ncoord; ++i) {
-                assert(((bp - basis) + i - ncoord) >= 0);
-                assert(((bp - basis) + i - ncoord) < ncoord * order);
-                assert(((bp - basis) + i - (2 * ncoord)) >= 0);
-                assert(((bp - basis) + i - (2 * ncoord)) < ncoord * order);
-                bp[i] = (basis[ncoord+i] * bp[i-ncoord]);
-                bp[i] *= 2.0;
-                bp[i] -= bp[i-(2 * ncoord)];
+    for (start = 0; start < ncoord; start += POLYNOMIAL_BLOCK) {
+        end = MIN(start + POLYNOMIAL_BLOCK, ncoord);
+        bp = basis;
+
+        for (k = 0; k < order; ++k) {
+            if (k == 0) {
+                for (i = start; i < end; ++i) {
+                    bp[i] = 1.0;
+                }
+            } else if (k == 1) {
+                for (i = start; i < end; ++i) {
+                    bp[i] = (x[i<<1] + k1) * k2;
+                }
+            } else {
+                for (i = start; i < end; ++i) {
+                    bp[i] = (basis[ncoord+i] * bp[i-ncoord]) * 2.0 -
+                        bp[i-(2 * ncoord)];
+                }
             }
-        }
 
-        bp += ncoord;
+            bp += ncoord;
+        }
     }
 
     return 0;
@@ -400,48 +466,55 @@ basis_legendre(
         double* const basis,
         stimage_error_t* const error) {
 
-    size_t              i   = 0;
-    int                 k   = 0;
-    const double* const x   = (double*)ref + axis;
-    double*             bp  = basis;
-    double              ri  = 0.0;
-    double              ri1 = 0.0;
-    double              ri2 = 0.0;
+    size_t              i     = 0;
+    size_t              start = 0;
+    size_t              end   = 0;
+    int                 k     = 0;
+    const double* const x     = (double*)ref + axis;
+    double*             bp    = basis;
+    double              ri    = 0.0;
+    double              ri1   = 0.0;
+    double              ri2   = 0.0;
 
     assert(ref);
     assert(basis);
     assert(error);
 
-    for (k = 0; k < order; ++k) {
-        if (k == 0) {
-            for (i = 0; i < ncoord; ++i) {
-                bp[i] = 1.0;
-            }
-        } else if (k == 1) {
-            for (i = 0; i < ncoord; ++i) {
-                bp[i] = (x[i<<1] + k1) * k2;
-            }
-        } else {
-            assert(((bp - basis) + i - ncoord) >= 0);
-            assert(((bp - basis) + i - ncoord) < ncoord * order);
-            assert(((bp - basis) + i - (2 * ncoord)) >= 0);
-            assert(((bp - basis) + i - (2 * ncoord)) < ncoord * order);
+    for (start = 0; start < ncoord; start += POLYNOMIAL_BLOCK) {
+        end = MIN(start + POLYNOMIAL_BLOCK, ncoord);
+        bp = basis;
 
-            ri = k + 1;
-            ri1 = (2.0 * ri - 3.0) / (ri - 1.0);
-            ri2 = -(ri - 2.0) / (ri - 1.0);
-            for (i = 0; i < ncoord; ++i) {
-                bp[i] = (basis[ncoord+i] * bp[i-ncoord]);
-                bp[i] = bp[i] * ri1 + bp[i-(2 * ncoord)] * ri2;
+        for (k = 0; k < order; ++k) {
+            if (k == 0) {
+                for (i = start; i < end; ++i) {
+                    bp[i] = 1.0;
+                }
+            } else if (k == 1) {
+                for (i = start; i < end; ++i) {
+                    bp[i] = (x[i<<1] + k1) * k2;
+                }
+            } else {
+                ri = k + 1;
+                ri1 = (2.0 * ri - 3.0) / (ri - 1.0);
+                ri2 = -(ri - 2.0) / (ri - 1.0);
+                for (i = start; i < end; ++i) {
+                    bp[i] = (basis[ncoord+i] * bp[i-ncoord]);
+                    bp[i] = bp[i] * ri1 + bp[i-(2 * ncoord)] * ri2;
+                }
             }
-        }
 
-        bp += ncoord;
+            bp += ncoord;
+        }
     }
 
     return 0;
 }
 
+/* DIFF: The terms with cross terms are accumulated for each power of
+   y (the loops were misnested), the number of x terms with half cross
+   terms drops in step with surface_fit, and there are no special
+   cases for first order fits, which added to zfit without setting it
+   and ignored the normalization. */
 static int
 eval_poly_generic(
         const int xorder,
@@ -455,21 +528,28 @@ eval_poly_generic(
         const double k1y,
         const double k2y,
         basis_function_t basis_function,
+        workspace_t* const workspace,
         /* Output */
         double* const zfit,
         stimage_error_t* const error) {
 
     size_t       i        = 0;
+    size_t       start    = 0;
+    size_t       nblock   = 0;
     int          j        = 0;
     int          k        = 0;
+    double*      z        = NULL;
+    workspace_t  local;
+    workspace_t* w        = NULL;
+    size_t       mark     = 0;
     double*      xb       = NULL;
     double*      yb       = NULL;
     double*      accum    = NULL;
     int          cp       = 0;
-    const int maxorder = MAX(xorder + 1, yorder + 1);
+    const int    maxorder = MAX(xorder + 1, yorder + 1);
     int          xincr    = 0;
-    double*      xbp      = xb;
-    double*      ybp      = yb;
+    double*      xbp      = NULL;
+    double*      ybp      = NULL;
     int          status   = 1;
 
     assert(coeff);
@@ -477,6 +557,8 @@ eval_poly_generic(
     assert(zfit);
     assert(error);
 
+    workspace_new(&local);
+
     /* Fit a constant */
     if (xorder == 1 && yorder == 1) {
         for (i = 0; i < ncoord; ++i) {
@@ -486,101 +568,89 @@ eval_poly_generic(
         return 0;
     }
 
-    /* Fit first order in x and y */
-    if (xorder == 2 && yorder == 1) {
-        for (i = 0; i < ncoord; ++i) {
-            zfit[i] += ref[i].x * coeff[1];
+    w = reserve_workspace(
+            workspace, &local, (xorder + yorder + 1) * POLYNOMIAL_BLOCK,
+            error);
+    if (w == NULL) goto exit;
+    mark = w->used;
+    xb = workspace_alloc(w, xorder * POLYNOMIAL_BLOCK);
+    yb = workspace_alloc(w, yorder * POLYNOMIAL_BLOCK);
+    accum = workspace_alloc(w, POLYNOMIAL_BLOCK);
+
+    for (start = 0; start < ncoord; start += POLYNOMIAL_BLOCK) {
+        nblock = MIN(POLYNOMIAL_BLOCK, ncoord - start);
+        z = zfit + start;
+
+        /* Calculate basis functions */
+        if (basis_function(
+                    nblock, 0, ref + start, xorder, k1x, k2x, xb,
+                    error)) goto exit;
+        if (basis_function(
+                    nblock, 1, ref + start, yorder, k1y, k2y, yb,
+                    error)) goto exit;
+
+        /* Accumulate the output vector */
+        for (i = 0; i < nblock; ++i) {
+            z[i] = 0.0;
         }
 
-        return 0;
-    }
-
-    if (yorder == 2 && xorder == 1) {
-        for (i = 0; i < ncoord; ++i) {
-            zfit[i] += ref[i].y * coeff[1];
-        }
-
-        return 0;
-    }
-
-    if (yorder == 2 && xorder == 2 && xterms == xterms_none) {
-        for (i = 0; i < ncoord; ++i) {
-            zfit[i] += ref[i].x * coeff[1] + ref[i].y * coeff[2];
-        }
-
-        return 0;
-    }
-
-    xb = malloc_with_error(xorder * ncoord * sizeof(double), error);
-    if (xb == NULL) goto exit;
-    yb = malloc_with_error(yorder * ncoord * sizeof(double), error);
-    if (yb == NULL) goto exit;
-    accum = malloc_with_error(ncoord * sizeof(double), error);
-    if (accum == NULL) goto exit;
+        if (xterms != xterms_none) {
+            xincr = xorder;
+            cp = 0;
+            ybp = yb;
+            for (j = 1; j <= yorder; ++j) {
+                for (i = 0; i < nblock; ++i) {
+                    accum[i] = 0.0;
+                }
+                xbp = xb;
+                for (k = 0; k < xincr; ++k) {
+                    for (i = 0; i < nblock; ++i) {
+                        accum[i] += xbp[i] * coeff[cp+k];
+                    }
+                    xbp += nblock;
+                }
 
-    /* Calculate basis functions */
-    if (basis_function(ncoord, 0, ref, xorder, k1x, k2x, xb, error)) goto exit;
-    if (basis_function(ncoord, 1, ref, yorder, k1y, k2y, yb, error)) goto exit;
+                for (i = 0; i < nblock; ++i) {
+                    z[i] += accum[i] * ybp[i];
+                }
 
-    /* Accumulate the output vector */
-    for (i = 0; i < ncoord; ++i) {
-        zfit[i] = 0.0;
-    }
+                cp += xincr;
+                ybp += nblock;
 
-    if (xterms != xterms_none) {
-        xincr = xorder;
-        ybp = yb;
-        for (j = 0; j < yorder; ++j) {
-            for (i = 0; i < ncoord; ++i) {
-                accum[i] = 0.0;
+                if (xterms == xterms_half) {
+                    if ((j + xorder + 1) > maxorder) {
+                        xincr -= 1;
+                    }
+                }
             }
+        } else { /* xterms == surface_xterms_none */
             xbp = xb;
-            for (k = 0; k < xincr; ++k) {
-                for (i = 0; i < ncoord; ++i) {
-                    accum[i] += xbp[i] * coeff[cp+k];
+            for (k = 0; k < xorder; ++k) {
+                for (i = 0; i < nblock; ++i) {
+                    z[i] += xbp[i] * coeff[k];
                 }
-            }
-            xbp += ncoord;
-        }
-
-        for (i = 0; i < ncoord; ++i) {
-            zfit[i] += accum[i] * ybp[i];
-        }
-
-        cp += xincr;
-        ybp += ncoord;
 
-        if (xterms == xterms_half) {
-            if ((j + xorder + 1) > maxorder) {
-                xincr -= 1;
-            }
-        }
-    } else { /* xterms == surface_xterms_none */
-        xbp = xb;
-        for (k = 0; k < xorder; ++k) {
-            for (i = 0; i < ncoord; ++i) {
-                zfit[i] += xbp[i] * coeff[k];
+                xbp += nblock;
             }
 
-            xbp += ncoord;
-        }
+            ybp = yb + nblock;
+            for (k = 0; k < yorder - 1; ++k) {
+                for (i = 0; i < nblock; ++i) {
+                    z[i] += ybp[i] * coeff[xorder+k];
+                }
 
-        ybp = yb + ncoord;
-        for (k = 0; k < yorder - 1; ++k) {
-            for (i = 0; i < ncoord; ++i) {
-                zfit[i] += ybp[i] * coeff[xorder+k];
+                ybp += nblock;
             }
-
-            ybp += ncoord;
         }
     }
 
     status = 0;
 
  exit:
-    free(xb);
-    free(yb);
-    free(accum);
+    if (w != NULL) {
+        w->used = mark;
+    }
+    workspace_free(&local);
 
     return status;
 }
@@ -597,13 +667,14 @@ eval_poly(
         const double k2x,
         const double k1y,
         const double k2y,
+        workspace_t* const workspace,
         /* Output */
         double* const zfit,
         stimage_error_t* const error) {
 
     return eval_poly_generic(
             xorder, yorder, coeff, ncoord, ref, xterms, k1x, k2x, k1y, k2y,
-            &basis_poly, zfit, error);
+            &basis_poly, workspace, zfit, error);
 }
 
 int
@@ -618,13 +689,14 @@ eval_chebyshev(
         const double k2x,
         const double k1y,
         const double k2y,
+        workspace_t* const workspace,
         /* Output */
         double* const zfit,
         stimage_error_t* const error) {
 
     return eval_poly_generic(
             xorder, yorder, coeff, ncoord, ref, xterms, k1x, k2x, k1y, k2y,
-            &basis_chebyshev, zfit, error);
+            &basis_chebyshev, workspace, zfit, error);
 }
 
 int
@@ -639,11 +711,12 @@ eval_legendre(
         const double k2x,
         const double k1y,
         const double k2y,
+        workspace_t* const workspace,
         /* Output */
         double* const zfit,
         stimage_error_t* const error) {
 
     return eval_poly_generic(
             xorder, yorder, coeff, ncoord, ref, xterms, k1x, k2x, k1y, k2y,
-            &basis_legendre, zfit, error);
+            &basis_legendre, workspace, zfit, error);
 }
@@ -0,0 +1,145 @@
+/*
+Copyright (C) 2008-2025 Association of Universities for Research in Astronomy (AURA)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above
+      copyright notice, this list of conditions and the following
+      disclaimer in the documentation and/or other materials provided
+      with the distribution.
+
+    3. The name of AURA and its representatives may not be used to
+      endorse or promote products derived from this software without
+      specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY AURA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL AURA BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+*/
+
+#include <assert.h>
+#include <string.h>
+
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <time.h>
+#endif
+
+#include "lib/stats.h"
+
+void
+stimage_stats_init(
+        stimage_stats_t* const s) {
+
+    assert(s);
+
+    s->nstats = 0;
+}
+
+double
+stimage_stats_clock(void) {
+
+#ifdef _WIN32
+    LARGE_INTEGER frequency;
+    LARGE_INTEGER count;
+
+    QueryPerformanceFrequency(&frequency);
+    QueryPerformanceCounter(&count);
+    return (double)count.QuadPart / (double)frequency.QuadPart;
+#else
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (double)ts.tv_sec + 1e-9 * (double)ts.tv_nsec;
+#endif
+}
+
+static stimage_stat_t*
+stimage_stats_find(
+        const stimage_stats_t* const s,
+        const char* const name) {
+
+    size_t i;
+
+    for (i = 0; i < s->nstats; ++i) {
+        if (s->stats[i].name == name || strcmp(s->stats[i].name, name) == 0) {
+            return (stimage_stat_t*)&s->stats[i];
+        }
+    }
+
+    return NULL;
+}
+
+void
+stimage_stats_add(
+        stimage_stats_t* const s,
+        const char* const name,
+        const stimage_stat_kind_e kind,
+        const double value) {
+
+    stimage_stat_t* stat;
+
+    assert(s);
+    assert(name);
+
+    stat = stimage_stats_find(s, name);
+    if (stat == NULL) {
+        if (s->nstats >= STIMAGE_STATS_MAX) {
+            return;
+        }
+        stat = &s->stats[s->nstats++];
+        stat->name = name;
+        stat->kind = kind;
+        stat->value = 0.0;
+    }
+
+    if (kind == stimage_stat_max) {
+        stat->value = MAX(stat->value, value);
+    } else {
+        stat->value += value;
+    }
+}
+
+double
+stimage_stats_get(
+        const stimage_stats_t* const s,
+        const char* const name) {
+
+    const stimage_stat_t* stat;
+
+    assert(s);
+    assert(name);
+
+    stat = stimage_stats_find(s, name);
+    return (stat != NULL) ? stat->value : 0.0;
+}
+
+void
+stimage_stats_merge(
+        stimage_stats_t* const dst,
+        const stimage_stats_t* const src) {
+
+    size_t i;
+
+    assert(dst);
+    assert(src);
+
+    for (i = 0; i < src->nstats; ++i) {
+        stimage_stats_add(
+                dst, src->stats[i].name, src->stats[i].kind,
+                src->stats[i].value);
+    }
+}
@@ -71,6 +71,23 @@ calloc_with_error(
     return result;
 }
 
+void *
+realloc_with_error(
+        void* ptr,
+        size_t size,
+        stimage_error_t* error) {
+
+    void *result = NULL;
+
+    assert(error);
+
+    result = realloc(ptr, size);
+    if (result == NULL) {
+        stimage_error_format_message(error, "Error allocating %u bytes", size);
+    }
+    return result;
+}
+
 STIMAGE_Int64
 factorial(
         size_t n) {
@@ -0,0 +1,102 @@
+/*
+Copyright (C) 2008-2025 Association of Universities for Research in Astronomy (AURA)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above
+      copyright notice, this list of conditions and the following
+      disclaimer in the documentation and/or other materials provided
+      with the distribution.
+
+    3. The name of AURA and its representatives may not be used to
+      endorse or promote products derived from this software without
+      specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY AURA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL AURA BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+*/
+
+#include <assert.h>
+#include <stdlib.h>
+
+#include "lib/workspace.h"
+
+void
+workspace_new(
+        workspace_t* const w) {
+
+    assert(w);
+
+    w->size = 0;
+    w->used = 0;
+    w->buffer = NULL;
+}
+
+int
+workspace_reserve(
+        workspace_t* const w,
+        const size_t size,
+        stimage_error_t* const error) {
+
+    double* buffer = NULL;
+
+    assert(w);
+    assert(error);
+
+    if (w->used + size <= w->size) {
+        return 0;
+    }
+
+    /* Nothing may be handed out when the buffer moves */
+    assert(w->used == 0);
+
+    buffer = malloc_with_error((w->used + size) * sizeof(double), error);
+    if (buffer == NULL) {
+        return 1;
+    }
+
+    free(w->buffer);
+    w->buffer = buffer;
+    w->size = w->used + size;
+
+    return 0;
+}
+
+double*
+workspace_alloc(
+        workspace_t* const w,
+        const size_t size) {
+
+    double* result;
+
+    assert(w);
+    assert(w->used + size <= w->size);
+
+    result = w->buffer + w->used;
+    w->used += size;
+
+    return result;
+}
+
+void
+workspace_free(
+        workspace_t* const w) {
+
+    assert(w);
+
+    free(w->buffer);
+    workspace_new(w);
+}
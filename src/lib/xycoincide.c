@@ -34,30 +34,48 @@ DAMAGE.
 */
 
 #include <assert.h>
+#include <math.h>
 #include <string.h>
 
 #include "lib/xycoincide.h"
+#include "lib/xygrid.h"
 
-size_t
-xycoincide(
+/* The sweep is abandoned for the grid once it has made more than this
+   many comparisons per coordinate so far (after the first
+   XYCOINCIDE_SWEEP_WARMUP coordinates).  The sweep is much cheaper
+   per comparison, so it is faster unless many coordinates fall within
+   the tolerance in y of each other. */
+#define XYCOINCIDE_SWEEP_WORK 64
+#define XYCOINCIDE_SWEEP_WARMUP 256
+
+/* The smallest search radius used with the grid.  A smaller tolerance
+   squares to zero (or nearly), in which case coordinates closer than
+   about 1e-162 still coincide. */
+#define XYCOINCIDE_MIN_RADIUS 1e-150
+
+/* The original algorithm: each remaining coordinate deletes the later
+   ones within tolerance, stopping at the first that is too far away
+   in y.  Its cost depends on how many coordinates fall within the
+   tolerance in y, which is large for dense lists.
+
+   If adaptive, stops before the first remaining coordinate at which
+   it has been too slow, and returns its position (or ncoords if it
+   finished).  At that point, every coordinate before it is final, and
+   every coordinate within tolerance of one of them has been
+   deleted. */
+static size_t
+xycoincide_sweep(
     const size_t ncoords,
-    const coord_t* const * const input /*[ncoords]*/,
     const coord_t** const output /*[ncoords]*/,
-    const double tolerance) {
+    const double tolerance2,
+    const int adaptive,
+    size_t* const ndeleted) {
 
-    double tolerance2 = tolerance * tolerance;
-    size_t nunique = ncoords;
     double distance = 0.0;
     double r2 = 0.0;
     size_t iprev = 0;
     size_t i = 0;
-
-    assert(input);
-    assert(output);
-
-    if ((coord_t **)input != (coord_t **)output) {
-        memcpy(output, input, sizeof(coord_t *) * ncoords);
-    }
+    size_t work = 0;
 
     for (iprev = 0; iprev < ncoords; ++iprev) {
         /* Jump to the next object if this one has been deleted,
@@ -66,7 +84,14 @@ xycoincide(
             continue;
         }
 
+        if (adaptive &&
+            work > XYCOINCIDE_SWEEP_WORK * (iprev + XYCOINCIDE_SWEEP_WARMUP)) {
+            return iprev;
+        }
+
         for (i = iprev + 1; i < ncoords; ++i) {
+            ++work;
+
             /* Skip to the next object if this one has been deleted */
             if (output[i] == NULL) {
                 continue;
@@ -87,19 +112,167 @@ xycoincide(
             if (r2 <= tolerance2) {
                 /* Delete it */
                 output[i] = NULL;
-                --nunique;
+                ++*ndeleted;
+            }
+        }
+    }
+
+    return ncoords;
+}
+
+/* Finishes what xycoincide_sweep started at position start, but each
+   coordinate looks for an earlier remaining coordinate within
+   tolerance in a uniform grid, so the cost does not depend on the
+   density along y.  A coordinate is deleted exactly when the sweep
+   would delete it: when some earlier (in sorted order) remaining
+   coordinate is within tolerance.
+
+   The coordinates are first copied in sorted order, so that the
+   neighbors looked at, which are close in y, are close in memory. */
+static int
+xycoincide_grid(
+    const size_t ncoords,
+    const coord_t** const output /*[ncoords]*/,
+    const size_t start,
+    const double tolerance,
+    const double tolerance2,
+    size_t* const ndeleted,
+    stimage_error_t* const error) {
+
+    const double    radius  = MAX(fabs(tolerance), XYCOINCIDE_MIN_RADIUS);
+    coord_t         nowhere;
+    coord_t*        sorted  = NULL;
+    const coord_t** ptrs    = NULL;
+    char*           deleted = NULL;
+    xygrid_t        grid;
+    const coord_t*  coord;
+    const coord_t*  prev;
+    size_t          i, k, p, ix, iy, x0, y0, x1, y1, cell;
+    double          distance, r2;
+    int             status  = 1;
+
+    xygrid_new(&grid);
+
+    /* Deleted coordinates are left out of the grid */
+    nowhere.x = nowhere.y = NAN;
+
+    sorted = malloc_with_error(ncoords * sizeof(coord_t), error);
+    if (sorted == NULL) goto exit;
+
+    ptrs = malloc_with_error(ncoords * sizeof(coord_t*), error);
+    if (ptrs == NULL) goto exit;
+
+    deleted = malloc_with_error(ncoords * sizeof(char), error);
+    if (deleted == NULL) goto exit;
+
+    for (i = 0; i < ncoords; ++i) {
+        if (output[i] == NULL) {
+            sorted[i] = nowhere;
+            deleted[i] = 1;
+        } else {
+            sorted[i] = *output[i];
+            deleted[i] = 0;
+        }
+        ptrs[i] = &sorted[i];
+    }
+
+    if (xygrid_init(&grid, ncoords, ptrs, radius, error)) goto exit;
+
+    for (i = start; i < ncoords; ++i) {
+        coord = &sorted[i];
+        if (deleted[i] ||
+            !xygrid_cell_range(&grid, coord, radius, &x0, &y0, &x1, &y1)) {
+            continue;
+        }
+
+        for (iy = y0; iy <= y1 && !deleted[i]; ++iy) {
+            for (ix = x0; ix <= x1 && !deleted[i]; ++ix) {
+                cell = iy * grid.nx + ix;
+                /* The items in each cell are in sorted order, so stop
+                   at the first one that is not before this one */
+                for (k = grid.cell_start[cell];
+                     k < grid.cell_start[cell + 1];
+                     ++k) {
+                    p = grid.items[k];
+                    if (p >= i) {
+                        break;
+                    }
+                    if (deleted[p]) {
+                        continue;
+                    }
+
+                    prev = &sorted[p];
+                    distance = coord->y - prev->y;
+                    r2 = distance * distance;
+                    distance = coord->x - prev->x;
+                    r2 += distance * distance;
+                    if (r2 <= tolerance2) {
+                        deleted[i] = 1;
+                        output[i] = NULL;
+                        ++*ndeleted;
+                        break;
+                    }
+                }
             }
         }
     }
 
+    status = 0;
+
+ exit:
+
+    xygrid_free(&grid);
+    free(sorted);
+    free(ptrs);
+    free(deleted);
+
+    return status;
+}
+
+size_t
+xycoincide(
+    const size_t ncoords,
+    const coord_t* const * const input /*[ncoords]*/,
+    const coord_t** const output /*[ncoords]*/,
+    const double tolerance) {
+
+    double tolerance2 = tolerance * tolerance;
+    size_t ndeleted = 0;
+    size_t nunique = 0;
+    size_t start = 0;
+    size_t i = 0;
+    stimage_error_t error;
+
+    assert(input);
+    assert(output);
+
+    if ((coord_t **)input != (coord_t **)output) {
+        memcpy(output, input, sizeof(coord_t *) * ncoords);
+    }
+
+    /* The grid can't be used with an infinite or NaN tolerance */
+    start = xycoincide_sweep(
+            ncoords, output, tolerance2, isfinite(tolerance), &ndeleted);
+
+    if (start < ncoords) {
+        stimage_error_init(&error);
+        if (xycoincide_grid(
+                    ncoords, output, start, tolerance, tolerance2,
+                    &ndeleted, &error)) {
+            /* The grid could not be allocated, so finish the sweep */
+            xycoincide_sweep(ncoords, output, tolerance2, 0, &ndeleted);
+        }
+    }
+
     /* Compress the array */
-    if (nunique < ncoords) {
-        iprev = 0;
+    if (ndeleted > 0) {
         for (i = 0; i < ncoords; ++i) {
             if (output[i] != NULL) {
-                output[iprev++] = output[i];
+                output[nunique++] = output[i];
             }
         }
+    } else {
+        nunique = ncoords;
     }
 
     return nunique;
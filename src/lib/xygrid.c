@@ -0,0 +1,245 @@
+/*
+Copyright (C) 2008-2025 Association of Universities for Research in Astronomy (AURA)
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above
+      copyright notice, this list of conditions and the following
+      disclaimer in the documentation and/or other materials provided
+      with the distribution.
+
+    3. The name of AURA and its representatives may not be used to
+      endorse or promote products derived from this software without
+      specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY AURA ``AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL AURA BE LIABLE FOR ANY DIRECT, INDIRECT,
+INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS
+OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+DAMAGE.
+*/
+
+#include <assert.h>
+#include <math.h>
+#include <string.h>
+
+#include "lib/xygrid.h"
+
+/* The maximum number of cells per coordinate.  Cells are enlarged
+   beyond the requested size to keep the grid within this bound, so a
+   sparse list spread over a large area doesn't allocate a huge, mostly
+   empty, grid. */
+#define XYGRID_CELLS_PER_COORD 4
+
+void
+xygrid_new(
+        xygrid_t* const g) {
+
+    assert(g);
+
+    memset(g, 0, sizeof(xygrid_t));
+}
+
+void
+xygrid_free(
+        xygrid_t* const g) {
+
+    assert(g);
+
+    free(g->cell_start); g->cell_start = NULL;
+    free(g->items); g->items = NULL;
+    g->nx = 0;
+    g->ny = 0;
+    g->nitems = 0;
+}
+
+static inline size_t
+xygrid_cell_index(
+        const double v,
+        const double min,
+        const double cell_size,
+        const size_t n) {
+
+    double i = floor((v - min) / cell_size);
+
+    if (i < 0.0) {
+        return 0;
+    } else if (i >= (double)n) {
+        return n - 1;
+    }
+    return (size_t)i;
+}
+
+int
+xygrid_init(
+        xygrid_t* const g,
+        const size_t ncoords,
+        const coord_t* const * const coords,
+        const double cell_size,
+        stimage_error_t* const error) {
+
+    const double max_cells = (double)(XYGRID_CELLS_PER_COORD * ncoords + 16);
+    double       cs        = cell_size;
+    double       nx, ny;
+    size_t       ncells    = 0;
+    size_t*      counts    = NULL;
+    size_t       ix, iy, cell;
+    size_t       i;
+    int          status    = 1;
+
+    assert(g);
+    assert(coords);
+    assert(error);
+
+    xygrid_new(g);
+
+    if (!(cell_size > 0.0) || !isfinite(cell_size)) {
+        stimage_error_format_message(
+            error, "Invalid grid cell size (%f)", cell_size);
+        goto exit;
+    }
+
+    bbox_init(&g->bbox);
+    for (i = 0; i < ncoords; ++i) {
+        if (!coord_is_finite(coords[i])) {
+            continue;
+        }
+        if (!isfinite(g->bbox.min.x) || coords[i]->x < g->bbox.min.x) {
+            g->bbox.min.x = coords[i]->x;
+        }
+        if (!isfinite(g->bbox.max.x) || coords[i]->x > g->bbox.max.x) {
+            g->bbox.max.x = coords[i]->x;
+        }
+        if (!isfinite(g->bbox.min.y) || coords[i]->y < g->bbox.min.y) {
+            g->bbox.min.y = coords[i]->y;
+        }
+        if (!isfinite(g->bbox.max.y) || coords[i]->y > g->bbox.max.y) {
+            g->bbox.max.y = coords[i]->y;
+        }
+    }
+
+    if (!isfinite(g->bbox.min.x)) {
+        /* No finite coordinates: make a single, empty, cell */
+        g->bbox.min.x = g->bbox.max.x = 0.0;
+        g->bbox.min.y = g->bbox.max.y = 0.0;
+    }
+
+    /* Determine the grid dimensions, growing the cells if there would
+       be too many of them */
+    for (;;) {
+        nx = floor((g->bbox.max.x - g->bbox.min.x) / cs) + 1.0;
+        ny = floor((g->bbox.max.y - g->bbox.min.y) / cs) + 1.0;
+        if (nx * ny <= max_cells) {
+            break;
+        }
+        cs *= MAX(1.01, sqrt((nx * ny) / max_cells));
+    }
+
+    g->cell_size = cs;
+    g->nx = (size_t)nx;
+    g->ny = (size_t)ny;
+    ncells = g->nx * g->ny;
+
+    g->cell_start = calloc_with_error(ncells + 1, sizeof(size_t), error);
+    if (g->cell_start == NULL) goto exit;
+
+    counts = calloc_with_error(ncells, sizeof(size_t), error);
+    if (counts == NULL) goto exit;
+
+    g->items = malloc_with_error(MAX(ncoords, 1) * sizeof(size_t), error);
+    if (g->items == NULL) goto exit;
+
+    /* Counting sort of the coordinates into the cells */
+    for (i = 0; i < ncoords; ++i) {
+        if (!coord_is_finite(coords[i])) {
+            continue;
+        }
+        ix = xygrid_cell_index(coords[i]->x, g->bbox.min.x, cs, g->nx);
+        iy = xygrid_cell_index(coords[i]->y, g->bbox.min.y, cs, g->ny);
+        ++counts[iy * g->nx + ix];
+    }
+
+    for (cell = 0; cell < ncells; ++cell) {
+        g->cell_start[cell + 1] = g->cell_start[cell] + counts[cell];
+        counts[cell] = g->cell_start[cell];
+    }
+
+    for (i = 0; i < ncoords; ++i) {
+        if (!coord_is_finite(coords[i])) {
+            continue;
+        }
+        ix = xygrid_cell_index(coords[i]->x, g->bbox.min.x, cs, g->nx);
+        iy = xygrid_cell_index(coords[i]->y, g->bbox.min.y, cs, g->ny);
+        g->items[counts[iy * g->nx + ix]++] = i;
+    }
+
+    g->nitems = g->cell_start[ncells];
+
+    status = 0;
+
+ exit:
+
+    free(counts);
+    if (status) {
+        xygrid_free(g);
+    }
+
+    return status;
+}
+
+int
+xygrid_cell_range(
+        const xygrid_t* const g,
+        const coord_t* const center,
+        const double radius,
+        size_t* const x0,
+        size_t* const y0,
+        size_t* const x1,
+        size_t* const y1) {
+
+    double pad, lo, hi;
+
+    assert(g);
+    assert(center);
+    assert(x0);
+    assert(y0);
+    assert(x1);
+    assert(y1);
+
+    if (g->nitems == 0 || !coord_is_finite(center)) {
+        return 0;
+    }
+
+    /* Widen the search by the rounding error in the cell computation */
+    pad = radius * 1e-9 +
+        (fabs(center->x) + fabs(center->y) +
+         fabs(g->bbox.min.x) + fabs(g->bbox.min.y)) * 16.0 * EPS_DOUBLE;
+
+    lo = floor((center->x - radius - pad - g->bbox.min.x) / g->cell_size);
+    hi = floor((center->x + radius + pad - g->bbox.min.x) / g->cell_size);
+    if (hi < 0.0 || lo >= (double)g->nx) {
+        return 0;
+    }
+    *x0 = lo < 0.0 ? 0 : (size_t)lo;
+    *x1 = hi >= (double)g->nx ? g->nx - 1 : (size_t)hi;
+
+    lo = floor((center->y - radius - pad - g->bbox.min.y) / g->cell_size);
+    hi = floor((center->y + radius + pad - g->bbox.min.y) / g->cell_size);
+    if (hi < 0.0 || lo >= (double)g->ny) {
+        return 0;
+    }
+    *y0 = lo < 0.0 ? 0 : (size_t)lo;
+    *y1 = hi >= (double)g->ny ? g->ny - 1 : (size_t)hi;
+
+    return 1;
+}
@@ -35,6 +35,7 @@ DAMAGE.
 
 #include <assert.h>
 #include <stdlib.h>
+#include <string.h>
 
 #include "lib/xysort.h"
 
@@ -48,28 +49,274 @@ DAMAGE.
    Whereas the original function sorts the data as well as a set of
    indices, we treat the data as constant and sort pointers to the
    data (which can later be used as indices using pointer
-   subtraction).  This allows us to use the C stdlib qsort as-is
-   rather than writing our own quicksort algorithm.
+   subtraction).
+
+   Coordinates with equal x and y are kept in the order of their
+   indices, so the result is fully determined, and -0.0 sorts equal to
+   0.0.  NaNs sort after (or, if negative, before) all other values.
 */
 
+/* Coordinates are sorted on unsigned integer keys that order the same
+   way as the doubles they are made from, so they can be radix sorted.
+   -0.0 is folded into 0.0, since they compare equal. */
+typedef struct {
+    unsigned long long key;
+    size_t             index;
+} xysort_item_t;
+
+/* Used to sort runs of equal y on x */
+typedef struct {
+    unsigned long long xkey;
+    size_t             index;
+} xysort_tie_t;
+
+/* Lists shorter than this are sorted with qsort */
+#define XYSORT_RADIX_MIN 512
+
+/* The radix sort works on digits of this many bits */
+#define XYSORT_RADIX_BITS 11
+#define XYSORT_RADIX_SIZE (1 << XYSORT_RADIX_BITS)
+#define XYSORT_RADIX_PASSES ((64 + XYSORT_RADIX_BITS - 1) / XYSORT_RADIX_BITS)
+
+static inline unsigned long long
+xysort_key(const double value) {
+    const double       v    = value + 0.0;
+    unsigned long long bits = 0;
+
+    memcpy(&bits, &v, sizeof(bits));
+    if (bits & 0x8000000000000000ULL) {
+        return ~bits;
+    }
+    return bits | 0x8000000000000000ULL;
+}
+
+static int
+xysort_tie_compare(const void* ap, const void* bp) {
+    const xysort_tie_t* a = (const xysort_tie_t*)ap;
+    const xysort_tie_t* b = (const xysort_tie_t*)bp;
+
+    if (a->xkey != b->xkey) {
+        return a->xkey < b->xkey ? -1 : 1;
+    } else if (a->index != b->index) {
+        return a->index < b->index ? -1 : 1;
+    }
+    return 0;
+}
+
+/* Pointers into the same array order the same way as their indices,
+   so this gives the same order as the radix sort */
 static int
 xysort_compare(const void* ap, const void* bp) {
-    const coord_t* a = *(const coord_t**)ap;
-    const coord_t* b = *(const coord_t**)bp;
-
-    if (a->y < b->y) {
-        return -1;
-    } else if (a->y > b->y) {
-        return 1;
-    } else {
-        if (a->x < b->x) {
-            return -1;
-        } else if (a->x > b->x) {
-            return 1;
-        } else {
-            return 0;
+    const coord_t*     a  = *(const coord_t**)ap;
+    const coord_t*     b  = *(const coord_t**)bp;
+    unsigned long long ka = xysort_key(a->y);
+    unsigned long long kb = xysort_key(b->y);
+
+    if (ka == kb) {
+        ka = xysort_key(a->x);
+        kb = xysort_key(b->x);
+    }
+
+    if (ka != kb) {
+        return ka < kb ? -1 : 1;
+    } else if (a != b) {
+        return a < b ? -1 : 1;
+    }
+    return 0;
+}
+
+/* A stable least-significant-digit radix sort of the items on their
+   keys.  Digits which are the same in every key are skipped.  Returns
+   the buffer holding the result, which is either items or tmp. */
+static xysort_item_t*
+xysort_radix(
+        const size_t ncoords,
+        xysort_item_t* items,
+        xysort_item_t* tmp,
+        size_t* const counts /* [XYSORT_RADIX_PASSES * XYSORT_RADIX_SIZE] */) {
+
+    xysort_item_t* swap;
+    size_t*        count;
+    size_t         pass, shift, digit, i, sum, n;
+
+    memset(counts, 0,
+           XYSORT_RADIX_PASSES * XYSORT_RADIX_SIZE * sizeof(size_t));
+
+    for (i = 0; i < ncoords; ++i) {
+        for (pass = 0; pass < XYSORT_RADIX_PASSES; ++pass) {
+            shift = pass * XYSORT_RADIX_BITS;
+            digit = (size_t)(items[i].key >> shift) & (XYSORT_RADIX_SIZE - 1);
+            ++counts[pass * XYSORT_RADIX_SIZE + digit];
+        }
+    }
+
+    for (pass = 0; pass < XYSORT_RADIX_PASSES; ++pass) {
+        shift = pass * XYSORT_RADIX_BITS;
+        count = counts + pass * XYSORT_RADIX_SIZE;
+
+        digit = (size_t)(items[0].key >> shift) & (XYSORT_RADIX_SIZE - 1);
+        if (count[digit] == ncoords) {
+            continue;
+        }
+
+        sum = 0;
+        for (digit = 0; digit < XYSORT_RADIX_SIZE; ++digit) {
+            n = count[digit];
+            count[digit] = sum;
+            sum += n;
+        }
+
+        for (i = 0; i < ncoords; ++i) {
+            digit = (size_t)(items[i].key >> shift) & (XYSORT_RADIX_SIZE - 1);
+            tmp[count[digit]++] = items[i];
         }
+
+        swap = items;
+        items = tmp;
+        tmp = swap;
     }
+
+    return items;
+}
+
+/* Sort the items, which are keyed on y and in index order, by x
+   within each run of equal y.  The radix sort is stable, so this
+   gives the order (y, x, index). */
+static int
+xysort_ties(
+        const size_t ncoords,
+        const coord_t* const coords,
+        xysort_item_t* const items,
+        stimage_error_t* const error) {
+
+    xysort_tie_t* ties  = NULL;
+    size_t        nties = 0;
+    size_t        i, j, k;
+
+    for (i = 0; i < ncoords; i = j) {
+        for (j = i + 1; j < ncoords && items[j].key == items[i].key; ++j) {
+            /* Find the end of the run */
+        }
+
+        if (j - i < 2) {
+            continue;
+        }
+
+        if (j - i > nties) {
+            free(ties);
+            nties = MAX(j - i, 2 * nties);
+            ties = malloc_with_error(nties * sizeof(xysort_tie_t), error);
+            if (ties == NULL) return 1;
+        }
+
+        for (k = i; k < j; ++k) {
+            ties[k - i].xkey = xysort_key(coords[items[k].index].x);
+            ties[k - i].index = items[k].index;
+        }
+
+        qsort(ties, j - i, sizeof(xysort_tie_t), &xysort_tie_compare);
+
+        for (k = i; k < j; ++k) {
+            items[k].index = ties[k - i].index;
+        }
+    }
+
+    free(ties);
+
+    return 0;
+}
+
+/* Sort the coordinates into a newly allocated array of items, which
+   is returned in *result and must be freed by the caller */
+static int
+xysort_items(
+        const size_t ncoords,
+        const coord_t* const coords,
+        xysort_item_t** const result,
+        stimage_error_t* const error) {
+
+    xysort_item_t* items  = NULL;
+    xysort_item_t* tmp    = NULL;
+    xysort_item_t* sorted = NULL;
+    size_t*        counts = NULL;
+    size_t         i;
+    int            status = 1;
+
+    *result = NULL;
+
+    items = malloc_with_error(MAX(ncoords, 1) * sizeof(xysort_item_t), error);
+    if (items == NULL) goto exit;
+
+    for (i = 0; i < ncoords; ++i) {
+        items[i].key = xysort_key(coords[i].y);
+        items[i].index = i;
+    }
+
+    tmp = malloc_with_error(MAX(ncoords, 1) * sizeof(xysort_item_t), error);
+    if (tmp == NULL) goto exit;
+
+    counts = malloc_with_error(
+            XYSORT_RADIX_PASSES * XYSORT_RADIX_SIZE * sizeof(size_t), error);
+    if (counts == NULL) goto exit;
+
+    sorted = xysort_radix(ncoords, items, tmp, counts);
+    if (xysort_ties(ncoords, coords, sorted, error)) goto exit;
+
+    *result = sorted;
+    status = 0;
+
+ exit:
+
+    if (sorted != items) {
+        free(items);
+    }
+    if (sorted != tmp) {
+        free(tmp);
+    }
+    if (status) {
+        free(sorted);
+    }
+    free(counts);
+
+    return status;
+}
+
+int
+xysort_permutation(
+    const size_t ncoords,
+    const coord_t* const coords /* [ncoords] */,
+    size_t* const perm /* [ncoords] */,
+    stimage_error_t* const error) {
+
+    xysort_item_t*  items  = NULL;
+    const coord_t** ptrs   = NULL;
+    size_t          i;
+
+    assert(coords);
+    assert(perm);
+    assert(error);
+
+    if (ncoords < XYSORT_RADIX_MIN) {
+        ptrs = malloc_with_error(MAX(ncoords, 1) * sizeof(coord_t*), error);
+        if (ptrs == NULL) return 1;
+
+        xysort(ncoords, coords, ptrs);
+        for (i = 0; i < ncoords; ++i) {
+            perm[i] = (size_t)(ptrs[i] - coords);
+        }
+
+        free(ptrs);
+        return 0;
+    }
+
+    if (xysort_items(ncoords, coords, &items, error)) return 1;
+
+    for (i = 0; i < ncoords; ++i) {
+        perm[i] = items[i].index;
+    }
+
+    free(items);
+    return 0;
 }
 
 void
@@ -78,11 +325,26 @@ xysort(
     const coord_t* const coords /* [ncoords] */,
     const coord_t** const coords_ptr /* [ncoords] */) {
 
-    size_t i;
+    xysort_item_t*  items = NULL;
+    size_t          i;
+    stimage_error_t error;
 
     assert(coords);
     assert(coords_ptr);
 
+    if (ncoords >= XYSORT_RADIX_MIN) {
+        stimage_error_init(&error);
+        if (!xysort_items(ncoords, coords, &items, &error)) {
+            for (i = 0; i < ncoords; ++i) {
+                coords_ptr[i] = coords + items[i].index;
+            }
+            free(items);
+            return;
+        }
+        /* Out of memory for the keys: fall back to sorting the
+           pointers in place, which gives the same order */
+    }
+
     /* Fill the pointer array */
     for (i = 0; i < ncoords; ++i) {
         coords_ptr[i] = (coord_t*)coords + i;
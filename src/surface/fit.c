@@ -30,11 +30,14 @@ DAMAGE.
 */
 
 #include <assert.h>
+#include <math.h>
 #include <stdio.h>
 
 #include "surface/cholesky.h"
 #include "surface/fit.h"
+#include "lib/parallel.h"
 #include "lib/polynomial.h"
+#include "lib/workspace.h"
 
 static double
 vector_dot_product(
@@ -52,8 +55,312 @@ vector_dot_product(
     return sum;
 }
 
-/* was dgsacpts */
+/* Calculate the non-zero basis functions */
+static int
+surface_fit_compute_basis(
+        const surface_t* const s,
+        const size_t ncoord,
+        const coord_t* const coord,
+        /* Output */
+        double* const xbasis,
+        double* const ybasis,
+        stimage_error_t* const error) {
+
+    switch (s->type) {
+    case surface_type_polynomial:
+        if (basis_poly(
+                    ncoord, 0, coord, s->xorder, s->xmaxmin, s->xrange,
+                    xbasis, error)) return 1;
+        if (basis_poly(
+                    ncoord, 1, coord, s->yorder, s->ymaxmin, s->yrange,
+                    ybasis, error)) return 1;
+        break;
+    case surface_type_chebyshev:
+        if (basis_chebyshev(
+                    ncoord, 0, coord, s->xorder, s->xmaxmin, s->xrange,
+                    xbasis, error)) return 1;
+        if (basis_chebyshev(
+                    ncoord, 1, coord, s->yorder, s->ymaxmin, s->yrange,
+                    ybasis, error)) return 1;
+        break;
+    case surface_type_legendre:
+        if (basis_legendre(
+                    ncoord, 0, coord, s->xorder, s->xmaxmin, s->xrange,
+                    xbasis, error)) return 1;
+        if (basis_legendre(
+                    ncoord, 1, coord, s->yorder, s->ymaxmin, s->yrange,
+                    ybasis, error)) return 1;
+        break;
+    default:
+        stimage_error_set_message(error, "Illegal curve type");
+        return 1;
+    }
+
+    return 0;
+}
+
+/* The number of points whose rows of the design matrix are built at a
+   time.  The block of the design matrix of even a high-order surface
+   then stays in cache while each element of the normal equations is
+   updated from it, rather than every element streaming over all of
+   the points. */
+#define SURFACE_FIT_BLOCK 128
+
+/* Accumulate the inner products of the basis functions into matrix
+   (if not NULL), which is usually s->matrix, and the inner products
+   of the basis functions and z into vector (if z is not NULL), which
+   is usually s->vector.  xbasis and ybasis hold the basis functions of the
+   ncoord points, as computed by surface_fit_compute_basis.  design
+   is scratch space for 2 * s->ncoeff * SURFACE_FIT_BLOCK values. */
+static void
+surface_fit_accumulate(
+        const surface_t* const s,
+        const size_t ncoord,
+        const double* const xbasis,
+        const double* const ybasis,
+        const double* const z,
+        const double* const w,
+        double* const matrix,
+        double* const vector,
+        double* const design) {
+
+    const size_t ncoeff   = s->ncoeff;
+    const int    maxorder = MAX(s->xorder + 1, s->yorder + 1);
+    double*      a        = design;
+    double*      aw       = design + ncoeff * SURFACE_FIT_BLOCK;
+    size_t       i0, n, i, k, l, c, c1, c2, xorder;
+
+    for (i0 = 0; i0 < ncoord; i0 += SURFACE_FIT_BLOCK) {
+        n = MIN(SURFACE_FIT_BLOCK, ncoord - i0);
+
+        /* Build the rows of the design matrix of this block of
+           points, and their weighted copies, in the order of the
+           coefficients */
+        c = 0;
+        xorder = s->xorder;
+        for (l = 0; l < s->yorder; ++l) {
+            const double* const by = ybasis + l * ncoord + i0;
+            for (k = 0; k < xorder; ++k, ++c) {
+                const double* const bx = xbasis + k * ncoord + i0;
+                double* const ac = a + c * SURFACE_FIT_BLOCK;
+                double* const awc = aw + c * SURFACE_FIT_BLOCK;
+                for (i = 0; i < n; ++i) {
+                    ac[i] = bx[i] * by[i];
+                    awc[i] = w[i0 + i] * ac[i];
+                }
+            }
+
+            switch (s->xterms) {
+            case xterms_none:
+                xorder = 1;
+                break;
+            case xterms_half:
+                if ((int) (l + s->xorder + 2) > maxorder) {
+                    --xorder;
+                }
+                break;
+            default:
+                break;
+            }
+        }
+        assert(c == ncoeff);
+
+        if (z != NULL) {
+            for (c1 = 0; c1 < ncoeff; ++c1) {
+                vector[c1] += vector_dot_product(
+                        n, aw + c1 * SURFACE_FIT_BLOCK, z + i0);
+            }
+        }
+
+        if (matrix == NULL) {
+            continue;
+        }
+
+        /* The upper triangle of the matrix, whose element (c1, c2) is
+           stored at c1 * ncoeff + (c2 - c1).  Four columns are
+           updated together, so that each weighted row is loaded once
+           for all of them. */
+        for (c1 = 0; c1 < ncoeff; ++c1) {
+            const double* const awc = aw + c1 * SURFACE_FIT_BLOCK;
+            double* const row = matrix + c1 * ncoeff - c1;
+
+            for (c2 = c1; c2 + 4 <= ncoeff; c2 += 4) {
+                const double* const a0 = a + c2 * SURFACE_FIT_BLOCK;
+                const double* const a1 = a0 + SURFACE_FIT_BLOCK;
+                const double* const a2 = a1 + SURFACE_FIT_BLOCK;
+                const double* const a3 = a2 + SURFACE_FIT_BLOCK;
+                double s0 = 0.0, s1 = 0.0, s2 = 0.0, s3 = 0.0;
+
+                for (i = 0; i < n; ++i) {
+                    const double v = awc[i];
+                    s0 += v * a0[i];
+                    s1 += v * a1[i];
+                    s2 += v * a2[i];
+                    s3 += v * a3[i];
+                }
+                row[c2] += s0;
+                row[c2 + 1] += s1;
+                row[c2 + 2] += s2;
+                row[c2 + 3] += s3;
+            }
+
+            for (; c2 < ncoeff; ++c2) {
+                row[c2] += vector_dot_product(
+                        n, awc, a + c2 * SURFACE_FIT_BLOCK);
+            }
+        }
+    }
+}
+
+/* Accumulate the points into matrix (if not NULL) and vector, as
+   surface_fit_accumulate does, evaluating their basis functions a
+   block at a time */
+static int
+surface_fit_accumulate_points(
+        const surface_t* const s,
+        const size_t ncoord,
+        const coord_t* const coord,
+        const double* const z,
+        const double* const w,
+        double* const matrix,
+        double* const vector,
+        stimage_error_t* const error) {
+
+    workspace_t workspace;
+    double*     xbasis;
+    double*     ybasis;
+    double*     design;
+    size_t      i, n;
+    int         status = 1;
+
+    workspace_new(&workspace);
+
+    if (workspace_reserve(
+                &workspace,
+                SURFACE_FIT_BLOCK * (s->xorder + s->yorder + 2 * s->ncoeff),
+                error)) goto exit;
+    xbasis = workspace_alloc(&workspace, SURFACE_FIT_BLOCK * s->xorder);
+    ybasis = workspace_alloc(&workspace, SURFACE_FIT_BLOCK * s->yorder);
+    design = workspace_alloc(&workspace, 2 * SURFACE_FIT_BLOCK * s->ncoeff);
+
+    for (i = 0; i < ncoord; i += SURFACE_FIT_BLOCK) {
+        n = MIN(SURFACE_FIT_BLOCK, ncoord - i);
+        if (surface_fit_compute_basis(
+                    s, n, coord + i, xbasis, ybasis, error)) goto exit;
+        surface_fit_accumulate(
+                s, n, xbasis, ybasis, z + i, w + i, matrix, vector, design);
+    }
+
+    status = 0;
+
+ exit:
+
+    workspace_free(&workspace);
+
+    return status;
+}
+
+/* More points than this are split into chunks, whose partial sums
+   are accumulated separately, possibly by different threads, and then
+   added together in order.  The chunks only depend on the number of
+   points, so neither does the result. */
+#define SURFACE_FIT_CHUNK (64 * SURFACE_FIT_BLOCK)
+
+/* The most chunks the points are split into, which bounds the memory
+   taken by the partial sums */
+#define SURFACE_FIT_MAX_CHUNKS 64
+
+typedef struct {
+    const surface_t* s;
+    size_t           ncoord;
+    const coord_t*   coord;
+    const double*    z;
+    const double*    w;
+    size_t           chunk;    /* points per chunk */
+    size_t           nmatrix;  /* 0 when only the vector is accumulated */
+    double*          partial;  /* [nchunks * (nmatrix + ncoeff)] */
+} surface_fit_chunks_t;
+
+static int
+surface_fit_chunk_task(
+        void* data,
+        size_t index,
+        stimage_error_t* error) {
+
+    const surface_fit_chunks_t* const c = (surface_fit_chunks_t*)data;
+    const size_t start  = index * c->chunk;
+    const size_t n      = MIN(c->chunk, c->ncoord - start);
+    double* const part  = c->partial + index * (c->nmatrix + c->s->ncoeff);
+
+    return surface_fit_accumulate_points(
+            c->s, n, c->coord + start, c->z + start, c->w + start,
+            c->nmatrix ? part + c->s->ncoeff : NULL, part, error);
+}
+
+/* Accumulate the points into matrix (if not NULL) and vector, over
+   nthreads threads */
 static int
+surface_fit_accumulate_chunks(
+        const surface_t* const s,
+        const size_t ncoord,
+        const coord_t* const coord,
+        const double* const z,
+        const double* const w,
+        const size_t nthreads,
+        double* const matrix,
+        double* const vector,
+        stimage_error_t* const error) {
+
+    surface_fit_chunks_t chunks;
+    size_t               nchunks, stride, i, j;
+    const double*        part;
+
+    nchunks = MIN(SURFACE_FIT_MAX_CHUNKS,
+                  (ncoord + SURFACE_FIT_CHUNK - 1) / SURFACE_FIT_CHUNK);
+    if (nchunks <= 1) {
+        return surface_fit_accumulate_points(
+                s, ncoord, coord, z, w, matrix, vector, error);
+    }
+
+    chunks.s = s;
+    chunks.ncoord = ncoord;
+    chunks.coord = coord;
+    chunks.z = z;
+    chunks.w = w;
+    chunks.chunk = (ncoord + nchunks - 1) / nchunks;
+    chunks.chunk = SURFACE_FIT_BLOCK *
+        ((chunks.chunk + SURFACE_FIT_BLOCK - 1) / SURFACE_FIT_BLOCK);
+    nchunks = (ncoord + chunks.chunk - 1) / chunks.chunk;
+    chunks.nmatrix = (matrix != NULL) ? s->ncoeff * s->ncoeff : 0;
+    stride = chunks.nmatrix + s->ncoeff;
+
+    chunks.partial = calloc_with_error(
+            nchunks * stride, sizeof(double), error);
+    if (chunks.partial == NULL) return 1;
+
+    if (parallel_for(
+                nchunks, nthreads, &surface_fit_chunk_task, &chunks, error)) {
+        free(chunks.partial);
+        return 1;
+    }
+
+    for (i = 0; i < nchunks; ++i) {
+        part = chunks.partial + i * stride;
+        for (j = 0; j < s->ncoeff; ++j) {
+            vector[j] += part[j];
+        }
+        for (j = 0; j < chunks.nmatrix; ++j) {
+            matrix[j] += part[s->ncoeff + j];
+        }
+    }
+
+    free(chunks.partial);
+
+    return 0;
+}
+
+/* was dgsacpts */
+int
 surface_fit_add_points(
         surface_t* const s,
         const size_t ncoord,
@@ -61,26 +368,10 @@ surface_fit_add_points(
         const double* const z,
         double* const w,
         const surface_fit_weight_e weight_type,
+        const size_t nthreads,
         stimage_error_t* const error) {
 
-    size_t i, j, k, l, ii, jj, ll;
-    double* byw = NULL;
-    double* bw = NULL;
-    double* xbasis = NULL;
-    double* ybasis = NULL;
-    double* vzp;
-    double* mzp;
-    double* bxp;
-    double* byp;
-    double* vindex;
-    double* mindex;
-    double* bbyp;
-    double* bbxp;
-    int xorder;
-    int xxorder;
-    int maxorder;
-    size_t ntimes;
-    int status = 1;
+    size_t i;
 
     assert(s);
     assert(coord);
@@ -122,145 +413,11 @@ surface_fit_add_points(
         break;
     }
 
-    xbasis = malloc_with_error(ncoord * s->xorder * sizeof(double), error);
-    if (xbasis == NULL) goto exit;
-    ybasis = malloc_with_error(ncoord * s->yorder * sizeof(double), error);
-    if (ybasis == NULL) goto exit;
-
-    /* Calculate the non-zero basis functions */
-    switch (s->type) {
-    case surface_type_polynomial:
-        if (basis_poly(
-                    ncoord, 0, coord, s->xorder, s->xmaxmin, s->xrange,
-                    xbasis, error)) goto exit;
-        if (basis_poly(
-                    ncoord, 1, coord, s->yorder, s->ymaxmin, s->yrange,
-                    ybasis, error)) goto exit;
-        break;
-    case surface_type_chebyshev:
-        if (basis_chebyshev(
-                    ncoord, 0, coord, s->xorder, s->xmaxmin, s->xrange,
-                    xbasis, error)) goto exit;
-        if (basis_chebyshev(
-                    ncoord, 1, coord, s->yorder, s->ymaxmin, s->yrange,
-                    ybasis, error)) goto exit;
-        break;
-    case surface_type_legendre:
-        if (basis_legendre(
-                    ncoord, 0, coord, s->xorder, s->xmaxmin, s->xrange,
-                    xbasis, error)) goto exit;
-        if (basis_legendre(
-                    ncoord, 1, coord, s->yorder, s->ymaxmin, s->yrange,
-                    ybasis, error)) goto exit;
-        break;
-    default:
-        stimage_error_set_message(error, "Illegal curve type");
-        goto exit;
-    }
-
-    /* Allocate temporary space for matrix accumulation */
-    byw = malloc_with_error(ncoord * sizeof(double), error);
-    if (byw == NULL) goto exit;
-    bw = malloc_with_error(ncoord * sizeof(double), error);
-    if (bw == NULL) goto exit;
-
-    vzp = s->vector - 1;
-    mzp = s->matrix;
-    bxp = xbasis;
-    byp = ybasis;
-
-    maxorder = MAX(s->xorder + 1, s->yorder + 1);
-    xorder = s->xorder;
-    ntimes = 0;
-    for (l = 1; l <= s->yorder; ++l) {
-        for (i = 0; i < ncoord; ++i) {
-            byw[i] = w[i] * byp[i];
-        }
-
-        bxp = xbasis;
-
-        for (k = 1; k <= xorder; ++k) {
-            for (i = 0; i < ncoord; ++i) {
-                bw[i] = byw[i] * bxp[i];
-            }
-
-            vindex = vzp + k;
-            assert(vindex - s->vector < s->ncoeff);
-            *vindex += vector_dot_product(ncoord, bw, z);
-            bbyp = byp;
-            bbxp = bxp;
-            xxorder = xorder;
-            jj = k;
-            ll = l;
-            ii = 0;
-            for (j = k + ntimes; j <= s->ncoeff; ++j) {
-                mindex = mzp + ii;
-                assert(mindex - s->matrix < s->ncoeff * s->ncoeff);
-                assert((bbxp - xbasis) + ncoord - 1 < ncoord * s->xorder);
-                assert((bbyp - ybasis) + ncoord - 1 < ncoord * s->yorder);
-                for (i = 0; i < ncoord; ++i) {
-                    *mindex += bw[i] * bbxp[i] * bbyp[i];
-                }
-                if (jj % xxorder == 0) {
-                    jj = 1;
-                    ++ll;
-                    bbxp = xbasis;
-                    bbyp += ncoord;
-                    switch (s->xterms) {
-                    case xterms_none:
-                        xxorder = 1;
-                        break;
-                    case xterms_half:
-                        if ((int) (ll + s->xorder) > maxorder) {
-                            --xxorder;
-                        }
-                        break;
-                    default:
-                        break;
-                    }
-                } else {
-                    ++jj;
-                    bbxp += ncoord;
-                }
-                ++ii;
-            }
-            mzp += s->ncoeff;
-            bxp += ncoord;
-        }
-
-        vzp += xorder;
-        ntimes += xorder;
-
-        switch (s->xterms) {
-        case xterms_none:
-            xorder = 1;
-            break;
-        case xterms_half:
-            if ((int) (l + s->xorder + 1) > maxorder) {
-                --xorder;
-            }
-            break;
-        default:
-            break;
-        }
-        byp += ncoord;
-    }
-
-    status = 0;
-
-    surface_print(s);
-
- exit:
-
-    free(byw);
-    free(bw);
-    free(xbasis);
-    free(ybasis);
-
-    return status;
+    return surface_fit_accumulate_chunks(
+            s, ncoord, coord, z, w, nthreads, s->matrix, s->vector, error);
 }
 
-static int
+int
 surface_fit_solve(
         surface_t* const s,
         /* Output  */
@@ -302,8 +459,6 @@ surface_fit_solve(
         return 1;
     }
 
-    surface_print(s);
-
     return 0;
 }
 
@@ -315,6 +470,7 @@ surface_fit(
         const double* const z,
         double* const w,
         const surface_fit_weight_e weight_type,
+        const size_t nthreads,
         /* Output */
         surface_fit_error_e* const error_type,
         stimage_error_t* const error) {
@@ -326,10 +482,239 @@ surface_fit(
     assert(error);
 
     if (surface_zero(s, error) ||
-        surface_fit_add_points(s, ncoord, coord, z, w, weight_type, error) ||
+        surface_fit_add_points(
+                s, ncoord, coord, z, w, weight_type, nthreads, error) ||
         surface_fit_solve(s, error_type, error)) {
         return 1;
     }
 
     return 0;
 }
+
+int
+surface_fit_add_vector(
+        const surface_t* const s,
+        const size_t ncoord,
+        const coord_t* const coord,
+        const double* const z,
+        const double* const w,
+        /* Input/Output */
+        double* const vector,
+        stimage_error_t* const error) {
+
+    assert(s);
+    assert(coord);
+    assert(z);
+    assert(w);
+    assert(vector);
+    assert(error);
+
+    return surface_fit_accumulate_chunks(
+            s, ncoord, coord, z, w, 1, NULL, vector, error);
+}
+
+int
+surface_fit_merge(
+        surface_t* const s,
+        const surface_t* const other,
+        stimage_error_t* const error) {
+
+    size_t i;
+
+    assert(s);
+    assert(other);
+    assert(error);
+    assert(s->matrix);
+    assert(s->vector);
+
+    if (other->type != s->type ||
+        other->xorder != s->xorder ||
+        other->yorder != s->yorder ||
+        other->xterms != s->xterms ||
+        other->xrange != s->xrange ||
+        other->xmaxmin != s->xmaxmin ||
+        other->yrange != s->yrange ||
+        other->ymaxmin != s->ymaxmin) {
+        stimage_error_set_message(
+                error, "Can not merge the normal equations of different surfaces");
+        return 1;
+    }
+
+    for (i = 0; i < s->ncoeff * s->ncoeff; ++i) {
+        s->matrix[i] += other->matrix[i];
+    }
+
+    for (i = 0; i < s->ncoeff; ++i) {
+        s->vector[i] += other->vector[i];
+    }
+
+    s->npoints += other->npoints;
+
+    return 0;
+}
+
+void
+surface_basis_new(
+        surface_basis_t* const b) {
+
+    assert(b);
+
+    b->ncoord = 0;
+    b->xorder = 0;
+    b->yorder = 0;
+    b->xbasis = NULL;
+    b->ybasis = NULL;
+}
+
+int
+surface_basis_init(
+        surface_basis_t* const b,
+        const surface_t* const s,
+        const size_t ncoord,
+        const coord_t* const coord,
+        stimage_error_t* const error) {
+
+    assert(b);
+    assert(s);
+    assert(coord);
+    assert(error);
+
+    surface_basis_free(b);
+
+    b->xbasis = malloc_with_error(ncoord * s->xorder * sizeof(double), error);
+    if (b->xbasis == NULL) goto fail;
+    b->ybasis = malloc_with_error(ncoord * s->yorder * sizeof(double), error);
+    if (b->ybasis == NULL) goto fail;
+
+    if (surface_fit_compute_basis(
+                s, ncoord, coord, b->xbasis, b->ybasis, error)) goto fail;
+
+    b->ncoord = ncoord;
+    b->xorder = s->xorder;
+    b->yorder = s->yorder;
+
+    return 0;
+
+ fail:
+    surface_basis_free(b);
+
+    return 1;
+}
+
+void
+surface_basis_free(
+        surface_basis_t* const b) {
+
+    assert(b);
+
+    free(b->xbasis);
+    free(b->ybasis);
+    surface_basis_new(b);
+}
+
+int
+surface_fit_reweight(
+        surface_t* const s,
+        const surface_basis_t* const basis,
+        const double* const z,
+        const double* const w_old,
+        const double* const w,
+        /* Output */
+        surface_fit_error_e* const error_type,
+        stimage_error_t* const error) {
+
+    const size_t ncoord  = basis->ncoord;
+    workspace_t  workspace;
+    double*      design  = NULL;
+    double*      xbasis  = NULL;
+    double*      ybasis  = NULL;
+    double*      dw      = NULL;
+    double       total   = 0.0;
+    double       changed = 0.0;
+    size_t       nchange = 0;
+    size_t       i, j, k;
+    int          status  = 1;
+
+    assert(s);
+    assert(basis);
+    assert(z);
+    assert(w_old);
+    assert(w);
+    assert(error_type);
+    assert(error);
+    assert(s->vector);
+    assert(s->matrix);
+    assert(basis->xorder == s->xorder && basis->yorder == s->yorder);
+
+    workspace_new(&workspace);
+
+    for (i = 0; i < ncoord; ++i) {
+        total += fabs(w_old[i]);
+        if (w[i] != w_old[i]) {
+            changed += fabs(w_old[i]);
+            ++nchange;
+        }
+    }
+
+    for (i = 0; i < s->ncoeff; ++i) {
+        s->vector[i] = 0.0;
+    }
+
+    if (workspace_reserve(
+                &workspace,
+                2 * SURFACE_FIT_BLOCK * s->ncoeff +
+                nchange * (s->xorder + s->yorder + 1),
+                error)) goto exit;
+    design = workspace_alloc(&workspace, 2 * SURFACE_FIT_BLOCK * s->ncoeff);
+
+    if (changed > 0.5 * total) {
+        /* Subtracting most of the matrix would lose too much
+           precision, so start again */
+        if (surface_zero(s, error)) goto exit;
+
+        surface_fit_accumulate(
+                s, ncoord, basis->xbasis, basis->ybasis, z, w, s->matrix,
+                s->vector, design);
+    } else {
+        if (nchange > 0) {
+            /* Gather the basis functions of the points whose weight
+               changed, and accumulate them with the change in
+               weight */
+            xbasis = workspace_alloc(&workspace, nchange * s->xorder);
+            ybasis = workspace_alloc(&workspace, nchange * s->yorder);
+            dw = workspace_alloc(&workspace, nchange);
+
+            for (i = 0, j = 0; i < ncoord; ++i) {
+                if (w[i] != w_old[i]) {
+                    for (k = 0; k < s->xorder; ++k) {
+                        xbasis[k * nchange + j] =
+                            basis->xbasis[k * ncoord + i];
+                    }
+                    for (k = 0; k < s->yorder; ++k) {
+                        ybasis[k * nchange + j] =
+                            basis->ybasis[k * ncoord + i];
+                    }
+                    dw[j++] = w[i] - w_old[i];
+                }
+            }
+
+            surface_fit_accumulate(
+                    s, nchange, xbasis, ybasis, NULL, dw, s->matrix,
+                    s->vector, design);
+        }
+
+        surface_fit_accumulate(
+                s, ncoord, basis->xbasis, basis->ybasis, z, w, NULL,
+                s->vector, design);
+    }
+
+    if (surface_fit_solve(s, error_type, error)) goto exit;
+
+    status = 0;
+
+ exit:
+
+    workspace_free(&workspace);
+
+    return status;
+}
@@ -30,15 +30,68 @@ DAMAGE.
 */
 
 #include <assert.h>
+#include <string.h>
 
+#include "lib/parallel.h"
 #include "lib/polynomial.h"
 #include "surface/vector.h"
 
+/* The number of points evaluated by each task of surface_vector */
+#define SURFACE_VECTOR_CHUNK 16384
+
+typedef struct {
+    const surface_t* s;
+    size_t           ncoord;
+    const coord_t*   ref;
+    double*          zfit;
+} surface_vector_chunks_t;
+
+static int
+surface_vector_task(
+        void* data,
+        size_t index,
+        stimage_error_t* error) {
+
+    const surface_vector_chunks_t* const c = (surface_vector_chunks_t*)data;
+    const size_t start = index * SURFACE_VECTOR_CHUNK;
+
+    return surface_vector_workspace(
+            c->s, MIN(SURFACE_VECTOR_CHUNK, c->ncoord - start),
+            c->ref + start, NULL, c->zfit + start, error);
+}
+
 int
 surface_vector(
         const surface_t* const s,
         const size_t ncoord,
         const coord_t* const ref,
+        const size_t nthreads,
+        /* Output */
+        double* const zfit,
+        stimage_error_t* const error) {
+
+    surface_vector_chunks_t chunks;
+
+    if (nthreads == 1 || ncoord <= SURFACE_VECTOR_CHUNK) {
+        return surface_vector_workspace(s, ncoord, ref, NULL, zfit, error);
+    }
+
+    chunks.s = s;
+    chunks.ncoord = ncoord;
+    chunks.ref = ref;
+    chunks.zfit = zfit;
+
+    return parallel_for(
+            (ncoord + SURFACE_VECTOR_CHUNK - 1) / SURFACE_VECTOR_CHUNK,
+            nthreads, &surface_vector_task, &chunks, error);
+}
+
+int
+surface_vector_workspace(
+        const surface_t* const s,
+        const size_t ncoord,
+        const coord_t* const ref,
+        workspace_t* const workspace,
         /* Output */
         double* const zfit,
         stimage_error_t* const error) {
@@ -54,17 +107,19 @@ surface_vector(
     case surface_type_polynomial:
         if (s->xorder == 1) {
             status = eval_1dpoly(
-                    s->yorder, s->coeff, ncoord, 1, ref, zfit, error);
+                    s->yorder, s->coeff, ncoord, 1, ref, workspace, zfit,
+                    error);
         } else if (s->yorder == 1) {
             status = eval_1dpoly(
-                    s->xorder, s->coeff, ncoord, 0, ref, zfit, error);
+                    s->xorder, s->coeff, ncoord, 0, ref, workspace, zfit,
+                    error);
         } else {
             status = eval_poly(
                     s->xorder, s->yorder, s->coeff,
                     ncoord, ref, s->xterms,
                     s->xmaxmin, s->xrange,
                     s->ymaxmin, s->yrange,
-                    zfit, error);
+                    workspace, zfit, error);
         }
         break;
 
@@ -72,18 +127,18 @@ surface_vector(
         if (s->xorder == 1) {
             status = eval_1dchebyshev(
                     s->yorder, s->coeff, ncoord, 1, ref,
-                    s->ymaxmin, s->yrange, zfit, error);
+                    s->ymaxmin, s->yrange, workspace, zfit, error);
         } else if (s->yorder == 1) {
             status = eval_1dchebyshev(
                     s->xorder, s->coeff, ncoord, 0, ref,
-                    s->xmaxmin, s->xrange, zfit, error);
+                    s->xmaxmin, s->xrange, workspace, zfit, error);
         } else {
             status = eval_chebyshev(
                     s->xorder, s->yorder, s->coeff,
                     ncoord, ref, s->xterms,
                     s->xmaxmin, s->xrange,
                     s->ymaxmin, s->yrange,
-                    zfit, error);
+                    workspace, zfit, error);
         }
         break;
 
@@ -91,18 +146,18 @@ surface_vector(
         if (s->xorder == 1) {
             status = eval_1dlegendre(
                     s->yorder, s->coeff, ncoord, 1, ref,
-                    s->ymaxmin, s->yrange, zfit, error);
+                    s->ymaxmin, s->yrange, workspace, zfit, error);
         } else if (s->yorder == 1) {
             status = eval_1dlegendre(
                     s->xorder, s->coeff, ncoord, 0, ref,
-                    s->xmaxmin, s->xrange, zfit, error);
+                    s->xmaxmin, s->xrange, workspace, zfit, error);
         } else {
             status = eval_legendre(
                     s->xorder, s->yorder, s->coeff,
                     ncoord, ref, s->xterms,
                     s->xmaxmin, s->xrange,
                     s->ymaxmin, s->yrange,
-                    zfit, error);
+                    workspace, zfit, error);
         }
         break;
 
@@ -113,3 +168,185 @@ surface_vector(
 
     return status;
 }
+
+/* Columns of the grid are evaluated this many at a time, so that their
+   basis functions stay in cache while they are combined for every
+   row */
+#define SURFACE_GRID_BLOCK 256
+
+/* Evaluate the basis functions of the given axis at n values */
+static int
+surface_grid_basis(
+        const surface_t* const s,
+        const size_t axis,
+        const size_t n,
+        const double* const v,
+        coord_t* const coord,
+        /* Output */
+        double* const basis,
+        stimage_error_t* const error) {
+
+    const int    order  = (int)(axis ? s->yorder : s->xorder);
+    const double maxmin = axis ? s->ymaxmin : s->xmaxmin;
+    const double range  = axis ? s->yrange : s->xrange;
+    size_t       i      = 0;
+
+    for (i = 0; i < n; ++i) {
+        coord[i].x = coord[i].y = v[i];
+    }
+
+    switch (s->type) {
+    case surface_type_polynomial:
+        return basis_poly(n, axis, coord, order, maxmin, range, basis, error);
+    case surface_type_chebyshev:
+        return basis_chebyshev(
+                n, axis, coord, order, maxmin, range, basis, error);
+    case surface_type_legendre:
+        return basis_legendre(
+                n, axis, coord, order, maxmin, range, basis, error);
+    default:
+        stimage_error_set_message(error, "Unknown surface function");
+        return 1;
+    }
+}
+
+/* Expand the coefficients into a dense [yorder][xorder] array, with
+   zeros for the terms that are not part of the surface */
+static void
+surface_grid_coeff(
+        const surface_t* const s,
+        /* Output */
+        double* const dense) {
+
+    const int xorder   = (int)s->xorder;
+    const int yorder   = (int)s->yorder;
+    const int maxorder = MAX(xorder + 1, yorder + 1);
+    int       xincr    = xorder;
+    int       cp       = 0;
+    int       j        = 0;
+    int       k        = 0;
+
+    memset(dense, 0, xorder * yorder * sizeof(double));
+
+    if (s->xterms != xterms_none) {
+        for (j = 1; j <= yorder; ++j) {
+            for (k = 0; k < xincr; ++k) {
+                dense[(j-1)*xorder + k] = s->coeff[cp+k];
+            }
+            cp += xincr;
+            if (s->xterms == xterms_half) {
+                if ((j + xorder + 1) > maxorder) {
+                    xincr -= 1;
+                }
+            }
+        }
+    } else {
+        for (k = 0; k < xorder; ++k) {
+            dense[k] = s->coeff[k];
+        }
+        for (k = 0; k < yorder - 1; ++k) {
+            dense[(k+1)*xorder] = s->coeff[xorder+k];
+        }
+    }
+}
+
+int
+surface_grid(
+        const surface_t* const s,
+        const size_t nx,
+        const double* const x,
+        const size_t ny,
+        const double* const y,
+        const int accumulate,
+        const size_t row_stride,
+        const size_t col_stride,
+        /* Output */
+        double* const zfit,
+        stimage_error_t* const error) {
+
+    const size_t  xorder = s->xorder;
+    const size_t  yorder = s->yorder;
+    double*       buffer = NULL;
+    double*       xbasis = NULL;
+    double*       ybasis = NULL;
+    double*       dense  = NULL;
+    double*       rowc   = NULL;
+    coord_t*      coord  = NULL;
+    const double* a      = NULL;
+    const double* xbp    = NULL;
+    double*       z      = NULL;
+    size_t        i      = 0;
+    size_t        j      = 0;
+    size_t        k      = 0;
+    size_t        start  = 0;
+    size_t        end    = 0;
+    double        sum    = 0.0;
+    int           status = 1;
+
+    assert(s);
+    assert(s->coeff);
+    assert(x);
+    assert(y);
+    assert(zfit);
+    assert(error);
+
+    if (nx == 0 || ny == 0) {
+        return 0;
+    }
+
+    buffer = malloc_with_error(
+            (xorder * nx + yorder * ny + xorder * yorder + xorder * ny) *
+            sizeof(double), error);
+    if (buffer == NULL) goto exit;
+    xbasis = buffer;
+    ybasis = xbasis + xorder * nx;
+    dense = ybasis + yorder * ny;
+    rowc = dense + xorder * yorder;
+
+    coord = malloc_with_error(MAX(nx, ny) * sizeof(coord_t), error);
+    if (coord == NULL) goto exit;
+
+    if (surface_grid_basis(s, 0, nx, x, coord, xbasis, error) ||
+        surface_grid_basis(s, 1, ny, y, coord, ybasis, error)) goto exit;
+
+    surface_grid_coeff(s, dense);
+
+    /* Reduce each row to a polynomial in x alone */
+    for (j = 0; j < ny; ++j) {
+        for (k = 0; k < xorder; ++k) {
+            sum = 0.0;
+            for (i = 0; i < yorder; ++i) {
+                sum += dense[i*xorder + k] * ybasis[i*ny + j];
+            }
+            rowc[j*xorder + k] = sum;
+        }
+    }
+
+    for (start = 0; start < nx; start += SURFACE_GRID_BLOCK) {
+        end = MIN(start + SURFACE_GRID_BLOCK, nx);
+        for (j = 0; j < ny; ++j) {
+            a = rowc + j * xorder;
+            z = zfit + j * row_stride;
+            for (i = start; i < end; ++i) {
+                sum = 0.0;
+                xbp = xbasis + i;
+                for (k = 0; k < xorder; ++k, xbp += nx) {
+                    sum += a[k] * *xbp;
+                }
+                if (accumulate) {
+                    z[i * col_stride] += sum;
+                } else {
+                    z[i * col_stride] = sum;
+                }
+            }
+        }
+    }
+
+    status = 0;
+
+ exit:
+    free(buffer);
+    free(coord);
+
+    return status;
+}
@@ -38,6 +38,7 @@ DAMAGE.
 
 #include "wrap_util.h"
 #include "immatch/geomap.h"
+#include "lib/parallel.h"
 #include <structmember.h>
 
 typedef struct {
@@ -54,8 +55,614 @@ typedef struct {
     PyArrayObject *ycoeff;
     PyArrayObject *x2coeff;
     PyArrayObject *y2coeff;
+    PyObject *transform;
 } geomap_object;
 
+typedef struct {
+    PyObject_HEAD
+    geomap_transform_t transform;
+} transform_object;
+
+typedef struct {
+    PyObject_HEAD
+    geomap_accumulator_t acc;
+    PyObject *args; /* the arguments to __init__, for pickling */
+} accumulator_object;
+
+/****************************************
+ GeomapTransform
+*/
+
+static PyTypeObject transform_class;
+
+static void
+transform_dealloc(transform_object* self)
+{
+    geomap_transform_free(&self->transform);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyObject *
+transform_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    transform_object *self;
+    self = (transform_object *)type->tp_alloc(type, 0);
+    if (self != NULL) {
+        geomap_transform_new(&self->transform);
+    }
+
+    return (PyObject *)self;
+}
+
+/* Converts a surface tuple, as returned by from_surface_t, to a surface */
+static int
+to_surface_t(
+        const char* const name,
+        PyObject* o,
+        surface_t* const s) {
+
+    char*           function_str = NULL;
+    char*           xterms_str   = NULL;
+    Py_ssize_t      xorder       = 0;
+    Py_ssize_t      yorder       = 0;
+    PyObject*       bbox_obj     = NULL;
+    PyObject*       coeff_obj    = NULL;
+    PyArrayObject*  coeff_array  = NULL;
+    surface_type_e  function     = surface_type_polynomial;
+    xterms_e        xterms       = xterms_none;
+    bbox_t          bbox;
+    double          xrange, xmaxmin, yrange, ymaxmin;
+    size_t          i            = 0;
+    stimage_error_t error;
+
+    stimage_error_init(&error);
+
+    if (!PyTuple_Check(o) ||
+        !PyArg_ParseTuple(
+                o, "snnsO(dddd)O", &function_str, &xorder, &yorder,
+                &xterms_str, &bbox_obj, &xrange, &xmaxmin, &yrange, &ymaxmin,
+                &coeff_obj)) {
+        PyErr_Format(
+                PyExc_ValueError,
+                "%s must be a (function, xorder, yorder, xterms, bbox, "
+                "(xrange, xmaxmin, yrange, ymaxmin), coeff) tuple",
+                name);
+        return -1;
+    }
+
+    bbox_init(&bbox);
+    if (to_surface_type_e("function", function_str, &function) ||
+        to_xterms_e("xterms", xterms_str, &xterms) ||
+        to_bbox_t("bbox", bbox_obj, &bbox)) {
+        return -1;
+    }
+
+    coeff_array = (PyArrayObject*)PyArray_ContiguousFromAny(
+            coeff_obj, NPY_DOUBLE, 1, 1);
+    if (coeff_array == NULL) {
+        return -1;
+    }
+
+    if (surface_init(
+                s, function, (int)xorder, (int)yorder, xterms, &bbox,
+                &error)) {
+        PyErr_Format(
+                PyExc_ValueError, "%s: %s", name,
+                stimage_error_get_message(&error));
+        Py_DECREF(coeff_array);
+        return -1;
+    }
+
+    if ((size_t)PyArray_DIM(coeff_array, 0) != s->ncoeff) {
+        PyErr_Format(
+                PyExc_ValueError,
+                "%s must have %lu coefficients",
+                name, (unsigned long)s->ncoeff);
+        Py_DECREF(coeff_array);
+        surface_free(s);
+        return -1;
+    }
+
+    s->xrange = xrange;
+    s->xmaxmin = xmaxmin;
+    s->yrange = yrange;
+    s->ymaxmin = ymaxmin;
+    for (i = 0; i < s->ncoeff; ++i) {
+        s->coeff[i] = ((double*)PyArray_DATA(coeff_array))[i];
+    }
+
+    Py_DECREF(coeff_array);
+
+    return 0;
+}
+
+static PyObject*
+from_surface_t(
+        const surface_t* const s) {
+
+    PyObject*      function = NULL;
+    PyObject*      xterms   = NULL;
+    PyArrayObject* bbox     = NULL;
+    PyArrayObject* coeff    = NULL;
+    PyObject*      result   = NULL;
+    npy_intp       dims[2]  = {2, 2};
+    double*        data     = NULL;
+    size_t         i        = 0;
+
+    if (from_surface_type_e(s->type, &function) ||
+        from_xterms_e(s->xterms, &xterms)) {
+        goto exit;
+    }
+
+    bbox = (PyArrayObject*)PyArray_SimpleNew(2, dims, NPY_DOUBLE);
+    if (bbox == NULL) goto exit;
+    data = (double*)PyArray_DATA(bbox);
+    data[0] = s->bbox.min.x;
+    data[1] = s->bbox.min.y;
+    data[2] = s->bbox.max.x;
+    data[3] = s->bbox.max.y;
+
+    dims[0] = (npy_intp)s->ncoeff;
+    coeff = (PyArrayObject*)PyArray_SimpleNew(1, dims, NPY_DOUBLE);
+    if (coeff == NULL) goto exit;
+    for (i = 0; i < s->ncoeff; ++i) {
+        ((double*)PyArray_DATA(coeff))[i] = s->coeff[i];
+    }
+
+    result = Py_BuildValue(
+            "OnnOO(dddd)O", function, (Py_ssize_t)s->xorder,
+            (Py_ssize_t)s->yorder, xterms, bbox, s->xrange, s->xmaxmin,
+            s->yrange, s->ymaxmin, coeff);
+
+ exit:
+    Py_XDECREF(function);
+    Py_XDECREF(xterms);
+    Py_XDECREF(bbox);
+    Py_XDECREF(coeff);
+
+    return result;
+}
+
+static int
+transform_init(transform_object *self, PyObject *args, PyObject *kwds)
+{
+    PyObject*          sx1_obj = NULL;
+    PyObject*          sy1_obj = NULL;
+    PyObject*          sx2_obj = Py_None;
+    PyObject*          sy2_obj = Py_None;
+    geomap_transform_t transform;
+
+    const char* keywords[] = {"sx1", "sy1", "sx2", "sy2", NULL};
+
+    if (self->transform.sx1.coeff != NULL) {
+        PyErr_SetString(
+                PyExc_RuntimeError, "GeomapTransform is already initialized");
+        return -1;
+    }
+
+    if (!PyArg_ParseTupleAndKeywords(
+                args, kwds, "OO|OO:GeomapTransform",
+                (char **)keywords,
+                &sx1_obj, &sy1_obj, &sx2_obj, &sy2_obj)) {
+        return -1;
+    }
+
+    geomap_transform_new(&transform);
+    transform.has_sx2 = (sx2_obj != Py_None);
+    transform.has_sy2 = (sy2_obj != Py_None);
+
+    if (to_surface_t("sx1", sx1_obj, &transform.sx1) ||
+        to_surface_t("sy1", sy1_obj, &transform.sy1) ||
+        (transform.has_sx2 &&
+         to_surface_t("sx2", sx2_obj, &transform.sx2)) ||
+        (transform.has_sy2 &&
+         to_surface_t("sy2", sy2_obj, &transform.sy2))) {
+        geomap_transform_free(&transform);
+        return -1;
+    }
+
+    self->transform = transform;
+
+    return 0;
+}
+
+static PyObject*
+transform_get_surfaces(transform_object* self, void* closure)
+{
+    const geomap_transform_t* t      = &self->transform;
+    PyObject*                 sx1    = NULL;
+    PyObject*                 sy1    = NULL;
+    PyObject*                 sx2    = NULL;
+    PyObject*                 sy2    = NULL;
+    PyObject*                 result = NULL;
+
+    if (t->sx1.coeff == NULL) {
+        PyErr_SetString(
+                PyExc_ValueError, "GeomapTransform is not initialized");
+        return NULL;
+    }
+
+    sx1 = from_surface_t(&t->sx1);
+    if (sx1 == NULL) goto exit;
+    sy1 = from_surface_t(&t->sy1);
+    if (sy1 == NULL) goto exit;
+    if (t->has_sx2) {
+        sx2 = from_surface_t(&t->sx2);
+        if (sx2 == NULL) goto exit;
+    } else {
+        Py_INCREF(Py_None);
+        sx2 = Py_None;
+    }
+    if (t->has_sy2) {
+        sy2 = from_surface_t(&t->sy2);
+        if (sy2 == NULL) goto exit;
+    } else {
+        Py_INCREF(Py_None);
+        sy2 = Py_None;
+    }
+
+    result = PyTuple_Pack(4, sx1, sy1, sx2, sy2);
+
+ exit:
+    Py_XDECREF(sx1);
+    Py_XDECREF(sy1);
+    Py_XDECREF(sx2);
+    Py_XDECREF(sy2);
+
+    return result;
+}
+
+static PyObject*
+transform_reduce(transform_object* self, PyObject* args)
+{
+    PyObject* surfaces = NULL;
+    PyObject* result   = NULL;
+
+    surfaces = transform_get_surfaces(self, NULL);
+    if (surfaces == NULL) {
+        return NULL;
+    }
+
+    result = Py_BuildValue("(OO)", (PyObject*)Py_TYPE(self), surfaces);
+    Py_DECREF(surfaces);
+
+    return result;
+}
+
+static PyObject*
+transform_transform(transform_object* self, PyObject* args, PyObject* kwds)
+{
+    PyObject*       xy_obj     = NULL;
+    PyObject*       out_obj    = Py_None;
+    int             distortion = 1;
+    Py_ssize_t      nthreads   = 1;
+    coord_arg_t     xy;
+    PyArrayObject*  out_array  = NULL;
+    npy_intp        dims[2];
+    int             status     = 0;
+    stimage_error_t error;
+
+    const char* keywords[] = {"xy", "out", "distortion", "nthreads", NULL};
+
+    stimage_error_init(&error);
+
+    if (!PyArg_ParseTupleAndKeywords(
+                args, kwds, "O|Oin:transform",
+                (char **)keywords,
+                &xy_obj, &out_obj, &distortion, &nthreads)) {
+        return NULL;
+    }
+
+    if (nthreads < 0) {
+        PyErr_SetString(PyExc_ValueError, "nthreads must be non-negative");
+        return NULL;
+    }
+
+    if (self->transform.sx1.coeff == NULL) {
+        PyErr_SetString(
+                PyExc_ValueError, "GeomapTransform is not initialized");
+        return NULL;
+    }
+
+    if (to_coord_arg("xy", xy_obj, &xy)) {
+        return NULL;
+    }
+
+    if (out_obj == Py_None) {
+        dims[0] = (npy_intp)xy.view.n;
+        dims[1] = 2;
+        out_array = (PyArrayObject*)PyArray_SimpleNew(2, dims, NPY_DOUBLE);
+        if (out_array == NULL) goto exit;
+    } else {
+        if (!PyArray_Check(out_obj) ||
+            PyArray_TYPE((PyArrayObject*)out_obj) != NPY_DOUBLE ||
+            PyArray_NDIM((PyArrayObject*)out_obj) != 2 ||
+            PyArray_DIM((PyArrayObject*)out_obj, 0) != (npy_intp)xy.view.n ||
+            PyArray_DIM((PyArrayObject*)out_obj, 1) != 2 ||
+            !PyArray_IS_C_CONTIGUOUS((PyArrayObject*)out_obj) ||
+            !PyArray_ISWRITEABLE((PyArrayObject*)out_obj)) {
+            PyErr_SetString(
+                    PyExc_ValueError,
+                    "out must be a writeable C-contiguous float64 array "
+                    "with a row for each coordinate in xy");
+            goto exit;
+        }
+        Py_INCREF(out_obj);
+        out_array = (PyArrayObject*)out_obj;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    status = geomap_transform_apply(
+            &self->transform, distortion, &xy.view, (size_t)nthreads,
+            (coord_t*)PyArray_DATA(out_array), &error);
+    Py_END_ALLOW_THREADS
+    if (status) {
+        PyErr_SetString(PyExc_RuntimeError, stimage_error_get_message(&error));
+        Py_CLEAR(out_array);
+    }
+
+ exit:
+    free_coord_arg(&xy);
+
+    return (PyObject*)out_array;
+}
+
+/* Converts the coordinates of the columns or rows of a grid */
+static int
+to_grid_axis(
+        const char* const name,
+        PyObject* o,
+        const npy_intp size,
+        PyArrayObject** const a) {
+
+    npy_intp dim = size;
+    npy_intp i   = 0;
+
+    if (o == Py_None) {
+        /* Pixel coordinates start at 1 */
+        *a = (PyArrayObject*)PyArray_SimpleNew(1, &dim, NPY_DOUBLE);
+        if (*a == NULL) {
+            return -1;
+        }
+        for (i = 0; i < size; ++i) {
+            ((double*)PyArray_DATA(*a))[i] = (double)(i + 1);
+        }
+        return 0;
+    }
+
+    *a = (PyArrayObject*)PyArray_ContiguousFromAny(o, NPY_DOUBLE, 1, 1);
+    if (*a == NULL) {
+        return -1;
+    }
+
+    if (size >= 0 && PyArray_DIM(*a, 0) != size) {
+        Py_CLEAR(*a);
+        PyErr_Format(
+                PyExc_ValueError, "%s does not match shape", name);
+        return -1;
+    }
+
+    return 0;
+}
+
+static PyObject*
+transform_evaluate_grid(transform_object* self, PyObject* args, PyObject* kwds)
+{
+    PyObject*       shape_obj  = Py_None;
+    PyObject*       x_obj      = Py_None;
+    PyObject*       y_obj      = Py_None;
+    PyObject*       out_obj    = Py_None;
+    int             distortion = 1;
+    Py_ssize_t      nthreads   = 1;
+    Py_ssize_t      nrows      = -1;
+    Py_ssize_t      ncols      = -1;
+    PyArrayObject*  x_array    = NULL;
+    PyArrayObject*  y_array    = NULL;
+    PyArrayObject*  out_array  = NULL;
+    npy_intp        dims[3];
+    npy_intp*       strides    = NULL;
+    int             status     = 0;
+    stimage_error_t error;
+
+    const char* keywords[] = {
+        "shape", "x", "y", "out", "distortion", "nthreads", NULL};
+
+    stimage_error_init(&error);
+
+    if (!PyArg_ParseTupleAndKeywords(
+                args, kwds, "|OOOOin:evaluate_grid",
+                (char **)keywords,
+                &shape_obj, &x_obj, &y_obj, &out_obj, &distortion,
+                &nthreads)) {
+        return NULL;
+    }
+
+    if (nthreads < 0) {
+        PyErr_SetString(PyExc_ValueError, "nthreads must be non-negative");
+        return NULL;
+    }
+
+    if (self->transform.sx1.coeff == NULL) {
+        PyErr_SetString(
+                PyExc_ValueError, "GeomapTransform is not initialized");
+        return NULL;
+    }
+
+    if (shape_obj != Py_None) {
+        if (!PyArg_ParseTuple(shape_obj, "nn", &nrows, &ncols)) {
+            return NULL;
+        }
+        if (nrows < 0 || ncols < 0) {
+            PyErr_SetString(PyExc_ValueError, "shape must be non-negative");
+            return NULL;
+        }
+    } else if (x_obj == Py_None || y_obj == Py_None) {
+        PyErr_SetString(
+                PyExc_ValueError, "Either shape or both x and y must be given");
+        return NULL;
+    }
+
+    if (to_grid_axis("x", x_obj, ncols, &x_array) ||
+        to_grid_axis("y", y_obj, nrows, &y_array)) {
+        goto exit;
+    }
+
+    dims[0] = PyArray_DIM(y_array, 0);
+    dims[1] = PyArray_DIM(x_array, 0);
+    dims[2] = 2;
+
+    if (out_obj == Py_None) {
+        out_array = (PyArrayObject*)PyArray_SimpleNew(3, dims, NPY_DOUBLE);
+        if (out_array == NULL) goto exit;
+    } else {
+        /* The rows of out may be strided, so that a tile of a larger
+           array can be filled in place */
+        if (!PyArray_Check(out_obj) ||
+            PyArray_TYPE((PyArrayObject*)out_obj) != NPY_DOUBLE ||
+            PyArray_NDIM((PyArrayObject*)out_obj) != 3 ||
+            PyArray_DIM((PyArrayObject*)out_obj, 0) != dims[0] ||
+            PyArray_DIM((PyArrayObject*)out_obj, 1) != dims[1] ||
+            PyArray_DIM((PyArrayObject*)out_obj, 2) != 2 ||
+            !PyArray_ISWRITEABLE((PyArrayObject*)out_obj) ||
+            !PyArray_ISALIGNED((PyArrayObject*)out_obj)) {
+            PyErr_SetString(
+                    PyExc_ValueError,
+                    "out must be a writeable float64 array of shape "
+                    "(ny, nx, 2)");
+            goto exit;
+        }
+        strides = PyArray_STRIDES((PyArrayObject*)out_obj);
+        if ((dims[1] > 1 && strides[1] != sizeof(coord_t)) ||
+            strides[2] != sizeof(double) ||
+            (dims[0] > 1 &&
+             (strides[0] < 0 || strides[0] % sizeof(coord_t) != 0))) {
+            PyErr_SetString(
+                    PyExc_ValueError,
+                    "out must have contiguous (x, y) pairs along each row");
+            goto exit;
+        }
+        Py_INCREF(out_obj);
+        out_array = (PyArrayObject*)out_obj;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    status = geomap_transform_grid(
+            &self->transform, distortion,
+            (size_t)dims[1], (double*)PyArray_DATA(x_array),
+            (size_t)dims[0], (double*)PyArray_DATA(y_array),
+            (size_t)(PyArray_STRIDE(out_array, 0) / sizeof(coord_t)),
+            (size_t)nthreads, (coord_t*)PyArray_DATA(out_array), &error);
+    Py_END_ALLOW_THREADS
+    if (status) {
+        PyErr_SetString(PyExc_RuntimeError, stimage_error_get_message(&error));
+        Py_CLEAR(out_array);
+    }
+
+ exit:
+    Py_XDECREF(x_array);
+    Py_XDECREF(y_array);
+
+    return (PyObject*)out_array;
+}
+
+static PyObject*
+transform_get_has_distortion(transform_object* self, void* closure)
+{
+    return PyBool_FromLong(
+            self->transform.has_sx2 || self->transform.has_sy2);
+}
+
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wmissing-field-initializers"
+#pragma clang diagnostic push
+#pragma clang diagnostic ignored "-Wcast-function-type-mismatch"
+static PyMethodDef transform_methods[] = {
+    {"transform", (PyCFunction)(void (*)(void))transform_transform,
+     METH_VARARGS | METH_KEYWORDS,
+     "transform(xy, out=None, distortion=True, nthreads=1)\n\n"
+     "Map an Nx2 array, or a tuple of x and y arrays, of reference\n"
+     "coordinates to input coordinates.\n"
+     "The result is written to *out* if given, which may be *xy* itself.\n"
+     "If *distortion* is False, only the linear part of the fit is\n"
+     "applied.  The coordinates are split between *nthreads* threads,\n"
+     "or one per processor if 0."},
+    {"evaluate_grid", (PyCFunction)(void (*)(void))transform_evaluate_grid,
+     METH_VARARGS | METH_KEYWORDS,
+     "evaluate_grid(shape=None, x=None, y=None, out=None, distortion=True,\n"
+     "              nthreads=1)\n\n"
+     "Map the grid of reference coordinates (x[i], y[j]) to input\n"
+     "coordinates, returning an array of shape (ny, nx, 2).  If *shape*\n"
+     "(ny, nx) is given, *x* and *y* default to the pixel coordinates\n"
+     "1..nx and 1..ny.  *out* may be a tile of a larger array, or a\n"
+     "memory-mapped array, as long as each row holds contiguous (x, y)\n"
+     "pairs.  The rows are split between *nthreads* threads, or one per\n"
+     "processor if 0."},
+    {"__reduce__", (PyCFunction)transform_reduce, METH_NOARGS,
+     "Support for pickling"},
+    {NULL}  /* Sentinel */
+};
+
+static PyGetSetDef transform_getset[] = {
+    {"surfaces", (getter)transform_get_surfaces, NULL,
+     "The (sx1, sy1, sx2, sy2) surfaces of the fit", NULL},
+    {"has_distortion", (getter)transform_get_has_distortion, NULL,
+     "True if the fit has a distortion part", NULL},
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject transform_class = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "stsci.stimage._stimage.GeomapTransform", /* tp_name */
+    sizeof(transform_object),  /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)transform_dealloc,/* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    0,                         /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,        /* tp_flags */
+    "GeomapTransform(sx1, sy1, sx2=None, sy2=None)\n\n"
+    "The transformation fit by geomap, from reference to input\n"
+    "coordinates.  sx1 and sy1 are the linear part of the x and y fits,\n"
+    "and sx2 and sy2 the distortion part, or None.  Each surface is a\n"
+    "(function, xorder, yorder, xterms, bbox,\n"
+    "(xrange, xmaxmin, yrange, ymaxmin), coeff) tuple, as returned by\n"
+    "the surfaces attribute.", /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    0,                         /* tp_iter */
+    0,                         /* tp_iternext */
+    transform_methods,         /* tp_methods */
+    0,                         /* tp_members */
+    transform_getset,          /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    (initproc)transform_init,  /* tp_init */
+    0,                         /* tp_alloc */
+    transform_new,             /* tp_new */
+};
+#pragma clang diagnostic pop
+#pragma GCC diagnostic pop
+
+/****************************************
+ GeomapResults
+*/
+
 static PyObject *
 geomap_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
 {
@@ -119,6 +726,9 @@ geomap_init(geomap_object *self, PyObject *args, PyObject *kwds)
     self->y2coeff = geomap_array_init();
     if (self->y2coeff == NULL) return -1;
 
+    Py_INCREF(Py_None);
+    self->transform = Py_None;
+
     return 0;
 }
 
@@ -137,6 +747,7 @@ geomap_dealloc(geomap_object *self)
     Py_XDECREF(self->ycoeff);
     Py_XDECREF(self->x2coeff);
     Py_XDECREF(self->y2coeff);
+    Py_XDECREF(self->transform);
     Py_TYPE(self)->tp_free((PyObject*)self);
 }
 
@@ -161,6 +772,7 @@ static PyMemberDef geomap_members[] = {
     {"ycoeff", T_OBJECT_EX, offsetof(geomap_object, ycoeff), 0, "ycoeff"},
     {"x2coeff", T_OBJECT_EX, offsetof(geomap_object, x2coeff), 0, "x2coeff"},
     {"y2coeff", T_OBJECT_EX, offsetof(geomap_object, y2coeff), 0, "y2coeff"},
+    {"transform", T_OBJECT_EX, offsetof(geomap_object, transform), 0, "transform"},
     {NULL}  /* Sentinel */
 };
 
@@ -207,114 +819,104 @@ static PyTypeObject geomap_class = {
 #pragma clang diagnostic pop
 #pragma GCC diagnostic pop
 
-PyObject*
-py_geomap(PyObject* self, PyObject* args, PyObject* kwds) {
-    PyObject* input_obj        = NULL;
-    PyObject* ref_obj          = NULL;
-    PyObject* bbox_obj         = NULL;
-    PyObject* fit_obj          = NULL;
-    char*     fit_geometry_str = NULL;
-    char*     surface_type_str = NULL;
-    size_t    xxorder          = 2;
-    size_t    xyorder          = 2;
-    size_t    yxorder          = 2;
-    size_t    yyorder          = 2;
-    char*     xxterms_str      = NULL;
-    char*     yxterms_str      = NULL;
-    size_t    maxiter          = 0;
-    double    reject           = 0.0;
-
-    size_t         ninput       = 0;
-    PyArrayObject* input_array  = NULL;
-    size_t         nref         = 0;
-    PyArrayObject* ref_array    = NULL;
+typedef struct {
     bbox_t         bbox;
-    geomap_fit_e   fit_geometry = geomap_fit_general;
-    surface_type_e surface_type = surface_type_polynomial;
-    xterms_e       xxterms      = xterms_half;
-    xterms_e       yxterms      = xterms_half;
+    geomap_fit_e   fit_geometry;
+    surface_type_e surface_type;
+    size_t         xxorder;
+    size_t         xyorder;
+    size_t         yxorder;
+    size_t         yyorder;
+    xterms_e       xxterms;
+    xterms_e       yxterms;
+    size_t         maxiter;
+    double           reject;
+    output_e         output;
+    size_t           nthreads;
+    stimage_stats_t* stats;
+} geomap_params_t;
 
-    geomap_result_t  fit;
-    PyObject*        tmp          = NULL;
-    PyArrayObject*   tmp_arr      = NULL;
-    npy_intp         dims         = 0;
-    size_t           i            = 0;
-    size_t           noutput      = 0;
-    geomap_output_t* output       = NULL;
-    PyObject*        dtype_list   = NULL;
-    PyArray_Descr*   dtype        = NULL;
-    PyObject*        result       = NULL;
-    PyArrayObject*   output_array = NULL;
-    stimage_error_t  error;
+typedef struct {
+    const geomap_params_t* params;
+    coord_arg_t*           coords;  /* [2 * npairs] */
+    size_t*                noutput; /* [npairs] */
+    geomap_output_t**      output;  /* [npairs] */
+    geomap_result_t*       fit;     /* [npairs] */
+} geomap_batch_t;
 
-    const char*    keywords[]    = {
-        "input", "ref", "bbox", "fit_geometry", "function",
-        "xxorder", "xyorder", "yxorder", "yyorder", "xxterms",
-        "yxterms", "maxiter", "reject", NULL
-    };
+static void
+geomap_params_init(
+        geomap_params_t* const p) {
 
-    bbox_init(&bbox);
-    geomap_result_init(&fit);
-    stimage_error_init(&error);
+    bbox_init(&p->bbox);
+    p->fit_geometry = geomap_fit_general;
+    p->surface_type = surface_type_polynomial;
+    p->xxorder = 2;
+    p->xyorder = 2;
+    p->yxorder = 2;
+    p->yyorder = 2;
+    p->xxterms = xterms_half;
+    p->yxterms = xterms_half;
+    p->maxiter = 0;
+    p->reject = 0.0;
+    p->output = output_full;
+    p->nthreads = 1;
+    p->stats = NULL;
+}
 
-    if (!PyArg_ParseTupleAndKeywords(
-                args, kwds, "OO|Ossnnnnssnd:geomap",
-                (char **)keywords,
-                &input_obj, &ref_obj, &bbox_obj, &fit_geometry_str,
-                &surface_type_str, &xxorder, &xyorder, &yxorder, &yyorder,
-                &xxterms_str, &yxterms_str, &maxiter, &reject)) {
-        return NULL;
-    }
+static int
+geomap_params_convert(
+        geomap_params_t* const p,
+        PyObject* bbox_obj,
+        const char* const fit_geometry_str,
+        const char* const surface_type_str,
+        const char* const xxterms_str,
+        const char* const yxterms_str,
+        const char* const output_str) {
 
-    input_array = (PyArrayObject*)PyArray_ContiguousFromAny(
-            input_obj, NPY_DOUBLE, 2, 2);
-    if (input_array == NULL) {
-        goto exit;
-    }
-    if (PyArray_DIM(input_array, 1) != 2) {
-        PyErr_SetString(PyExc_TypeError, "input array must be an Nx2 array");
-        goto exit;
-    }
+    return (to_bbox_t("bbox", bbox_obj, &p->bbox) ||
+            to_geomap_fit_e("fit_geometry", fit_geometry_str, &p->fit_geometry) ||
+            to_surface_type_e("surface_type", surface_type_str, &p->surface_type) ||
+            to_xterms_e("xxterms", xxterms_str, &p->xxterms) ||
+            to_xterms_e("yxterms", yxterms_str, &p->yxterms) ||
+            to_output_e("output", output_str, output_none, &p->output));
+}
 
-    ref_array = (PyArrayObject*)PyArray_ContiguousFromAny(
-            ref_obj, NPY_DOUBLE, 2, 2);
-    if (ref_array == NULL) {
-        goto exit;
-    }
-    if (PyArray_DIM(ref_array, 1) != 2) {
-        PyErr_SetString(PyExc_TypeError, "ref array must be an Nx2 array");
-        goto exit;
-    }
+static size_t
+geomap_output_size(
+        const coord_arg_t* const input,
+        const coord_arg_t* const ref) {
 
-    if (to_bbox_t("bbox", bbox_obj, &bbox) ||
-        to_geomap_fit_e("fit_geometry", fit_geometry_str, &fit_geometry) ||
-        to_surface_type_e("surface_type", surface_type_str, &surface_type) ||
-        to_xterms_e("xxterms", xxterms_str, &xxterms) ||
-        to_xterms_e("yxterms", yxterms_str, &yxterms)) {
-        goto exit;
-    }
+    return MAX(input->view.n, ref->view.n);
+}
 
-    ninput = PyArray_DIM(input_array, 0);
-    nref = PyArray_DIM(ref_array, 0);
-    noutput = MAX(ninput, nref);
-    output = malloc(noutput * sizeof(geomap_output_t));
-    if (output == NULL) {
-        result = PyErr_NoMemory();
-        goto exit;
-    }
+/* Must be callable without holding the GIL */
+static int
+geomap_run(
+        const geomap_params_t* const p,
+        const coord_arg_t* const input,
+        const coord_arg_t* const ref,
+        size_t* const noutput,
+        geomap_output_t* const output,
+        geomap_result_t* const fit,
+        stimage_error_t* const error) {
 
-    if (geomap(
-                ninput, (coord_t*)PyArray_DATA(input_array),
-                nref, (coord_t*)PyArray_DATA(ref_array),
-                &bbox, fit_geometry, surface_type,
-                xxorder, xyorder, yxorder, yyorder,
-                xxterms, yxterms,
-                maxiter, reject,
-                &noutput, output, &fit,
-                &error)) {
-        PyErr_SetString(PyExc_RuntimeError, stimage_error_get_message(&error));
-        goto exit;
-    }
+    return geomap_view(
+            &input->view, &ref->view,
+            &p->bbox, p->fit_geometry, p->surface_type,
+            p->xxorder, p->xyorder, p->yxorder, p->yyorder,
+            p->xxterms, p->yxterms,
+            p->maxiter, p->reject, p->nthreads,
+            noutput, output, fit,
+            p->stats, error);
+}
+
+/* Returns a new reference to the dtype of the geomap_output_t table */
+static PyArray_Descr*
+geomap_output_dtype(void) {
+
+    PyObject*      dtype_list = NULL;
+    PyArray_Descr* dtype      = NULL;
 
     dtype_list = Py_BuildValue(
             "[(ss)(ss)(ss)(ss)(ss)(ss)(ss)(ss)]",
@@ -327,21 +929,103 @@ py_geomap(PyObject* self, PyObject* args, PyObject* kwds) {
             "resid_x", "f8",
             "resid_y", "f8");
     if (dtype_list == NULL) {
-        goto exit;
+        return NULL;
     }
     if (!PyArray_DescrConverter(dtype_list, &dtype)) {
-        goto exit;
+        dtype = NULL;
     }
     Py_DECREF(dtype_list);
-    dims = (npy_intp)noutput;
-    output_array = (PyArrayObject *) PyArray_NewFromDescr(
-            &PyArray_Type, dtype, 1, &dims, NULL, output,
-            NPY_ARRAY_OWNDATA, NULL);
-    if (output_array == NULL) {
-        goto exit;
+
+    return dtype;
+}
+
+/* Checks that an out argument can hold the output of geomap for
+   noutput coordinates, and returns a pointer to its data */
+static geomap_output_t*
+geomap_output_from_out(
+        PyObject* out_obj,
+        const size_t noutput) {
+
+    PyArrayObject* out   = (PyArrayObject*)out_obj;
+    PyArray_Descr* dtype = NULL;
+    int            ok    = 0;
+
+    dtype = geomap_output_dtype();
+    if (dtype == NULL) {
+        return NULL;
+    }
+
+    ok = (PyArray_Check(out_obj) &&
+          PyArray_NDIM(out) == 1 &&
+          PyArray_DIM(out, 0) >= (npy_intp)noutput &&
+          PyArray_IS_C_CONTIGUOUS(out) &&
+          PyArray_ISWRITEABLE(out) &&
+          PyArray_ISALIGNED(out) &&
+          PyArray_EquivTypes(PyArray_DESCR(out), dtype));
+    Py_DECREF(dtype);
+
+    if (!ok) {
+        PyErr_Format(
+                PyExc_ValueError,
+                "out must be a writeable contiguous 1-D array with the "
+                "dtype of the geomap output and at least %lu elements",
+                (unsigned long)noutput);
+        return NULL;
     }
 
+    return (geomap_output_t*)PyArray_DATA(out);
+}
+
+/* Steals fit->transform on success.  The second item of the result
+   is out[:noutput] if out_obj is given, None if output is NULL, and
+   otherwise an array that steals output. */
+static PyObject*
+geomap_result(
+        geomap_result_t* const fit,
+        const size_t noutput,
+        geomap_output_t* output,
+        PyObject* out_obj) {
+
+    PyObject*      fit_obj      = NULL;
+    PyObject*      transform    = NULL;
+    PyObject*      tmp          = NULL;
+    PyArrayObject* tmp_arr      = NULL;
+    npy_intp       dims         = 0;
+    size_t         i            = 0;
+    PyArray_Descr* dtype        = NULL;
+    PyObject*      result       = NULL;
+    PyObject*      output_obj   = NULL;
+    PyArrayObject* output_array = NULL;
+
     fit_obj = geomap_new(&geomap_class, NULL, NULL);
+    if (fit_obj == NULL) {
+        goto exit;
+    }
+
+    if (out_obj != NULL) {
+        output_obj = PySequence_GetSlice(out_obj, 0, (Py_ssize_t)noutput);
+        if (output_obj == NULL) {
+            goto exit;
+        }
+    } else if (output == NULL) {
+        Py_INCREF(Py_None);
+        output_obj = Py_None;
+    } else {
+        dtype = geomap_output_dtype();
+        if (dtype == NULL) {
+            goto exit;
+        }
+
+        dims = (npy_intp)noutput;
+        output_array = (PyArrayObject *) PyArray_NewFromDescr(
+                &PyArray_Type, dtype, 1, &dims, NULL, output,
+                NPY_ARRAY_OWNDATA, NULL);
+        if (output_array == NULL) {
+            goto exit;
+        }
+        PyArray_ENABLEFLAGS(output_array, NPY_ARRAY_OWNDATA);
+        output_obj = (PyObject*)output_array;
+    }
 
     #define ADD_ATTR(func, member, name) \
         if ((func)((member), &tmp)) goto exit;      \
@@ -350,7 +1034,7 @@ py_geomap(PyObject* self, PyObject* args, PyObject* kwds) {
 
     #define ADD_ARR_ATTR(func, member, name) \
     if ((func)((member), &tmp_arr)) goto exit;      \
-    PyObject_SetAttrString(fit_obj, (name), tmp);       \
+    PyObject_SetAttrString(fit_obj, (name), (PyObject *) tmp_arr);       \
     Py_DECREF(tmp_arr);
 
     #define ADD_ARRAY(size, member, name) \
@@ -361,34 +1045,732 @@ py_geomap(PyObject* self, PyObject* args, PyObject* kwds) {
         PyObject_SetAttrString(fit_obj, (name), (PyObject *) tmp_arr); \
         Py_DECREF(tmp_arr);
 
-    ADD_ATTR(from_geomap_fit_e, fit.fit_geometry, "fit_geometry");
-    ADD_ATTR(from_surface_type_e, fit.function, "function");
-    ADD_ARR_ATTR(from_coord_t, &fit.rms, "rms");
-    ADD_ARR_ATTR(from_coord_t, &fit.mean_ref, "mean_ref");
-    ADD_ARR_ATTR(from_coord_t, &fit.mean_input, "mean_input");
-    ADD_ARR_ATTR(from_coord_t, &fit.shift, "shift");
-    ADD_ARR_ATTR(from_coord_t, &fit.mag, "mag");
-    ADD_ARR_ATTR(from_coord_t, &fit.rotation, "rotation");
-    ADD_ARRAY(fit.nxcoeff, fit.xcoeff, "xcoeff");
-    ADD_ARRAY(fit.nycoeff, fit.ycoeff, "ycoeff");
-    ADD_ARRAY(fit.nx2coeff, fit.x2coeff, "x2coeff");
-    ADD_ARRAY(fit.ny2coeff, fit.y2coeff, "y2coeff");
-
-    result = Py_BuildValue("OO", fit_obj, output_array);
+    ADD_ATTR(from_geomap_fit_e, fit->fit_geometry, "fit_geometry");
+    ADD_ATTR(from_surface_type_e, fit->function, "function");
+    ADD_ARR_ATTR(from_coord_t, &fit->rms, "rms");
+    ADD_ARR_ATTR(from_coord_t, &fit->mean_ref, "mean_ref");
+    ADD_ARR_ATTR(from_coord_t, &fit->mean_input, "mean_input");
+    ADD_ARR_ATTR(from_coord_t, &fit->shift, "shift");
+    ADD_ARR_ATTR(from_coord_t, &fit->mag, "mag");
+    ADD_ARR_ATTR(from_coord_t, &fit->rotation, "rotation");
+    ADD_ARRAY(fit->nxcoeff, fit->xcoeff, "xcoeff");
+    ADD_ARRAY(fit->nycoeff, fit->ycoeff, "ycoeff");
+    ADD_ARRAY(fit->nx2coeff, fit->x2coeff, "x2coeff");
+    ADD_ARRAY(fit->ny2coeff, fit->y2coeff, "y2coeff");
+
+    transform = transform_new(&transform_class, NULL, NULL);
+    if (transform == NULL) goto exit;
+    PyObject_SetAttrString(fit_obj, "transform", transform);
+
+    #undef ADD_ATTR
+    #undef ADD_ARR_ATTR
+    #undef ADD_ARRAY
+
+    result = Py_BuildValue("OO", fit_obj, output_obj);
+    if (result != NULL) {
+        ((transform_object*)transform)->transform = fit->transform;
+        geomap_transform_new(&fit->transform);
+    }
 
  exit:
-    Py_XDECREF(input_array);
-    Py_XDECREF(ref_array);
+    Py_XDECREF(transform);
+    Py_XDECREF(fit_obj);
+    if (output_array != NULL && result == NULL) {
+        /* Give the buffer back to the caller */
+        PyArray_CLEARFLAGS(output_array, NPY_ARRAY_OWNDATA);
+    }
+    Py_XDECREF(output_obj);
+
+    return result;
+}
+
+static int
+geomap_task(
+        void* data,
+        size_t index,
+        stimage_error_t* error) {
+
+    geomap_batch_t* batch = (geomap_batch_t*)data;
+    stimage_error_t pair_error;
+
+    stimage_error_init(&pair_error);
+
+    if (geomap_run(
+                batch->params,
+                &batch->coords[2*index], &batch->coords[2*index + 1],
+                &batch->noutput[index], batch->output[index],
+                &batch->fit[index], &pair_error)) {
+        stimage_error_format_message(
+                error, "pair %lu: %s", (unsigned long)index,
+                stimage_error_get_message(&pair_error));
+        return 1;
+    }
+
+    return 0;
+}
+
+PyObject*
+py_geomap(PyObject* self, PyObject* args, PyObject* kwds) {
+    PyObject* input_obj        = NULL;
+    PyObject* ref_obj          = NULL;
+    PyObject* bbox_obj         = NULL;
+    char*     fit_geometry_str = NULL;
+    char*     surface_type_str = NULL;
+    char*     xxterms_str      = NULL;
+    char*     yxterms_str      = NULL;
+    char*     output_str       = NULL;
+    PyObject* out_obj          = Py_None;
+    int       want_stats       = 0;
+
+    coord_arg_t     input;
+    coord_arg_t     ref;
+    geomap_params_t params;
+    stimage_stats_t stats;
+    PyObject*       stats_obj  = NULL;
+    PyObject*       tmp        = NULL;
+
+    geomap_result_t  fit;
+    size_t           noutput = 0;
+    geomap_output_t* output  = NULL;
+    PyObject*        result  = NULL;
+    int              status  = 0;
+    stimage_error_t  error;
+
+    const char*    keywords[]    = {
+        "input", "ref", "bbox", "fit_geometry", "function",
+        "xxorder", "xyorder", "yxorder", "yyorder", "xxterms",
+        "yxterms", "maxiter", "reject", "output", "out", "stats",
+        "nthreads", NULL
+    };
+
+    geomap_params_init(&params);
+    geomap_result_init(&fit);
+    stimage_stats_init(&stats);
+    stimage_error_init(&error);
+    input.owner = NULL;
+    ref.owner = NULL;
+
+    if (!PyArg_ParseTupleAndKeywords(
+                args, kwds, "OO|OssnnnnssndsOpn:geomap",
+                (char **)keywords,
+                &input_obj, &ref_obj, &bbox_obj, &fit_geometry_str,
+                &surface_type_str, &params.xxorder, &params.xyorder,
+                &params.yxorder, &params.yyorder, &xxterms_str, &yxterms_str,
+                &params.maxiter, &params.reject, &output_str, &out_obj,
+                &want_stats, &params.nthreads)) {
+        return NULL;
+    }
+
+    if (want_stats) {
+        params.stats = &stats;
+    }
+
+    if (to_coord_arg("input", input_obj, &input) ||
+        to_coord_arg("ref", ref_obj, &ref) ||
+        geomap_params_convert(
+                &params, bbox_obj, fit_geometry_str, surface_type_str,
+                xxterms_str, yxterms_str, output_str)) {
+        goto exit;
+    }
+
+    if (out_obj == Py_None) {
+        out_obj = NULL;
+    } else if (params.output == output_none) {
+        PyErr_SetString(
+                PyExc_ValueError, "out may not be given with output='none'");
+        goto exit;
+    }
+
+    noutput = geomap_output_size(&input, &ref);
+    if (out_obj != NULL) {
+        output = geomap_output_from_out(out_obj, noutput);
+        if (output == NULL) {
+            goto exit;
+        }
+    } else if (params.output == output_full) {
+        output = malloc(MAX(1, noutput) * sizeof(geomap_output_t));
+        if (output == NULL) {
+            result = PyErr_NoMemory();
+            goto exit;
+        }
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    status = geomap_run(
+            &params, &input, &ref, &noutput, output, &fit, &error);
+    Py_END_ALLOW_THREADS
+    if (status) {
+        PyErr_SetString(PyExc_RuntimeError, stimage_error_get_message(&error));
+        goto exit;
+    }
+
+    if (want_stats && from_stimage_stats_t(&stats, &stats_obj)) {
+        goto exit;
+    }
+
+    result = geomap_result(&fit, noutput, output, out_obj);
+
+    if (result != NULL && stats_obj != NULL) {
+        tmp = Py_BuildValue(
+                "OOO", PyTuple_GET_ITEM(result, 0), PyTuple_GET_ITEM(result, 1),
+                stats_obj);
+        Py_DECREF(result);
+        result = tmp;
+        /* The output is owned by the array just released */
+        output = NULL;
+    }
+
+ exit:
+    free_coord_arg(&input);
+    free_coord_arg(&ref);
     geomap_result_free(&fit);
-    if (result == NULL) {
-        Py_XDECREF(output_array);
+    Py_XDECREF(stats_obj);
+    if (result == NULL && out_obj == NULL) {
         free(output);
-        Py_XDECREF(fit_obj);
     }
 
     return result;
 }
 
+PyObject*
+py_geomap_many(PyObject* self, PyObject* args, PyObject* kwds) {
+    PyObject* pairs_obj        = NULL;
+    PyObject* bbox_obj         = NULL;
+    char*     fit_geometry_str = NULL;
+    char*     surface_type_str = NULL;
+    char*     xxterms_str      = NULL;
+    char*     yxterms_str      = NULL;
+    size_t    nthreads         = 0;
+    char*     output_str       = NULL;
+
+    size_t          npairs = 0;
+    coord_arg_t*    coords = NULL;
+    geomap_params_t params;
+    geomap_batch_t  batch;
+
+    PyObject*       result = NULL;
+    PyObject*       item   = NULL;
+    size_t          i      = 0;
+    int             status = 0;
+    stimage_error_t error;
+
+    const char*    keywords[]    = {
+        "pairs", "bbox", "fit_geometry", "function",
+        "xxorder", "xyorder", "yxorder", "yyorder", "xxterms",
+        "yxterms", "maxiter", "reject", "nthreads", "output", NULL
+    };
+
+    geomap_params_init(&params);
+    stimage_error_init(&error);
+    batch.noutput = NULL;
+    batch.output = NULL;
+    batch.fit = NULL;
+
+    if (!PyArg_ParseTupleAndKeywords(
+                args, kwds, "O|Ossnnnnssndns:geomap_many",
+                (char **)keywords,
+                &pairs_obj, &bbox_obj, &fit_geometry_str,
+                &surface_type_str, &params.xxorder, &params.xyorder,
+                &params.yxorder, &params.yyorder, &xxterms_str, &yxterms_str,
+                &params.maxiter, &params.reject, &nthreads, &output_str)) {
+        return NULL;
+    }
+
+    if (to_coord_arg_pairs("pairs", pairs_obj, &npairs, &coords) ||
+        geomap_params_convert(
+                &params, bbox_obj, fit_geometry_str, surface_type_str,
+                xxterms_str, yxterms_str, output_str)) {
+        goto exit;
+    }
+
+    batch.params = &params;
+    batch.coords = coords;
+    batch.noutput = calloc(MAX(1, npairs), sizeof(size_t));
+    batch.output = calloc(MAX(1, npairs), sizeof(geomap_output_t*));
+    batch.fit = calloc(MAX(1, npairs), sizeof(geomap_result_t));
+    if (batch.noutput == NULL || batch.output == NULL || batch.fit == NULL) {
+        PyErr_NoMemory();
+        goto exit;
+    }
+
+    for (i = 0; i < npairs; ++i) {
+        geomap_result_init(&batch.fit[i]);
+        batch.noutput[i] = geomap_output_size(&coords[2*i], &coords[2*i + 1]);
+        if (params.output == output_none) {
+            continue;
+        }
+        batch.output[i] = malloc(
+                MAX(1, batch.noutput[i]) * sizeof(geomap_output_t));
+        if (batch.output[i] == NULL) {
+            PyErr_NoMemory();
+            goto exit;
+        }
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    status = parallel_for(npairs, nthreads, geomap_task, &batch, &error);
+    Py_END_ALLOW_THREADS
+    if (status) {
+        PyErr_SetString(PyExc_RuntimeError, stimage_error_get_message(&error));
+        goto exit;
+    }
+
+    result = PyList_New(npairs);
+    if (result == NULL) {
+        goto exit;
+    }
+
+    for (i = 0; i < npairs; ++i) {
+        item = geomap_result(
+                &batch.fit[i], batch.noutput[i], batch.output[i], NULL);
+        if (item == NULL) {
+            Py_CLEAR(result);
+            goto exit;
+        }
+        batch.output[i] = NULL;
+        PyList_SET_ITEM(result, i, item);
+    }
+
+ exit:
+    free_coord_arg_pairs(npairs, coords);
+    if (batch.output != NULL) {
+        for (i = 0; i < npairs; ++i) {
+            free(batch.output[i]);
+        }
+    }
+    if (batch.fit != NULL) {
+        for (i = 0; i < npairs; ++i) {
+            geomap_result_free(&batch.fit[i]);
+        }
+    }
+    free(batch.output);
+    free(batch.noutput);
+    free(batch.fit);
+
+    return result;
+}
+
+/****************************************
+ GeomapAccumulator
+*/
+
+static PyTypeObject accumulator_class;
+
+static void
+accumulator_dealloc(accumulator_object* self)
+{
+    geomap_accumulator_free(&self->acc);
+    Py_XDECREF(self->args);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyObject *
+accumulator_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    accumulator_object *self;
+    self = (accumulator_object *)type->tp_alloc(type, 0);
+    if (self != NULL) {
+        self->args = NULL;
+        geomap_accumulator_new(&self->acc);
+    }
+
+    return (PyObject *)self;
+}
+
+static int
+accumulator_init(accumulator_object *self, PyObject *args, PyObject *kwds)
+{
+    PyObject*       bbox_obj         = NULL;
+    char*           fit_geometry_str = "general";
+    char*           surface_type_str = "polynomial";
+    char*           xxterms_str      = "half";
+    char*           yxterms_str      = "half";
+    geomap_params_t params;
+    stimage_error_t error;
+
+    const char* keywords[] = {
+        "bbox", "fit_geometry", "function", "xxorder", "xyorder",
+        "yxorder", "yyorder", "xxterms", "yxterms", NULL
+    };
+
+    geomap_params_init(&params);
+    stimage_error_init(&error);
+
+    if (self->args != NULL) {
+        PyErr_SetString(
+                PyExc_RuntimeError, "GeomapAccumulator is already initialized");
+        return -1;
+    }
+
+    if (!PyArg_ParseTupleAndKeywords(
+                args, kwds, "O|ssnnnnss:GeomapAccumulator",
+                (char **)keywords,
+                &bbox_obj, &fit_geometry_str, &surface_type_str,
+                &params.xxorder, &params.xyorder, &params.yxorder,
+                &params.yyorder, &xxterms_str, &yxterms_str)) {
+        return -1;
+    }
+
+    if (bbox_obj == Py_None) {
+        PyErr_SetString(PyExc_ValueError, "bbox must be given");
+        return -1;
+    }
+
+    if (geomap_params_convert(
+                &params, bbox_obj, fit_geometry_str, surface_type_str,
+                xxterms_str, yxterms_str, NULL)) {
+        return -1;
+    }
+
+    if (geomap_accumulator_init(
+                &self->acc, &params.bbox, params.fit_geometry,
+                params.surface_type, params.xxorder, params.xyorder,
+                params.yxorder, params.yyorder, params.xxterms,
+                params.yxterms, &error)) {
+        PyErr_SetString(PyExc_ValueError, stimage_error_get_message(&error));
+        return -1;
+    }
+
+    self->args = Py_BuildValue(
+            "((dddd)ssnnnnss)",
+            params.bbox.min.x, params.bbox.min.y,
+            params.bbox.max.x, params.bbox.max.y,
+            fit_geometry_str, surface_type_str,
+            params.xxorder, params.xyorder, params.yxorder, params.yyorder,
+            xxterms_str, yxterms_str);
+    if (self->args == NULL) {
+        geomap_accumulator_free(&self->acc);
+        return -1;
+    }
+
+    return 0;
+}
+
+static int
+accumulator_check(accumulator_object* self)
+{
+    if (self->args == NULL) {
+        PyErr_SetString(
+                PyExc_RuntimeError, "GeomapAccumulator is not initialized");
+        return -1;
+    }
+
+    return 0;
+}
+
+static PyObject*
+accumulator_add(accumulator_object* self, PyObject* args, PyObject* kwds)
+{
+    PyObject*       input_obj   = NULL;
+    PyObject*       ref_obj     = NULL;
+    PyObject*       weights_obj = Py_None;
+    PyArrayObject*  weights     = NULL;
+    coord_arg_t     input;
+    coord_arg_t     ref;
+    PyObject*       result      = NULL;
+    int             status      = 0;
+    stimage_error_t error;
+
+    const char* keywords[] = {"input", "ref", "weights", NULL};
+
+    stimage_error_init(&error);
+    input.owner = NULL;
+    ref.owner = NULL;
+
+    if (!PyArg_ParseTupleAndKeywords(
+                args, kwds, "OO|O:add", (char **)keywords,
+                &input_obj, &ref_obj, &weights_obj)) {
+        return NULL;
+    }
+
+    if (accumulator_check(self) ||
+        to_coord_arg("input", input_obj, &input) ||
+        to_coord_arg("ref", ref_obj, &ref)) {
+        goto exit;
+    }
+
+    if (input.view.n != ref.view.n) {
+        PyErr_SetString(
+                PyExc_ValueError, "input and ref must be the same length");
+        goto exit;
+    }
+
+    if (weights_obj != Py_None) {
+        weights = (PyArrayObject*)PyArray_ContiguousFromAny(
+                weights_obj, NPY_DOUBLE, 1, 1);
+        if (weights == NULL) {
+            goto exit;
+        }
+        if ((size_t)PyArray_DIM(weights, 0) != input.view.n) {
+            PyErr_SetString(
+                    PyExc_ValueError,
+                    "weights must be the same length as input");
+            goto exit;
+        }
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    status = geomap_accumulator_add(
+            &self->acc, &input.view, &ref.view,
+            weights == NULL ? NULL : (double*)PyArray_DATA(weights), &error);
+    Py_END_ALLOW_THREADS
+    if (status) {
+        PyErr_SetString(PyExc_RuntimeError, stimage_error_get_message(&error));
+        goto exit;
+    }
+
+    Py_INCREF(Py_None);
+    result = Py_None;
+
+ exit:
+    free_coord_arg(&input);
+    free_coord_arg(&ref);
+    Py_XDECREF(weights);
+
+    return result;
+}
+
+static PyObject*
+accumulator_merge(accumulator_object* self, PyObject* args)
+{
+    accumulator_object* other = NULL;
+    stimage_error_t     error;
+
+    stimage_error_init(&error);
+
+    if (!PyArg_ParseTuple(args, "O!:merge", &accumulator_class, &other)) {
+        return NULL;
+    }
+
+    if (accumulator_check(self) || accumulator_check(other)) {
+        return NULL;
+    }
+
+    if (other == self) {
+        PyErr_SetString(
+                PyExc_ValueError, "Can not merge a GeomapAccumulator into itself");
+        return NULL;
+    }
+
+    if (geomap_accumulator_merge(&self->acc, &other->acc, &error)) {
+        PyErr_SetString(PyExc_ValueError, stimage_error_get_message(&error));
+        return NULL;
+    }
+
+    Py_RETURN_NONE;
+}
+
+static PyObject*
+accumulator_solve(accumulator_object* self, PyObject* args)
+{
+    geomap_result_t fit;
+    PyObject*       pair   = NULL;
+    PyObject*       result = NULL;
+    int             status = 0;
+    stimage_error_t error;
+
+    if (accumulator_check(self)) {
+        return NULL;
+    }
+
+    geomap_result_init(&fit);
+    stimage_error_init(&error);
+
+    Py_BEGIN_ALLOW_THREADS
+    status = geomap_accumulator_solve(&self->acc, &fit, &error);
+    Py_END_ALLOW_THREADS
+    if (status) {
+        PyErr_SetString(PyExc_RuntimeError, stimage_error_get_message(&error));
+        goto exit;
+    }
+
+    pair = geomap_result(&fit, 0, NULL, NULL);
+    if (pair == NULL) {
+        goto exit;
+    }
+
+    result = PyTuple_GET_ITEM(pair, 0);
+    Py_INCREF(result);
+
+ exit:
+    Py_XDECREF(pair);
+    geomap_result_free(&fit);
+
+    return result;
+}
+
+static PyObject*
+accumulator_get_ncoord(accumulator_object* self, void* closure)
+{
+    return PyLong_FromSize_t(self->acc.ncoord);
+}
+
+static PyObject*
+accumulator_reduce(accumulator_object* self, PyObject* args)
+{
+    PyArrayObject* state = NULL;
+    PyObject*      result = NULL;
+    npy_intp       dims   = 0;
+
+    if (accumulator_check(self)) {
+        return NULL;
+    }
+
+    dims = (npy_intp)geomap_accumulator_state_size(&self->acc);
+    state = (PyArrayObject*)PyArray_SimpleNew(1, &dims, NPY_DOUBLE);
+    if (state == NULL) {
+        return NULL;
+    }
+    geomap_accumulator_get_state(&self->acc, (double*)PyArray_DATA(state));
+
+    result = Py_BuildValue(
+            "(OOO)", (PyObject*)Py_TYPE(self), self->args, (PyObject*)state);
+    Py_DECREF(state);
+
+    return result;
+}
+
+static PyObject*
+accumulator_setstate(accumulator_object* self, PyObject* args)
+{
+    PyObject*      state_obj = NULL;
+    PyArrayObject* state     = NULL;
+
+    if (!PyArg_ParseTuple(args, "O:__setstate__", &state_obj)) {
+        return NULL;
+    }
+
+    if (accumulator_check(self)) {
+        return NULL;
+    }
+
+    state = (PyArrayObject*)PyArray_ContiguousFromAny(
+            state_obj, NPY_DOUBLE, 1, 1);
+    if (state == NULL) {
+        return NULL;
+    }
+
+    if ((size_t)PyArray_DIM(state, 0) !=
+        geomap_accumulator_state_size(&self->acc)) {
+        PyErr_SetString(
+                PyExc_ValueError,
+                "state does not match the parameters of the GeomapAccumulator");
+        Py_DECREF(state);
+        return NULL;
+    }
+
+    geomap_accumulator_set_state(&self->acc, (double*)PyArray_DATA(state));
+    Py_DECREF(state);
+
+    Py_RETURN_NONE;
+}
+
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wmissing-field-initializers"
+#pragma clang diagnostic push
+#pragma clang diagnostic ignored "-Wcast-function-type-mismatch"
+static PyMethodDef accumulator_methods[] = {
+    {"add", (PyCFunction)(void (*)(void))accumulator_add,
+     METH_VARARGS | METH_KEYWORDS,
+     "add(input, ref, weights=None)\n\n"
+     "Add a chunk of matched input and reference coordinates to the fit."},
+    {"merge", (PyCFunction)accumulator_merge, METH_VARARGS,
+     "merge(other)\n\n"
+     "Add the coordinates accumulated by another GeomapAccumulator with\n"
+     "the same parameters."},
+    {"solve", (PyCFunction)accumulator_solve, METH_NOARGS,
+     "solve()\n\n"
+     "Return the fit of all of the coordinates added so far, as a\n"
+     "GeomapResults object."},
+    {"__reduce__", (PyCFunction)accumulator_reduce, METH_NOARGS,
+     "Support for pickling"},
+    {"__setstate__", (PyCFunction)accumulator_setstate, METH_VARARGS,
+     "Support for pickling"},
+    {NULL}  /* Sentinel */
+};
+
+static PyGetSetDef accumulator_getset[] = {
+    {"ncoord", (getter)accumulator_get_ncoord, NULL,
+     "The number of coordinates added so far", NULL},
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject accumulator_class = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "stsci.stimage._stimage.GeomapAccumulator", /* tp_name */
+    sizeof(accumulator_object), /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)accumulator_dealloc,/* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    0,                         /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /* tp_flags */
+    "GeomapAccumulator(bbox, fit_geometry='general', function='polynomial',\n"
+    "                  xxorder=2, xyorder=2, yxorder=2, yyorder=2,\n"
+    "                  xxterms='half', yxterms='half')\n\n"
+    "The partial sums of a geomap fit, accumulated from chunks of\n"
+    "coordinates.", /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    0,                         /* tp_iter */
+    0,                         /* tp_iternext */
+    accumulator_methods,       /* tp_methods */
+    0,                         /* tp_members */
+    accumulator_getset,        /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    (initproc)accumulator_init,/* tp_init */
+    0,                         /* tp_alloc */
+    accumulator_new,           /* tp_new */
+};
+#pragma clang diagnostic pop
+#pragma GCC diagnostic pop
+
+int
+py_geomap_init_type(PyObject* m) {
+    if (PyType_Ready(&geomap_class) < 0 ||
+        PyType_Ready(&transform_class) < 0 ||
+        PyType_Ready(&accumulator_class) < 0) {
+        return -1;
+    }
+
+    Py_INCREF(&transform_class);
+    if (PyModule_AddObject(m, "GeomapTransform", (PyObject *)&transform_class)) {
+        Py_DECREF(&transform_class);
+        return -1;
+    }
+
+    Py_INCREF(&geomap_class);
+    if (PyModule_AddObject(m, "GeomapResults", (PyObject *)&geomap_class)) {
+        Py_DECREF(&geomap_class);
+        return -1;
+    }
+
+    Py_INCREF(&accumulator_class);
+    if (PyModule_AddObject(m, "GeomapAccumulator", (PyObject *)&accumulator_class)) {
+        Py_DECREF(&accumulator_class);
+        return -1;
+    }
+
+    return 0;
+}
+
 #if PY_MAJOR_VERSION >= 3
 
 static PyModuleDef geomap_module = {
@@ -38,100 +38,642 @@ DAMAGE.
 
 #include "wrap_util.h"
 #include "immatch/xyxymatch.h"
+#include "lib/parallel.h"
+#include <structmember.h>
 
-PyObject*
-py_xyxymatch(PyObject* self, PyObject* args, PyObject* kwds) {
-    PyObject* input_obj      = NULL;
-    PyObject* ref_obj        = NULL;
-    PyObject* origin_obj     = NULL;
-    PyObject* mag_obj        = NULL;
-    PyObject* rotation_obj   = NULL;
-    PyObject* ref_origin_obj = NULL;
-    char*     algorithm_str  = NULL;
-    double    tolerance      = 1.0;
-    double    separation     = 9.0;
-    size_t    nmatch         = 30;
-    double    maxratio       = 10.0;
-    size_t    nreject        = 10;
-
-    PyArrayObject*   input_array = NULL;
-    PyArrayObject*   ref_array   = NULL;
-    coord_t          origin      = {0.0, 0.0};
-    coord_t          mag         = {1.0, 1.0};
-    coord_t          rotation    = {0.0, 0.0};
-    coord_t          ref_origin  = {0.0, 0.0};
-    xyxymatch_algo_e algorithm   = xyxymatch_algo_tolerance;
-
-    PyObject*           result     = NULL;
-    PyArrayObject*      result_arr = NULL;
-    size_t              noutput    = 0;
-    xyxymatch_output_t* output     = NULL;
-    PyObject*           dtype_list = NULL;
-    PyArray_Descr*      dtype      = NULL;
-    npy_intp            dims;
-    stimage_error_t     error;
+typedef struct {
+    PyObject_HEAD
+    PyArrayObject*  ref;
+    xyxymatch_ref_t prepared;
+} catalog_object;
+
+typedef struct {
+    coord_t             origin;
+    coord_t             mag;
+    coord_t             rotation;
+    coord_t             ref_origin;
+    xyxymatch_algo_e    algorithm;
+    double              tolerance;
+    double              separation;
+    size_t              nmatch;
+    double              maxratio;
+    size_t              nreject;
+    xyxymatch_options_t options;
+    output_e            output;
+} xyxymatch_params_t;
+
+typedef struct {
+    const xyxymatch_params_t* params;
+    coord_arg_t*              coords;  /* [2 * npairs] */
+    catalog_object**          catalogs; /* [npairs] */
+    size_t*                   noutput; /* [npairs] */
+    xyxymatch_output_t**      output;  /* [npairs] */
+    xyxymatch_indices_t*      indices; /* [npairs] */
+} xyxymatch_batch_t;
+
+/****************************************
+ ReferenceCatalog
+*/
+
+static PyTypeObject catalog_class;
+
+static void
+catalog_dealloc(catalog_object* self)
+{
+    xyxymatch_ref_free(&self->prepared);
+    Py_XDECREF(self->ref);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyObject *
+catalog_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    catalog_object *self;
+    self = (catalog_object *)type->tp_alloc(type, 0);
+    if (self != NULL) {
+        self->ref = NULL;
+        xyxymatch_ref_new(&self->prepared);
+    }
+
+    return (PyObject *)self;
+}
+
+static int
+catalog_init(catalog_object *self, PyObject *args, PyObject *kwds)
+{
+    PyObject*       ref_obj           = NULL;
+    char*           triangle_mode_str = NULL;
+    PyArrayObject*  ref_array         = NULL;
+    double          separation        = 9.0;
+    double          tolerance         = 1.0;
+    Py_ssize_t      nmatch            = 30;
+    double          maxratio          = 10.0;
+    triangle_mode_e triangle_mode     = triangle_mode_all;
+    Py_ssize_t      k                 = 8;
+    xyxymatch_ref_t prepared;
+    int             status            = 0;
+    stimage_error_t error;
 
     const char* keywords[] = {
-        "input", "ref", "origin", "mag", "rotation", "ref_origin", "algorithm",
-        "tolerance", "separation", "nmatch", "maxratio", "nreject", NULL
+        "ref", "separation", "tolerance", "nmatch", "maxratio",
+        "triangle_mode", "k", NULL
     };
 
     stimage_error_init(&error);
+    xyxymatch_ref_new(&prepared);
+
+    if (self->ref != NULL) {
+        PyErr_SetString(
+                PyExc_RuntimeError, "ReferenceCatalog is already initialized");
+        return -1;
+    }
 
     if (!PyArg_ParseTupleAndKeywords(
-                args, kwds, "OO|OOOOsddndn:xyxymatch",
+                args, kwds, "O|ddndsn:ReferenceCatalog",
                 (char **)keywords,
-                &input_obj, &ref_obj, &origin_obj, &mag_obj, &rotation_obj,
-                &ref_origin_obj, &algorithm_str, &tolerance, &separation,
-                &nmatch, &maxratio, &nreject)) {
+                &ref_obj, &separation, &tolerance, &nmatch, &maxratio,
+                &triangle_mode_str, &k)) {
+        return -1;
+    }
+
+    if (nmatch < 0 || k < 0) {
+        PyErr_SetString(PyExc_ValueError, "nmatch and k must be non-negative");
+        return -1;
+    }
+
+    if (to_coord_array("ref", ref_obj, &ref_array) ||
+        to_triangle_mode_e("triangle_mode", triangle_mode_str, &triangle_mode)) {
+        Py_XDECREF(ref_array);
+        return -1;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    status = (
+        xyxymatch_ref_init(
+            &prepared, PyArray_DIM(ref_array, 0),
+            (coord_t*)PyArray_DATA(ref_array), separation, &error) ||
+        xyxymatch_ref_init_grid(&prepared, tolerance, &error) ||
+        xyxymatch_ref_init_triangles(
+            &prepared, (size_t)nmatch, tolerance, maxratio,
+            triangle_mode, (size_t)k, &error));
+    Py_END_ALLOW_THREADS
+    if (status) {
+        PyErr_SetString(PyExc_RuntimeError, stimage_error_get_message(&error));
+        xyxymatch_ref_free(&prepared);
+        Py_DECREF(ref_array);
+        return -1;
+    }
+
+    self->ref = ref_array;
+    self->prepared = prepared;
+
+    return 0;
+}
+
+static PyObject*
+catalog_serialize(catalog_object* self, PyObject* args)
+{
+    PyObject*       result = NULL;
+    size_t          size   = 0;
+    int             status = 0;
+    stimage_error_t error;
+
+    stimage_error_init(&error);
+
+    if (self->ref == NULL) {
+        PyErr_SetString(
+                PyExc_ValueError, "ReferenceCatalog is not initialized");
         return NULL;
     }
 
-    input_array = (PyArrayObject*)PyArray_ContiguousFromAny(
-            input_obj, NPY_DOUBLE, 2, 2);
-    if (input_array == NULL) {
-        goto exit;
+    size = xyxymatch_ref_serialized_size(&self->prepared);
+    result = PyBytes_FromStringAndSize(NULL, (Py_ssize_t)size);
+    if (result == NULL) {
+        return NULL;
     }
-    if (PyArray_DIM(input_array, 1) != 2) {
-        PyErr_SetString(PyExc_TypeError, "input array must be an Nx2 array");
-        goto exit;
+
+    Py_BEGIN_ALLOW_THREADS
+    status = xyxymatch_ref_serialize(
+            &self->prepared, size, PyBytes_AS_STRING(result), &error);
+    Py_END_ALLOW_THREADS
+    if (status) {
+        PyErr_SetString(PyExc_RuntimeError, stimage_error_get_message(&error));
+        Py_DECREF(result);
+        return NULL;
+    }
+
+    return result;
+}
+
+static PyObject*
+catalog_from_buffer(PyTypeObject* type, PyObject* args)
+{
+    PyObject*       buffer_obj = NULL;
+    Py_buffer       view;
+    catalog_object* self       = NULL;
+    PyArrayObject*  ref_array  = NULL;
+    npy_intp        dims[2];
+    int             status     = 0;
+    stimage_error_t error;
+
+    stimage_error_init(&error);
+
+    if (!PyArg_ParseTuple(args, "O:_from_buffer", &buffer_obj)) {
+        return NULL;
+    }
+
+    if (PyObject_GetBuffer(buffer_obj, &view, PyBUF_C_CONTIGUOUS)) {
+        return NULL;
+    }
+
+    self = (catalog_object*)catalog_new(type, NULL, NULL);
+    if (self == NULL) {
+        PyBuffer_Release(&view);
+        return NULL;
     }
 
-    ref_array = (PyArrayObject*)PyArray_ContiguousFromAny(
-            ref_obj, NPY_DOUBLE, 2, 2);
+    Py_BEGIN_ALLOW_THREADS
+    status = xyxymatch_ref_deserialize(
+            &self->prepared, (size_t)view.len, view.buf, &error);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&view);
+    if (status) {
+        PyErr_SetString(PyExc_ValueError, stimage_error_get_message(&error));
+        Py_DECREF(self);
+        return NULL;
+    }
+
+    /* The reference coordinates stay in the buffer, which is kept
+       alive as the base of the array */
+    dims[0] = (npy_intp)self->prepared.nref;
+    dims[1] = 2;
+    ref_array = (PyArrayObject*)PyArray_New(
+            &PyArray_Type, 2, dims, NPY_DOUBLE, NULL,
+            (void*)self->prepared.ref, 0,
+            NPY_ARRAY_C_CONTIGUOUS | NPY_ARRAY_ALIGNED, NULL);
     if (ref_array == NULL) {
-        goto exit;
+        Py_DECREF(self);
+        return NULL;
     }
-    if (PyArray_DIM(ref_array, 1) != 2) {
-        PyErr_SetString(PyExc_TypeError, "ref array must be an Nx2 array");
-        goto exit;
+
+    Py_INCREF(buffer_obj);
+    if (PyArray_SetBaseObject(ref_array, buffer_obj)) {
+        Py_DECREF(ref_array);
+        Py_DECREF(self);
+        return NULL;
     }
 
-    if (to_coord_t("origin", origin_obj, &origin) ||
-        to_coord_t("mag", mag_obj, &mag) ||
-        to_coord_t("rotation", rotation_obj, &rotation) ||
-        to_coord_t("ref_origin", ref_origin_obj, &ref_origin) ||
-        to_xyxymatch_algo_e("algorithm", algorithm_str, &algorithm)) {
-        goto exit;
+    self->ref = ref_array;
+
+    return (PyObject*)self;
+}
+
+static PyObject*
+catalog_get_ref(catalog_object* self, void* closure)
+{
+    if (self->ref == NULL) {
+        Py_RETURN_NONE;
     }
 
-    noutput = PyArray_DIM(input_array, 0);
-    output = malloc(noutput * sizeof(xyxymatch_output_t));
-    if (output == NULL) {
-        result = PyErr_NoMemory();
-        goto exit;
+    Py_INCREF(self->ref);
+    return (PyObject*)self->ref;
+}
+
+static PyObject*
+catalog_get_nref_unique(catalog_object* self, void* closure)
+{
+    return PyLong_FromSize_t(self->prepared.nref_unique);
+}
+
+static PyObject*
+catalog_get_triangle_mode(catalog_object* self, void* closure)
+{
+    return PyUnicode_FromString(
+            self->prepared.triangle_mode == triangle_mode_knn ? "knn" : "all");
+}
+
+static PyObject*
+catalog_get_ntriangles(catalog_object* self, void* closure)
+{
+    return PyLong_FromSize_t(self->prepared.triangles.ntriangles);
+}
+
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wmissing-field-initializers"
+#pragma clang diagnostic push
+#pragma clang diagnostic ignored "-Wcast-function-type-mismatch"
+static PyMethodDef catalog_methods[] = {
+    {"_serialize", (PyCFunction)catalog_serialize, METH_NOARGS,
+     "Return the prepared reference coordinates as bytes"},
+    {"_from_buffer", (PyCFunction)catalog_from_buffer, METH_VARARGS | METH_CLASS,
+     "Load prepared reference coordinates from a buffer"},
+    {NULL}  /* Sentinel */
+};
+
+static PyMemberDef catalog_members[] = {
+    {"separation", T_DOUBLE, offsetof(catalog_object, prepared.separation),
+     READONLY, "The minimum separation of the reference coordinates"},
+    {"tolerance", T_DOUBLE, offsetof(catalog_object, prepared.tolerance),
+     READONLY, "The tolerance the catalog was prepared for"},
+    {"nmatch", T_PYSSIZET, offsetof(catalog_object, prepared.nmatch),
+     READONLY, "The nmatch the reference triangles were built with"},
+    {"maxratio", T_DOUBLE, offsetof(catalog_object, prepared.maxratio),
+     READONLY, "The maxratio the reference triangles were built with"},
+    {"k", T_PYSSIZET, offsetof(catalog_object, prepared.k),
+     READONLY, "The k the reference triangles were built with"},
+    {NULL}  /* Sentinel */
+};
+
+static PyGetSetDef catalog_getset[] = {
+    {"ref", (getter)catalog_get_ref, NULL,
+     "The reference coordinates", NULL},
+    {"nref_unique", (getter)catalog_get_nref_unique, NULL,
+     "The number of reference coordinates left after culling", NULL},
+    {"triangle_mode", (getter)catalog_get_triangle_mode, NULL,
+     "The triangle_mode the reference triangles were built with", NULL},
+    {"ntriangles", (getter)catalog_get_ntriangles, NULL,
+     "The number of prepared reference triangles", NULL},
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject catalog_class = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "stsci.stimage._stimage.ReferenceCatalog", /* tp_name */
+    sizeof(catalog_object),    /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)catalog_dealloc,/* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    0,                         /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /* tp_flags */
+    "prepared reference coordinates for xyxymatch", /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    0,                         /* tp_iter */
+    0,                         /* tp_iternext */
+    catalog_methods,           /* tp_methods */
+    catalog_members,           /* tp_members */
+    catalog_getset,            /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    (initproc)catalog_init,    /* tp_init */
+    0,                         /* tp_alloc */
+    catalog_new,               /* tp_new */
+};
+#pragma clang diagnostic pop
+#pragma GCC diagnostic pop
+
+int
+py_xyxymatch_init_type(PyObject* m) {
+    if (PyType_Ready(&catalog_class) < 0) {
+        return -1;
     }
-    if (xyxymatch(
-                PyArray_DIM(input_array, 0), (coord_t*)PyArray_DATA(input_array),
-                PyArray_DIM(ref_array, 0), (coord_t*)PyArray_DATA(ref_array),
-                &noutput, output,
-                &origin, &mag, &rotation, &ref_origin,
-                algorithm, tolerance, separation, nmatch, maxratio, nreject,
-                &error)) {
-        PyErr_SetString(PyExc_RuntimeError, stimage_error_get_message(&error));
+
+    Py_INCREF(&catalog_class);
+    if (PyModule_AddObject(m, "ReferenceCatalog", (PyObject *)&catalog_class)) {
+        Py_DECREF(&catalog_class);
+        return -1;
+    }
+
+    return 0;
+}
+
+/* Converts a ref argument, which may be a ReferenceCatalog or a list
+   of coordinates.  A new reference is returned in either catalog or
+   a. */
+static int
+to_ref(
+        PyObject* o,
+        catalog_object** const catalog,
+        coord_arg_t* const a) {
+
+    *catalog = NULL;
+    a->owner = NULL;
+
+    if (PyObject_TypeCheck(o, &catalog_class)) {
+        if (((catalog_object*)o)->ref == NULL) {
+            PyErr_SetString(
+                    PyExc_ValueError, "ReferenceCatalog is not initialized");
+            return -1;
+        }
+        Py_INCREF(o);
+        *catalog = (catalog_object*)o;
+        return 0;
+    }
+
+    return to_coord_arg("ref", o, a);
+}
+
+static int
+xyxymatch_pairs_convert(
+        PyObject* o,
+        size_t* const npairs,
+        coord_arg_t** const coords,
+        catalog_object*** const catalogs) {
+
+    PyObject*  seq    = NULL;
+    PyObject*  pair   = NULL;
+    PyObject*  item   = NULL;
+    Py_ssize_t i      = 0;
+    int        status = -1;
+
+    *npairs = 0;
+    *coords = NULL;
+    *catalogs = NULL;
+
+    seq = PySequence_Fast(o, "pairs must be a sequence");
+    if (seq == NULL) {
+        return -1;
+    }
+
+    *npairs = (size_t)PySequence_Fast_GET_SIZE(seq);
+    *coords = calloc(MAX(1, 2 * *npairs), sizeof(coord_arg_t));
+    *catalogs = calloc(MAX(1, *npairs), sizeof(catalog_object*));
+    if (*coords == NULL || *catalogs == NULL) {
+        PyErr_NoMemory();
         goto exit;
     }
 
+    for (i = 0; i < (Py_ssize_t)*npairs; ++i) {
+        pair = PySequence_Fast_GET_ITEM(seq, i);
+        if (!PySequence_Check(pair) || PySequence_Size(pair) != 2) {
+            PyErr_SetString(
+                    PyExc_ValueError,
+                    "pairs must be a sequence of (input, ref) pairs");
+            goto exit;
+        }
+
+        item = PySequence_GetItem(pair, 0);
+        if (item == NULL) goto exit;
+        if (to_coord_arg("input", item, &(*coords)[2*i])) {
+            Py_DECREF(item);
+            goto exit;
+        }
+        Py_DECREF(item);
+
+        item = PySequence_GetItem(pair, 1);
+        if (item == NULL) goto exit;
+        if (to_ref(item, &(*catalogs)[i], &(*coords)[2*i + 1])) {
+            Py_DECREF(item);
+            goto exit;
+        }
+        Py_DECREF(item);
+    }
+
+    status = 0;
+
+ exit:
+    Py_DECREF(seq);
+
+    return status;
+}
+
+static void
+free_catalogs(
+        const size_t n,
+        catalog_object** catalogs) {
+
+    size_t i;
+
+    if (catalogs == NULL) {
+        return;
+    }
+
+    for (i = 0; i < n; ++i) {
+        Py_XDECREF(catalogs[i]);
+    }
+    free(catalogs);
+}
+
+/****************************************
+ xyxymatch
+*/
+
+static void
+xyxymatch_params_init(
+        xyxymatch_params_t* const p) {
+
+    p->origin.x = p->origin.y = 0.0;
+    p->mag.x = p->mag.y = 1.0;
+    p->rotation.x = p->rotation.y = 0.0;
+    p->ref_origin.x = p->ref_origin.y = 0.0;
+    p->algorithm = xyxymatch_algo_tolerance;
+    p->tolerance = 1.0;
+    p->separation = 9.0;
+    p->nmatch = 30;
+    p->maxratio = 10.0;
+    p->nreject = 10;
+    xyxymatch_options_init(&p->options);
+    p->output = output_full;
+}
+
+/* The offsets algorithm checks these again itself, but invalid
+   arguments are the caller's error, not a failure of the match */
+static int
+check_offsets_params(
+        const xyxymatch_params_t* const p) {
+
+    const xyxymatch_options_t* const o = &p->options;
+
+    if (p->algorithm != xyxymatch_algo_offsets) {
+        return 0;
+    }
+
+    if (!(p->tolerance > 0.0) || !isfinite(p->tolerance)) {
+        PyErr_SetString(
+                PyExc_ValueError,
+                "The offsets algorithm requires a finite, positive tolerance");
+        return 1;
+    }
+
+    if (!(o->offsets_max_rotation >= 0.0) ||
+        !isfinite(o->offsets_max_rotation)) {
+        PyErr_SetString(
+                PyExc_ValueError,
+                "offsets_max_rotation must be finite and non-negative");
+        return 1;
+    }
+
+    if (o->offsets_max_rotation > 0.0 &&
+        (!(o->offsets_rotation_step > 0.0) ||
+         !isfinite(o->offsets_rotation_step))) {
+        PyErr_SetString(
+                PyExc_ValueError,
+                "offsets_rotation_step must be finite and positive");
+        return 1;
+    }
+
+    if (!(o->offsets_max_scale >= 0.0) || !(o->offsets_max_scale < 1.0)) {
+        PyErr_SetString(
+                PyExc_ValueError,
+                "offsets_max_scale must be non-negative and less than 1");
+        return 1;
+    }
+
+    if (o->offsets_max_scale > 0.0 &&
+        (!(o->offsets_scale_step > 0.0) ||
+         !isfinite(o->offsets_scale_step))) {
+        PyErr_SetString(
+                PyExc_ValueError,
+                "offsets_scale_step must be finite and positive");
+        return 1;
+    }
+
+    return 0;
+}
+
+static int
+xyxymatch_params_convert(
+        xyxymatch_params_t* const p,
+        PyObject* origin_obj,
+        PyObject* mag_obj,
+        PyObject* rotation_obj,
+        PyObject* ref_origin_obj,
+        const char* const algorithm_str,
+        const char* const index_str,
+        const char* const triangle_mode_str,
+        const char* const triangle_merge_str,
+        const char* const output_str) {
+
+    return (to_coord_t("origin", origin_obj, &p->origin) ||
+            to_coord_t("mag", mag_obj, &p->mag) ||
+            to_coord_t("rotation", rotation_obj, &p->rotation) ||
+            to_coord_t("ref_origin", ref_origin_obj, &p->ref_origin) ||
+            to_xyxymatch_algo_e("algorithm", algorithm_str, &p->algorithm) ||
+            to_xyxymatch_index_e("index", index_str, &p->options.index) ||
+            to_triangle_mode_e(
+                    "triangle_mode", triangle_mode_str,
+                    &p->options.triangle_mode) ||
+            to_triangle_merge_e(
+                    "triangle_merge", triangle_merge_str,
+                    &p->options.triangle_merge) ||
+            to_output_e("output", output_str, output_indices, &p->output) ||
+            check_offsets_params(p));
+}
+
+/* Must be callable without holding the GIL.  The matches are always
+   found as indices, in the growable indices, so that neither output
+   mode limits how many there may be.  If p->output is output_full,
+   they are then copied to a new array of records in *output. */
+static int
+xyxymatch_run(
+        const xyxymatch_params_t* const p,
+        const coord_arg_t* const input,
+        const coord_arg_t* const ref,
+        const catalog_object* const catalog,
+        size_t* const noutput,
+        xyxymatch_output_t** const output,
+        xyxymatch_indices_t* const indices,
+        stimage_error_t* const error) {
+
+    xyxymatch_output_t* entry = NULL;
+    size_t              i     = 0;
+    int                 status;
+
+    if (catalog != NULL) {
+        status = xyxymatch_prepared_indices(
+                &input->view, &catalog->prepared, indices,
+                &p->origin, &p->mag, &p->rotation, &p->ref_origin,
+                p->algorithm, p->tolerance, p->separation, p->nmatch,
+                p->maxratio, p->nreject,
+                &p->options, error);
+    } else {
+        status = xyxymatch_indices(
+                &input->view, &ref->view, indices,
+                &p->origin, &p->mag, &p->rotation, &p->ref_origin,
+                p->algorithm, p->tolerance, p->separation, p->nmatch,
+                p->maxratio, p->nreject,
+                &p->options, error);
+    }
+
+    if (status || p->output == output_indices) {
+        return status;
+    }
+
+    *noutput = indices->nmatches;
+    *output = malloc_with_error(
+            MAX(1, *noutput) * sizeof(xyxymatch_output_t), error);
+    if (*output == NULL) {
+        return 1;
+    }
+
+    for (i = 0; i < *noutput; ++i) {
+        entry = &(*output)[i];
+        entry->coord_idx = indices->coord_idx[i];
+        entry->ref_idx = indices->ref_idx[i];
+        entry->coord = coord_view_get(&input->view, entry->coord_idx);
+        entry->ref = (catalog != NULL) ?
+            catalog->prepared.ref[entry->ref_idx] :
+            coord_view_get(&ref->view, entry->ref_idx);
+    }
+
+    return 0;
+}
+
+/* Returns a new reference to the dtype of the xyxymatch_output_t
+   table */
+static PyArray_Descr*
+xyxymatch_output_dtype(void) {
+
+    PyObject*      dtype_list = NULL;
+    PyArray_Descr* dtype      = NULL;
+
     dtype_list = Py_BuildValue(
             "[(ss)(ss)(ss)(ss)(ss)(ss)]",
             "input_x", "f8",
@@ -141,24 +683,513 @@ py_xyxymatch(PyObject* self, PyObject* args, PyObject* kwds) {
             "ref_y", "f8",
             "ref_idx", SIZE_T_D);
     if (dtype_list == NULL) {
-        goto exit;
+        return NULL;
     }
     if (!PyArray_DescrConverter(dtype_list, &dtype)) {
-        goto exit;
+        dtype = NULL;
     }
     Py_DECREF(dtype_list);
+
+    return dtype;
+}
+
+/* Steals output on success */
+static PyObject*
+xyxymatch_result(
+        const size_t noutput,
+        xyxymatch_output_t* output) {
+
+    PyArrayObject* result_arr = NULL;
+    PyArray_Descr* dtype      = NULL;
+    npy_intp       dims;
+
+    dtype = xyxymatch_output_dtype();
+    if (dtype == NULL) {
+        return NULL;
+    }
     dims = (npy_intp)noutput;
     result_arr = (PyArrayObject *) PyArray_NewFromDescr(
             &PyArray_Type, dtype, 1, &dims, NULL, output, NPY_ARRAY_OWNDATA, NULL);
+    if (result_arr == NULL) {
+        return NULL;
+    }
     PyArray_ENABLEFLAGS(result_arr, NPY_ARRAY_OWNDATA);
-    result = Py_BuildValue("N", result_arr);
+
+    return (PyObject*)result_arr;
+}
+
+/* Returns a 1-D array that owns data, or NULL */
+static PyObject*
+index_array(
+        const size_t n,
+        size_t* data) {
+
+    PyArrayObject* a    = NULL;
+    npy_intp       dims = (npy_intp)n;
+
+    /* The same type as SIZE_T_D */
+    a = (PyArrayObject*)PyArray_NewFromDescr(
+            &PyArray_Type, PyArray_DescrFromType(NPY_UINTP), 1, &dims, NULL,
+            data, NPY_ARRAY_OWNDATA, NULL);
+    if (a == NULL) {
+        return NULL;
+    }
+    PyArray_ENABLEFLAGS(a, NPY_ARRAY_OWNDATA);
+
+    return (PyObject*)a;
+}
+
+/* Returns a tuple (input_idx, ref_idx).  Steals the memory of indices
+   on success. */
+static PyObject*
+xyxymatch_indices_result(
+        xyxymatch_indices_t* const indices) {
+
+    const size_t n         = indices->nmatches;
+    size_t*      shrunk    = NULL;
+    PyObject*    input_idx = NULL;
+    PyObject*    ref_idx   = NULL;
+
+    /* Make sure there is something to own, and drop the spare
+       capacity */
+    if (indices->capacity == 0) {
+        indices->coord_idx = malloc(sizeof(size_t));
+        indices->ref_idx = malloc(sizeof(size_t));
+        if (indices->coord_idx == NULL || indices->ref_idx == NULL) {
+            return PyErr_NoMemory();
+        }
+        indices->capacity = 1;
+    } else if (indices->capacity > MAX(1, n)) {
+        shrunk = realloc(indices->coord_idx, MAX(1, n) * sizeof(size_t));
+        if (shrunk != NULL) indices->coord_idx = shrunk;
+        shrunk = realloc(indices->ref_idx, MAX(1, n) * sizeof(size_t));
+        if (shrunk != NULL) indices->ref_idx = shrunk;
+    }
+
+    input_idx = index_array(n, indices->coord_idx);
+    if (input_idx == NULL) {
+        return NULL;
+    }
+    indices->coord_idx = NULL;
+
+    ref_idx = index_array(n, indices->ref_idx);
+    if (ref_idx == NULL) {
+        Py_DECREF(input_idx);
+        return NULL;
+    }
+    indices->ref_idx = NULL;
+
+    xyxymatch_indices_free(indices);
+
+    return Py_BuildValue("(NN)", input_idx, ref_idx);
+}
+
+static int
+xyxymatch_task(
+        void* data,
+        size_t index,
+        stimage_error_t* error) {
+
+    xyxymatch_batch_t* batch = (xyxymatch_batch_t*)data;
+    stimage_error_t    pair_error;
+
+    stimage_error_init(&pair_error);
+
+    if (xyxymatch_run(
+                batch->params,
+                &batch->coords[2*index], &batch->coords[2*index + 1],
+                batch->catalogs[index],
+                &batch->noutput[index], &batch->output[index],
+                &batch->indices[index], &pair_error)) {
+        stimage_error_format_message(
+                error, "pair %lu: %s", (unsigned long)index,
+                stimage_error_get_message(&pair_error));
+        return 1;
+    }
+
+    return 0;
+}
+
+PyObject*
+py_xyxymatch(PyObject* self, PyObject* args, PyObject* kwds) {
+    PyObject* input_obj         = NULL;
+    PyObject* ref_obj           = NULL;
+    PyObject* origin_obj        = NULL;
+    PyObject* mag_obj           = NULL;
+    PyObject* rotation_obj      = NULL;
+    PyObject* ref_origin_obj    = NULL;
+    char*     algorithm_str     = NULL;
+    char*     index_str         = NULL;
+    char*     triangle_mode_str = NULL;
+    char*     triangle_merge_str = NULL;
+    char*     output_str        = NULL;
+    int       want_stats        = 0;
+
+    coord_arg_t        input;
+    coord_arg_t        ref;
+    catalog_object*    catalog     = NULL;
+    xyxymatch_params_t params;
+    stimage_stats_t    stats;
+
+    PyObject*           result  = NULL;
+    PyObject*           stats_obj = NULL;
+    PyObject*           tmp     = NULL;
+    size_t              noutput = 0;
+    xyxymatch_output_t* output  = NULL;
+    xyxymatch_indices_t indices;
+    int                 status  = 0;
+    stimage_error_t     error;
+
+    const char* keywords[] = {
+        "input", "ref", "origin", "mag", "rotation", "ref_origin", "algorithm",
+        "tolerance", "separation", "nmatch", "maxratio", "nreject", "index",
+        "triangle_mode", "k", "output", "stats", "nthreads", "triangle_merge",
+        "offsets_max_rotation", "offsets_rotation_step", "offsets_max_scale",
+        "offsets_scale_step", "nmatch_start", NULL
+    };
+
+    stimage_error_init(&error);
+    xyxymatch_params_init(&params);
+    xyxymatch_indices_new(&indices);
+    stimage_stats_init(&stats);
+    input.owner = NULL;
+    ref.owner = NULL;
+
+    if (!PyArg_ParseTupleAndKeywords(
+                args, kwds, "OO|OOOOsddndnssnspnsddddn:xyxymatch",
+                (char **)keywords,
+                &input_obj, &ref_obj, &origin_obj, &mag_obj, &rotation_obj,
+                &ref_origin_obj, &algorithm_str, &params.tolerance,
+                &params.separation, &params.nmatch, &params.maxratio,
+                &params.nreject, &index_str, &triangle_mode_str,
+                &params.options.k, &output_str, &want_stats,
+                &params.options.nthreads, &triangle_merge_str,
+                &params.options.offsets_max_rotation,
+                &params.options.offsets_rotation_step,
+                &params.options.offsets_max_scale,
+                &params.options.offsets_scale_step,
+                &params.options.nmatch_start)) {
+        return NULL;
+    }
+
+    if (want_stats) {
+        params.options.stats = &stats;
+    }
+
+    if (to_coord_arg("input", input_obj, &input) ||
+        to_ref(ref_obj, &catalog, &ref) ||
+        xyxymatch_params_convert(
+                &params, origin_obj, mag_obj, rotation_obj, ref_origin_obj,
+                algorithm_str, index_str, triangle_mode_str,
+                triangle_merge_str, output_str)) {
+        goto exit;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    status = xyxymatch_run(
+            &params, &input, &ref, catalog, &noutput, &output, &indices,
+            &error);
+    Py_END_ALLOW_THREADS
+    if (status) {
+        PyErr_SetString(PyExc_RuntimeError, stimage_error_get_message(&error));
+        goto exit;
+    }
+
+    if (want_stats && from_stimage_stats_t(&stats, &stats_obj)) {
+        goto exit;
+    }
+
+    if (params.output == output_indices) {
+        result = xyxymatch_indices_result(&indices);
+    } else {
+        result = xyxymatch_result(noutput, output);
+    }
+
+    if (result != NULL && stats_obj != NULL) {
+        tmp = PyTuple_Pack(2, result, stats_obj);
+        Py_DECREF(result);
+        result = tmp;
+        /* The output is owned by the array just released */
+        output = NULL;
+    }
 
  exit:
-    Py_XDECREF(input_array);
-    Py_XDECREF(ref_array);
+    free_coord_arg(&input);
+    free_coord_arg(&ref);
+    Py_XDECREF(catalog);
+    Py_XDECREF(stats_obj);
+    xyxymatch_indices_free(&indices);
     if (result == NULL) {
         free(output);
     }
 
     return result;
 }
+
+PyObject*
+py_xyxymatch_many(PyObject* self, PyObject* args, PyObject* kwds) {
+    PyObject* pairs_obj         = NULL;
+    PyObject* origin_obj        = NULL;
+    PyObject* mag_obj           = NULL;
+    PyObject* rotation_obj      = NULL;
+    PyObject* ref_origin_obj    = NULL;
+    char*     algorithm_str     = NULL;
+    char*     index_str         = NULL;
+    char*     triangle_mode_str = NULL;
+    char*     triangle_merge_str = NULL;
+    size_t    nthreads          = 0;
+    char*     output_str        = NULL;
+
+    size_t             npairs   = 0;
+    coord_arg_t*       coords   = NULL;
+    catalog_object**   catalogs = NULL;
+    xyxymatch_params_t params;
+    xyxymatch_batch_t  batch;
+
+    PyObject*       result = NULL;
+    PyObject*       item   = NULL;
+    size_t          i      = 0;
+    int             status = 0;
+    stimage_error_t error;
+
+    const char* keywords[] = {
+        "pairs", "origin", "mag", "rotation", "ref_origin", "algorithm",
+        "tolerance", "separation", "nmatch", "maxratio", "nreject", "index",
+        "triangle_mode", "k", "nthreads", "output", "triangle_merge",
+        "offsets_max_rotation", "offsets_rotation_step", "offsets_max_scale",
+        "offsets_scale_step", "nmatch_start", NULL
+    };
+
+    stimage_error_init(&error);
+    xyxymatch_params_init(&params);
+    batch.noutput = NULL;
+    batch.output = NULL;
+    batch.indices = NULL;
+
+    if (!PyArg_ParseTupleAndKeywords(
+                args, kwds, "O|OOOOsddndnssnnssddddn:xyxymatch_many",
+                (char **)keywords,
+                &pairs_obj, &origin_obj, &mag_obj, &rotation_obj,
+                &ref_origin_obj, &algorithm_str, &params.tolerance,
+                &params.separation, &params.nmatch, &params.maxratio,
+                &params.nreject, &index_str, &triangle_mode_str,
+                &params.options.k, &nthreads, &output_str,
+                &triangle_merge_str,
+                &params.options.offsets_max_rotation,
+                &params.options.offsets_rotation_step,
+                &params.options.offsets_max_scale,
+                &params.options.offsets_scale_step,
+                &params.options.nmatch_start)) {
+        return NULL;
+    }
+
+    if (xyxymatch_pairs_convert(pairs_obj, &npairs, &coords, &catalogs) ||
+        xyxymatch_params_convert(
+                &params, origin_obj, mag_obj, rotation_obj, ref_origin_obj,
+                algorithm_str, index_str, triangle_mode_str,
+                triangle_merge_str, output_str)) {
+        goto exit;
+    }
+
+    batch.params = &params;
+    batch.coords = coords;
+    batch.catalogs = catalogs;
+    batch.noutput = calloc(MAX(1, npairs), sizeof(size_t));
+    batch.output = calloc(MAX(1, npairs), sizeof(xyxymatch_output_t*));
+    batch.indices = calloc(MAX(1, npairs), sizeof(xyxymatch_indices_t));
+    if (batch.noutput == NULL || batch.output == NULL ||
+        batch.indices == NULL) {
+        PyErr_NoMemory();
+        goto exit;
+    }
+
+    for (i = 0; i < npairs; ++i) {
+        xyxymatch_indices_new(&batch.indices[i]);
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    status = parallel_for(npairs, nthreads, xyxymatch_task, &batch, &error);
+    Py_END_ALLOW_THREADS
+    if (status) {
+        PyErr_SetString(PyExc_RuntimeError, stimage_error_get_message(&error));
+        goto exit;
+    }
+
+    result = PyList_New(npairs);
+    if (result == NULL) {
+        goto exit;
+    }
+
+    for (i = 0; i < npairs; ++i) {
+        if (params.output == output_indices) {
+            item = xyxymatch_indices_result(&batch.indices[i]);
+        } else {
+            item = xyxymatch_result(batch.noutput[i], batch.output[i]);
+            if (item != NULL) {
+                batch.output[i] = NULL;
+            }
+        }
+        if (item == NULL) {
+            Py_CLEAR(result);
+            goto exit;
+        }
+        PyList_SET_ITEM(result, i, item);
+    }
+
+ exit:
+    free_coord_arg_pairs(npairs, coords);
+    free_catalogs(npairs, catalogs);
+    if (batch.output != NULL) {
+        for (i = 0; i < npairs; ++i) {
+            free(batch.output[i]);
+        }
+    }
+    if (batch.indices != NULL) {
+        for (i = 0; i < npairs; ++i) {
+            xyxymatch_indices_free(&batch.indices[i]);
+        }
+    }
+    free(batch.indices);
+    free(batch.output);
+    free(batch.noutput);
+
+    return result;
+}
+
+/****************************************
+ xyxymatch_tiled
+*/
+
+typedef struct {
+    PyObject*      sink;
+    PyArray_Descr* dtype;
+} tiled_sink_t;
+
+/* Called without holding the GIL.  Passes a copy of the matches to
+   the Python sink. */
+static int
+tiled_sink(
+        void* data,
+        size_t nmatches,
+        const xyxymatch_output_t* matches,
+        stimage_error_t* error) {
+
+    tiled_sink_t*    s      = (tiled_sink_t*)data;
+    PyGILState_STATE gil;
+    PyArrayObject*   chunk  = NULL;
+    PyObject*        result = NULL;
+    npy_intp         dims   = (npy_intp)nmatches;
+
+    gil = PyGILState_Ensure();
+
+    Py_INCREF(s->dtype);
+    chunk = (PyArrayObject*)PyArray_NewFromDescr(
+            &PyArray_Type, s->dtype, 1, &dims, NULL, NULL, 0, NULL);
+    if (chunk != NULL) {
+        memcpy(PyArray_DATA(chunk), matches,
+               nmatches * sizeof(xyxymatch_output_t));
+        result = PyObject_CallFunctionObjArgs(
+                s->sink, (PyObject*)chunk, NULL);
+        Py_DECREF(chunk);
+    }
+    Py_XDECREF(result);
+
+    PyGILState_Release(gil);
+
+    if (result == NULL) {
+        stimage_error_set_message(error, "sink raised an exception");
+        return 1;
+    }
+
+    return 0;
+}
+
+PyObject*
+py_xyxymatch_tiled(PyObject* self, PyObject* args, PyObject* kwds) {
+    PyObject* input_obj      = NULL;
+    PyObject* ref_obj        = NULL;
+    PyObject* sink_obj       = NULL;
+    PyObject* origin_obj     = NULL;
+    PyObject* mag_obj        = NULL;
+    PyObject* rotation_obj   = NULL;
+    PyObject* ref_origin_obj = NULL;
+    char*     index_str      = NULL;
+    double    tile_size      = 0.0;
+    size_t    max_coords     = 1 << 22;
+    size_t    nthreads       = 0;
+
+    coord_arg_t        input;
+    coord_arg_t        ref;
+    xyxymatch_params_t params;
+    tiled_sink_t       sink;
+    PyObject*          result  = NULL;
+    int                status  = 0;
+    stimage_error_t    error;
+
+    const char* keywords[] = {
+        "input", "ref", "sink", "tile_size", "origin", "mag", "rotation",
+        "ref_origin", "tolerance", "separation", "index", "max_coords",
+        "nthreads", NULL
+    };
+
+    stimage_error_init(&error);
+    xyxymatch_params_init(&params);
+    input.owner = NULL;
+    ref.owner = NULL;
+    sink.dtype = NULL;
+
+    if (!PyArg_ParseTupleAndKeywords(
+                args, kwds, "OOOd|OOOOddsnn:xyxymatch_tiled",
+                (char **)keywords,
+                &input_obj, &ref_obj, &sink_obj, &tile_size,
+                &origin_obj, &mag_obj, &rotation_obj, &ref_origin_obj,
+                &params.tolerance, &params.separation, &index_str,
+                &max_coords, &nthreads)) {
+        return NULL;
+    }
+
+    if (!PyCallable_Check(sink_obj)) {
+        PyErr_SetString(PyExc_TypeError, "sink must be callable");
+        return NULL;
+    }
+
+    if (to_coord_arg("input", input_obj, &input) ||
+        to_coord_arg("ref", ref_obj, &ref) ||
+        xyxymatch_params_convert(
+                &params, origin_obj, mag_obj, rotation_obj, ref_origin_obj,
+                NULL, index_str, NULL, NULL, NULL)) {
+        goto exit;
+    }
+
+    sink.sink = sink_obj;
+    sink.dtype = xyxymatch_output_dtype();
+    if (sink.dtype == NULL) {
+        goto exit;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    status = xyxymatch_tiled(
+            &input.view, &ref.view,
+            &params.origin, &params.mag, &params.rotation, &params.ref_origin,
+            params.tolerance, params.separation, tile_size, max_coords,
+            nthreads, &params.options, tiled_sink, &sink, &error);
+    Py_END_ALLOW_THREADS
+    if (status) {
+        /* Keep the exception raised by the sink, if any */
+        if (!PyErr_Occurred()) {
+            PyErr_SetString(
+                    PyExc_RuntimeError, stimage_error_get_message(&error));
+        }
+        goto exit;
+    }
+
+    Py_INCREF(Py_None);
+    result = Py_None;
+
+ exit:
+    free_coord_arg(&input);
+    free_coord_arg(&ref);
+    Py_XDECREF(sink.dtype);
+
+    return result;
+}
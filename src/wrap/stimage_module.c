@@ -36,7 +36,12 @@ DAMAGE.
 #include "wrap_util.h"
 
 PyObject* py_xyxymatch(PyObject*, PyObject*, PyObject*);
+PyObject* py_xyxymatch_many(PyObject*, PyObject*, PyObject*);
+PyObject* py_xyxymatch_tiled(PyObject*, PyObject*, PyObject*);
+int py_xyxymatch_init_type(PyObject*);
 PyObject* py_geomap(PyObject*, PyObject*, PyObject*);
+PyObject* py_geomap_many(PyObject*, PyObject*, PyObject*);
+int py_geomap_init_type(PyObject*);
 
 #pragma GCC diagnostic push
 #pragma GCC diagnostic ignored "-Wmissing-field-initializers"
@@ -44,7 +49,10 @@ PyObject* py_geomap(PyObject*, PyObject*, PyObject*);
 #pragma clang diagnostic ignored "-Wcast-function-type-mismatch"
 static PyMethodDef module_methods[] = {
     {"xyxymatch", (PyCFunction)py_xyxymatch, METH_VARARGS | METH_KEYWORDS, NULL},
+    {"xyxymatch_many", (PyCFunction)py_xyxymatch_many, METH_VARARGS | METH_KEYWORDS, NULL},
+    {"xyxymatch_tiled", (PyCFunction)py_xyxymatch_tiled, METH_VARARGS | METH_KEYWORDS, NULL},
     {"geomap", (PyCFunction)py_geomap, METH_VARARGS | METH_KEYWORDS, NULL},
+    {"geomap_many", (PyCFunction)py_geomap_many, METH_VARARGS | METH_KEYWORDS, NULL},
     {NULL}  /* Sentinel */
 };
 #pragma clang diagnostic pop
@@ -79,10 +87,17 @@ init_stimage(void)
 
 #if PY_MAJOR_VERSION >= 3
     m = PyModule_Create(&moduledef);
+    if (m == NULL || py_xyxymatch_init_type(m) || py_geomap_init_type(m)) {
+        Py_XDECREF(m);
+        return NULL;
+    }
 	return m;
 #else
     m = Py_InitModule3("_stimage", module_methods,
                        "Example module that creates an extension type.");
+    if (m == NULL) return;
+    py_xyxymatch_init_type(m);
+    py_geomap_init_type(m);
 	return;
 #endif
 }
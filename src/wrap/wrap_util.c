@@ -92,6 +92,246 @@ from_coord_t(
     return 0;
 }
 
+int
+to_coord_array(
+        const char* const name,
+        PyObject* o,
+        PyArrayObject** const a) {
+
+    /* Always a copy, even of a contiguous double array, since the
+       caller keeps pointers into it that must not change under it */
+    *a = (PyArrayObject*)PyArray_FromAny(
+            o, PyArray_DescrFromType(NPY_DOUBLE), 2, 2,
+            NPY_ARRAY_CARRAY | NPY_ARRAY_ENSURECOPY, NULL);
+    if (*a == NULL) {
+        return -1;
+    }
+
+    if (PyArray_DIM(*a, 1) != 2) {
+        Py_CLEAR(*a);
+        PyErr_Format(
+                PyExc_TypeError,
+                "%s array must be an Nx2 array",
+                name);
+        return -1;
+    }
+
+    PyArray_CLEARFLAGS(*a, NPY_ARRAY_WRITEABLE);
+
+    return 0;
+}
+
+/* Returns a new reference to o as an array that a coord_view_t can
+   read in place: single or double precision floats, in either byte
+   order.  Anything else is converted to a double array. */
+static PyArrayObject*
+to_view_array(
+        PyObject* o,
+        const int mindim,
+        const int maxdim) {
+
+    PyArrayObject* a = NULL;
+
+    a = (PyArrayObject*)PyArray_FromAny(o, NULL, mindim, maxdim, 0, NULL);
+    if (a == NULL) {
+        return NULL;
+    }
+
+    if (PyArray_TYPE(a) == NPY_DOUBLE || PyArray_TYPE(a) == NPY_FLOAT) {
+        return a;
+    }
+
+    Py_DECREF(a);
+    return (PyArrayObject*)PyArray_FromAny(
+            o, PyArray_DescrFromType(NPY_DOUBLE), mindim, maxdim,
+            NPY_ARRAY_ALIGNED, NULL);
+}
+
+static coord_view_type_e
+view_type(
+        PyArrayObject* a) {
+
+    return (PyArray_TYPE(a) == NPY_FLOAT) ?
+        coord_view_float32 : coord_view_float64;
+}
+
+int
+to_coord_arg(
+        const char* const name,
+        PyObject* o,
+        coord_arg_t* const a) {
+
+    PyArrayObject* x = NULL;
+    PyArrayObject* y = NULL;
+    PyObject*      t = NULL;
+
+    a->owner = NULL;
+
+    /* A pair of 1-D arrays is a pair of x and y columns */
+    if (PyTuple_Check(o) && PyTuple_GET_SIZE(o) == 2 &&
+        PyArray_Check(PyTuple_GET_ITEM(o, 0)) &&
+        PyArray_Check(PyTuple_GET_ITEM(o, 1)) &&
+        PyArray_NDIM((PyArrayObject*)PyTuple_GET_ITEM(o, 0)) == 1 &&
+        PyArray_NDIM((PyArrayObject*)PyTuple_GET_ITEM(o, 1)) == 1) {
+        x = to_view_array(PyTuple_GET_ITEM(o, 0), 1, 1);
+        if (x == NULL) goto fail;
+        y = to_view_array(PyTuple_GET_ITEM(o, 1), 1, 1);
+        if (y == NULL) goto fail;
+
+        if (PyArray_DIM(x, 0) != PyArray_DIM(y, 0)) {
+            PyErr_Format(
+                    PyExc_ValueError,
+                    "%s x and y columns must have the same length",
+                    name);
+            goto fail;
+        }
+
+        /* The view has a single type and byte order */
+        if (view_type(x) != view_type(y) ||
+            PyArray_ISNOTSWAPPED(x) != PyArray_ISNOTSWAPPED(y)) {
+            t = PyArray_FROMANY((PyObject*)x, NPY_DOUBLE, 1, 1, NPY_ARRAY_ALIGNED);
+            Py_SETREF(x, (PyArrayObject*)t);
+            if (x == NULL) goto fail;
+            t = PyArray_FROMANY((PyObject*)y, NPY_DOUBLE, 1, 1, NPY_ARRAY_ALIGNED);
+            Py_SETREF(y, (PyArrayObject*)t);
+            if (y == NULL) goto fail;
+        }
+
+        a->owner = PyTuple_Pack(2, x, y);
+        if (a->owner == NULL) goto fail;
+
+        coord_view_init_columns(
+                &a->view, (size_t)PyArray_DIM(x, 0), view_type(x),
+                !PyArray_ISNOTSWAPPED(x),
+                PyArray_DATA(x), PyArray_STRIDE(x, 0),
+                PyArray_DATA(y), PyArray_STRIDE(y, 0));
+
+        Py_DECREF(x);
+        Py_DECREF(y);
+        return 0;
+    }
+
+    x = to_view_array(o, 2, 2);
+    if (x == NULL) {
+        return -1;
+    }
+
+    if (PyArray_DIM(x, 1) != 2) {
+        Py_DECREF(x);
+        PyErr_Format(
+                PyExc_TypeError,
+                "%s array must be an Nx2 array",
+                name);
+        return -1;
+    }
+
+    coord_view_init_columns(
+            &a->view, (size_t)PyArray_DIM(x, 0), view_type(x),
+            !PyArray_ISNOTSWAPPED(x),
+            PyArray_DATA(x), PyArray_STRIDE(x, 0),
+            (char*)PyArray_DATA(x) + PyArray_STRIDE(x, 1),
+            PyArray_STRIDE(x, 0));
+    a->owner = (PyObject*)x;
+
+    return 0;
+
+ fail:
+    Py_XDECREF(x);
+    Py_XDECREF(y);
+    return -1;
+}
+
+void
+free_coord_arg(
+        coord_arg_t* const a) {
+
+    Py_CLEAR(a->owner);
+}
+
+int
+to_coord_arg_pairs(
+        const char* const name,
+        PyObject* o,
+        size_t* const npairs,
+        coord_arg_t** const args) {
+
+    PyObject*  seq    = NULL;
+    PyObject*  item   = NULL;
+    Py_ssize_t i      = 0;
+    int        status = -1;
+
+    *npairs = 0;
+    *args = NULL;
+
+    seq = PySequence_Fast(o, "pairs must be a sequence");
+    if (seq == NULL) {
+        return -1;
+    }
+
+    *npairs = (size_t)PySequence_Fast_GET_SIZE(seq);
+    *args = calloc(MAX(1, 2 * *npairs), sizeof(coord_arg_t));
+    if (*args == NULL) {
+        PyErr_NoMemory();
+        goto exit;
+    }
+
+    for (i = 0; i < (Py_ssize_t)*npairs; ++i) {
+        item = PySequence_Fast_GET_ITEM(seq, i);
+        if (!PySequence_Check(item) || PySequence_Size(item) != 2) {
+            PyErr_Format(
+                    PyExc_ValueError,
+                    "%s must be a sequence of (input, ref) pairs",
+                    name);
+            goto exit;
+        }
+
+        item = PySequence_GetItem(item, 0);
+        if (item == NULL) goto exit;
+        if (to_coord_arg("input", item, &(*args)[2*i])) {
+            Py_DECREF(item);
+            goto exit;
+        }
+        Py_DECREF(item);
+
+        item = PySequence_GetItem(PySequence_Fast_GET_ITEM(seq, i), 1);
+        if (item == NULL) goto exit;
+        if (to_coord_arg("ref", item, &(*args)[2*i + 1])) {
+            Py_DECREF(item);
+            goto exit;
+        }
+        Py_DECREF(item);
+    }
+
+    status = 0;
+
+ exit:
+    Py_DECREF(seq);
+    if (status) {
+        free_coord_arg_pairs(*npairs, *args);
+        *npairs = 0;
+        *args = NULL;
+    }
+
+    return status;
+}
+
+void
+free_coord_arg_pairs(
+        const size_t npairs,
+        coord_arg_t* args) {
+
+    size_t i;
+
+    if (args == NULL) {
+        return;
+    }
+
+    for (i = 0; i < 2 * npairs; ++i) {
+        free_coord_arg(&args[i]);
+    }
+    free(args);
+}
+
 int
 to_bbox_t(
         const char* const name,
@@ -147,10 +387,37 @@ to_xyxymatch_algo_e(
         *e = xyxymatch_algo_tolerance;
     } else if (strcmp(s, "triangles") == 0) {
         *e = xyxymatch_algo_triangles;
+    } else if (strcmp(s, "offsets") == 0) {
+        *e = xyxymatch_algo_offsets;
+    } else {
+        PyErr_Format(
+                PyExc_ValueError,
+                "%s must be 'tolerance', 'triangles' or 'offsets'",
+                name);
+        return -1;
+    }
+
+    return 0;
+}
+
+int
+to_xyxymatch_index_e(
+        const char* const name,
+        const char* const s,
+        xyxymatch_index_e* const e) {
+
+    if (s == NULL) {
+        return 0;
+    }
+
+    if (strcmp(s, "grid") == 0) {
+        *e = xyxymatch_index_grid;
+    } else if (strcmp(s, "sweep") == 0) {
+        *e = xyxymatch_index_sweep;
     } else {
         PyErr_Format(
                 PyExc_ValueError,
-                "%s must be 'tolerance' or 'triangles'",
+                "%s must be 'grid' or 'sweep'",
                 name);
         return -1;
     }
@@ -158,6 +425,84 @@ to_xyxymatch_algo_e(
     return 0;
 }
 
+int
+to_triangle_mode_e(
+        const char* const name,
+        const char* const s,
+        triangle_mode_e* const e) {
+
+    if (s == NULL) {
+        return 0;
+    }
+
+    if (strcmp(s, "all") == 0) {
+        *e = triangle_mode_all;
+    } else if (strcmp(s, "knn") == 0) {
+        *e = triangle_mode_knn;
+    } else {
+        PyErr_Format(
+                PyExc_ValueError,
+                "%s must be 'all' or 'knn'",
+                name);
+        return -1;
+    }
+
+    return 0;
+}
+
+int
+to_triangle_merge_e(
+        const char* const name,
+        const char* const s,
+        triangle_merge_e* const e) {
+
+    if (s == NULL) {
+        return 0;
+    }
+
+    if (strcmp(s, "grid") == 0) {
+        *e = triangle_merge_grid;
+    } else if (strcmp(s, "sweep") == 0) {
+        *e = triangle_merge_sweep;
+    } else {
+        PyErr_Format(
+                PyExc_ValueError,
+                "%s must be 'grid' or 'sweep'",
+                name);
+        return -1;
+    }
+
+    return 0;
+}
+
+int
+to_output_e(
+        const char* const name,
+        const char* const s,
+        const output_e other,
+        output_e* const e) {
+
+    const char* other_str = (other == output_indices) ? "indices" : "none";
+
+    if (s == NULL) {
+        return 0;
+    }
+
+    if (strcmp(s, "full") == 0) {
+        *e = output_full;
+    } else if (strcmp(s, other_str) == 0) {
+        *e = other;
+    } else {
+        PyErr_Format(
+                PyExc_ValueError,
+                "%s must be 'full' or '%s'",
+                name, other_str);
+        return -1;
+    }
+
+    return 0;
+}
+
 int
 to_geomap_fit_e(
         const char* const name,
@@ -369,3 +714,59 @@ from_xterms_e(
 
     return 0;
 }
+
+int
+from_stimage_stats_t(
+        const stimage_stats_t* const s,
+        PyObject** o) {
+
+    const stimage_stat_t* stat;
+    const char*           dot;
+    PyObject*             stage = NULL;
+    PyObject*             key   = NULL;
+    PyObject*             value = NULL;
+    size_t                i;
+
+    *o = PyDict_New();
+    if (*o == NULL) {
+        return -1;
+    }
+
+    for (i = 0; i < s->nstats; ++i) {
+        stat = &s->stats[i];
+        dot = strchr(stat->name, '.');
+        if (dot == NULL) {
+            continue;
+        }
+
+        key = PyUnicode_FromStringAndSize(stat->name, dot - stat->name);
+        if (key == NULL) goto fail;
+        stage = PyDict_GetItem(*o, key); /* borrowed */
+        if (stage == NULL) {
+            stage = PyDict_New();
+            if (stage == NULL || PyDict_SetItem(*o, key, stage)) {
+                Py_XDECREF(stage);
+                goto fail;
+            }
+            Py_DECREF(stage);
+        }
+        Py_CLEAR(key);
+
+        if (stat->kind == stimage_stat_time) {
+            value = PyFloat_FromDouble(stat->value);
+        } else {
+            value = PyLong_FromDouble(stat->value);
+        }
+        if (value == NULL ||
+            PyDict_SetItemString(stage, dot + 1, value)) goto fail;
+        Py_CLEAR(value);
+    }
+
+    return 0;
+
+ fail:
+    Py_XDECREF(key);
+    Py_XDECREF(value);
+    Py_CLEAR(*o);
+    return -1;
+}
@@ -47,6 +47,8 @@ DAMAGE.
 
 #include "immatch/xyxymatch.h"
 #include "immatch/geomap.h"
+#include "lib/coord_view.h"
+#include "lib/stats.h"
 #include "lib/util.h"
 #include "lib/xybbox.h"
 
@@ -63,6 +65,44 @@ from_coord_t(
         const coord_t* const c,
         PyArrayObject** o);
 
+/* Converts o to a new, read-only Nx2 double array */
+int
+to_coord_array(
+        const char* const name,
+        PyObject* o,
+        PyArrayObject** const a);
+
+/* Coordinates passed from Python, read in place through a view */
+typedef struct {
+    coord_view_t view;
+    PyObject*    owner; /* keeps the memory of the view alive */
+} coord_arg_t;
+
+/* Converts an Nx2 array, or a tuple of two 1-D x and y arrays.  Single
+   and double precision arrays with any strides and byte order are
+   read in place. */
+int
+to_coord_arg(
+        const char* const name,
+        PyObject* o,
+        coord_arg_t* const a);
+
+void
+free_coord_arg(
+        coord_arg_t* const a);
+
+int
+to_coord_arg_pairs(
+        const char* const name,
+        PyObject* o,
+        size_t* const npairs,
+        coord_arg_t** const args);
+
+void
+free_coord_arg_pairs(
+        const size_t npairs,
+        coord_arg_t* args);
+
 int
 to_bbox_t(
         const char* const name,
@@ -75,6 +115,40 @@ to_xyxymatch_algo_e(
         const char* const s,
         xyxymatch_algo_e* const e);
 
+int
+to_xyxymatch_index_e(
+        const char* const name,
+        const char* const s,
+        xyxymatch_index_e* const e);
+
+int
+to_triangle_mode_e(
+        const char* const name,
+        const char* const s,
+        triangle_mode_e* const e);
+
+int
+to_triangle_merge_e(
+        const char* const name,
+        const char* const s,
+        triangle_merge_e* const e);
+
+/* How much is returned for each match or fitted coordinate */
+typedef enum {
+    output_full,
+    output_indices,
+    output_none
+} output_e;
+
+/* Accepts 'full', or the name of the one other mode the caller
+   supports */
+int
+to_output_e(
+        const char* const name,
+        const char* const s,
+        const output_e other,
+        output_e* const e);
+
 int
 to_geomap_fit_e(
         const char* const name,
@@ -108,4 +182,10 @@ from_xterms_e(
         const xterms_e e,
         PyObject** o);
 
+/* Convert the statistics to a dict of dicts, {stage: {counter: value}} */
+int
+from_stimage_stats_t(
+        const stimage_stats_t* const s,
+        PyObject** o);
+
 #endif
@@ -28,8 +28,29 @@
 # DAMAGE.
 
 from __future__ import absolute_import
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
 from ._version import version as __version__
 from . import _stimage
+from ._stimage import GeomapTransform
+
+
+def _report_stats(result, stats):
+    """
+    Hand the statistics appended to *result* by the C functions to
+    *stats*, if it is callable, and return the rest of *result*.
+    """
+    if not stats or not callable(stats):
+        return result
+    stats(result[-1])
+    if len(result) == 2:
+        return result[0]
+    return result[:-1]
 
 
 def xyxymatch(input,
@@ -43,7 +64,19 @@ def xyxymatch(input,
               separation = 9.0,
               nmatch = 30,
               maxratio = 10.0,
-              nreject = 10):
+              nreject = 10,
+              index = 'grid',
+              triangle_mode = 'all',
+              k = 8,
+              output = 'full',
+              stats = False,
+              nthreads = 1,
+              triangle_merge = 'sweep',
+              offsets_max_rotation = 0.0,
+              offsets_rotation_step = 1.0,
+              offsets_max_scale = 0.0,
+              offsets_scale_step = 0.01,
+              nmatch_start = 0):
     """
     Match pixels coordinate lists using various methods.
 
@@ -147,11 +180,43 @@ def xyxymatch(input,
       parameter will increase the ability to deal with distortions but
       will also produce more false matches.
 
+    - If *algorithm* is "offsets", `xyxymatch` takes up to *nmatch*
+      transformed input coordinates and *nmatch* reference
+      coordinates, in the order they are given, and bins the offsets
+      between every input and every reference coordinate in a
+      histogram with cells of size *tolerance*.  The offsets of the
+      coordinates the lists have in common pile up in one place, whose
+      position gives the shift between the lists.  The shift is
+      combined with the initial linear transformation, the entire
+      lists are matched with the "tolerance" algorithm, and the
+      matches are used to fit a new linear transformation and match
+      the lists once more.  If the lists are sorted brightest first,
+      the brightest objects are the ones used.  Rotations and scale
+      changes blur the histogram, so a set of trial rotations and
+      scales may be tried (see *offsets_max_rotation* and
+      *offsets_max_scale*), and the one whose histogram has the
+      highest peak is used.  The "offsets" algorithm requires no tie
+      point information and its cost grows only as the square of
+      *nmatch*, which makes it well suited to exposures that differ
+      mainly by a shift.  Some shift always collects a few offsets
+      between objects that do not correspond.  Unless the peak has
+      at least three offsets and stands out from the number those
+      are expected to give, which depends on the numbers of objects,
+      the areas they cover and the number of trials, no matches are
+      returned.  This is also the result when the lists differ by a
+      rotation or scale change outside the trials.
+
     **Parameters:**
 
-    - *input*: Array of input coordinates. (Must be an Nx2 array).
+    - *input*: Array of input coordinates.  Either an Nx2 array, or a
+      tuple ``(x, y)`` of two 1-D arrays, such as the columns of a
+      table.  Single and double precision arrays are read in place,
+      whatever their strides.
 
-    - *ref*: Array of reference coordinates. (Must be an Nx2 array).
+    - *ref*: Array of reference coordinates, in any of the forms
+      accepted for *input*.  May also be a `ReferenceCatalog`, to
+      reuse the work done on the reference coordinates across many
+      calls.
 
     - *origin*: The origin of the input coordinate system.  Default:
       (0.0, 0.0)
@@ -198,6 +263,15 @@ def xyxymatch(input,
         between the *x* and *y* axes, and higher order distortion
         terms in the coordinate transformation.
 
+      - ``'offsets'``: The shift between the input and reference
+        coordinate lists is found from a histogram of the offsets
+        between their first *nmatch* coordinates, optionally over a
+        set of trial rotations and scales, and the lists are then
+        matched with the ``'tolerance'`` algorithm.  Like the
+        triangles algorithm, it needs no tie points, but it is much
+        cheaper, and it only handles the rotations and scales it is
+        asked to try.
+
     - *tolerance*: The matching tolerance in pixels. Default: 1.0
 
     - *separation*: The minimum separation for objects in the input
@@ -208,10 +282,27 @@ def xyxymatch(input,
     - *nmatch*: The maximum number of reference and input coordinates
       used by the ``'triangles'`` pattern matching algorithm.  If
       either list contains more coordinates than *nmatch*, the lists
-      are subsampled.  *nmatch* should be kept small as the
-      computation and memory requirements of the triangles algorithm
-      depend on a high power of lengths of the respective lists.
-      Default: 30
+      are subsampled, the matches in the subsample are used to fit a
+      new linear transformation, and the whole lists are then matched
+      using the ``'tolerance'`` algorithm.  Matches the fit cannot map
+      to within *tolerance* are rejected from it, and if the whole
+      lists then give fewer matches than the subsample did, the
+      subsample's matches are returned instead.  *nmatch* should be kept
+      small as the computation and memory requirements of the
+      triangles algorithm depend on a high power of lengths of the
+      respective lists.  It is also the number of coordinates taken
+      from each list by the ``'offsets'`` algorithm.  Default: 30
+
+    - *nmatch_start*: If nonzero and less than *nmatch*, the
+      ``'triangles'`` algorithm matches adaptively.  It first uses
+      only up to *nmatch_start* coordinates of each list, and only if
+      fewer than 5 of them, or fewer than a fifth, are matched, does
+      it double the number of coordinates, up to *nmatch*, and try
+      again.  Lists that are easy to match are then matched at the
+      cheapest level, while those with little in common still get up
+      to *nmatch* coordinates.  The number of coordinates the matches
+      were found with is reported as ``stats['match_triangles']
+      ['nmatch']``.  Default: 0
 
     - *maxratio*: The maximum ratio of the longest to shortest side of
       the triangles generated by the triangles pattern matching
@@ -223,8 +314,96 @@ def xyxymatch(input,
     - *nreject*: The maximum number of rejection iterations for the
       ``'triangles'`` pattern matching algorithm.  Default: 10
 
-    **Returns**: A structured array containing the output
-    information.  It has the following columns:
+    - *index*: The spatial index used by the ``'tolerance'`` algorithm
+      to find the candidate matches for each reference coordinate.
+      The choices are:
+
+      - ``'grid'``: The transformed input coordinates are bucketed
+        into a uniform grid with cells the size of *tolerance*, and
+        only the cells neighbouring each reference coordinate are
+        searched.
+
+      - ``'sweep'``: Every transformed input coordinate within
+        *tolerance* in *y* of each reference coordinate is searched.
+        This degrades when many coordinates share the same range in
+        *y*.
+
+      Both give identical results.  Default: ``'grid'``
+
+    - *triangle_mode*: How the triangles are formed by the
+      ``'triangles'`` algorithm.  The choices are:
+
+      - ``'all'``: Every triangle that can be formed from up to
+        *nmatch* coordinates is used.  The number of triangles grows
+        as the cube of *nmatch*, so *nmatch* must be kept small.
+
+      - ``'knn'``: Only the triangles formed by each coordinate and
+        two of its *k* nearest neighbors are used.  The number of
+        triangles grows as *nmatch* times the square of *k*, so
+        *nmatch* may be several hundred.
+
+      Default: ``'all'``
+
+    - *k*: The number of nearest neighbors used when *triangle_mode*
+      is ``'knn'``.  Must be at least 2.  Default: 8
+
+    - *output*: What is returned for each match.  The choices are:
+
+      - ``'full'``: The coordinates and indices of both sides of the
+        match.
+
+      - ``'indices'``: Only the indices.  No memory is set aside
+        for a match to every input coordinate, and no coordinates are
+        copied, which matters when many large lists are matched and
+        only the pairing is kept.
+
+      Default: ``'full'``
+
+    - *stats*: If true, the wall time and counters of each stage of
+      the match are also returned, as a dict of dicts such as
+      ``{'xycoincide': {'time': 0.001, 'input_removed': 3}, ...}``.
+      Times are in seconds.  If callable, it is called with that dict
+      instead, and the result is returned alone.  Nothing is measured
+      when false.  Default: False
+
+    - *nthreads*: The number of threads the ``'triangles'`` algorithm
+      builds, sorts and merges its triangles on.  The reference and
+      input triangles are built at the same time.  If 0, the number of
+      processors is used.  The matches do not depend on *nthreads*.
+      Default: 1
+
+    - *triangle_merge*: How the ``'triangles'`` algorithm pairs up
+      the reference and input triangles.  The choices are:
+
+      - ``'sweep'``: Every input triangle within the largest ratio
+        tolerance of each reference triangle is tested.  This degrades
+        when there are many triangles, or a few of them have much
+        larger tolerances than the rest.
+
+      - ``'grid'``: The input triangles are looked up in a grid over
+        their ratios and cosines, so that only those the tolerances
+        can reach are tested.
+
+      Both give identical results.  Default: ``'sweep'``
+
+    - *offsets_max_rotation*, *offsets_rotation_step*: The
+      ``'offsets'`` algorithm tries the rotations from
+      -*offsets_max_rotation* to *offsets_max_rotation* degrees in
+      steps of *offsets_rotation_step*, relative to *rotation*.  The
+      step should be small enough that the coordinates at the edges of
+      the lists move by less than about *tolerance*.  `ValueError`
+      is raised if *offsets_max_rotation* is negative, or if it is
+      positive and the step is not.  Default: 0.0 and 1.0
+
+    - *offsets_max_scale*, *offsets_scale_step*: The ``'offsets'``
+      algorithm tries the scales from 1 - *offsets_max_scale* to 1 +
+      *offsets_max_scale* in steps of *offsets_scale_step*, relative
+      to *mag*.  `ValueError` is raised unless *offsets_max_scale*
+      is in [0, 1) and, if it is positive, the step is positive.
+      Default: 0.0 and 0.01
+
+    **Returns**: If *output* is ``'full'``, a structured array
+    containing the output information.  It has the following columns:
 
     - *input_x*
     - *input_y*
@@ -232,8 +411,14 @@ def xyxymatch(input,
     - *ref_x*
     - *ref_y*
     - *ref_idx*
+
+    If *output* is ``'indices'``, a 2-tuple of integer arrays
+    ``(input_idx, ref_idx)``, the same as those columns.
+
+    If *stats* is true and not callable, a 2-tuple of the above and
+    the dict of statistics.
     """
-    return _stimage.xyxymatch(
+    result = _stimage.xyxymatch(
         input,
         ref,
         origin,
@@ -245,7 +430,175 @@ def xyxymatch(input,
         separation,
         nmatch,
         maxratio,
-        nreject)
+        nreject,
+        index,
+        triangle_mode,
+        k,
+        output,
+        bool(stats),
+        nthreads,
+        triangle_merge,
+        offsets_max_rotation,
+        offsets_rotation_step,
+        offsets_max_scale,
+        offsets_scale_step,
+        nmatch_start)
+    return _report_stats(result, stats)
+
+
+class ReferenceCatalog(_stimage.ReferenceCatalog):
+    """
+    A list of reference coordinates prepared for `xyxymatch`.
+
+    When the same reference coordinates are matched against many input
+    coordinate lists, the work that depends only on the reference
+    coordinates can be done once, by passing a `ReferenceCatalog` as
+    the *ref* argument to `xyxymatch` or `xyxymatch_many` instead of
+    an array.  The reference coordinates are sorted and culled when
+    the catalog is created, and the spatial grid used by the
+    ``'tolerance'`` algorithm and the reference triangles used by the
+    ``'triangles'`` algorithm are built in advance.
+
+    The results are identical to passing the array of reference
+    coordinates.  The grid is only reused by calls with the same
+    *tolerance*, and the triangles are only reused by calls with the
+    same *tolerance*, *nmatch*, *maxratio*, *triangle_mode* and *k*;
+    otherwise they are rebuilt for that call.  The reference
+    coordinates are always culled with the catalog's *separation*,
+    and the *separation* passed to `xyxymatch` only applies to the
+    input coordinates.
+
+    A catalog is read-only once created, and may be shared between
+    threads.  It may also be saved to a file with `save`, and loaded
+    with `load`.  Loading memory-maps the file rather than rebuilding
+    the catalog, so a pool of worker processes can share one prepared
+    catalog.  `cached` does this automatically, using a directory of
+    files named by a hash of the reference coordinates and the
+    parameters.
+
+    **Parameters:**
+
+    - *ref*: Array of reference coordinates. (Must be an Nx2 array).
+
+    - *separation*: The minimum separation for objects in the
+      reference coordinate list.  Default: 9.0
+
+    - *tolerance*: The matching tolerance in pixels the catalog is
+      prepared for.  Default: 1.0
+
+    - *nmatch*, *maxratio*, *triangle_mode*, *k*: The ``'triangles'``
+      parameters the reference triangles are built for.  See
+      `xyxymatch`.  Defaults: 30, 10.0, ``'all'``, 8
+    """
+    def __init__(self,
+                 ref,
+                 separation = 9.0,
+                 tolerance = 1.0,
+                 nmatch = 30,
+                 maxratio = 10.0,
+                 triangle_mode = 'all',
+                 k = 8):
+        super(ReferenceCatalog, self).__init__(
+            ref,
+            separation,
+            tolerance,
+            nmatch,
+            maxratio,
+            triangle_mode,
+            k)
+
+    def save(self, path):
+        """
+        Save the catalog to a file.
+
+        The file is written to a temporary file in the same directory
+        and then renamed, so other processes never see a partially
+        written file.  The format is versioned and in the native byte
+        order; `load` rejects files it can not read.
+        """
+        data = self._serialize()
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a catalog saved with `save`.
+
+        If *mmap* is True, the file is memory-mapped read-only and the
+        reference coordinates and triangles are used in place, so
+        processes loading the same file share its memory.  Otherwise
+        the file is read into memory.  The grid used by the
+        ``'tolerance'`` algorithm is not saved and is rebuilt on load.
+
+        Raises `ValueError` if the file is not a catalog, was written
+        by an incompatible version, or is corrupt.
+        """
+        if mmap:
+            buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        else:
+            buffer = np.fromfile(path, dtype=np.uint8)
+        return cls._from_buffer(buffer)
+
+    @staticmethod
+    def cache_key(ref,
+                  separation = 9.0,
+                  tolerance = 1.0,
+                  nmatch = 30,
+                  maxratio = 10.0,
+                  triangle_mode = 'all',
+                  k = 8):
+        """
+        Return the hash of the reference coordinates and parameters
+        that `cached` uses to name the file for a catalog.
+        """
+        ref = np.ascontiguousarray(ref, dtype=np.float64)
+        h = hashlib.sha1()
+        h.update(repr((ref.shape, float(separation), float(tolerance),
+                       int(nmatch), float(maxratio), str(triangle_mode),
+                       int(k))).encode('ascii'))
+        h.update(ref.tobytes())
+        return h.hexdigest()
+
+    @classmethod
+    def cached(cls,
+               ref,
+               cache_dir,
+               separation = 9.0,
+               tolerance = 1.0,
+               nmatch = 30,
+               maxratio = 10.0,
+               triangle_mode = 'all',
+               k = 8):
+        """
+        Return a catalog for *ref*, loading it from *cache_dir* if it
+        was prepared before, and otherwise preparing it and saving it
+        there.
+
+        The file is named by `cache_key`, so any change to the
+        reference coordinates or the parameters prepares a new
+        catalog.  Files that can not be loaded are rebuilt.
+        """
+        params = (separation, tolerance, nmatch, maxratio, triangle_mode, k)
+        path = os.path.join(
+            cache_dir, cls.cache_key(ref, *params) + '.stimref')
+        if os.path.exists(path):
+            try:
+                return cls.load(path)
+            except ValueError:
+                pass
+        catalog = cls(ref, *params)
+        os.makedirs(cache_dir, exist_ok=True)
+        catalog.save(path)
+        return catalog
 
 
 def geomap(input,
@@ -260,7 +613,11 @@ def geomap(input,
            xxterms="half",
            yxterms="half",
            maxiter=0,
-           reject=0.0):
+           reject=0.0,
+           output="full",
+           out=None,
+           stats=False,
+           nthreads=1):
     """
     `geomap` computes the transformation required to map the reference
     coordinate system to the input coordinate system.
@@ -422,9 +779,13 @@ def geomap(input,
 
     **Parameters:**
 
-    - *input*: Array of input coordinates. (Must be an Nx2 array).
+    - *input*: Array of input coordinates.  Either an Nx2 array, or a
+      tuple ``(x, y)`` of two 1-D arrays, such as the columns of a
+      table.  Single and double precision arrays are read in place,
+      whatever their strides.
 
-    - *ref*: Array of reference coordinates. (Must be an Nx2 array).
+    - *ref*: Array of reference coordinates, in any of the forms
+      accepted for *input*.
 
     - *bbox*: The range of reference coordinates over which the
       computed coordinate transformation is valid.  Must be
@@ -526,6 +887,30 @@ def geomap(input,
 
     - *reject* = 3.0: The rejection limit in units of sigma.
 
+    - *output*: Whether the fitted values and residuals of each
+      coordinate are returned.  If ``"full"`` (default), they are
+      returned in a structured array.  If ``"none"``, they are not
+      computed, and only the fit is returned, which saves the memory
+      and time of a table as large as the input in batch runs.
+
+    - *out*: A structured array with the columns listed below, and
+      at least as many rows as there are coordinates, to write the
+      per-coordinate table into instead of allocating a new one.
+      Default: None
+
+    - *stats*: If true, the wall time and counters of each stage of
+      the fit are also returned, as a dict of dicts such as
+      ``{'reject': {'time': 0.002, 'iterations': 3, 'rejected': 12},
+      ...}``.  Times are in seconds.  If callable, it is called with
+      that dict instead.  Nothing is measured when false.
+      Default: False
+
+    - *nthreads*: The number of threads the points are split between
+      when the surfaces are fit and evaluated.  If 0, the number of
+      processors is used.  The partial sums of each block of points
+      are added in a fixed order, so the result does not depend on
+      *nthreads*.  Default: 1
+
     **Returns:** A 2-tuple with the following parts:
 
     - `GeomapResults` object, with the following attributes:
@@ -561,7 +946,20 @@ def geomap(input,
       - *y2coeff* double array: The second-order *y* coefficients of
         the fit.
 
-    - A Numpy structured array with the following columns:
+      - *transform* `GeomapTransform`: The fitted surfaces, which map
+        reference coordinates to input coordinates.  Call
+        ``transform.transform(xy, out=None, distortion=True,
+        nthreads=1)`` to apply the fit to an array of reference
+        coordinates, or ``transform.evaluate_grid(shape=None, x=None,
+        y=None, out=None, distortion=True, nthreads=1)`` to apply it
+        to every point of a grid, such as the pixels of an image, in a
+        single pass.  The evaluation runs in C without holding the
+        GIL, on *nthreads* threads (0 for one per processor), and the
+        object can be pickled.
+
+    - A Numpy structured array with the following columns, or
+      `None` if *output* is ``"none"``.  If *out* is given, this is a
+      view of its leading rows.
 
       - *input_x*
       - *input_y*
@@ -571,8 +969,11 @@ def geomap(input,
       - *fit_y*
       - *resid_x*
       - *resid_y*
+
+    If *stats* is true and not callable, the dict of statistics is
+    added as a third item.
     """
-    return _stimage.geomap(
+    result = _stimage.geomap(
         input,
         ref,
         bbox,
@@ -585,4 +986,339 @@ def geomap(input,
         xxterms,
         yxterms,
         maxiter,
-        reject)
+        reject,
+        output,
+        out,
+        bool(stats),
+        nthreads)
+    return _report_stats(result, stats)
+
+
+def xyxymatch_many(pairs,
+                   origin = (0.0, 0.0),
+                   mag = (1.0, 1.0),
+                   rotation = (0.0, 0.0),
+                   ref_origin = (0.0, 0.0),
+                   algorithm = 'tolerance',
+                   tolerance = 1.0,
+                   separation = 9.0,
+                   nmatch = 30,
+                   maxratio = 10.0,
+                   nreject = 10,
+                   index = 'grid',
+                   triangle_mode = 'all',
+                   k = 8,
+                   nthreads = 0,
+                   output = 'full',
+                   triangle_merge = 'sweep',
+                   offsets_max_rotation = 0.0,
+                   offsets_rotation_step = 1.0,
+                   offsets_max_scale = 0.0,
+                   offsets_scale_step = 0.01,
+                   nmatch_start = 0):
+    """
+    Run `xyxymatch` on many pairs of coordinate lists at once.
+
+    The pairs are matched in parallel on a pool of native threads, and
+    the Python interpreter lock is released while they run.  The same
+    matching parameters are used for every pair.
+
+    **Parameters:**
+
+    - *pairs*: A sequence of ``(input, ref)`` pairs, where each of
+      *input* and *ref* is a list of coordinates as accepted by
+      `xyxymatch`.  *ref* may also be a `ReferenceCatalog`, and the
+      same catalog may appear in many pairs.
+
+    - *nthreads*: The number of threads to use.  If 0, the number of
+      processors is used.  Default: 0
+
+    All other parameters are the same as for `xyxymatch`.
+
+    **Returns**: A list containing one result for each pair, in the
+    same order as *pairs*.  Each is the same as the one returned by
+    `xyxymatch` with the same *output*.  If matching any of the
+    pairs fails, `RuntimeError` is raised and no results are
+    returned.
+    """
+    return _stimage.xyxymatch_many(
+        pairs,
+        origin,
+        mag,
+        rotation,
+        ref_origin,
+        algorithm,
+        tolerance,
+        separation,
+        nmatch,
+        maxratio,
+        nreject,
+        index,
+        triangle_mode,
+        k,
+        nthreads,
+        output,
+        triangle_merge,
+        offsets_max_rotation,
+        offsets_rotation_step,
+        offsets_max_scale,
+        offsets_scale_step,
+        nmatch_start)
+
+
+def xyxymatch_tiled(input,
+                    ref,
+                    tile_size,
+                    out = None,
+                    sink = None,
+                    origin = (0.0, 0.0),
+                    mag = (1.0, 1.0),
+                    rotation = (0.0, 0.0),
+                    ref_origin = (0.0, 0.0),
+                    tolerance = 1.0,
+                    separation = 9.0,
+                    index = 'grid',
+                    max_coords = 1 << 22,
+                    nthreads = 0):
+    """
+    Match coordinate lists too large to be matched at once with the
+    ``'tolerance'`` algorithm of `xyxymatch`, in bounded memory.
+
+    The bounding box of the reference coordinates is divided into
+    square tiles, each of which is matched separately.  Each tile also
+    collects the coordinates within a halo of *tolerance* +
+    *separation* around it, so coordinates near its edge can match
+    coordinates across it, but only keeps the matches to reference
+    coordinates inside it, so no match is found twice.
+
+    *input* and *ref* are read in place when they are float64 or
+    float32 arrays, so they may be `numpy.memmap` arrays of catalogs
+    larger than memory.  They are read once to count the coordinates
+    in each tile, and then once for each batch of tiles that together
+    hold at most *max_coords* coordinates.  Only one batch is in
+    memory at a time, and its tiles are matched in parallel on native
+    threads without holding the Python interpreter lock.
+
+    The matches are the same as those of `xyxymatch` with
+    ``algorithm='tolerance'``, but in a different order: they are
+    written tile by tile.  Culling by *separation* only looks as far
+    as the halo, so a long chain of coordinates, each within
+    *separation* of the next, that crosses the edge of a tile may be
+    culled differently; with ``separation=0`` the matches are always
+    the same.  Coordinates that are not finite are ignored.
+
+    **Parameters:**
+
+    - *input*, *ref*: The input and reference coordinates, in any of
+      the forms accepted by `xyxymatch`.
+
+    - *tile_size*: The width and height of the tiles, in reference
+      pixels.  It should be much larger than *tolerance* +
+      *separation*.
+
+    - *out*: A structured array with the dtype of the result of
+      `xyxymatch`, such as a `numpy.memmap`, to write the matches to.
+      `ValueError` is raised if it is too small.
+
+    - *sink*: A callable that is passed the matches of each tile, as a
+      structured array with the dtype of the result of `xyxymatch`.
+      Any exception it raises stops the matching and is propagated.
+      May not be given with *out*.
+
+    - *max_coords*: The most coordinates to hold in memory at once.
+      A single tile that holds more is still matched.
+      Default: 4194304
+
+    - *nthreads*: The number of threads to use.  If 0, the number of
+      processors is used.  Default: 0
+
+    All other parameters are the same as for `xyxymatch`.
+
+    **Returns**: If *out* is given, the view of its leading rows that
+    holds the matches.  If *sink* is given, the number of matches.
+    Otherwise, a structured array of all of the matches, as returned
+    by `xyxymatch`.
+    """
+    if out is not None and sink is not None:
+        raise ValueError("out and sink may not both be given")
+
+    nmatches = [0]
+    chunks = []
+
+    def write(chunk):
+        n = nmatches[0]
+        if out is not None:
+            if n + len(chunk) > len(out):
+                raise ValueError("out is too small for the matches")
+            out[n:n + len(chunk)] = chunk
+        elif sink is not None:
+            sink(chunk)
+        else:
+            chunks.append(chunk)
+        nmatches[0] = n + len(chunk)
+
+    _stimage.xyxymatch_tiled(
+        input,
+        ref,
+        write,
+        tile_size,
+        origin,
+        mag,
+        rotation,
+        ref_origin,
+        tolerance,
+        separation,
+        index,
+        max_coords,
+        nthreads)
+
+    if out is not None:
+        return out[:nmatches[0]]
+    if sink is not None:
+        return nmatches[0]
+    if not chunks:
+        return np.zeros(0, dtype=[
+            ('input_x', 'f8'), ('input_y', 'f8'), ('input_idx', np.uintp),
+            ('ref_x', 'f8'), ('ref_y', 'f8'), ('ref_idx', np.uintp)])
+    return np.concatenate(chunks)
+
+
+def geomap_many(pairs,
+                bbox=None,
+                fit_geometry="general",
+                function="polynomial",
+                xxorder=2,
+                xyorder=2,
+                yxorder=2,
+                yyorder=2,
+                xxterms="half",
+                yxterms="half",
+                maxiter=0,
+                reject=0.0,
+                nthreads=0,
+                output="full"):
+    """
+    Run `geomap` on many pairs of coordinate lists at once.
+
+    The pairs are fit in parallel on a pool of native threads, and the
+    Python interpreter lock is released while they run.  The same
+    fitting parameters are used for every pair.
+
+    **Parameters:**
+
+    - *pairs*: A sequence of ``(input, ref)`` pairs, where each of
+      *input* and *ref* is a list of coordinates as accepted by
+      `geomap`.
+
+    - *nthreads*: The number of threads to use.  If 0, the number of
+      processors is used.  Default: 0
+
+    All other parameters are the same as for `geomap`, except that
+    *out* is not supported.
+
+    **Returns**: A list containing one 2-tuple for each pair, in the
+    same order as *pairs*.  Each 2-tuple is the same as the one
+    returned by `geomap`.  If fitting any of the pairs fails,
+    `RuntimeError` is raised and no results are returned.
+    """
+    return _stimage.geomap_many(
+        pairs,
+        bbox,
+        fit_geometry,
+        function,
+        xxorder,
+        xyorder,
+        yxorder,
+        yyorder,
+        xxterms,
+        yxterms,
+        maxiter,
+        reject,
+        nthreads,
+        output)
+
+
+class GeomapAccumulator(_stimage.GeomapAccumulator):
+    """
+    Fit a `geomap` transformation to more matched coordinates than fit
+    in memory at once.
+
+    Chunks of matched coordinates are added with `add`, which folds
+    them into fixed-size partial sums (the normal equations of the
+    fit) and keeps no per-coordinate data.  `solve` then returns the
+    fit of all of the coordinates added so far, and may be called
+    again after adding more.  Accumulators with the same parameters
+    can be combined with `merge`, and can be pickled, so the chunks
+    may be accumulated by separate threads or processes.  `add`
+    releases the Python interpreter lock, but a single accumulator
+    must not be used by two threads at once.
+
+    The fit is the same, up to rounding, as that of `geomap` on all of
+    the coordinates with the same *bbox*, except that:
+
+    - *bbox* must be given up front, since the surfaces are normalized
+      to it.  Coordinates whose reference coordinate is outside of it
+      are ignored.
+
+    - There is no rejection (*maxiter* and *reject*), since that needs
+      the residual of every coordinate.
+
+    - The *rms* is computed from the accumulated sums rather than from
+      the residual of each coordinate.
+
+    **Parameters:**
+
+    - *bbox*: The range of reference coordinates to fit, as
+      ``(xmin, ymin, xmax, ymax)``.  It must be finite and have a
+      non-zero width and height.
+
+    - *fit_geometry*, *function*, *xxorder*, *xyorder*, *yxorder*,
+      *yyorder*, *xxterms*, *yxterms*: The same as for `geomap`.
+    """
+    def __init__(self,
+                 bbox,
+                 fit_geometry="general",
+                 function="polynomial",
+                 xxorder=2,
+                 xyorder=2,
+                 yxorder=2,
+                 yyorder=2,
+                 xxterms="half",
+                 yxterms="half"):
+        super(GeomapAccumulator, self).__init__(
+            bbox,
+            fit_geometry,
+            function,
+            xxorder,
+            xyorder,
+            yxorder,
+            yyorder,
+            xxterms,
+            yxterms)
+
+    def add(self, input, ref, weights=None):
+        """
+        Add a chunk of matched coordinates to the fit.
+
+        *input* and *ref* are lists of coordinates of the same length,
+        in any of the forms accepted by `geomap`, where ``input[i]``
+        is matched with ``ref[i]``.  *weights*, if given, is the
+        weight of each pair.
+        """
+        super(GeomapAccumulator, self).add(input, ref, weights)
+
+    def merge(self, other):
+        """
+        Add the coordinates accumulated by *other*, which must be a
+        `GeomapAccumulator` with the same parameters.
+        """
+        super(GeomapAccumulator, self).merge(other)
+
+    def solve(self):
+        """
+        Return the fit of all of the coordinates added so far.
+
+        **Returns**: An object with the same attributes as the first
+        item returned by `geomap`.
+        """
+        return super(GeomapAccumulator, self).solve()
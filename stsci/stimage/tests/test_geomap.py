@@ -27,6 +27,8 @@
 # USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
 # DAMAGE.
 
+import pickle
+
 import numpy as np
 import stsci.stimage as stimage
 
@@ -42,5 +44,345 @@ import stsci.stimage as stimage
 
 #     assert False
 
+def test_many_matches_single():
+    np.random.seed(0)
+    pairs = []
+    for i in range(5):
+        ref = np.random.random((64, 2)) * 100.0
+        input = ref + np.random.random(2)
+        pairs.append((input, ref))
+
+    results = stimage.geomap_many(pairs, nthreads=2)
+
+    assert len(results) == len(pairs)
+    for (input, ref), (fit, output) in zip(pairs, results):
+        single_fit, single_output = stimage.geomap(input, ref)
+        assert np.array_equal(fit.xcoeff, single_fit.xcoeff)
+        assert np.array_equal(fit.ycoeff, single_fit.ycoeff)
+        assert np.array_equal(output['input_x'], single_output['input_x'])
+        assert np.array_equal(output['ref_y'], single_output['ref_y'])
+
+def _rotation(theta, xmag=1.0, ymag=1.0):
+    # The linear part of a transform with the rotation (in degrees) and
+    # magnifications that geomap reports
+    theta = np.deg2rad(theta)
+    return np.array([[xmag * np.cos(theta), ymag * np.sin(theta)],
+                     [-xmag * np.sin(theta), ymag * np.cos(theta)]])
+
+def test_analytic_fits():
+    # Exact transforms of coordinates far from the origin, so that the
+    # centering of the legendre and chebyshev surfaces matters
+    np.random.seed(3)
+    ref = np.random.random((100, 2)) * (900.0, 700.0) + (1500.0, -800.0)
+    shift = np.array([12.5, -7.25])
+
+    cases = [
+        ('shift', np.eye(2), (0.0, 0.0), (1.0, 1.0)),
+        ('xyscale', np.diag([1.02, 0.97]), (0.0, 0.0), (1.02, 0.97)),
+        ('rotate', _rotation(4.0), (4.0, 4.0), (1.0, 1.0)),
+        ('rscale', _rotation(4.0, 1.03, 1.03), (4.0, 4.0), (1.03, 1.03)),
+        ('rxyscale', _rotation(4.0, 1.03, 0.98), (4.0, 4.0), (1.03, 0.98)),
+        ('general', np.array([[1.01, 0.02], [-0.03, 0.99]]), None, None)]
+
+    for fit_geometry, matrix, rotation, mag in cases:
+        input = np.dot(ref, matrix.T) + shift
+        for function in ('polynomial', 'legendre', 'chebyshev'):
+            fit, output = stimage.geomap(
+                input, ref, fit_geometry=fit_geometry, function=function)
+            np.testing.assert_allclose(output['fit_x'], input[:, 0],
+                                       rtol=0.0, atol=1e-8)
+            np.testing.assert_allclose(output['fit_y'], input[:, 1],
+                                       rtol=0.0, atol=1e-8)
+            np.testing.assert_allclose(fit.rms, 0.0, atol=1e-8)
+            np.testing.assert_allclose(fit.shift, shift, atol=1e-8)
+            if rotation is not None:
+                np.testing.assert_allclose(fit.rotation, rotation,
+                                           atol=1e-8)
+                np.testing.assert_allclose(fit.mag, mag, atol=1e-10)
+
+    # A distortion surface on top of the linear one
+    input = np.column_stack([
+        3.0 + 1.01 * ref[:, 0] + 0.02 * ref[:, 1] +
+        2e-5 * ref[:, 0] * ref[:, 1],
+        -4.0 - 0.03 * ref[:, 0] + 0.99 * ref[:, 1] + 1e-5 * ref[:, 0] ** 2])
+    for function in ('polynomial', 'legendre', 'chebyshev'):
+        fit, output = stimage.geomap(
+            input, ref, function=function, xxorder=3, xyorder=3,
+            yxorder=3, yyorder=3, xxterms='full', yxterms='full')
+        np.testing.assert_allclose(output['fit_x'], input[:, 0],
+                                   rtol=0.0, atol=1e-6)
+        np.testing.assert_allclose(output['fit_y'], input[:, 1],
+                                   rtol=0.0, atol=1e-6)
+
+def test_transform():
+    np.random.seed(0)
+    ref = np.random.random((256, 2)) * 1000.0
+    input = ref * 1.01 + (3.0, 4.0) + 1e-5 * ref ** 2
+
+    fit, output = stimage.geomap(
+        input, ref, function='legendre', xxorder=3, xyorder=3,
+        yxorder=3, yyorder=3)
+    transform = fit.transform
+    assert transform.has_distortion
+
+    xy = transform.transform(ref)
+    assert np.array_equal(xy[:, 0], output['fit_x'])
+    assert np.array_equal(xy[:, 1], output['fit_y'])
+
+    out = ref.copy()
+    assert transform.transform(out, out=out) is out
+    assert np.array_equal(out, xy)
+
+    restored = pickle.loads(pickle.dumps(transform))
+    assert np.array_equal(restored.transform(ref), xy)
+    assert np.array_equal(
+        restored.transform(ref, distortion=False),
+        transform.transform(ref, distortion=False))
+
+    columns = (ref[:, 0].astype(np.float32), ref[:, 1].astype(np.float32))
+    assert np.array_equal(
+        transform.transform(columns),
+        transform.transform(ref.astype(np.float32).astype(np.float64)))
+
+    fit2, output2 = stimage.geomap(
+        (input[:, 0], input[:, 1]), (ref[:, 0], ref[:, 1]),
+        function='legendre', xxorder=3, xyorder=3, yxorder=3, yyorder=3)
+    assert np.array_equal(output2, output)
+
+def test_high_order_terms():
+    # A distortion that each choice of cross terms can represent
+    # exactly, over more points than are accumulated at a time
+    np.random.seed(8)
+    ref = np.random.random((1000, 2)) * 2.0 - 1.0
+    x, y = ref[:, 0], ref[:, 1]
+    distortions = {
+        'none': (0.01 * x ** 3, 0.02 * y ** 3),
+        'half': (0.01 * x ** 2 * y, 0.02 * x * y ** 2),
+        'full': (0.01 * x ** 3 * y ** 3, 0.02 * x ** 2 * y ** 3),
+    }
+    for xterms, (dx, dy) in distortions.items():
+        input = ref * 1.01 + (0.3, -0.2)
+        input[:, 0] += dx
+        input[:, 1] += dy
+        fit, output = stimage.geomap(
+            input, ref, function='legendre', xxorder=4, xyorder=4,
+            yxorder=4, yyorder=4, xxterms=xterms, yxterms=xterms)
+        np.testing.assert_allclose(output['resid_x'], 0.0, atol=1e-10)
+        np.testing.assert_allclose(output['resid_y'], 0.0, atol=1e-10)
+
+def test_evaluate_grid():
+    np.random.seed(0)
+    ref = np.random.random((256, 2)) * 100.0
+    input = ref * 1.01 + (3.0, 4.0) + 1e-4 * ref ** 2
+
+    fit, output = stimage.geomap(
+        input, ref, function='chebyshev', xxorder=3, xyorder=3,
+        yxorder=3, yyorder=3, xxterms='full', yxterms='full')
+    transform = fit.transform
+
+    grid = transform.evaluate_grid(shape=(40, 30))
+    x, y = np.meshgrid(np.arange(1.0, 31.0), np.arange(1.0, 41.0))
+    xy = transform.transform(np.column_stack([x.ravel(), y.ravel()]))
+    np.testing.assert_allclose(grid.reshape(-1, 2), xy, rtol=1e-12)
+
+    # Fill one tile of a larger array in place
+    out = np.zeros((40, 30, 2))
+    transform.evaluate_grid(
+        x=np.arange(11.0, 21.0), y=np.arange(6.0, 26.0),
+        out=out[5:25, 10:20])
+    assert np.array_equal(out[5:25, 10:20], grid[5:25, 10:20])
+    assert not out[:5].any()
+
+def _evaluate_surface(surface, xy):
+    # An evaluation of a (function, xorder, yorder, xterms, bbox,
+    # (xrange, xmaxmin, yrange, ymaxmin), coeff) surface with numpy,
+    # independent of the C code
+    if surface is None:
+        return 0.0
+    (function, xorder, yorder, xterms, bbox,
+     (xrange, xmaxmin, yrange, ymaxmin), coeff) = surface
+    x, y = xy[:, 0], xy[:, 1]
+    if function != 'polynomial':
+        x = (x + xmaxmin) * xrange
+        y = (y + ymaxmin) * yrange
+    vander = {'polynomial': np.polynomial.polynomial.polyvander,
+              'legendre': np.polynomial.legendre.legvander,
+              'chebyshev': np.polynomial.chebyshev.chebvander}[function]
+    bx = vander(x, xorder - 1)
+    by = vander(y, yorder - 1)
+
+    # The x terms vary fastest.  Without cross terms the constant is
+    # followed by the pure x, then the pure y terms, and with half
+    # cross terms only x**i * y**j with i + j < max(xorder, yorder)
+    # are kept.
+    if xterms == 'none':
+        terms = [bx[:, i] for i in range(xorder)]
+        terms += [by[:, j] for j in range(1, yorder)]
+    else:
+        maxorder = max(xorder, yorder)
+        terms = [bx[:, i] * by[:, j]
+                 for j in range(yorder) for i in range(xorder)
+                 if xterms == 'full' or i + j < maxorder]
+    assert len(terms) == len(coeff)
+    return np.dot(np.column_stack(terms), coeff)
+
+def test_surface_evaluation():
+    np.random.seed(10)
+    ref = np.random.random((600, 2)) * 1000.0 + (200.0, -300.0)
+    input = (ref * 1.01 + (3.0, 4.0) + 1e-5 * ref ** 2 +
+             1e-8 * ref[:, ::-1] ** 3 +
+             np.random.normal(scale=0.05, size=ref.shape))
+
+    for function in ('polynomial', 'legendre', 'chebyshev'):
+        for xterms in ('none', 'half', 'full'):
+            for xorder, yorder in ((2, 2), (3, 3), (4, 4), (4, 2), (2, 3)):
+                fit, output = stimage.geomap(
+                    input, ref, function=function,
+                    xxorder=xorder, xyorder=yorder,
+                    yxorder=yorder, yyorder=xorder,
+                    xxterms=xterms, yxterms=xterms)
+                # A linear fit without cross terms has no distortion
+                # surfaces
+                sx1, sy1, sx2, sy2 = fit.transform.surfaces
+                if max(xorder, yorder) > 2 or xterms == 'full':
+                    assert sx2[1:4] == (xorder, yorder, xterms)
+                    assert sy2[1:4] == (yorder, xorder, xterms)
+
+                fit_x = (_evaluate_surface(sx1, ref) +
+                         _evaluate_surface(sx2, ref))
+                fit_y = (_evaluate_surface(sy1, ref) +
+                         _evaluate_surface(sy2, ref))
+                np.testing.assert_allclose(
+                    output['fit_x'], fit_x, rtol=0.0, atol=1e-8)
+                np.testing.assert_allclose(
+                    output['fit_y'], fit_y, rtol=0.0, atol=1e-8)
+                np.testing.assert_allclose(
+                    output['resid_x'], input[:, 0] - fit_x,
+                    rtol=0.0, atol=1e-8)
+                np.testing.assert_allclose(
+                    output['resid_y'], input[:, 1] - fit_y,
+                    rtol=0.0, atol=1e-8)
+
+def test_output_modes():
+    np.random.seed(1)
+    ref = np.random.random((200, 2)) * 1000.0
+    input = ref * 0.99 + (1.0, -2.0) + 1e-6 * ref ** 2
+
+    fit, output = stimage.geomap(input, ref, xxorder=3, xyorder=3,
+                                 yxorder=3, yyorder=3)
+
+    lean, none = stimage.geomap(input, ref, xxorder=3, xyorder=3,
+                                yxorder=3, yyorder=3, output='none')
+    assert none is None
+    assert np.array_equal(lean.xcoeff, fit.xcoeff)
+    assert np.array_equal(lean.x2coeff, fit.x2coeff)
+    assert np.array_equal(lean.rms, fit.rms)
+
+    out = np.zeros(len(ref) + 10, dtype=output.dtype)
+    fit2, output2 = stimage.geomap(input, ref, xxorder=3, xyorder=3,
+                                   yxorder=3, yyorder=3, out=out)
+    assert np.shares_memory(output2, out)
+    assert np.array_equal(output2, output)
+
+    for fit3, output3 in stimage.geomap_many([(input, ref)] * 2,
+                                             xxorder=3, xyorder=3,
+                                             yxorder=3, yyorder=3,
+                                             output='none'):
+        assert output3 is None
+        assert np.array_equal(fit3.xcoeff, fit.xcoeff)
+
+def test_accumulator():
+    np.random.seed(2)
+    ref = np.random.random((3000, 2)) * 1000.0
+    input = (ref * 1.01 + (3.0, 4.0) + 1e-5 * ref ** 2 +
+             np.random.normal(scale=0.1, size=ref.shape))
+    bbox = (0.0, 0.0, 1000.0, 1000.0)
+
+    for function in ('polynomial', 'legendre'):
+        for fit_geometry in ('shift', 'xyscale', 'rotate', 'rscale',
+                             'rxyscale', 'general'):
+            kwargs = dict(fit_geometry=fit_geometry, function=function,
+                          xxorder=3, xyorder=3, yxorder=3, yyorder=3)
+            fit, output = stimage.geomap(input, ref, bbox=bbox, **kwargs)
+
+            # Accumulate the chunks in two accumulators, one of them
+            # sent through pickle, as if by another process
+            first = stimage.GeomapAccumulator(bbox, **kwargs)
+            second = stimage.GeomapAccumulator(bbox, **kwargs)
+            first.add(input[:1000], ref[:1000])
+            second.add((input[1000:2000, 0], input[1000:2000, 1]),
+                       ref[1000:2000])
+            second = pickle.loads(pickle.dumps(second))
+            second.add(input[2000:], ref[2000:])
+            first.merge(second)
+            assert first.ncoord == len(ref)
+
+            result = first.solve()
+            assert result.fit_geometry == fit.fit_geometry
+            for name in ('xcoeff', 'ycoeff', 'x2coeff', 'y2coeff', 'shift',
+                         'mag', 'rotation', 'mean_ref', 'mean_input', 'rms'):
+                np.testing.assert_allclose(
+                    getattr(result, name), getattr(fit, name),
+                    rtol=1e-7, atol=1e-7)
+
+    # A weight of zero drops a coordinate
+    weights = np.ones(len(ref))
+    weights[::3] = 0.0
+    acc = stimage.GeomapAccumulator(bbox)
+    acc.add(input, ref, weights=weights)
+    fit, output = stimage.geomap(input[weights != 0], ref[weights != 0],
+                                 bbox=bbox)
+    np.testing.assert_allclose(acc.solve().xcoeff, fit.xcoeff, rtol=1e-9)
+
+def test_geomap_stats():
+    np.random.seed(7)
+    ref = np.random.random((500, 2)) * 1000.0
+    input = ref + (1.0, 2.0) + np.random.normal(scale=0.1, size=ref.shape)
+    input[::50] += 20.0
+
+    fit, output, stats = stimage.geomap(
+        input, ref, bbox=(0.0, 0.0, 900.0, 1000.0), maxiter=3, reject=3.0,
+        stats=True)
+    assert stats['fit']['points'] == len(output)
+    assert stats['bbox']['removed'] == len(ref) - len(output)
+    assert 1 <= stats['reject']['iterations'] <= 3
+    assert stats['reject']['rejected'] == np.isnan(output['fit_x']).sum()
+    assert stats['geomap']['time'] >= stats['fit']['time'] > 0.0
+
+    collected = []
+    fit, output = stimage.geomap(input, ref, output='none',
+                                 stats=collected.append)
+    assert output is None
+    assert 'evaluate' not in collected[0]
+
+def test_nthreads():
+    # Enough points to be split into several chunks, with outliers so
+    # that the rejection iterations run too
+    np.random.seed(9)
+    ref = np.random.random((100000, 2)) * 4000.0
+    input = (ref * 1.001 + (12.0, -7.0) + 1e-6 * ref ** 2 +
+             np.random.normal(scale=0.05, size=ref.shape))
+    input[::50] += 20.0
+
+    kwargs = dict(function='legendre', xxorder=4, xyorder=4, yxorder=4,
+                  yyorder=4, xxterms='full', yxterms='full', maxiter=3,
+                  reject=3.0)
+    fit, output = stimage.geomap(input, ref, **kwargs)
+    for nthreads in (0, 4):
+        fit2, output2 = stimage.geomap(input, ref, nthreads=nthreads,
+                                       **kwargs)
+        for name in ('xcoeff', 'ycoeff', 'x2coeff', 'y2coeff', 'rms'):
+            assert np.array_equal(getattr(fit2, name), getattr(fit, name))
+        for name in output.dtype.names:
+            assert np.array_equal(output2[name], output[name],
+                                  equal_nan=True)
+
+        transform = fit.transform
+        assert np.array_equal(transform.transform(ref, nthreads=nthreads),
+                              transform.transform(ref))
+        assert np.array_equal(
+            transform.evaluate_grid(shape=(300, 200), nthreads=nthreads),
+            transform.evaluate_grid(shape=(300, 200)))
+
 if __name__ == '__main__':
     test_same()
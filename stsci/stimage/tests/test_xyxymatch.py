@@ -29,6 +29,8 @@
 
 from __future__ import print_function
 
+import os
+
 import numpy as np
 import stsci.stimage as stimage
 
@@ -73,3 +75,597 @@ def test_different():
         assert r['ref_idx'][i] < 512
 
 
+
+def test_grid_matches_sweep():
+    np.random.seed(0)
+    # A coarse lattice produces many exact distance ties, and rounding
+    # the y values puts many coordinates in the same y band.
+    ref = np.round(np.random.random((2048, 2)) * 64.0) / 2.0
+    input = ref + np.random.normal(scale=0.3, size=ref.shape)
+    input[:, 1] = np.round(input[:, 1])
+
+    for tolerance in (0.5, 1.0, 2.5):
+        sweep = stimage.xyxymatch(input, ref, algorithm='tolerance',
+                                  tolerance=tolerance, separation=0.0,
+                                  index='sweep')
+        grid = stimage.xyxymatch(input, ref, algorithm='tolerance',
+                                 tolerance=tolerance, separation=0.0,
+                                 index='grid')
+
+        assert len(sweep) > 0
+        assert np.array_equal(sweep, grid)
+
+
+def test_many_matches_single():
+    np.random.seed(0)
+    pairs = []
+    for i in range(9):
+        ref = np.random.random((256, 2)) * 100.0
+        input = ref + np.random.normal(scale=0.05, size=ref.shape)
+        pairs.append((input[np.random.permutation(256)], ref))
+
+    for nthreads in (1, 4):
+        results = stimage.xyxymatch_many(pairs, tolerance=0.5,
+                                         separation=0.0, nthreads=nthreads)
+
+        assert len(results) == len(pairs)
+        for (input, ref), r in zip(pairs, results):
+            assert len(r) > 0
+            assert np.array_equal(
+                r, stimage.xyxymatch(input, ref, tolerance=0.5,
+                                     separation=0.0))
+
+
+def test_triangles_refines_full_list():
+    np.random.seed(0)
+    ref = np.random.random((400, 2)) * 2000.0
+    input = ref + [15.3, -8.2] + np.random.normal(scale=0.05, size=ref.shape)
+    order = np.random.permutation(len(ref))
+    input = input[order]
+
+    # More coordinates than nmatch, so only a subsample is matched
+    # with triangles and the rest with the refined transform.
+    r = stimage.xyxymatch(input, ref, algorithm='triangles', tolerance=1.0,
+                          separation=0.0, nmatch=30)
+
+    assert len(r) == len(ref)
+    assert np.all(order[r['input_idx']] == r['ref_idx'])
+
+
+def test_triangles_keeps_matches_refine_loses():
+    np.random.seed(0)
+    ref = np.random.random((300, 2)) * 1000.0
+    keep = np.random.permutation(len(ref))[:270]
+    input = np.vstack([ref[keep] + [10.0, -20.0],
+                       np.random.random((5, 2)) * 1000.0])
+
+    # The transform refit to these triangle matches finds fewer
+    # matches in the whole lists, so the triangle matches are kept
+    r, stats = stimage.xyxymatch(
+        input, ref, algorithm='triangles', tolerance=1.0, separation=0.0,
+        nmatch=50, stats=True)
+    assert stats['match_triangles']['matches'] == 50
+    assert stats['refine']['kept'] == 50
+    assert len(r) == 50
+
+    r, stats = stimage.xyxymatch(
+        input, ref, algorithm='triangles', tolerance=1.0, separation=0.0,
+        nmatch=60, stats=True)
+    assert 'kept' not in stats['refine']
+    assert len(r) == 270
+    assert np.all(keep[r['input_idx']] == r['ref_idx'])
+
+
+def test_refine_rejects_wrong_matches():
+    np.random.seed(3)
+    ref = np.random.random((320, 2)) * 1000.0
+    keep = np.random.permutation(len(ref))[:270]
+    theta = np.deg2rad(-0.7)
+    rot = np.array([[np.cos(theta), -np.sin(theta)],
+                    [np.sin(theta), np.cos(theta)]])
+    input = np.vstack([
+        np.dot(ref[keep], rot.T) + [40.0, 40.0] +
+        np.random.normal(scale=0.3, size=(270, 2)),
+        np.random.random((40, 2)) * 1000.0])
+
+    # The rotation is left to the refit, so the first matches with
+    # the offset alone include some wrong pairs, which would pull a
+    # plain least squares fit off the true transform.  The lists are
+    # not in the same order, so all of them are used for the offsets.
+    r, stats = stimage.xyxymatch(
+        input, ref, algorithm='offsets', tolerance=3.0, separation=0.0,
+        nmatch=len(ref), stats=True)
+    assert stats['refine']['rejected'] > 0
+    good = r['input_idx'] < len(keep)
+    good[good] = keep[r['input_idx'][good]] == r['ref_idx'][good]
+    assert np.count_nonzero(good) >= 265
+
+
+def test_triangles_knn():
+    np.random.seed(0)
+    ref = np.random.random((300, 2)) * 2000.0
+    theta = np.deg2rad(30.0)
+    rot = np.array([[np.cos(theta), -np.sin(theta)],
+                    [np.sin(theta), np.cos(theta)]])
+    keep = np.nonzero(np.random.random(len(ref)) < 0.85)[0]
+    input = np.dot(ref[keep] - 1000.0, rot.T) * 1.2 + [1100.0, 900.0]
+    order = np.random.permutation(len(input))
+    input = input[order]
+
+    # nmatch covers the whole lists, which would be far too many
+    # triangles with triangle_mode='all'.
+    r = stimage.xyxymatch(input, ref, algorithm='triangles', tolerance=1.0,
+                          separation=0.0, nmatch=400, triangle_mode='knn',
+                          k=8)
+
+    assert len(r) == len(keep)
+    assert np.all(keep[order[r['input_idx']]] == r['ref_idx'])
+
+
+def test_reference_catalog():
+    np.random.seed(2)
+    ref = np.random.random((200, 2)) * 1000.0
+    inputs = [ref[np.random.permutation(len(ref))[:150]] + 0.1 * i
+              for i in range(3)]
+
+    catalog = stimage.ReferenceCatalog(ref, separation=0.0, tolerance=0.5,
+                                       nmatch=20)
+    assert catalog.nref_unique == len(ref)
+
+    for kwargs in [dict(tolerance=0.5),
+                   dict(tolerance=0.5, index='sweep'),
+                   dict(tolerance=0.3),
+                   dict(algorithm='triangles', tolerance=0.5, nmatch=20),
+                   dict(algorithm='triangles', tolerance=0.5, nmatch=25),
+                   dict(algorithm='triangles', tolerance=0.5, nmatch=100,
+                        triangle_mode='knn')]:
+        expected = [stimage.xyxymatch(input, ref, separation=0.0, **kwargs)
+                    for input in inputs]
+        for input, e in zip(inputs, expected):
+            r = stimage.xyxymatch(input, catalog, separation=0.0, **kwargs)
+            assert np.all(r == e)
+        many = stimage.xyxymatch_many([(input, catalog) for input in inputs],
+                                      separation=0.0, **kwargs)
+        for r, e in zip(many, expected):
+            assert np.all(r == e)
+
+    # The catalog keeps its own, read-only copy of the coordinates, so
+    # changing the array it was made from does not change the matches
+    assert not np.shares_memory(catalog.ref, ref)
+    assert not catalog.ref.flags.writeable
+    expected = stimage.xyxymatch(inputs[0], catalog, separation=0.0,
+                                 tolerance=0.5)
+    ref[:] = 0.0
+    r = stimage.xyxymatch(inputs[0], catalog, separation=0.0, tolerance=0.5)
+    assert len(r) == len(inputs[0])
+    assert np.all(r == expected)
+
+
+def test_reference_catalog_save_load(tmp_path):
+    np.random.seed(3)
+    ref = np.random.random((200, 2)) * 1000.0
+    input = ref[np.random.permutation(len(ref))[:150]] + 0.1
+
+    catalog = stimage.ReferenceCatalog(ref, separation=0.0, tolerance=0.5,
+                                       nmatch=20)
+    path = str(tmp_path / 'catalog.stimref')
+    catalog.save(path)
+
+    for mmap in (True, False):
+        loaded = stimage.ReferenceCatalog.load(path, mmap=mmap)
+        assert isinstance(loaded, stimage.ReferenceCatalog)
+        assert np.all(loaded.ref == ref)
+        assert loaded.ntriangles == catalog.ntriangles
+        assert loaded.nmatch == 20
+        for algorithm in ('tolerance', 'triangles'):
+            r = stimage.xyxymatch(input, loaded, algorithm=algorithm,
+                                  tolerance=0.5, separation=0.0, nmatch=20)
+            e = stimage.xyxymatch(input, ref, algorithm=algorithm,
+                                  tolerance=0.5, separation=0.0, nmatch=20)
+            assert np.all(r == e)
+
+    data = open(path, 'rb').read()
+    with open(path, 'wb') as fh:
+        fh.write(data[:-8])
+    try:
+        stimage.ReferenceCatalog.load(path)
+    except ValueError:
+        pass
+    else:
+        assert False, "a truncated file was loaded"
+
+    # A flipped byte in any of the parameters in the header (from the
+    # separation at offset 40 to k at offset 111) is detected
+    catalog.save(path)
+    data = bytearray(open(path, 'rb').read())
+    for offset in (40, 72, 104, 111):
+        corrupt = bytearray(data)
+        corrupt[offset] ^= 0x10
+        with open(path, 'wb') as fh:
+            fh.write(corrupt)
+        try:
+            stimage.ReferenceCatalog.load(path)
+        except ValueError:
+            pass
+        else:
+            assert False, "a corrupt header at %d was loaded" % offset
+
+    cache_dir = str(tmp_path / 'cache')
+    first = stimage.ReferenceCatalog.cached(ref, cache_dir, separation=0.0)
+    second = stimage.ReferenceCatalog.cached(ref, cache_dir, separation=0.0)
+    assert isinstance(second.ref.base, np.memmap)
+    assert np.all(second.ref == first.ref)
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_column_inputs():
+    np.random.seed(0)
+    ref = np.random.random((300, 2)) * 1000.0
+    input = ref + np.random.normal(scale=0.05, size=ref.shape)
+
+    expected = stimage.xyxymatch(input, ref, algorithm='tolerance',
+                                 tolerance=0.5, separation=0.0)
+
+    # Columns of a record array are strided views, read in place
+    table = np.zeros(len(input), dtype=[('id', 'i4'), ('x', 'f8'),
+                                        ('flag', 'u1'), ('y', 'f8')])
+    table['x'] = input[:, 0]
+    table['y'] = input[:, 1]
+    r = stimage.xyxymatch((table['x'], table['y']), (ref[:, 0], ref[:, 1]),
+                          algorithm='tolerance', tolerance=0.5,
+                          separation=0.0)
+    assert np.array_equal(r, expected)
+
+    swapped = input.astype('>f8')
+    r = stimage.xyxymatch(swapped, ref, algorithm='tolerance',
+                          tolerance=0.5, separation=0.0)
+    assert np.array_equal(r, expected)
+
+    single = input.astype(np.float32)
+    r = stimage.xyxymatch((single[:, 0], single[:, 1]), ref,
+                          algorithm='tolerance', tolerance=0.5,
+                          separation=0.0)
+    assert len(r) == len(expected)
+    assert np.array_equal(r['input_idx'], expected['input_idx'])
+    assert np.array_equal(r['input_x'], single[r['input_idx'], 0])
+
+
+def test_output_indices():
+    np.random.seed(4)
+    ref = np.random.random((300, 2)) * 1000.0
+    input = ref[np.random.permutation(len(ref))[:200]] + 0.1
+    catalog = stimage.ReferenceCatalog(ref, separation=0.0, tolerance=0.5,
+                                       nmatch=20)
+
+    for kwargs in [dict(tolerance=0.5),
+                   dict(algorithm='triangles', tolerance=0.5, nmatch=20)]:
+        full = stimage.xyxymatch(input, ref, separation=0.0, **kwargs)
+        for r in (ref, catalog):
+            input_idx, ref_idx = stimage.xyxymatch(
+                input, r, separation=0.0, output='indices', **kwargs)
+            assert np.array_equal(input_idx, full['input_idx'])
+            assert np.array_equal(ref_idx, full['ref_idx'])
+
+        many = stimage.xyxymatch_many([(input, ref)] * 3, separation=0.0,
+                                      output='indices', **kwargs)
+        for input_idx, ref_idx in many:
+            assert np.array_equal(input_idx, full['input_idx'])
+            assert np.array_equal(ref_idx, full['ref_idx'])
+
+
+def test_output_more_matches_than_inputs():
+    np.random.seed(15)
+    ref = np.random.random((200, 2)) * 1000.0
+    input = ref[:50] + 0.1
+    catalog = stimage.ReferenceCatalog(ref, separation=0.0, tolerance=50.0)
+
+    # A large tolerance matches many references to each input, so
+    # there are more matches than input coordinates
+    for algorithm in ('tolerance', 'triangles', 'offsets'):
+        for r in (ref, catalog):
+            input_idx, ref_idx = stimage.xyxymatch(
+                input, r, algorithm=algorithm, tolerance=50.0,
+                separation=0.0, output='indices')
+            full = stimage.xyxymatch(
+                input, r, algorithm=algorithm, tolerance=50.0,
+                separation=0.0)
+            assert np.array_equal(full['input_idx'], input_idx)
+            assert np.array_equal(full['ref_idx'], ref_idx)
+            assert np.array_equal(full['input_x'], input[input_idx, 0])
+            assert np.array_equal(full['ref_y'], ref[ref_idx, 1])
+
+        input_idx, ref_idx = stimage.xyxymatch(
+            input, ref, algorithm=algorithm, tolerance=50.0,
+            separation=0.0, output='indices')
+        many = stimage.xyxymatch_many(
+            [(input, ref)], algorithm=algorithm, tolerance=50.0,
+            separation=0.0)
+        assert np.array_equal(many[0]['input_idx'], input_idx)
+        assert np.array_equal(many[0]['ref_idx'], ref_idx)
+
+    full = stimage.xyxymatch(input, ref, tolerance=50.0, separation=0.0)
+    assert len(full) > len(input)
+
+
+def test_tiled(tmp_path):
+    np.random.seed(5)
+    ref = np.random.random((20000, 2)) * 3000.0
+    input = (ref[np.random.permutation(len(ref))] + (2.0, -1.0) +
+             np.random.normal(scale=0.2, size=ref.shape))
+    kwargs = dict(origin=(2.0, -1.0), tolerance=1.0, separation=0.0)
+
+    expected = stimage.xyxymatch(input, ref, **kwargs)
+    expected = np.sort(expected, order='ref_idx')
+
+    input_map = np.memmap(str(tmp_path / 'input'), dtype=np.float64,
+                          mode='w+', shape=input.shape)
+    input_map[:] = input
+    out = np.memmap(str(tmp_path / 'out'), dtype=expected.dtype,
+                    mode='w+', shape=(len(input),))
+
+    # Small batches, so the lists are read many times
+    r = stimage.xyxymatch_tiled(input_map, ref, 200.0, out=out,
+                                max_coords=5000, nthreads=4, **kwargs)
+    assert np.shares_memory(r, out)
+    assert np.array_equal(np.sort(r, order='ref_idx'), expected)
+
+    chunks = []
+    n = stimage.xyxymatch_tiled(input, ref, 200.0, sink=chunks.append,
+                                **kwargs)
+    assert n == len(expected)
+    assert len(chunks) > 1
+    r = stimage.xyxymatch_tiled(input, ref, 200.0, **kwargs)
+    assert np.array_equal(np.concatenate(chunks), r)
+
+    try:
+        stimage.xyxymatch_tiled(input, ref, 200.0, out=out[:10], **kwargs)
+    except ValueError:
+        pass
+    else:
+        assert False, "out was too small"
+
+
+def test_stats():
+    np.random.seed(6)
+    ref = np.random.random((200, 2)) * 1000.0
+    input = ref + (3.0, 2.0)
+    ref[1] = ref[0] + 1.0
+
+    expected = stimage.xyxymatch(input, ref, algorithm='triangles')
+    r, stats = stimage.xyxymatch(input, ref, algorithm='triangles',
+                                 stats=True)
+    assert np.array_equal(r, expected)
+    assert stats['xyxymatch']['matches'] == len(r)
+    assert stats['xycoincide']['ref_removed'] >= 1
+    assert stats['find_triangles']['kept'] > 0
+    assert stats['vote']['max_votes'] <= stats['vote']['votes']
+    assert stats['xyxymatch']['time'] >= stats['vote']['time'] > 0.0
+
+    collected = []
+    r = stimage.xyxymatch(input, ref, origin=(3.0, 2.0),
+                          stats=collected.append)
+    assert np.array_equal(r, stimage.xyxymatch(input, ref, origin=(3.0, 2.0)))
+    assert collected[0]['tolerance']['matches'] == len(r)
+    assert 'find_triangles' not in collected[0]
+
+
+def test_triangles_nthreads():
+    np.random.seed(9)
+    ref = np.random.random((50, 2)) * 2000.0
+    theta = np.deg2rad(10.0)
+    rot = np.array([[np.cos(theta), -np.sin(theta)],
+                    [np.sin(theta), np.cos(theta)]])
+    input = (np.dot(ref - 1000.0, rot.T) * 1.05 + [1030.0, 980.0] +
+             np.random.normal(scale=0.05, size=ref.shape))
+
+    # Enough triangles that they are sorted and merged in several parts
+    expected, stats = stimage.xyxymatch(
+        input, ref, algorithm='triangles', separation=0.0, nmatch=50,
+        stats=True)
+    assert len(expected) == len(ref)
+    for nthreads in (0, 4):
+        r, threaded_stats = stimage.xyxymatch(
+            input, ref, algorithm='triangles', separation=0.0, nmatch=50,
+            nthreads=nthreads, stats=True)
+        assert np.array_equal(r, expected)
+        for stage in ('find_triangles', 'merge_triangles'):
+            for name, value in stats[stage].items():
+                if name != 'time':
+                    assert threaded_stats[stage][name] == value
+
+
+def test_triangle_merge_grid():
+    np.random.seed(11)
+    ref = np.random.random((40, 2)) * 2000.0
+    theta = np.deg2rad(-25.0)
+    rot = np.array([[np.cos(theta), -np.sin(theta)],
+                    [np.sin(theta), np.cos(theta)]])
+    input = (np.dot(ref - 1000.0, rot.T) * 0.9 + [950.0, 1040.0] +
+             np.random.normal(scale=0.05, size=ref.shape))
+
+    for triangle_mode in ('all', 'knn'):
+        expected, stats = stimage.xyxymatch(
+            input, ref, algorithm='triangles', separation=0.0,
+            triangle_mode=triangle_mode, stats=True)
+        r, grid_stats = stimage.xyxymatch(
+            input, ref, algorithm='triangles', separation=0.0,
+            triangle_mode=triangle_mode, triangle_merge='grid', stats=True)
+        assert len(expected) == len(ref)
+        assert np.array_equal(r, expected)
+        assert (grid_stats['merge_triangles']['matches'] ==
+                stats['merge_triangles']['matches'])
+        assert (grid_stats['merge_triangles']['candidates'] <
+                stats['merge_triangles']['candidates'])
+
+    r = stimage.xyxymatch_many(
+        [(input, ref)], algorithm='triangles', separation=0.0,
+        triangle_merge='grid')
+    assert np.array_equal(r[0], expected)
+
+    try:
+        stimage.xyxymatch(input, ref, algorithm='triangles',
+                          triangle_merge='hash')
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_nmatch_start():
+    np.random.seed(14)
+    ref = np.random.random((60, 2)) * 2000.0
+    input = ref + [12.0, -7.0] + np.random.normal(scale=0.05, size=ref.shape)
+
+    expected, stats = stimage.xyxymatch(
+        input, ref, algorithm='triangles', separation=0.0, nmatch=60,
+        stats=True)
+    assert len(expected) == len(ref)
+    assert stats['match_triangles']['levels'] == 1
+    assert stats['match_triangles']['nmatch'] == 60
+
+    # A convincing match among the first few coordinates stops the
+    # escalation well short of nmatch
+    r, stats = stimage.xyxymatch(
+        input, ref, algorithm='triangles', separation=0.0, nmatch=60,
+        nmatch_start=8, stats=True)
+    assert np.array_equal(np.sort(r, order='input_idx'),
+                          np.sort(expected, order='input_idx'))
+    assert stats['match_triangles']['nmatch'] < 60
+
+    r = stimage.xyxymatch_many(
+        [(input, ref)], algorithm='triangles', separation=0.0, nmatch=60,
+        nmatch_start=8)
+    assert np.array_equal(np.sort(r[0], order='input_idx'),
+                          np.sort(expected, order='input_idx'))
+
+    # Unrelated lists escalate all the way to nmatch
+    r, stats = stimage.xyxymatch(
+        np.random.random((60, 2)) * 2000.0, ref, algorithm='triangles',
+        separation=0.0, nmatch=30, nmatch_start=4, stats=True)
+    assert stats['match_triangles']['nmatch'] == 30
+    assert stats['match_triangles']['levels'] == 4
+
+    # The only triangle of the first three coordinates is too long and
+    # thin to pass maxratio, which just moves on to the next level
+    thin = np.vstack([[[100.0, 100.0], [101.0, 100.0], [1500.0, 900.0]],
+                      ref])
+    r, stats = stimage.xyxymatch(
+        thin + [12.0, -7.0], thin, algorithm='triangles', separation=0.0,
+        nmatch=63, nmatch_start=3, stats=True)
+    assert len(r) == len(thin)
+    assert np.all(r['input_idx'] == r['ref_idx'])
+    assert stats['match_triangles']['levels'] == 2
+    assert stats['match_triangles']['nmatch'] == 6
+
+    # Any other error at a level below nmatch is raised
+    try:
+        stimage.xyxymatch(
+            thin + [12.0, -7.0], thin, algorithm='triangles',
+            separation=0.0, nmatch=63, nmatch_start=3, maxratio=20.0)
+    except RuntimeError:
+        pass
+    else:
+        assert False
+
+
+def test_offsets():
+    np.random.seed(12)
+    ref = np.random.random((450, 2)) * 1000.0
+    # The sources the lists have in common come first, as they would
+    # if both were sorted by brightness
+    input = np.vstack([
+        ref[:400] + [250.0, -130.0] +
+        np.random.normal(scale=0.1, size=(400, 2)),
+        np.random.random((60, 2)) * 1000.0])
+
+    r, stats = stimage.xyxymatch(
+        input, ref, algorithm='offsets', separation=0.0, stats=True)
+    assert len(r) == 400
+    assert np.all(r['input_idx'] == r['ref_idx'])
+    assert stats['offsets']['trials'] == 1
+    assert stats['offsets']['votes'] >= 3
+
+    expected = stimage.xyxymatch(
+        input, ref, origin=(250.0, -130.0), separation=0.0)
+    assert np.array_equal(r, expected)
+
+    r = stimage.xyxymatch_many(
+        [(input, ref)], algorithm='offsets', separation=0.0)
+    assert np.array_equal(r[0], expected)
+
+    # Unrelated lists give no matches
+    r = stimage.xyxymatch(
+        np.random.random((450, 2)) * 1000.0, ref, algorithm='offsets',
+        separation=0.0)
+    assert len(r) == 0
+
+
+def test_offsets_background():
+    np.random.seed(14)
+    ref = np.random.random((450, 2)) * 1000.0
+    theta = np.deg2rad(10.0)
+    rot = np.array([[np.cos(theta), -np.sin(theta)],
+                    [np.sin(theta), np.cos(theta)]])
+    input = np.dot(ref - 500.0, rot.T) + [750.0, 370.0]
+
+    # A rotation outside the trials leaves only the random offsets,
+    # some of which agree by chance, but not enough to stand out
+    r, stats = stimage.xyxymatch(
+        input, ref, algorithm='offsets', tolerance=3.0, separation=0.0,
+        nmatch=450, stats=True)
+    assert len(r) == 0
+    assert stats['offsets']['votes'] > 3
+    assert stats['offsets']['votes'] < stats['offsets']['min_votes']
+
+    # Trying the rotation finds a peak that does
+    r, stats = stimage.xyxymatch(
+        input, ref, algorithm='offsets', tolerance=3.0, separation=0.0,
+        nmatch=450, offsets_max_rotation=10.0, offsets_rotation_step=1.0,
+        stats=True)
+    assert len(r) == len(ref)
+    assert np.all(r['input_idx'] == r['ref_idx'])
+    assert stats['offsets']['votes'] >= stats['offsets']['min_votes']
+
+
+def test_offsets_trials():
+    np.random.seed(13)
+    ref = np.random.random((400, 2)) * 1000.0
+    theta = np.deg2rad(0.3)
+    rot = np.array([[np.cos(theta), -np.sin(theta)],
+                    [np.sin(theta), np.cos(theta)]])
+    input = np.dot(ref - 500.0, rot.T) * 1.004 + [750.0, 370.0]
+
+    r, stats = stimage.xyxymatch(
+        input, ref, algorithm='offsets', tolerance=2.0, separation=0.0,
+        offsets_max_rotation=0.5, offsets_rotation_step=0.1,
+        offsets_max_scale=0.01, offsets_scale_step=0.002, stats=True)
+    assert stats['offsets']['trials'] == 11 * 11
+    assert len(r) == len(ref)
+    assert np.all(r['input_idx'] == r['ref_idx'])
+
+    for kwargs in (dict(tolerance=0.0),
+                   dict(tolerance=np.nan),
+                   dict(offsets_max_rotation=-0.5),
+                   dict(offsets_max_rotation=np.inf),
+                   dict(offsets_max_rotation=0.5, offsets_rotation_step=0.0),
+                   dict(offsets_max_rotation=0.5, offsets_rotation_step=-0.1),
+                   dict(offsets_max_rotation=0.5,
+                        offsets_rotation_step=np.nan),
+                   dict(offsets_max_scale=-0.01),
+                   dict(offsets_max_scale=1.0),
+                   dict(offsets_max_scale=np.nan),
+                   dict(offsets_max_scale=0.01, offsets_scale_step=0.0),
+                   dict(offsets_max_scale=0.01, offsets_scale_step=np.inf)):
+        for match in (stimage.xyxymatch,
+                      lambda input, ref, **kwargs: stimage.xyxymatch_many(
+                          [(input, ref)], **kwargs)):
+            try:
+                match(input, ref, algorithm='offsets', **kwargs)
+            except ValueError:
+                pass
+            else:
+                assert False, kwargs
+
+    # The offsets arguments are not checked for the other algorithms
+    stimage.xyxymatch(input, ref, algorithm='tolerance',
+                      offsets_max_rotation=0.5, offsets_rotation_step=0.0)
@@ -0,0 +1,279 @@
+#ifndef STSCI_STIMAGE_BENCH_H
+#define STSCI_STIMAGE_BENCH_H
+
+/*
+Helpers shared by the C micro-benchmarks.
+
+Each benchmark case runs in its own child process (where fork is
+available), so that the peak resident memory reported for a case is
+not inflated by the cases that ran before it.  A case generates its
+own synthetic catalogs, which are deterministic for a given seed, and
+brackets the code it measures with bench_start and bench_stop.
+
+The results are printed one line per case, tab separated:
+
+    benchmark  case  repeat  best_ms  mean_ms  peak_kb  delta_kb
+
+where peak_kb is the peak resident memory of the case's process and
+delta_kb the growth of that peak during the timed sections.
+*/
+
+#include <math.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <sys/resource.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <time.h>
+#include <unistd.h>
+#endif
+
+#include "lib/util.h"
+
+typedef struct {
+    size_t repeat;
+    double best;
+    double total;
+    long   peak_kb;
+    long   base_kb;
+    double t0;
+} bench_stats_t;
+
+typedef int (*bench_case_t)(void* data, bench_stats_t* stats);
+
+static inline double
+bench_now(void) {
+#ifdef _WIN32
+    LARGE_INTEGER freq, count;
+    QueryPerformanceFrequency(&freq);
+    QueryPerformanceCounter(&count);
+    return (double)count.QuadPart / (double)freq.QuadPart;
+#else
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (double)ts.tv_sec + 1e-9 * (double)ts.tv_nsec;
+#endif
+}
+
+/* The peak resident memory of this process in kB, or -1 if unknown */
+static inline long
+bench_peak_kb(void) {
+#ifdef _WIN32
+    return -1;
+#else
+    struct rusage usage;
+    if (getrusage(RUSAGE_SELF, &usage)) return -1;
+#ifdef __APPLE__
+    return (long)(usage.ru_maxrss / 1024);
+#else
+    return (long)usage.ru_maxrss;
+#endif
+#endif
+}
+
+static inline void
+bench_start(bench_stats_t* const stats) {
+    if (stats->repeat == 0) {
+        stats->base_kb = bench_peak_kb();
+    }
+    stats->t0 = bench_now();
+}
+
+static inline void
+bench_stop(bench_stats_t* const stats) {
+    const double elapsed = bench_now() - stats->t0;
+
+    if (stats->repeat == 0 || elapsed < stats->best) {
+        stats->best = elapsed;
+    }
+    stats->total += elapsed;
+    ++stats->repeat;
+}
+
+static inline int
+bench_run_inprocess(
+        bench_case_t func, void* data, bench_stats_t* const stats) {
+    int status;
+
+    memset(stats, 0, sizeof(bench_stats_t));
+    status = func(data, stats);
+    stats->peak_kb = bench_peak_kb();
+    return status;
+}
+
+/**
+Run a benchmark case and print its results.
+
+@return Non-zero if the case failed
+*/
+static inline int
+bench_run(
+        const char* const benchmark,
+        const char* const name,
+        bench_case_t func,
+        void* data) {
+    bench_stats_t stats;
+    int status;
+
+#ifdef _WIN32
+    status = bench_run_inprocess(func, data, &stats);
+#else
+    int fds[2];
+    pid_t pid;
+    int wstatus;
+    ssize_t nread;
+
+    fflush(stdout);
+    if (pipe(fds)) return 1;
+    pid = fork();
+    if (pid < 0) {
+        close(fds[0]);
+        close(fds[1]);
+        status = bench_run_inprocess(func, data, &stats);
+    } else if (pid == 0) {
+        close(fds[0]);
+        status = bench_run_inprocess(func, data, &stats);
+        if (status == 0 &&
+            write(fds[1], &stats, sizeof(stats)) != sizeof(stats)) {
+            status = 1;
+        }
+        close(fds[1]);
+        fflush(stdout);
+        _exit(status);
+    } else {
+        close(fds[1]);
+        nread = read(fds[0], &stats, sizeof(stats));
+        close(fds[0]);
+        if (waitpid(pid, &wstatus, 0) != pid ||
+            !WIFEXITED(wstatus) || WEXITSTATUS(wstatus) != 0 ||
+            nread != sizeof(stats)) {
+            status = 1;
+        } else {
+            status = 0;
+        }
+    }
+#endif
+
+    if (status || stats.repeat == 0) {
+        printf("%s\t%s\tFAILED\n", benchmark, name);
+        return 1;
+    }
+
+    printf("%s\t%s\t%lu\t%.3f\t%.3f\t%ld\t%ld\n",
+           benchmark, name, (unsigned long)stats.repeat,
+           1e3 * stats.best, 1e3 * stats.total / (double)stats.repeat,
+           stats.peak_kb,
+           (stats.peak_kb < 0 || stats.base_kb < 0) ?
+               -1L : stats.peak_kb - stats.base_kb);
+    fflush(stdout);
+    return 0;
+}
+
+static inline void
+bench_header(void) {
+    printf("benchmark\tcase\trepeat\tbest_ms\tmean_ms\tpeak_kb\tdelta_kb\n");
+}
+
+/* A small deterministic generator (splitmix64), so that the catalogs
+   are the same on every platform */
+typedef struct {
+    uint64_t state;
+} bench_rng_t;
+
+static inline void
+bench_rng_init(bench_rng_t* const rng, const uint64_t seed) {
+    rng->state = seed;
+}
+
+static inline double
+bench_uniform(bench_rng_t* const rng) {
+    uint64_t z = (rng->state += 0x9e3779b97f4a7c15ULL);
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+    z = z ^ (z >> 31);
+    return (double)(z >> 11) * (1.0 / 9007199254740992.0);
+}
+
+static inline double
+bench_normal(bench_rng_t* const rng) {
+    double u = bench_uniform(rng);
+    const double v = bench_uniform(rng);
+
+    if (u < 1e-300) u = 1e-300;
+    return sqrt(-2.0 * log(u)) * cos(6.283185307179586 * v);
+}
+
+/* n points uniformly distributed in [0, width) x [0, width) */
+static inline void
+bench_catalog_uniform(
+        bench_rng_t* const rng, const size_t n, const double width,
+        coord_t* const coords) {
+    size_t i;
+
+    for (i = 0; i < n; ++i) {
+        coords[i].x = width * bench_uniform(rng);
+        coords[i].y = width * bench_uniform(rng);
+    }
+}
+
+/* n points in nclusters gaussian clusters of the given sigma, with
+   centers uniformly distributed in [0, width) x [0, width) */
+static inline void
+bench_catalog_clustered(
+        bench_rng_t* const rng, const size_t n, const double width,
+        const size_t nclusters, const double sigma,
+        coord_t* const coords) {
+    size_t i, c;
+    coord_t center;
+
+    for (i = 0, c = 0; c < nclusters; ++c) {
+        const size_t end = n * (c + 1) / nclusters;
+        center.x = width * bench_uniform(rng);
+        center.y = width * bench_uniform(rng);
+        for (; i < end; ++i) {
+            coords[i].x = center.x + sigma * bench_normal(rng);
+            coords[i].y = center.y + sigma * bench_normal(rng);
+        }
+    }
+}
+
+/* Rotate by angle (in degrees), scale and shift coordinates, and add
+   gaussian noise of the given sigma */
+static inline void
+bench_catalog_transform(
+        bench_rng_t* const rng, const size_t n, const coord_t* const in,
+        const double angle, const double scale,
+        const double dx, const double dy, const double noise,
+        coord_t* const out) {
+    const double c = scale * cos(angle * 0.017453292519943295);
+    const double s = scale * sin(angle * 0.017453292519943295);
+    size_t i;
+
+    for (i = 0; i < n; ++i) {
+        const double x = in[i].x;
+        const double y = in[i].y;
+        out[i].x = c * x - s * y + dx + noise * bench_normal(rng);
+        out[i].y = s * x + c * y + dy + noise * bench_normal(rng);
+    }
+}
+
+/* The number of repetitions that keeps a case to roughly budget
+   seconds, given the duration of a first run */
+static inline size_t
+bench_repeat(const double first, const double budget) {
+    size_t n;
+
+    if (first <= 0.0) return 10;
+    n = (size_t)(budget / first);
+    if (n < 1) return 1;
+    if (n > 50) return 50;
+    return n;
+}
+
+#endif /* STSCI_STIMAGE_BENCH_H */
@@ -0,0 +1,159 @@
+/*
+Benchmarks geomap across the surface function, the polynomial order,
+the cross terms and the number of rejection iterations.
+*/
+
+#include "immatch/geomap.h"
+#include "bench.h"
+
+typedef struct {
+    geomap_fit_e   fit_geometry;
+    surface_type_e function;
+    size_t         order;
+    xterms_e       xterms;
+    size_t         maxiter;
+    size_t         n;
+} geomap_case_t;
+
+static int
+fit_once(const geomap_case_t* const c,
+         const coord_t* const input, const coord_t* const ref,
+         geomap_output_t* const output, bench_stats_t* const stats) {
+    bbox_t bbox;
+    geomap_result_t result;
+    size_t noutput = c->n;
+    stimage_error_t error;
+    int status;
+
+    stimage_error_init(&error);
+    bbox_init(&bbox);
+    geomap_result_init(&result);
+
+    bench_start(stats);
+    status = geomap(
+            c->n, input, c->n, ref, &bbox,
+            c->fit_geometry, c->function,
+            c->order, c->order, c->order, c->order,
+            c->xterms, c->xterms,
+            c->maxiter, 3.0,
+            &noutput, output, &result, &error);
+    bench_stop(stats);
+
+    if (status) {
+        printf("%s\n", stimage_error_get_message(&error));
+    }
+    geomap_result_free(&result);
+    return status;
+}
+
+static int
+geomap_case(void* data, bench_stats_t* stats) {
+    const geomap_case_t* const c = (const geomap_case_t*)data;
+    coord_t* ref = NULL;
+    coord_t* input = NULL;
+    geomap_output_t* output = NULL;
+    bench_rng_t rng;
+    size_t i, repeat;
+    int status = 1;
+
+    ref = malloc(c->n * sizeof(coord_t));
+    input = malloc(c->n * sizeof(coord_t));
+    output = malloc(c->n * sizeof(geomap_output_t));
+    if (ref == NULL || input == NULL || output == NULL) goto exit;
+
+    /* A rotated, scaled and shifted field with a small quadratic
+       distortion, noise and 2% outliers */
+    bench_rng_init(&rng, 4);
+    bench_catalog_uniform(&rng, c->n, 4096.0, ref);
+    bench_catalog_transform(
+            &rng, c->n, ref, 0.5, 1.001, 12.0, -7.0, 0.05, input);
+    for (i = 0; i < c->n; ++i) {
+        input[i].x += 1e-6 * ref[i].x * ref[i].y;
+        input[i].y += 2e-6 * ref[i].x * ref[i].x;
+        if (i % 50 == 0) {
+            input[i].x += 20.0 * bench_normal(&rng);
+            input[i].y += 20.0 * bench_normal(&rng);
+        }
+    }
+
+    if (fit_once(c, input, ref, output, stats)) goto exit;
+    repeat = bench_repeat(stats->best, 0.5);
+    for (i = 1; i < repeat; ++i) {
+        if (fit_once(c, input, ref, output, stats)) goto exit;
+    }
+
+    status = 0;
+
+ exit:
+    free(ref);
+    free(input);
+    free(output);
+    return status;
+}
+
+int main(int argc, char** argv) {
+    const surface_type_e functions[] = {
+        surface_type_polynomial, surface_type_legendre,
+        surface_type_chebyshev};
+    const char* const function_names[] = {
+        "polynomial", "legendre", "chebyshev"};
+    const size_t orders[] = {2, 3, 4, 6};
+    const xterms_e xterms[] = {xterms_none, xterms_half, xterms_full};
+    const char* const xterms_names[] = {"none", "half", "full"};
+    const size_t maxiters[] = {0, 3};
+    const size_t ns[] = {1000, 100000};
+    const geomap_fit_e geometries[] = {
+        geomap_fit_shift, geomap_fit_xyscale, geomap_fit_rotate,
+        geomap_fit_rscale, geomap_fit_rxyscale};
+    const char* const geometry_names[] = {
+        "shift", "xyscale", "rotate", "rscale", "rxyscale"};
+    geomap_case_t c;
+    char name[160];
+    size_t f, o, x, m, i;
+    int status = 0;
+
+    (void)argc;
+    (void)argv;
+
+    bench_header();
+
+    c.fit_geometry = geomap_fit_general;
+    for (i = 0; i < sizeof(ns) / sizeof(size_t); ++i) {
+        c.n = ns[i];
+        for (f = 0; f < 3; ++f) {
+            c.function = functions[f];
+            for (o = 0; o < sizeof(orders) / sizeof(size_t); ++o) {
+                c.order = orders[o];
+                for (x = 0; x < 3; ++x) {
+                    c.xterms = xterms[x];
+                    for (m = 0; m < sizeof(maxiters) / sizeof(size_t); ++m) {
+                        c.maxiter = maxiters[m];
+                        snprintf(name, sizeof(name),
+                                 "general/n=%lu/%s/order=%lu/xterms=%s/"
+                                 "maxiter=%lu",
+                                 (unsigned long)c.n, function_names[f],
+                                 (unsigned long)c.order, xterms_names[x],
+                                 (unsigned long)c.maxiter);
+                        status |= bench_run("geomap", name, geomap_case, &c);
+                    }
+                }
+            }
+        }
+    }
+
+    c.function = surface_type_polynomial;
+    c.order = 2;
+    c.xterms = xterms_none;
+    c.maxiter = 0;
+    for (i = 0; i < sizeof(ns) / sizeof(size_t); ++i) {
+        c.n = ns[i];
+        for (f = 0; f < sizeof(geometries) / sizeof(geomap_fit_e); ++f) {
+            c.fit_geometry = geometries[f];
+            snprintf(name, sizeof(name), "%s/n=%lu",
+                     geometry_names[f], (unsigned long)c.n);
+            status |= bench_run("geomap", name, geomap_case, &c);
+        }
+    }
+
+    return status;
+}
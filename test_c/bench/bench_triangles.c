@@ -0,0 +1,165 @@
+/*
+Benchmarks the scaling of find_triangles, merge_triangles and
+merge_triangles_grid with nmatch, the number of coordinates the
+triangles are formed from.
+*/
+
+#include "immatch/lib/triangles.h"
+#include "lib/xycoincide.h"
+#include "lib/xysort.h"
+#include "bench.h"
+
+typedef enum {
+    stage_find,
+    stage_merge,
+    stage_merge_grid
+} stage_e;
+
+typedef struct {
+    stage_e stage;
+    size_t  nmatch;
+} triangles_case_t;
+
+typedef struct {
+    coord_t        coords[2][1024];
+    const coord_t* sorted[2][1024];
+    size_t           nunique[2];
+    triangle_table_t triangles[2];
+} triangles_data_t;
+
+static int
+build(triangles_data_t* const d, const size_t i, const size_t nmatch,
+      bench_stats_t* const stats) {
+    size_t ntriangles;
+    stimage_error_t error;
+    int status;
+
+    stimage_error_init(&error);
+    if (d->triangles[i].ratio == NULL) {
+        if (max_num_triangles(d->nunique[i], nmatch, &ntriangles, &error) ||
+            triangle_table_init(
+                    &d->triangles[i], ntriangles, d->sorted[i], &error)) {
+            printf("%s\n", stimage_error_get_message(&error));
+            return 1;
+        }
+    }
+
+    if (stats) bench_start(stats);
+    status = find_triangles(
+            d->nunique[i], d->sorted[i], &d->triangles[i],
+            nmatch, 1.0, 10.0, 1, NULL, &error);
+    if (stats) bench_stop(stats);
+
+    if (status) {
+        printf("%s\n", stimage_error_get_message(&error));
+    }
+    return status;
+}
+
+static int
+merge(triangles_data_t* const d, const stage_e stage,
+      triangle_match_t* const matches, const size_t nmatches,
+      bench_stats_t* const stats) {
+    size_t n = nmatches;
+    stimage_error_t error;
+    int status;
+
+    stimage_error_init(&error);
+    bench_start(stats);
+    status = (stage == stage_merge_grid ?
+              merge_triangles_grid : merge_triangles)(
+            &d->triangles[0], &d->triangles[1],
+            &n, matches, 1, NULL, &error);
+    bench_stop(stats);
+
+    if (status) {
+        printf("%s\n", stimage_error_get_message(&error));
+    }
+    return status;
+}
+
+static int
+triangles_case(void* data, bench_stats_t* stats) {
+    const triangles_case_t* const c = (const triangles_case_t*)data;
+    triangles_data_t* d = NULL;
+    triangle_match_t* matches = NULL;
+    size_t nmatches = 0;
+    bench_rng_t rng;
+    size_t i, repeat;
+    int status = 1;
+
+    d = calloc(1, sizeof(triangles_data_t));
+    if (d == NULL) goto exit;
+    triangle_table_new(&d->triangles[0]);
+    triangle_table_new(&d->triangles[1]);
+
+    bench_rng_init(&rng, 2);
+    bench_catalog_uniform(&rng, c->nmatch, 2048.0, d->coords[0]);
+    bench_catalog_transform(
+            &rng, c->nmatch, d->coords[0], 3.0, 1.01, 5.0, -3.0, 0.05,
+            d->coords[1]);
+    for (i = 0; i < 2; ++i) {
+        xysort(c->nmatch, d->coords[i], d->sorted[i]);
+        d->nunique[i] = xycoincide(
+                c->nmatch, d->sorted[i], d->sorted[i], 9.0);
+    }
+
+    if (c->stage == stage_find) {
+        if (build(d, 0, c->nmatch, stats)) goto exit;
+        repeat = bench_repeat(stats->best, 0.5);
+        for (i = 1; i < repeat; ++i) {
+            if (build(d, 0, c->nmatch, stats)) goto exit;
+        }
+    } else {
+        if (build(d, 0, c->nmatch, NULL) || build(d, 1, c->nmatch, NULL)) {
+            goto exit;
+        }
+        nmatches = MAX(d->triangles[0].ntriangles, d->triangles[1].ntriangles);
+        matches = malloc(nmatches * sizeof(triangle_match_t));
+        if (matches == NULL) goto exit;
+
+        if (merge(d, c->stage, matches, nmatches, stats)) goto exit;
+        repeat = bench_repeat(stats->best, 0.5);
+        for (i = 1; i < repeat; ++i) {
+            if (merge(d, c->stage, matches, nmatches, stats)) goto exit;
+        }
+    }
+
+    status = 0;
+
+ exit:
+    if (d != NULL) {
+        triangle_table_free(&d->triangles[0]);
+        triangle_table_free(&d->triangles[1]);
+    }
+    free(d);
+    free(matches);
+    return status;
+}
+
+int main(int argc, char** argv) {
+    const size_t nmatch[] = {10, 20, 30, 40, 50, 60};
+    const char* const stage_names[] = {
+        "find_triangles", "merge_triangles", "merge_triangles_grid"};
+    triangles_case_t c;
+    char name[128];
+    size_t i, j;
+    int status = 0;
+
+    (void)argc;
+    (void)argv;
+
+    bench_header();
+
+    for (j = 0; j < 3; ++j) {
+        c.stage = (stage_e)j;
+        for (i = 0; i < sizeof(nmatch) / sizeof(size_t); ++i) {
+            c.nmatch = nmatch[i];
+            snprintf(name, sizeof(name), "%s/nmatch=%lu",
+                     stage_names[j], (unsigned long)c.nmatch);
+            status |= bench_run("triangles", name, triangles_case, &c);
+        }
+    }
+
+    return status;
+}
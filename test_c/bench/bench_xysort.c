@@ -0,0 +1,131 @@
+/*
+Benchmarks xysort, xysort_permutation and xycoincide on uniform and
+clustered fields.
+*/
+
+#include "lib/xycoincide.h"
+#include "lib/xysort.h"
+#include "bench.h"
+
+typedef enum {
+    stage_xysort,
+    stage_permutation,
+    stage_xycoincide
+} stage_e;
+
+typedef struct {
+    stage_e stage;
+    size_t  n;
+    size_t  nclusters; /* 0 for a uniform field */
+} sort_case_t;
+
+static int
+sort_once(const sort_case_t* const c, const coord_t* const coords,
+          const coord_t** const sorted, size_t* const perm,
+          const coord_t** const unique, bench_stats_t* const stats) {
+    stimage_error_t error;
+    int status = 0;
+
+    stimage_error_init(&error);
+    switch (c->stage) {
+    case stage_xysort:
+        bench_start(stats);
+        xysort(c->n, coords, sorted);
+        bench_stop(stats);
+        break;
+    case stage_permutation:
+        bench_start(stats);
+        status = xysort_permutation(c->n, coords, perm, &error);
+        bench_stop(stats);
+        break;
+    case stage_xycoincide:
+        bench_start(stats);
+        xycoincide(c->n, sorted, unique, 3.0);
+        bench_stop(stats);
+        break;
+    }
+
+    if (status) {
+        printf("%s\n", stimage_error_get_message(&error));
+    }
+    return status;
+}
+
+static int
+sort_case(void* data, bench_stats_t* stats) {
+    const sort_case_t* const c = (const sort_case_t*)data;
+    const double width = 4096.0;
+    coord_t* coords = NULL;
+    const coord_t** sorted = NULL;
+    const coord_t** unique = NULL;
+    size_t* perm = NULL;
+    bench_rng_t rng;
+    size_t i, repeat;
+    int status = 1;
+
+    coords = malloc(c->n * sizeof(coord_t));
+    sorted = malloc(c->n * sizeof(coord_t*));
+    unique = malloc(c->n * sizeof(coord_t*));
+    perm = malloc(c->n * sizeof(size_t));
+    if (coords == NULL || sorted == NULL || unique == NULL || perm == NULL) {
+        goto exit;
+    }
+
+    bench_rng_init(&rng, 3);
+    if (c->nclusters) {
+        bench_catalog_clustered(
+                &rng, c->n, width, c->nclusters, 20.0, coords);
+    } else {
+        bench_catalog_uniform(&rng, c->n, width, coords);
+    }
+    if (c->stage == stage_xycoincide) {
+        xysort(c->n, coords, sorted);
+    }
+
+    if (sort_once(c, coords, sorted, perm, unique, stats)) goto exit;
+    repeat = bench_repeat(stats->best, 0.5);
+    for (i = 1; i < repeat; ++i) {
+        if (sort_once(c, coords, sorted, perm, unique, stats)) goto exit;
+    }
+
+    status = 0;
+
+ exit:
+    free(coords);
+    free(sorted);
+    free(unique);
+    free(perm);
+    return status;
+}
+
+int main(int argc, char** argv) {
+    const size_t n[] = {1000, 10000, 100000, 1000000};
+    const size_t nclusters[] = {0, 100, 10};
+    const char* const stage_names[] = {
+        "xysort", "xysort_permutation", "xycoincide"};
+    sort_case_t c;
+    char name[128];
+    size_t i, j, k;
+    int status = 0;
+
+    (void)argc;
+    (void)argv;
+
+    bench_header();
+
+    for (k = 0; k < 3; ++k) {
+        c.stage = (stage_e)k;
+        for (j = 0; j < sizeof(nclusters) / sizeof(size_t); ++j) {
+            c.nclusters = nclusters[j];
+            for (i = 0; i < sizeof(n) / sizeof(size_t); ++i) {
+                c.n = n[i];
+                snprintf(name, sizeof(name), "%s/n=%lu/clusters=%lu",
+                         stage_names[k], (unsigned long)c.n,
+                         (unsigned long)c.nclusters);
+                status |= bench_run("xysort", name, sort_case, &c);
+            }
+        }
+    }
+
+    return status;
+}
@@ -0,0 +1,158 @@
+/*
+Benchmarks xyxymatch with the tolerance, triangles and offsets algorithms across
+the number of coordinates and their density (coordinates per square
+pixel).
+*/
+
+#include "immatch/xyxymatch.h"
+#include "bench.h"
+
+typedef struct {
+    xyxymatch_algo_e  algorithm;
+    xyxymatch_index_e index;
+    triangle_mode_e   triangle_mode;
+    size_t            n;
+    double            density;
+} match_case_t;
+
+static int
+match_once(
+        const match_case_t* const c,
+        const size_t n, const coord_t* const input, const coord_t* const ref,
+        xyxymatch_output_t* const output,
+        bench_stats_t* const stats) {
+    const coord_t origin = {0.0, 0.0};
+    const coord_t mag = {1.0, 1.0};
+    const coord_t rot = {0.0, 0.0};
+    xyxymatch_options_t options;
+    size_t noutput = n;
+    stimage_error_t error;
+    int status;
+
+    stimage_error_init(&error);
+    xyxymatch_options_init(&options);
+    options.index = c->index;
+    options.triangle_mode = c->triangle_mode;
+
+    bench_start(stats);
+    status = xyxymatch(n, input, n, ref, &noutput, output,
+                       &origin, &mag, &rot, &origin,
+                       c->algorithm, 1.0, 9.0, 30, 10.0, 10,
+                       &options, &error);
+    bench_stop(stats);
+
+    if (status) {
+        printf("%s\n", stimage_error_get_message(&error));
+    }
+    return status;
+}
+
+static int
+match_case(void* data, bench_stats_t* stats) {
+    const match_case_t* const c = (const match_case_t*)data;
+    const double width = sqrt((double)c->n / c->density);
+    coord_t* ref = NULL;
+    coord_t* input = NULL;
+    xyxymatch_output_t* output = NULL;
+    bench_rng_t rng;
+    size_t i, repeat;
+    int status = 1;
+
+    ref = malloc(c->n * sizeof(coord_t));
+    input = malloc(c->n * sizeof(coord_t));
+    output = malloc(c->n * sizeof(xyxymatch_output_t));
+    if (ref == NULL || input == NULL || output == NULL) goto exit;
+
+    bench_rng_init(&rng, 1);
+    bench_catalog_uniform(&rng, c->n, width, ref);
+    if (c->algorithm == xyxymatch_algo_triangles) {
+        bench_catalog_transform(
+                &rng, c->n, ref, 3.0, 1.01, 5.0, -3.0, 0.05, input);
+    } else if (c->algorithm == xyxymatch_algo_offsets) {
+        bench_catalog_transform(
+                &rng, c->n, ref, 0.0, 1.0, 150.0, -80.0, 0.05, input);
+    } else {
+        bench_catalog_transform(
+                &rng, c->n, ref, 0.0, 1.0, 0.0, 0.0, 0.1, input);
+    }
+
+    if (match_once(c, c->n, input, ref, output, stats)) goto exit;
+    repeat = bench_repeat(stats->best, 0.5);
+    for (i = 1; i < repeat; ++i) {
+        if (match_once(c, c->n, input, ref, output, stats)) goto exit;
+    }
+
+    status = 0;
+
+ exit:
+    free(ref);
+    free(input);
+    free(output);
+    return status;
+}
+
+int main(int argc, char** argv) {
+    const size_t tolerance_n[] = {1000, 10000, 100000, 1000000};
+    const size_t triangles_n[] = {100, 1000, 10000};
+    const double densities[] = {1e-4, 1e-3, 1e-2};
+    const xyxymatch_index_e indices[] = {
+        xyxymatch_index_sweep, xyxymatch_index_grid};
+    const char* const index_names[] = {"sweep", "grid"};
+    const triangle_mode_e modes[] = {triangle_mode_all, triangle_mode_knn};
+    const char* const mode_names[] = {"all", "knn"};
+    match_case_t c;
+    char name[128];
+    size_t i, j, k;
+    int status = 0;
+
+    (void)argc;
+    (void)argv;
+
+    bench_header();
+
+    memset(&c, 0, sizeof(c));
+    c.algorithm = xyxymatch_algo_tolerance;
+    for (k = 0; k < 2; ++k) {
+        c.index = indices[k];
+        for (j = 0; j < sizeof(densities) / sizeof(double); ++j) {
+            c.density = densities[j];
+            for (i = 0; i < sizeof(tolerance_n) / sizeof(size_t); ++i) {
+                c.n = tolerance_n[i];
+                snprintf(name, sizeof(name), "tolerance/%s/n=%lu/density=%g",
+                         index_names[k], (unsigned long)c.n, c.density);
+                status |= bench_run("xyxymatch", name, match_case, &c);
+            }
+        }
+    }
+
+    memset(&c, 0, sizeof(c));
+    c.algorithm = xyxymatch_algo_triangles;
+    c.index = xyxymatch_index_grid;
+    for (k = 0; k < 2; ++k) {
+        c.triangle_mode = modes[k];
+        for (j = 0; j < sizeof(densities) / sizeof(double); ++j) {
+            c.density = densities[j];
+            for (i = 0; i < sizeof(triangles_n) / sizeof(size_t); ++i) {
+                c.n = triangles_n[i];
+                snprintf(name, sizeof(name), "triangles/%s/n=%lu/density=%g",
+                         mode_names[k], (unsigned long)c.n, c.density);
+                status |= bench_run("xyxymatch", name, match_case, &c);
+            }
+        }
+    }
+
+    memset(&c, 0, sizeof(c));
+    c.algorithm = xyxymatch_algo_offsets;
+    c.index = xyxymatch_index_grid;
+    for (j = 0; j < sizeof(densities) / sizeof(double); ++j) {
+        c.density = densities[j];
+        for (i = 0; i < sizeof(tolerance_n) / sizeof(size_t); ++i) {
+            c.n = tolerance_n[i];
+            snprintf(name, sizeof(name), "offsets/n=%lu/density=%g",
+                     (unsigned long)c.n, c.density);
+            status |= bench_run("xyxymatch", name, match_case, &c);
+        }
+    }
+
+    return status;
+}
@@ -1,4 +1,5 @@
 #include <assert.h>
+#include <math.h>
 #include <stdio.h>
 #include <stdlib.h>
 
@@ -21,6 +22,9 @@ int main(int argv, char** argc) {
     coord_t data[ncoords];
     coord_t data_trans[ncoords];
     lintransform_t transform;
+    lintransform_t second;
+    lintransform_t composed;
+    coord_t twice[ncoords];
     coord_t in = {0.0, 0.0};
     coord_t mag = {1.0, 1.0};
     coord_t rot = {0.0, 0.0};
@@ -81,6 +85,27 @@ int main(int argv, char** argc) {
 
     print_array(ncoords, data_trans, "rot");
 
+    /* Composing a transformation with another is the same as applying
+       them in turn */
+    mag.x = 1.5;
+    mag.y = 0.5;
+    rot.x = -30.0;
+    rot.y = 10.0;
+    out.x = 3.0;
+    out.y = -4.0;
+    compute_lintransform(in, mag, rot, out, &second);
+    apply_lintransform(&second, ncoords, data_trans, twice);
+    compose_lintransform(&transform, &second, &composed);
+    compose_lintransform(&transform, &second, &transform);
+    apply_lintransform(&transform, ncoords, data, data_trans);
+    for (i = 0; i < ncoords; ++i) {
+        if (fabs(twice[i].x - data_trans[i].x) > 1e-12 ||
+            fabs(twice[i].y - data_trans[i].y) > 1e-12 ||
+            composed.c != transform.c || composed.f != transform.f) {
+            return 1;
+        }
+    }
+
     printf("\n\n");
     fflush(stdout);
 
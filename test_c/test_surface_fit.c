@@ -0,0 +1,100 @@
+#include <assert.h>
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+
+#include "surface/fit.h"
+#include "test.h"
+
+/* Refitting with surface_fit_reweight after rejecting some points
+   should give the same normal equations as fitting from scratch. */
+int main(int argv, char** argc) {
+    #define ncoords 1000
+    coord_t coord[ncoords];
+    double z[ncoords];
+    double w[ncoords];
+    double w_old[ncoords];
+    surface_t surface;
+    surface_t refit;
+    surface_basis_t basis;
+    surface_fit_error_e fit_error;
+    bbox_t bbox;
+    stimage_error_t error;
+    size_t i;
+    int iter;
+    int status = 1;
+
+    stimage_error_init(&error);
+    bbox_init(&bbox);
+    surface_new(&surface);
+    surface_new(&refit);
+    surface_basis_new(&basis);
+
+    srand48(0);
+
+    for (i = 0; i < ncoords; ++i) {
+        coord[i].x = drand48();
+        coord[i].y = drand48();
+        z[i] = 1.0 + coord[i].x * coord[i].y + drand48();
+        w[i] = 1.0;
+    }
+
+    bbox.min.x = bbox.min.y = 0.0;
+    bbox.max.x = bbox.max.y = 1.0;
+
+    if (surface_init(
+                &surface, surface_type_legendre, 4, 4, xterms_half, &bbox,
+                &error)) goto exit;
+    if (surface_fit(
+                &surface, ncoords, coord, z, w, surface_fit_weight_user, 1,
+                &fit_error, &error)) goto exit;
+    if (surface_basis_init(
+                &basis, &surface, ncoords, coord, &error)) goto exit;
+
+    /* Reject a few points, then most of them, which takes the path
+       that accumulates the matrix again */
+    for (iter = 0; iter < 2; ++iter) {
+        for (i = 0; i < ncoords; ++i) {
+            w_old[i] = w[i];
+            if (drand48() < (iter ? 0.6 : 0.05)) {
+                w[i] = 0.0;
+            }
+        }
+
+        if (surface_fit_reweight(
+                    &surface, &basis, z, w_old, w, &fit_error,
+                    &error)) goto exit;
+
+        surface_free(&refit);
+        if (surface_init(
+                    &refit, surface_type_legendre, 4, 4, xterms_half, &bbox,
+                    &error)) goto exit;
+        if (surface_fit(
+                    &refit, ncoords, coord, z, w, surface_fit_weight_user, 1,
+                    &fit_error, &error)) goto exit;
+
+        if (surface.npoints != refit.npoints) goto exit;
+        for (i = 0; i < surface.ncoeff * surface.ncoeff; ++i) {
+            if (fabs(surface.matrix[i] - refit.matrix[i]) >
+                1e-10 * fabs(refit.matrix[0])) goto exit;
+        }
+        for (i = 0; i < surface.ncoeff; ++i) {
+            if (surface.vector[i] != refit.vector[i]) goto exit;
+        }
+    }
+
+    status = 0;
+
+ exit:
+    surface_free(&surface);
+    surface_free(&refit);
+    surface_basis_free(&basis);
+
+    if (status) {
+        if (error.message[0]) {
+            printf("%s", stimage_error_get_message(&error));
+        }
+    }
+
+    return status;
+}
@@ -1,4 +1,5 @@
 #include <stdio.h>
+#include <string.h>
 
 #include "immatch/lib/triangles.h"
 #include "lib/xysort.h"
@@ -15,17 +16,22 @@ int main(int argc, char** argv) {
     const coord_t* ref_matches[ncoords];
     const coord_t* input_matches[ncoords];
     size_t ntriangles1;
-    triangle_t* triangles1 = NULL;
-    size_t ntriangles2;
-    triangle_t* triangles2 = NULL;
-    triangle_t* trans_triangles = NULL;
-    triangle_t* tri = NULL;
+    triangle_table_t triangles1;
+    triangle_table_t triangles2;
+    const coord_t* vertices[3];
     size_t ntriangle_matches;
     triangle_match_t* triangle_matches = NULL;
+    triangle_table_t threaded;
+    triangle_table_t view;
+    void* columns = NULL;
+    const double* ratio_column;
+    size_t nthreaded_matches;
+    triangle_match_t* threaded_matches = NULL;
     size_t nunique;
     const double tolerance = 0.0001;
     const double max_ratio = 10.0;
     const size_t max_points = 30;
+    const size_t max_threaded_points = 50;
     const size_t nreject = 10;
     const double tol2 = tolerance*tolerance;
     double dist[3];
@@ -37,9 +43,19 @@ int main(int argc, char** argv) {
     size_t j = 0;
 
     stimage_error_init(&error);
+    triangle_table_new(&triangles1);
+    triangle_table_new(&triangles2);
+    triangle_table_new(&threaded);
+    triangle_table_new(&view);
 
     srand48(0);
 
+    if (sizeof(triangle_index_t) != 4) {
+        printf("Vertex indices are %lu bytes instead of 4\n",
+               (unsigned long)sizeof(triangle_index_t));
+        goto exit;
+    }
+
     for (i = 0; i < ncoords; ++i) {
         data1[i].x = data2[i].x = drand48();
         data1[i].y = data2[i].y = drand48();
@@ -52,70 +68,78 @@ int main(int argc, char** argv) {
     if (max_num_triangles(nunique, max_points, &ntriangles1, &error)) {
         goto exit;
     }
-    ntriangles2 = ntriangles1;
     printf("Allocating room for %lu triangles\n", (long unsigned)ntriangles1);
-    triangles1 = malloc(sizeof(triangle_t) * ntriangles1);
-    if (triangles1 == NULL) {
+    if (triangle_table_init(&triangles1, ntriangles1, ptr1, &error) ||
+        triangle_table_init(&triangles2, ntriangles1, ptr2, &error)) {
         goto exit;
     }
-    triangles2 = malloc(sizeof(triangle_t) * ntriangles2);
-    if (triangles1 == NULL) {
+    ratio_column = triangles1.ratio;
+
+    if (find_triangles(
+            nunique, ptr1, &triangles1, max_points,
+            tolerance, max_ratio, 1, NULL, &error)) {
         goto exit;
     }
 
-    if (find_triangles(
-            nunique, ptr1, &ntriangles1, triangles1, max_points,
-            tolerance, max_ratio, &error)) {
+    /* The triangles are sorted in place, in the columns allocated by
+       triangle_table_init */
+    if (triangles1.ratio != ratio_column) {
+        printf("The triangles were not sorted in place\n");
         goto exit;
     }
 
     if (find_triangles(
-            nunique, ptr2, &ntriangles2, triangles2, max_points,
-            tolerance, max_ratio, &error)) {
+            nunique, ptr2, &triangles2, max_points,
+            tolerance, max_ratio, 1, NULL, &error)) {
         goto exit;
     }
 
+    ntriangles1 = triangles1.ntriangles;
     printf("Found %lu triangles\n", (unsigned long)ntriangles1);
 
+    #define VERTEX(t, i, j) ((t).coords[(t).vertices[3*(i) + (j)]])
+
     /* Print some random triangles, just for kicks */
     for (i = ntriangles1-10; i < ntriangles1; ++i) {
-        tri = &triangles1[i];
+        for (j = 0; j < 3; ++j) {
+            vertices[j] = VERTEX(triangles1, i, j);
+        }
         printf("Triangle %lu:\n", (unsigned long)i);
 
         printf("   (%.3f, %.3f)--(%.3f, %.3f)--(%.3f, %.3f)\n",
-               tri->vertices[0]->x, tri->vertices[0]->y,
-               tri->vertices[1]->x, tri->vertices[1]->y,
-               tri->vertices[2]->x, tri->vertices[2]->y);
+               vertices[0]->x, vertices[0]->y,
+               vertices[1]->x, vertices[1]->y,
+               vertices[2]->x, vertices[2]->y);
         printf("   ");
         for (j = 0; j < 3; ++j) {
-            dist[j] = euclid_distance2(tri->vertices[j], tri->vertices[(j+1)%3]);
+            dist[j] = euclid_distance2(vertices[j], vertices[(j+1)%3]);
             printf("%f ", dist[j]);
         }
         printf("\n");
-        printf("   log_perimeter:    %.3f\n", tri->log_perimeter);
-        printf("   ratio:            %.3f\n", tri->ratio);
-        printf("   cosine_v1:        %.3f\n", tri->cosine_v1);
-        printf("   ratio_tolerance:  %.3f\n", tri->ratio_tolerance);
-        printf("   cosine_tolerance: %.3f\n", tri->cosine_tolerance);
-        printf("   sense:            %d\n", tri->sense);
+        printf("   ratio:            %.3f\n", triangles1.ratio[i]);
+        printf("   cosine_v1:        %.3f\n", triangles1.cosine_v1[i]);
+        printf("   ratio_tolerance:  %.3f\n", triangles1.ratio_tolerance[i]);
+        printf("   cosine_tolerance: %.3f\n", triangles1.cosine_tolerance[i]);
         printf("\n");
     }
 
-    last_ratio = triangles1[0].ratio;
+    last_ratio = triangles1.ratio[0];
     for (i = 1; i < ntriangles1; ++i) {
-        tri = &triangles1[i];
-
-        if (tri->ratio < last_ratio) {
+        if (triangles1.ratio[i] < last_ratio) {
             printf ("Ratios are not sorted\n");
             goto exit;
         }
-        if (tri->ratio > max_ratio) {
+        last_ratio = triangles1.ratio[i];
+        if (triangles1.ratio[i] > max_ratio) {
             printf("Ratio larger than max_ratio\n");
             goto exit;
         }
 
         for (j = 0; j < 3; ++j) {
-            dist[j] = euclid_distance2(tri->vertices[j], tri->vertices[(j+1)%3]);
+            vertices[j] = VERTEX(triangles1, i, j);
+        }
+        for (j = 0; j < 3; ++j) {
+            dist[j] = euclid_distance2(vertices[j], vertices[(j+1)%3]);
             if (dist[j] <= tol2) {
                 printf("Distances too short\n");
                 goto exit;
@@ -137,8 +161,8 @@ int main(int argc, char** argv) {
     }
 
     if (merge_triangles(
-            ntriangles1, triangles1, ntriangles2, triangles2,
-            &ntriangle_matches, triangle_matches, &error)) {
+            &triangles1, &triangles2,
+            &ntriangle_matches, triangle_matches, 1, NULL, &error)) {
         goto exit;
     }
 
@@ -149,7 +173,8 @@ int main(int argc, char** argv) {
     }
 
     if (reject_triangles(
-            &ntriangle_matches, triangle_matches, nreject, &error)) {
+            &triangles1, &triangles2,
+            &ntriangle_matches, triangle_matches, nreject, NULL, &error)) {
         goto exit;
     }
 
@@ -160,11 +185,11 @@ int main(int argc, char** argv) {
     }
 
     if (vote_triangle_matches(
-            ncoords, data2,
-            ncoords, data1,
+            ncoords, data2, &triangles2,
+            ncoords, data1, &triangles1,
             ntriangle_matches, triangle_matches,
             &ncoord_matches, ref_matches, input_matches,
-            &error)) {
+            NULL, &error)) {
         goto exit;
     }
 
@@ -190,13 +215,153 @@ int main(int argc, char** argv) {
         }
     }
 
+    /* Finding and merging the triangles on several threads gives the
+       same result, with enough triangles to be sorted and merged in
+       several parts */
+    triangle_table_free(&triangles1);
+    triangle_table_free(&triangles2);
+    free(triangle_matches);
+    triangle_matches = NULL;
+
+    if (max_num_triangles(nunique, max_threaded_points, &ntriangles1, &error)) {
+        goto exit;
+    }
+    if (triangle_table_init(&triangles1, ntriangles1, ptr1, &error) ||
+        triangle_table_init(&triangles2, ntriangles1, ptr2, &error) ||
+        triangle_table_init(&threaded, ntriangles1, ptr1, &error)) {
+        goto exit;
+    }
+
+    if (find_triangles(
+            nunique, ptr1, &triangles1, max_threaded_points,
+            tolerance, max_ratio, 1, NULL, &error) ||
+        find_triangles(
+            nunique, ptr2, &triangles2, max_threaded_points,
+            tolerance, max_ratio, 1, NULL, &error) ||
+        find_triangles(
+            nunique, ptr1, &threaded, max_threaded_points,
+            tolerance, max_ratio, 4, NULL, &error)) {
+        goto exit;
+    }
+
+    ntriangles1 = triangles1.ntriangles;
+    if (threaded.ntriangles != ntriangles1) {
+        printf("Found %lu triangles on several threads instead of %lu\n",
+               (unsigned long)threaded.ntriangles, (unsigned long)ntriangles1);
+        goto exit;
+    }
+
+    if (memcmp(threaded.vertices, triangles1.vertices,
+               3 * ntriangles1 * sizeof(triangle_index_t)) ||
+        memcmp(threaded.ratio, triangles1.ratio,
+               ntriangles1 * sizeof(double)) ||
+        memcmp(threaded.cosine_v1, triangles1.cosine_v1,
+               ntriangles1 * sizeof(double))) {
+        printf("Triangles found on several threads differ\n");
+        goto exit;
+    }
+
+    ntriangle_matches = nthreaded_matches = ntriangles1;
+    triangle_matches = malloc(sizeof(triangle_match_t) * ntriangles1);
+    threaded_matches = malloc(sizeof(triangle_match_t) * ntriangles1);
+    if (triangle_matches == NULL || threaded_matches == NULL) {
+        goto exit;
+    }
+
+    if (merge_triangles(
+            &triangles1, &triangles2,
+            &ntriangle_matches, triangle_matches, 1, NULL, &error) ||
+        merge_triangles(
+            &triangles1, &triangles2,
+            &nthreaded_matches, threaded_matches, 4, NULL, &error)) {
+        goto exit;
+    }
+
+    if (nthreaded_matches != ntriangle_matches ||
+        memcmp(threaded_matches, triangle_matches,
+               sizeof(triangle_match_t) * ntriangle_matches)) {
+        printf("Triangles merged on several threads differ\n");
+        goto exit;
+    }
+
+    /* Merging through the grid gives the same result, including when
+       a few triangles have much larger tolerances than the rest */
+    for (j = 0; j < 2; ++j) {
+        if (j == 1) {
+            triangles2.ratio_tolerance[7] = 1.0f;
+            triangles2.cosine_tolerance[7] = 1.0f;
+            triangles2.ratio_tolerance[11] = 1e4f;
+            triangles1.cosine_tolerance[3] = 1e4f;
+        }
+
+        ntriangle_matches = nthreaded_matches = ntriangles1;
+        if (merge_triangles(
+                &triangles1, &triangles2,
+                &ntriangle_matches, triangle_matches, 1, NULL, &error) ||
+            merge_triangles_grid(
+                &triangles1, &triangles2,
+                &nthreaded_matches, threaded_matches, 4, NULL, &error)) {
+            goto exit;
+        }
+
+        if (nthreaded_matches != ntriangle_matches ||
+            memcmp(threaded_matches, triangle_matches,
+                   sizeof(triangle_match_t) * ntriangle_matches)) {
+            printf("Triangles merged through the grid differ\n");
+            goto exit;
+        }
+    }
+
+    /* A view of a copy of the columns, as loaded from a saved
+       catalog, merges the same as the table it was copied from */
+    columns = malloc(triangle_table_columns_size(ntriangles1));
+    if (columns == NULL) {
+        goto exit;
+    }
+    triangle_table_view(&view, ntriangles1, ptr1, columns);
+    memcpy(view.ratio, triangles1.ratio, ntriangles1 * sizeof(double));
+    memcpy(view.cosine_v1, triangles1.cosine_v1,
+           ntriangles1 * sizeof(double));
+    memcpy(view.ratio_tolerance, triangles1.ratio_tolerance,
+           ntriangles1 * sizeof(float));
+    memcpy(view.cosine_tolerance, triangles1.cosine_tolerance,
+           ntriangles1 * sizeof(float));
+    memcpy(view.vertices, triangles1.vertices,
+           3 * ntriangles1 * sizeof(triangle_index_t));
+
+    if ((void*)view.ratio != columns || !view.borrowed) {
+        printf("The view does not borrow its columns\n");
+        goto exit;
+    }
+
+    ntriangle_matches = nthreaded_matches = ntriangles1;
+    if (merge_triangles(
+            &triangles1, &triangles2,
+            &ntriangle_matches, triangle_matches, 1, NULL, &error) ||
+        merge_triangles(
+            &view, &triangles2,
+            &nthreaded_matches, threaded_matches, 1, NULL, &error)) {
+        goto exit;
+    }
+
+    if (nthreaded_matches != ntriangle_matches ||
+        memcmp(threaded_matches, triangle_matches,
+               sizeof(triangle_match_t) * ntriangle_matches)) {
+        printf("Triangles merged from a view differ\n");
+        goto exit;
+    }
+
     status = 0;
 
  exit:
-    free(triangles1);
-    free(triangles2);
+    triangle_table_free(&triangles1);
+    triangle_table_free(&triangles2);
+    triangle_table_free(&threaded);
+    /* Leaves columns alone, since the view borrows them */
+    triangle_table_free(&view);
+    free(columns);
     free(triangle_matches);
-    free(trans_triangles);
+    free(threaded_matches);
 
     if (status) {
         if (error.message[0]) {
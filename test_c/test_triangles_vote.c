@@ -0,0 +1,216 @@
+#include <stdio.h>
+#include <stdlib.h>
+
+#include "immatch/lib/triangles.h"
+#include "test.h"
+
+/* Tally the votes in a dense nleft x nright array and apply the same
+   rules as vote_triangle_matches, to check the sparse tally against */
+int dense_vote(const size_t nleft,
+               const coord_t* const left,
+               const triangle_table_t* const l_triangles,
+               const size_t nright,
+               const coord_t* const right,
+               const triangle_table_t* const r_triangles,
+               const size_t ntriangle_matches,
+               const triangle_match_t* const triangle_matches,
+               size_t* ncoord_matches,
+               const coord_t** const left_matches,
+               const coord_t** const right_matches) {
+    size_t* tally = NULL;
+    size_t maxvote = 0;
+    size_t row_maxvote, row_2maxvote, vote;
+    size_t li, ri, i, j, best;
+    const coord_t* l_coord;
+    const coord_t* r_coord;
+
+    tally = calloc(nleft * nright, sizeof(size_t));
+    if (tally == NULL) {
+        return 1;
+    }
+
+    for (i = 0; i < ntriangle_matches; ++i) {
+        for (j = 0; j < 3; ++j) {
+            l_coord = l_triangles->coords[
+                    l_triangles->vertices[3 * triangle_matches[i].l + j]];
+            r_coord = r_triangles->coords[
+                    r_triangles->vertices[3 * triangle_matches[i].r + j]];
+            vote = ++tally[(r_coord - right) * nleft + (l_coord - left)];
+            if (vote > maxvote) {
+                maxvote = vote;
+            }
+        }
+    }
+
+    *ncoord_matches = 0;
+    for (ri = 0; ri < nright; ++ri) {
+        row_maxvote = row_2maxvote = 0;
+        best = 0;
+        for (li = 0; li < nleft; ++li) {
+            vote = tally[ri * nleft + li];
+            if (vote > row_maxvote) {
+                row_2maxvote = row_maxvote;
+                row_maxvote = vote;
+                best = li;
+            }
+        }
+
+        if (row_maxvote == 0 ||
+            row_maxvote <= maxvote / 2 ||
+            row_maxvote == row_2maxvote ||
+            (row_maxvote == 1 && (maxvote > 1 || ntriangle_matches > 1))) {
+            continue;
+        }
+
+        left_matches[*ncoord_matches] = left + best;
+        right_matches[*ncoord_matches] = right + ri;
+        ++*ncoord_matches;
+    }
+
+    free(tally);
+    return 0;
+}
+
+int main(int argc, char** argv) {
+    #define nleft 300
+    #define nright 400
+    #define ntri 2000
+    #define nmatches 3000
+    coord_t left[nleft];
+    coord_t right[nright];
+    const coord_t* lptr[nleft];
+    const coord_t* rptr[nright];
+    size_t right_to_left[nright];
+    triangle_table_t l_triangles;
+    triangle_table_t r_triangles;
+    triangle_match_t matches[nmatches];
+    const coord_t* left_matches[nright];
+    const coord_t* right_matches[nright];
+    const coord_t* expected_left[nright];
+    const coord_t* expected_right[nright];
+    size_t ncoord_matches = nright;
+    size_t nexpected = 0;
+    size_t ncorrect = 0;
+    stimage_error_t error;
+    triangle_index_t v;
+    size_t i = 0;
+    size_t j = 0;
+    int status = 1;
+
+    stimage_error_init(&error);
+    triangle_table_new(&l_triangles);
+    triangle_table_new(&r_triangles);
+
+    srand48(0);
+
+    for (i = 0; i < nleft; ++i) {
+        left[i].x = drand48();
+        left[i].y = drand48();
+        lptr[i] = &left[i];
+    }
+    for (i = 0; i < nright; ++i) {
+        right[i].x = drand48();
+        right[i].y = drand48();
+        rptr[i] = &right[i];
+        right_to_left[i] = (size_t)(drand48() * nleft);
+    }
+
+    if (triangle_table_init(&l_triangles, ntri, lptr, &error) ||
+        triangle_table_init(&r_triangles, ntri, rptr, &error)) {
+        goto exit;
+    }
+
+    /* Each right triangle has a left triangle whose vertices correspond
+       to its own, so that most of the votes agree */
+    for (i = 0; i < ntri; ++i) {
+        for (j = 0; j < 3; ++j) {
+            v = (triangle_index_t)(drand48() * nright);
+            r_triangles.vertices[3 * i + j] = v;
+            l_triangles.vertices[3 * i + j] =
+                (triangle_index_t)right_to_left[v];
+        }
+    }
+    l_triangles.ntriangles = r_triangles.ntriangles = ntri;
+
+    /* Most of the matches pair corresponding triangles, and the rest
+       are random, which spreads a few votes over many other pairs and
+       makes some ties */
+    for (i = 0; i < nmatches; ++i) {
+        matches[i].r = (triangle_index_t)(drand48() * ntri);
+        matches[i].l = i % 4 == 3 ?
+            (triangle_index_t)(drand48() * ntri) : matches[i].r;
+    }
+
+    if (dense_vote(nleft, left, &l_triangles, nright, right, &r_triangles,
+                   nmatches, matches,
+                   &nexpected, expected_left, expected_right)) {
+        goto exit;
+    }
+
+    if (vote_triangle_matches(
+                nleft, left, &l_triangles, nright, right, &r_triangles,
+                nmatches, matches,
+                &ncoord_matches, left_matches, right_matches,
+                NULL, &error)) {
+        goto exit;
+    }
+
+    printf("Found %lu coordinate matches\n", (unsigned long)ncoord_matches);
+
+    if (ncoord_matches != nexpected) {
+        printf("Found %lu matches instead of %lu\n",
+               (unsigned long)ncoord_matches, (unsigned long)nexpected);
+        goto exit;
+    }
+
+    for (i = 0; i < ncoord_matches; ++i) {
+        if (left_matches[i] != expected_left[i] ||
+            right_matches[i] != expected_right[i]) {
+            printf("Match %lu differs from the dense tally\n",
+                   (unsigned long)i);
+            goto exit;
+        }
+        if (left_matches[i] - left ==
+            (long)right_to_left[right_matches[i] - right]) {
+            ++ncorrect;
+        }
+    }
+
+    /* The check is not vacuous: many coordinates are matched, and
+       correctly */
+    if (ncoord_matches < nright / 4 || ncorrect != ncoord_matches) {
+        printf("Only %lu of %lu matches are correct\n",
+               (unsigned long)ncorrect, (unsigned long)ncoord_matches);
+        goto exit;
+    }
+
+    /* No triangle matches give no coordinate matches */
+    ncoord_matches = nright;
+    if (vote_triangle_matches(
+                nleft, left, &l_triangles, nright, right, &r_triangles,
+                0, matches,
+                &ncoord_matches, left_matches, right_matches,
+                NULL, &error)) {
+        goto exit;
+    }
+
+    if (ncoord_matches != 0) {
+        printf("Found %lu matches without any triangle matches\n",
+               (unsigned long)ncoord_matches);
+        goto exit;
+    }
+
+    status = 0;
+
+ exit:
+    triangle_table_free(&l_triangles);
+    triangle_table_free(&r_triangles);
+
+    if (status) {
+        if (error.message[0]) {
+            printf("%s", stimage_error_get_message(&error));
+        }
+    }
+
+    return status;
+}
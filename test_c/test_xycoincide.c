@@ -1,4 +1,5 @@
 #include <assert.h>
+#include <math.h>
 #include <stdio.h>
 #include <stdlib.h>
 
@@ -6,6 +7,107 @@
 #include "lib/xycoincide.h"
 #include "test.h"
 
+/* The original sweep, which xycoincide falls back from to a grid when
+   many coordinates are within the tolerance in y of each other */
+static size_t
+reference_coincide(
+        const size_t n,
+        const coord_t** const output,
+        const double tolerance) {
+
+    const double tolerance2 = tolerance * tolerance;
+    double distance, r2;
+    size_t iprev, i, nunique = 0;
+
+    for (iprev = 0; iprev < n; ++iprev) {
+        if (output[iprev] == NULL) continue;
+        for (i = iprev + 1; i < n; ++i) {
+            if (output[i] == NULL) continue;
+            distance = output[i]->y - output[iprev]->y;
+            r2 = distance * distance;
+            if (r2 > tolerance2) break;
+            distance = output[i]->x - output[iprev]->x;
+            r2 += distance * distance;
+            if (r2 <= tolerance2) output[i] = NULL;
+        }
+    }
+
+    for (i = 0; i < n; ++i) {
+        if (output[i] != NULL) output[nunique++] = output[i];
+    }
+    return nunique;
+}
+
+/* Compare xycoincide with the original sweep on n coordinates spread
+   over width in x and height in y.  A height much smaller than the
+   tolerance puts every coordinate within the tolerance in y of every
+   other, which makes xycoincide switch to the grid.  Some coordinates
+   are exact duplicates, signed zeros or NaNs. */
+static int
+check_reference(
+        const size_t n,
+        const double width,
+        const double height,
+        const double tolerance) {
+
+    coord_t*        data     = malloc((n + 1) * sizeof(coord_t));
+    const coord_t** ptr      = malloc((n + 1) * sizeof(coord_t*));
+    const coord_t** expected = malloc((n + 1) * sizeof(coord_t*));
+    size_t nunique = 0;
+    size_t nexpected = 0;
+    size_t i = 0;
+    int status = 1;
+
+    if (data == NULL || ptr == NULL || expected == NULL) goto exit;
+
+    for (i = 0; i < n; ++i) {
+        data[i].x = drand48() * width;
+        data[i].y = drand48() * height;
+        if (i % 7 == 3) {
+            data[i] = data[i / 2];
+        } else if (i % 29 == 5) {
+            data[i].x = -0.0;
+        } else if (i % 29 == 6) {
+            data[i].x = 0.0;
+        } else if (i % 53 == 11) {
+            data[i].y = NAN;
+        }
+    }
+
+    xysort(n, data, ptr);
+    for (i = 0; i < n; ++i) {
+        expected[i] = ptr[i];
+    }
+
+    nexpected = reference_coincide(n, expected, tolerance);
+    nunique = xycoincide(n, ptr, ptr, tolerance);
+
+    if (nunique != nexpected) {
+        printf("n=%lu height=%g: %lu unique, expected %lu\n",
+               (unsigned long)n, height, (unsigned long)nunique,
+               (unsigned long)nexpected);
+        goto exit;
+    }
+
+    for (i = 0; i < nunique; ++i) {
+        if (ptr[i] != expected[i]) {
+            printf("n=%lu height=%g: unique %lu is [%lu], expected [%lu]\n",
+                   (unsigned long)n, height, (unsigned long)i,
+                   (unsigned long)(ptr[i] - data),
+                   (unsigned long)(expected[i] - data));
+            goto exit;
+        }
+    }
+
+    status = 0;
+
+ exit:
+    free(data);
+    free(ptr);
+    free(expected);
+    return status;
+}
+
 int main(int argv, char** argc) {
     #define ncoords 512
     coord_t data[ncoords];
@@ -18,6 +120,7 @@ int main(int argv, char** argc) {
     double distance2;
     const double tolerance = 0.1;
     const double tolerance2 = tolerance*tolerance;
+    const size_t sizes[] = {100, 511, 512, 513, 4000};
 
     srand48(0);
 
@@ -49,5 +152,12 @@ int main(int argv, char** argc) {
         }
     }
 
+    for (i = 0; i < sizeof(sizes) / sizeof(size_t); ++i) {
+        /* Sparse in y, which the sweep finishes */
+        if (check_reference(sizes[i], 100.0, 100.0, 1.0)) return 1;
+        /* Dense in y, which is finished with the grid */
+        if (check_reference(sizes[i], 2000.0, 0.1, 1.0)) return 1;
+    }
+
     return 0;
 }
@@ -1,14 +1,121 @@
 #include <assert.h>
+#include <math.h>
 #include <stdio.h>
 #include <stdlib.h>
 
 #include "lib/xysort.h"
 #include "test.h"
 
+/* The documented order, computed from the doubles directly rather
+   than from the radix keys: y, then x, then index.  -0.0 equals 0.0,
+   and NaNs sort after (or, if negative, before) everything else. */
+static int
+rank(const double v) {
+    if (isnan(v)) {
+        return signbit(v) ? 0 : 2;
+    }
+    return 1;
+}
+
+static int
+compare_double(const double a, const double b) {
+    if (rank(a) != rank(b)) {
+        return rank(a) < rank(b) ? -1 : 1;
+    }
+    if (rank(a) == 1 && a != b) {
+        return a < b ? -1 : 1;
+    }
+    return 0;
+}
+
+static int
+reference_compare(const void* ap, const void* bp) {
+    const coord_t* a = *(const coord_t**)ap;
+    const coord_t* b = *(const coord_t**)bp;
+    int c = compare_double(a->y, b->y);
+
+    if (c == 0) {
+        c = compare_double(a->x, b->x);
+    }
+    if (c == 0 && a != b) {
+        c = a < b ? -1 : 1;
+    }
+    return c;
+}
+
+/* A value from a small set, so that there are many ties, signed
+   zeros and NaNs, or sometimes a random one */
+static double
+random_value(void) {
+    switch ((int)(drand48() * 8.0)) {
+    case 0: return -1.0;
+    case 1: return -0.0;
+    case 2: return 0.0;
+    case 3: return 0.5;
+    case 4: return NAN;
+    case 5: return -NAN;
+    default: return drand48() * 4.0 - 2.0;
+    }
+}
+
+/* Compare xysort and xysort_permutation with a qsort on the
+   documented order.  Below 512 coordinates xysort uses qsort, and
+   from there on the radix sort. */
+static int
+check_reference(const size_t n) {
+    coord_t*        data     = malloc((n + 1) * sizeof(coord_t));
+    const coord_t** ptr      = malloc((n + 1) * sizeof(coord_t*));
+    const coord_t** expected = malloc((n + 1) * sizeof(coord_t*));
+    size_t*         perm     = malloc((n + 1) * sizeof(size_t));
+    stimage_error_t error;
+    size_t i = 0;
+    int status = 1;
+
+    stimage_error_init(&error);
+    if (data == NULL || ptr == NULL || expected == NULL || perm == NULL) {
+        goto exit;
+    }
+
+    for (i = 0; i < n; ++i) {
+        data[i].x = random_value();
+        data[i].y = random_value();
+        expected[i] = &data[i];
+    }
+    qsort(expected, n, sizeof(coord_t*), &reference_compare);
+
+    xysort(n, data, ptr);
+    if (xysort_permutation(n, data, perm, &error)) {
+        printf("%s\n", stimage_error_get_message(&error));
+        goto exit;
+    }
+
+    for (i = 0; i < n; ++i) {
+        if (ptr[i] != expected[i] || perm[i] != (size_t)(expected[i] - data)) {
+            printf("n=%lu: position %lu is [%lu] (%f, %f), expected "
+                   "[%lu] (%f, %f)\n",
+                   (unsigned long)n, (unsigned long)i,
+                   (unsigned long)(ptr[i] - data), ptr[i]->x, ptr[i]->y,
+                   (unsigned long)(expected[i] - data),
+                   expected[i]->x, expected[i]->y);
+            goto exit;
+        }
+    }
+
+    status = 0;
+
+ exit:
+    free(data);
+    free(ptr);
+    free(expected);
+    free(perm);
+    return status;
+}
+
 int main(int argv, char** argc) {
     #define ncoords 512
     coord_t data[ncoords];
     const coord_t* ptr[ncoords];
+    const size_t sizes[] = {0, 1, 2, 100, 510, 511, 512, 513, 514, 3000};
     size_t i = 0;
     double lastx = 0.0;
     double lasty = 0.0;
@@ -38,5 +145,11 @@ int main(int argv, char** argc) {
         lasty = y;
     }
 
+    for (i = 0; i < sizeof(sizes) / sizeof(size_t); ++i) {
+        if (check_reference(sizes[i])) {
+            return 1;
+        }
+    }
+
     return 0;
 }
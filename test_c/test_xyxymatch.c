@@ -38,7 +38,7 @@ int main(int argc, char** argv) {
                        &origin, &mag, &rot, &ref_origin,
                        xyxymatch_algo_tolerance,
                        tolerance, 0.0, 0, 0.0, 0,
-                       &error);
+                       NULL, &error);
 
     if (status) {
         printf("%s", stimage_error_get_message(&error));
@@ -83,7 +83,7 @@ int main(int argc, char** argv) {
                        &origin, &mag, &rot, &ref_origin,
                        xyxymatch_algo_tolerance,
                        tolerance, 0.0, 0, 0.0, 0,
-                       &error);
+                       NULL, &error);
 
     if (status) {
         printf("%s", stimage_error_get_message(&error));
@@ -112,5 +112,39 @@ int main(int argc, char** argv) {
         }
     }
 
+    /* The offsets algorithm finds a shift much larger than the
+       tolerance without being told it */
+    for (i = 0; i < ncoords; ++i) {
+        input[i].x = ref[i].x - 3.0 + 0.001 * drand48();
+        input[i].y = ref[i].y + 2.0 + 0.001 * drand48();
+    }
+
+    noutput = ncoords;
+    status = xyxymatch(ncoords, input,
+                       ncoords, ref,
+                       &noutput, output,
+                       &origin, &mag, &rot, &ref_origin,
+                       xyxymatch_algo_offsets,
+                       tolerance, 0.0, 30, 0.0, 0,
+                       NULL, &error);
+
+    if (status) {
+        printf("%s", stimage_error_get_message(&error));
+        return status;
+    }
+
+    if (noutput != ncoords) {
+        printf("Found %lu matches by offsets instead of %lu\n",
+               (unsigned long)noutput, (unsigned long)ncoords);
+        return 1;
+    }
+
+    for (i = 0; i < noutput; ++i) {
+        if (output[i].coord_idx != output[i].ref_idx) {
+            printf("Wrong match by offsets\n");
+            return 1;
+        }
+    }
+
     return status;
 }
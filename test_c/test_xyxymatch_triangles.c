@@ -31,7 +31,7 @@ int compare(const size_t ncoords,
             &origin, &mag, &rot, &ref_origin,
             xyxymatch_algo_triangles,
             tolerance, 0.0, max_points, max_ratio, nreject,
-            &error);
+            NULL, &error);
 
     if (status) {
         printf("%s", stimage_error_get_message(&error));
@@ -53,6 +53,115 @@ int compare(const size_t ncoords,
     return 0;
 }
 
+/* Matches against a reference catalog that has been serialized and
+   loaded again, which uses the saved triangle columns in place */
+int compare_deserialized(const size_t ncoords,
+                         const coord_t* const ref,
+                         const coord_t* const input) {
+    const coord_t origin = {0.0, 0.0};
+    const coord_t mag = {1.0, 1.0};
+    const coord_t rot = {0.0, 0.0};
+    const double tolerance = 0.0001;
+    const double max_ratio = 10.0;
+    const size_t max_points = 40;
+    xyxymatch_ref_t prepared;
+    xyxymatch_ref_t loaded;
+    xyxymatch_output_t* expected = NULL;
+    xyxymatch_output_t* output = NULL;
+    size_t nexpected = ncoords;
+    size_t noutput = ncoords;
+    size_t size = 0;
+    double* buffer = NULL;
+    const char* columns = NULL;
+    stimage_error_t error;
+    size_t i = 0;
+    int status = 1;
+
+    stimage_error_init(&error);
+    xyxymatch_ref_new(&prepared);
+    xyxymatch_ref_new(&loaded);
+
+    expected = malloc(ncoords * sizeof(xyxymatch_output_t));
+    output = malloc(ncoords * sizeof(xyxymatch_output_t));
+    if (expected == NULL || output == NULL) {
+        printf("Out of memory\n");
+        goto exit;
+    }
+
+    if (xyxymatch_ref_init(&prepared, ncoords, ref, 0.0, &error) ||
+        xyxymatch_ref_init_triangles(&prepared, max_points, tolerance,
+                                     max_ratio, triangle_mode_all, 0,
+                                     &error)) {
+        printf("%s", stimage_error_get_message(&error));
+        goto exit;
+    }
+
+    size = xyxymatch_ref_serialized_size(&prepared);
+    buffer = malloc(size);
+    if (buffer == NULL) {
+        printf("Out of memory\n");
+        goto exit;
+    }
+
+    if (xyxymatch_ref_serialize(&prepared, size, buffer, &error) ||
+        xyxymatch_ref_deserialize(&loaded, size, buffer, &error)) {
+        printf("%s", stimage_error_get_message(&error));
+        goto exit;
+    }
+
+    columns = (const char*)loaded.triangles.ratio;
+    if (!loaded.triangles.borrowed ||
+        columns < (const char*)buffer ||
+        columns >= (const char*)buffer + size) {
+        printf("The triangles were copied out of the buffer\n");
+        goto exit;
+    }
+
+    if (loaded.triangles.ntriangles != prepared.triangles.ntriangles) {
+        printf("Expected %lu triangles, got %lu\n",
+               (unsigned long)prepared.triangles.ntriangles,
+               (unsigned long)loaded.triangles.ntriangles);
+        goto exit;
+    }
+
+    if (xyxymatch_prepared(ncoords, input, &prepared, &nexpected, expected,
+                           &origin, &mag, &rot, &origin,
+                           xyxymatch_algo_triangles, tolerance, 0.0,
+                           max_points, max_ratio, 10, NULL, &error) ||
+        xyxymatch_prepared(ncoords, input, &loaded, &noutput, output,
+                           &origin, &mag, &rot, &origin,
+                           xyxymatch_algo_triangles, tolerance, 0.0,
+                           max_points, max_ratio, 10, NULL, &error)) {
+        printf("%s", stimage_error_get_message(&error));
+        goto exit;
+    }
+
+    if (noutput != nexpected) {
+        printf("Expected %lu pairs, got %lu\n",
+               (unsigned long)nexpected, (unsigned long)noutput);
+        goto exit;
+    }
+
+    for (i = 0; i < noutput; ++i) {
+        if (output[i].coord_idx != expected[i].coord_idx ||
+            output[i].ref_idx != expected[i].ref_idx) {
+            printf("Mismatched pairs after loading\n");
+            goto exit;
+        }
+    }
+
+    status = 0;
+
+ exit:
+    /* The loaded table does not free the columns in buffer */
+    xyxymatch_ref_free(&loaded);
+    xyxymatch_ref_free(&prepared);
+    free(buffer);
+    free(output);
+    free(expected);
+    return status;
+}
+
 int main(int argc, char** argv) {
     #define ncoords 4098
     coord_t ref[ncoords];
@@ -122,5 +231,12 @@ int main(int argc, char** argv) {
         return 1;
     }
 
+    /* serialized catalog */
+    printf("Serialized\n");
+
+    if (compare_deserialized(ncoords, ref, input)) {
+        return 1;
+    }
+
     return 0;
 }